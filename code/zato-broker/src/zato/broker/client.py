@@ -20,6 +20,8 @@ from bunch import Bunch
 
 # gevent
 from gevent import sleep
+from gevent.event import AsyncResult
+from gevent.queue import Empty, Queue
 
 # Redis
 import redis
@@ -43,10 +45,60 @@ NEEDS_TMP_KEY = [v for k,v in TOPICS.items() if k in(
     MESSAGE_TYPE.TO_PARALLEL_ANY,
 )]
 
+# Messages of these types are delivered to exactly one of the clients, through a work queue kept in a Redis list
+WORK_QUEUE_TYPES = [MESSAGE_TYPE.TO_PARALLEL_ANY]
+
+# How long to block waiting for a message in a work queue before checking if the client should still run, in seconds
+WORK_QUEUE_POP_TIMEOUT = 1
+
+# Work queues are trimmed to that many messages, oldest ones dropped first, and deleted if nothing was pushed to them
+# for that many seconds, so that they do not grow without limits if no client consumes from them.
+WORK_QUEUE_MAX_SIZE = 10000
+WORK_QUEUE_TTL = 3600
+
+# Clients consuming from a work queue let senders know about it under a key that expires unless refreshed in time.
+# Senders check it at most that often and, if no client consumes from the queue, messages are published in the way
+# that servers which have not been upgraded yet expect them, in seconds.
+WORK_QUEUE_CONSUMER_TTL = 10
+WORK_QUEUE_CONSUMER_CHECK_INTERVAL = 5
+
+def get_work_queue_key(msg_type):
+    return b'zato:broker{}:queue'.format(KEYS[msg_type])
+
+def get_work_queue_consumer_key(queue_key):
+    return b'{}:consumer'.format(queue_key)
+
+# Defaults for outbound messages - how many of them to send to Redis in one pipeline at most
+# and how long to wait for more of them to arrive before a batch is sent, in milliseconds.
+PUB_MAX_BATCH = 500
+PUB_LINGER = 0
+
+# How long to wait for a result of a message sent synchronously and, when the client is being closed,
+# for messages still queued up to be sent, in seconds.
+PUB_SYNC_TIMEOUT = 10
+PUB_CLOSE_TIMEOUT = 5
+
+# If outbound messages are waiting to be sent, i.e. Redis does not keep up with them, their statistics are logged
+# at most that often, in seconds.
+PUB_STATS_INTERVAL = 60
+
+class OutboundMessage(object):
+    """ A message waiting to be sent to Redis by the pub client, along with a result its sender may wait for.
+    """
+    __slots__ = ('command', 'key', 'data', 'after', 'result')
+
+    def __init__(self, command, key, data, after=()):
+        self.command = command # E.g. 'publish' or 'lpush'
+        self.key = key
+        self.data = data
+        self.after = after # Other commands to send right after this one, each a tuple of a name and arguments
+        self.result = AsyncResult()
+
 CODE_RENAMED = 10
 CODE_NO_SUCH_FROM_KEY = 11
 
-def BrokerClient(kvdb, client_type, topic_callbacks, _initial_lua_programs):
+def BrokerClient(kvdb, client_type, topic_callbacks, _initial_lua_programs, pub_max_batch=PUB_MAX_BATCH,
+        pub_linger=PUB_LINGER):
 
     # Imported here so it's guaranteed to be monkey-patched using gevent.monkey.patch_all by whoever called us
     from thread import start_new_thread
@@ -56,12 +108,25 @@ def BrokerClient(kvdb, client_type, topic_callbacks, _initial_lua_programs):
             self.kvdb = kvdb.copy()
             self.kvdb.init()
             self.pubsub = pubsub
+            self.name = name
             self.topic_callbacks = topic_callbacks
             self.on_message = on_message
             self.client = None
             self.keep_running = ZATO_NONE
             self.connect_sleep_time = 1
 
+            # Work queue key -> topic that messages from the queue are handled as
+            self.queue_topics = {}
+            self.announce_at = 0
+
+            # Outbound messages and statistics of how they are sent, used by pub clients only
+            self.outbound = None
+            self.pub_stats = None
+            self.max_batch = PUB_MAX_BATCH
+            self.linger = PUB_LINGER
+            self.has_stopped = False
+            self.pub_stats_log_at = 0
+
         def set_up_pub_sub_client(self):
             try:
                 self.kvdb = self.kvdb.copy()
@@ -99,14 +164,173 @@ def BrokerClient(kvdb, client_type, topic_callbacks, _initial_lua_programs):
                 except KeyboardInterrupt:
                     self.keep_running = False
 
+            elif self.pubsub == 'queue':
+
+                self.client = self.kvdb
+                self.keep_running = True
+
+                queue_keys = sorted(self.queue_topics)
+
+                try:
+                    while self.keep_running:
+                        try:
+                            self.consume(queue_keys)
+                        except redis.RedisError, e:
+                            if self.keep_running:
+                                logger.warn('Caught Redis exception in work queue client `%s`, will retry after %ss',
+                                    e.message, self.connect_sleep_time)
+                                sleep(self.connect_sleep_time)
+                except KeyboardInterrupt:
+                    self.keep_running = False
+
             else:
                 self.client = self.kvdb
                 self.keep_running = True
 
-        def publish(self, topic, msg):
-            if has_debug:
-                logger.debug('Publishing `%s` to `%s`', msg, topic)
-            return self.client.publish(topic, msg)
+                try:
+                    while self.keep_running:
+                        batch = self.get_batch()
+                        if batch:
+                            self.send_batch(batch)
+                        self.log_pub_stats()
+
+                    # Messages queued up before the client was told to stop are still sent
+                    self.drain()
+
+                except KeyboardInterrupt:
+                    self.keep_running = False
+
+                finally:
+                    self.has_stopped = True
+
+        def consume(self, queue_keys, _time=time.time):
+            """ Lets senders know that the work queues are consumed from, unless it was done recently enough,
+            and waits for a message in any of the queues, handing it over to the callback if one arrives in time.
+            """
+            now = _time()
+
+            if now >= self.announce_at:
+                pipeline = self.client.conn.pipeline(transaction=False)
+                for key in queue_keys:
+                    consumer_key = get_work_queue_consumer_key(key)
+                    pipeline.set(consumer_key, self.name)
+                    pipeline.expire(consumer_key, WORK_QUEUE_CONSUMER_TTL)
+                pipeline.execute()
+
+                self.announce_at = now + WORK_QUEUE_CONSUMER_TTL / 2.0
+
+            # Only one of all the clients waiting on a queue will receive a given message
+            result = self.client.conn.brpop(queue_keys, WORK_QUEUE_POP_TIMEOUT)
+            if result:
+                key, msg = result
+                try:
+                    self.on_message(self.queue_topics[key], msg)
+                except Exception, e:
+                    logger.warn('Could not handle work queue message `%s`, e:`%s`', msg, format_exc(e))
+
+        def get_batch(self):
+            """ Waits for at least one outbound message and returns it along with any other ones that arrive,
+            up to max_batch of them, before linger time passes.
+            """
+            try:
+                batch = [self.outbound.get(timeout=WORK_QUEUE_POP_TIMEOUT)]
+            except Empty:
+                return
+
+            linger_until = time.time() + self.linger
+
+            while len(batch) < self.max_batch:
+                try:
+                    remaining = linger_until - time.time()
+                    if remaining > 0:
+                        batch.append(self.outbound.get(timeout=remaining))
+                    else:
+                        batch.append(self.outbound.get_nowait())
+                except Empty:
+                    break
+
+            return batch
+
+        def drain(self):
+            """ Sends all the outbound messages queued up, in batches, without waiting for new ones to arrive.
+            """
+            while not self.outbound.empty():
+                self.send_batch(self.get_batch())
+
+        def send_batch(self, batch):
+            """ Sends all messages from a batch in one pipeline, in the order they were queued up in,
+            and lets each sender know what the result of its own message was.
+            """
+            stats = self.pub_stats
+            stats.batches += 1
+            stats.messages += len(batch)
+            stats.last_batch_size = len(batch)
+            stats.max_batch_size = max(stats.max_batch_size, len(batch))
+
+            try:
+                pipeline = self.client.conn.pipeline(transaction=False)
+                for msg in batch:
+                    if has_debug:
+                        logger.debug('Sending `%s` to `%s` (%s)', msg.data, msg.key, msg.command)
+                    getattr(pipeline, msg.command)(msg.key, msg.data)
+                    for command, args in msg.after:
+                        getattr(pipeline, command)(*args)
+
+                # Errors are returned in place of results of commands that failed instead of being raised
+                results = iter(pipeline.execute(raise_on_error=False))
+
+            except Exception, e:
+                stats.errors += len(batch)
+                logger.warn('Could not send %d broker message(s), e:`%s`', len(batch), format_exc(e))
+
+                for msg in batch:
+                    msg.result.set_exception(e)
+
+                # Most likely the connection is down so give it some time before the next batch is sent
+                sleep(self.connect_sleep_time)
+
+            else:
+                for msg in batch:
+                    result = next(results)
+
+                    # Results of any commands sent after the main one are of no interest to the sender
+                    for command, _ in msg.after:
+                        after_result = next(results)
+                        if isinstance(after_result, Exception):
+                            logger.warn('Could not run `%s` after sending broker message to `%s`, e:`%s`',
+                                command, msg.key, after_result)
+
+                    if isinstance(result, Exception):
+                        stats.errors += 1
+                        logger.warn('Could not send broker message `%s` to `%s`, e:`%s`', msg.data, msg.key, result)
+                        msg.result.set_exception(result)
+                    else:
+                        msg.result.set(result)
+
+        def get_pub_stats(self):
+            """ Returns statistics of outbound messages, including how many of them are still waiting to be sent.
+            """
+            stats = Bunch(self.pub_stats)
+            stats.queue_depth = self.outbound.qsize()
+            stats.avg_batch_size = stats.messages / stats.batches if stats.batches else 0
+
+            return stats
+
+        def log_pub_stats(self, _time=time.time):
+            """ Logs statistics of outbound messages if any of them are waiting to be sent,
+            at most once in PUB_STATS_INTERVAL seconds.
+            """
+            now = _time()
+            if now < self.pub_stats_log_at:
+                return
+
+            stats = self.get_pub_stats()
+            if stats.queue_depth:
+                logger.info('Broker client `%s` has %d message(s) waiting to be sent; batches:%d, messages:%d, errors:%d, '
+                    'batch size avg:%.1f, max:%d, last:%d', self.name, stats.queue_depth, stats.batches, stats.messages,
+                    stats.errors, stats.avg_batch_size, stats.max_batch_size, stats.last_batch_size)
+
+                self.pub_stats_log_at = now + PUB_STATS_INTERVAL
 
         def close(self):
             self.keep_running = False
@@ -125,17 +349,19 @@ def BrokerClient(kvdb, client_type, topic_callbacks, _initial_lua_programs):
         1) and 2) are straightforward, a message is being published on a topic,
            off which it is read by broker client(s).
 
-        3) needs more work - the actual message is added to Redis and what is really
-           being published is a Redis key it's been stored under. The first client
-           to read it will be the one to handle it.
-
-           Yup, it means the messages are sent across to all of the clients
-           and the winning one is the one that picked up the Redis message; it's not
-           that bad as it may seem, there will be at most as many clients as there
-           are servers in the cluster and truth to be told, Zero MQ < 3.x also would
-           do client-side PUB/SUB filtering and it did scale nicely.
+        3) is sent through a work queue - the message is pushed to a Redis list
+           that each client interested in such messages blocks on. Exactly one of them
+           receives a given message, in a single round-trip, and no other client is woken up.
+
+           Earlier versions published a Redis key that the message was stored under
+           to all the clients and the first one to rename the key handled the message.
+           Such messages are still accepted, in case they come from servers that
+           have not been upgraded yet. Likewise, clients that do not consume from work
+           queues never receive messages pushed to them, so such messages are sent
+           the earlier way for as long as no client in the cluster consumes from the queue,
+           e.g. before the first server is upgraded.
         """
-        def __init__(self, kvdb, client_type, topic_callbacks, initial_lua_programs):
+        def __init__(self, kvdb, client_type, topic_callbacks, initial_lua_programs, pub_max_batch, pub_linger):
             self.kvdb = kvdb
             self.decrypt_func = kvdb.decrypt_func
             self.name = '{}-{}'.format(client_type, new_cid())
@@ -143,27 +369,69 @@ def BrokerClient(kvdb, client_type, topic_callbacks, _initial_lua_programs):
             self.lua_container = LuaContainer(self.kvdb.conn, initial_lua_programs)
             self.ready = False
 
+            # Messages to publish are queued up and sent to Redis in batches by the pub client
+            self.pub_max_batch = pub_max_batch
+            self.pub_linger = pub_linger / 1000.0 # In milliseconds on input
+            self.outbound = Queue()
+            self.pub_stats = Bunch(batches=0, messages=0, errors=0, last_batch_size=0, max_batch_size=0)
+
+            # Work queue key -> when it was last checked if any client consumes from the queue and whether any does
+            self.queue_consumers = {}
+
         def run(self):
             logger.debug('Starting broker client, host:`%s`, port:`%s`, name:`%s`, topics:`%s`',
                 self.kvdb.config.host, self.kvdb.config.port, self.name, sorted(self.topic_callbacks))
 
             self.pub_client = _ClientThread(self.kvdb.copy(), 'pub', self.name)
+            self.pub_client.outbound = self.outbound
+            self.pub_client.pub_stats = self.pub_stats
+            self.pub_client.max_batch = self.pub_max_batch
+            self.pub_client.linger = self.pub_linger
             self.sub_client = _ClientThread(self.kvdb.copy(), 'sub', self.name, self.topic_callbacks, self.on_message)
 
-            start_new_thread(self.pub_client.run, ())
-            start_new_thread(self.sub_client.run, ())
+            clients = [self.pub_client, self.sub_client]
+
+            # Only clients that handle messages sent to one of parallel servers will consume from work queues
+            queue_topics = dict((get_work_queue_key(msg_type), TOPICS[msg_type]) for msg_type in WORK_QUEUE_TYPES
+                if TOPICS[msg_type] in self.topic_callbacks)
 
-            for client in(self.pub_client, self.sub_client):
+            if queue_topics:
+                self.queue_client = _ClientThread(
+                    self.kvdb.copy(), 'queue', self.name, self.topic_callbacks, self.on_queue_message)
+                self.queue_client.queue_topics = queue_topics
+                clients.append(self.queue_client)
+            else:
+                self.queue_client = None
+
+            for client in clients:
+                start_new_thread(client.run, ())
+
+            for client in clients:
                 while client.keep_running == ZATO_NONE:
                     time.sleep(0.01)
                 self.ready = True
 
-        def publish(self, msg, msg_type=MESSAGE_TYPE.TO_PARALLEL_ALL, *ignored_args, **ignored_kwargs):
+        def _send(self, command, key, data, after=(), is_sync=False):
+            """ Queues up a message to be sent by the pub client and returns an AsyncResult that will be set to
+            the result of the Redis command or to an exception if the message could not be sent. If is_sync is True,
+            waits for the message to be sent and returns the result of the command or raises the exception.
+            """
+            msg = OutboundMessage(command, key, data, after)
+            self.outbound.put(msg)
+            return msg.result.get(timeout=PUB_SYNC_TIMEOUT) if is_sync else msg.result
+
+        def get_pub_stats(self):
+            """ Returns statistics of outbound messages, including how many of them are still waiting to be sent.
+            """
+            return self.pub_client.get_pub_stats()
+
+        def publish(self, msg, msg_type=MESSAGE_TYPE.TO_PARALLEL_ALL, is_sync=False, *ignored_args, **ignored_kwargs):
             msg['msg_type'] = msg_type
             topic = TOPICS[msg_type]
-            self.pub_client.publish(topic, dumps(msg))
+            return self._send('publish', topic, dumps(msg), is_sync=is_sync)
 
-        def invoke_async(self, msg, msg_type=MESSAGE_TYPE.TO_PARALLEL_ANY, expiration=BROKER.DEFAULT_EXPIRATION):
+        def invoke_async(self, msg, msg_type=MESSAGE_TYPE.TO_PARALLEL_ANY, expiration=BROKER.DEFAULT_EXPIRATION,
+                is_sync=False, _time=time.time):
             msg['msg_type'] = msg_type
 
             try:
@@ -173,13 +441,48 @@ def BrokerClient(kvdb, client_type, topic_callbacks, _initial_lua_programs):
                 logger.error(error_msg, msg, format_exc(e))
                 raise
             else:
-                topic = TOPICS[msg_type]
-                key = broker_msg = b'zato:broker{}:{}'.format(KEYS[msg_type], new_cid())
+                queue_key = get_work_queue_key(msg_type)
 
-                self.kvdb.conn.set(key, str(msg))
-                self.kvdb.conn.expire(key, expiration)  # In seconds
+                # Each message carries the time it expires at, in seconds, so as not to be handled
+                # if no client picked it up before it expired.
+                if self.has_queue_consumers(queue_key):
+                    return self._send('lpush', queue_key, b'{:.3f};{}'.format(_time() + expiration, msg), (
+                        ('ltrim', (queue_key, 0, WORK_QUEUE_MAX_SIZE - 1)),
+                        ('expire', (queue_key, max(WORK_QUEUE_TTL, expiration))),
+                    ), is_sync)
 
-                self.pub_client.publish(topic, broker_msg)
+                # No client would receive the message from the queue so it is sent the way earlier versions expect it
+                else:
+                    key = b'zato:broker{}:{}'.format(KEYS[msg_type], new_cid())
+                    return self._send('set', key, msg, (
+                        ('expire', (key, expiration)),
+                        ('publish', (TOPICS[msg_type], key)),
+                    ), is_sync)
+
+        def has_queue_consumers(self, queue_key, _time=time.time):
+            """ Returns True if any client consumed from the work queue recently enough, checking it in KVDB
+            unless it was done less than WORK_QUEUE_CONSUMER_CHECK_INTERVAL seconds ago.
+            """
+            now = _time()
+            checked_at, has_consumers = self.queue_consumers.get(queue_key, (None, False))
+
+            if checked_at is None or now - checked_at >= WORK_QUEUE_CONSUMER_CHECK_INTERVAL:
+                has_consumers = bool(self.kvdb.conn.exists(get_work_queue_consumer_key(queue_key)))
+                self.queue_consumers[queue_key] = (now, has_consumers)
+
+            return has_consumers
+
+        def on_queue_message(self, topic, msg, _time=time.time):
+            if has_debug:
+                logger.debug('Got work queue message `%s`', msg)
+
+            expires_at, msg = msg.split(b';', 1)
+
+            if float(expires_at) < _time():
+                logger.warning('Skipping expired work queue message `%s`', msg)
+                return
+
+            spawn_greenlet(self.topic_callbacks[topic], Bunch(loads(msg)))
 
         def on_message(self, msg):
             if has_debug:
@@ -216,11 +519,24 @@ def BrokerClient(kvdb, client_type, topic_callbacks, _initial_lua_programs):
                         logger.debug('No payload in msg: `%s`', msg)
 
         def close(self):
-            for client in(self.pub_client, self.sub_client):
+
+            # Give the pub client a chance to send messages still queued up
+            self.pub_client.keep_running = False
+            close_until = time.time() + PUB_CLOSE_TIMEOUT
+
+            while not self.pub_client.has_stopped and time.time() < close_until:
+                sleep(0.01)
+
+            if not self.pub_client.has_stopped:
+                logger.warn('Closing broker client with %d message(s) not sent', self.outbound.qsize())
+
+            for client in(self.pub_client, self.sub_client, self.queue_client):
+                if not client:
+                    continue
                 client.keep_running = False
                 client.kvdb.close()
 
-    client = _BrokerClient(kvdb, client_type, topic_callbacks, _initial_lua_programs)
+    client = _BrokerClient(kvdb, client_type, topic_callbacks, _initial_lua_programs, pub_max_batch, pub_linger)
     start_new_thread(client.run, ())
 
     return client
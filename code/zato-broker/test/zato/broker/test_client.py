@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# anyjson
+from anyjson import loads
+
+# Bunch
+from bunch import Bunch
+
+# gevent
+from gevent import sleep, spawn
+
+# mock
+from mock import patch
+
+# Zato
+from zato.broker.client import BrokerClient, get_work_queue_consumer_key, get_work_queue_key, WORK_QUEUE_TTL
+from zato.common.broker_message import MESSAGE_TYPE, TOPICS
+from zato.common.test import InRAMRedis
+
+# Redis
+from redis import ResponseError
+
+# ################################################################################################################################
+
+_queue_key = get_work_queue_key(MESSAGE_TYPE.TO_PARALLEL_ANY)
+
+# ################################################################################################################################
+
+class KVDB(object):
+    """ All copies of a KVDB share the same in-RAM connection, as though they were connected to the same Redis server.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.config = Bunch(host='localhost', port=6379)
+        self.decrypt_func = None
+
+    def copy(self):
+        return KVDB(self.conn)
+
+    def init(self):
+        pass
+
+    def close(self):
+        pass
+
+# ################################################################################################################################
+
+def _start_new_thread(func, args):
+    """ Client threads are not started, tests run each step of theirs directly, using KVDB the way run does it.
+    """
+    client = func.__self__
+    client.client = client.kvdb
+    client.keep_running = True
+
+# ################################################################################################################################
+
+class BrokerClientTestCase(TestCase):
+
+    def setUp(self):
+        self.conn = InRAMRedis()
+        self.received = []
+
+        patcher = patch('thread.start_new_thread', _start_new_thread)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_client(self, name, is_consumer=True):
+        topic_callbacks = {
+            TOPICS[MESSAGE_TYPE.TO_PARALLEL_ALL]: lambda msg: self.received.append((name, msg)),
+        }
+
+        if is_consumer:
+            topic_callbacks[TOPICS[MESSAGE_TYPE.TO_PARALLEL_ANY]] = lambda msg: self.received.append((name, msg))
+
+        client = BrokerClient(KVDB(self.conn), 'server', topic_callbacks, [])
+        client.run()
+
+        return client
+
+    def flush(self, client):
+        client.pub_client.send_batch(client.pub_client.get_batch())
+
+    def consume(self, client):
+        client.queue_client.consume([_queue_key])
+
+# ################################################################################################################################
+
+    def test_invoke_async_delivered_to_one_consumer(self):
+        client1 = self.get_client('client1')
+        client2 = self.get_client('client2')
+
+        # Both clients let senders know that they consume from the queue
+        self.consume(client1)
+        self.consume(client2)
+
+        result = client1.invoke_async({'action': 'my.action'})
+        self.flush(client1)
+
+        self.assertEquals(result.get(timeout=1), 1)
+        self.assertIn(_queue_key, self.conn.data)
+
+        # Only the first client to pop the message receives it
+        self.consume(client2)
+        self.consume(client1)
+
+        self.assertEquals(len(self.received), 1)
+        self.assertEquals(self.received[0][0], 'client2')
+        self.assertEquals(self.received[0][1].action, 'my.action')
+        self.assertEquals(self.received[0][1].msg_type, MESSAGE_TYPE.TO_PARALLEL_ANY)
+        self.assertNotIn(_queue_key, self.conn.data)
+
+    def test_invoke_async_expired_skipped(self):
+        client = self.get_client('client')
+        self.consume(client)
+
+        client.invoke_async({'action': 'my.action'}, expiration=15, _time=lambda: 1000.0)
+        self.flush(client)
+
+        self.assertTrue(self.conn.data[_queue_key][0].startswith(b'1015.000;'))
+
+        self.consume(client)
+        self.assertListEqual(self.received, [])
+
+    def test_invoke_async_queue_trimmed(self):
+        client = self.get_client('client')
+        self.consume(client)
+
+        with patch('zato.broker.client.WORK_QUEUE_MAX_SIZE', 2):
+            for idx in range(3):
+                client.invoke_async({'idx': idx})
+            self.flush(client)
+
+        # The oldest message was dropped and the queue will be deleted if no one pushes to it for long enough
+        self.assertListEqual([loads(msg.split(b';', 1)[1])['idx'] for msg in self.conn.data[_queue_key]], [2, 1])
+        self.assertEquals(self.conn.expiry[_queue_key], WORK_QUEUE_TTL)
+
+    def test_invoke_async_no_consumers(self):
+
+        # This client does not consume from the queue, as though it was a server that has not been upgraded yet
+        client = self.get_client('client', False)
+
+        client.invoke_async({'action': 'my.action'}, expiration=15)
+        self.flush(client)
+
+        # The message is stored under a key of its own that is published to all clients
+        self.assertNotIn(_queue_key, self.conn.data)
+        self.assertEquals(len(self.conn.published), 1)
+
+        topic, key = self.conn.published[0]
+        self.assertEquals(topic, TOPICS[MESSAGE_TYPE.TO_PARALLEL_ANY])
+        self.assertEquals(loads(self.conn.data[key])['action'], 'my.action')
+        self.assertEquals(self.conn.expiry[key], 15)
+
+    def test_consumers_announced(self):
+        client = self.get_client('client')
+
+        self.consume(client)
+        consumer_key = get_work_queue_consumer_key(_queue_key)
+        self.assertIn(consumer_key, self.conn.data)
+
+        # Not announced again until it is time to do it
+        del self.conn.data[consumer_key]
+        self.consume(client)
+        self.assertNotIn(consumer_key, self.conn.data)
+
+        client.queue_client.announce_at = 0
+        self.consume(client)
+        self.assertIn(consumer_key, self.conn.data)
+
+# ################################################################################################################################
+
+class OutboundTestCase(BrokerClientTestCase):
+    """ Tests how outbound messages are sent in batches.
+    """
+    def setUp(self):
+        super(OutboundTestCase, self).setUp()
+
+        # So that tests do not wait for the pub client to notice it should stop
+        patcher = patch('zato.broker.client.WORK_QUEUE_POP_TIMEOUT', 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_client(self, *args, **kwargs):
+        client = super(OutboundTestCase, self).get_client(*args, **kwargs)
+        client.pub_client.connect_sleep_time = 0
+
+        return client
+
+    def test_get_batch(self):
+        client = self.get_client('client')
+        client.pub_client.max_batch = 2
+
+        results = [client.publish({'idx': idx}) for idx in range(5)]
+        batches = [client.pub_client.get_batch() for idx in range(4)]
+
+        # Up to max_batch messages in each batch, in the order they were queued up in, and nothing once they are all sent
+        self.assertListEqual([[msg.result for msg in batch] for batch in batches[:3]], [results[:2], results[2:4], results[4:]])
+        self.assertIsNone(batches[3])
+
+    def test_send_batch_order(self):
+        client = self.get_client('client', False)
+
+        client.publish({'idx': 0})
+        client.publish({'idx': 1}, MESSAGE_TYPE.TO_SCHEDULER)
+        client.invoke_async({'idx': 2})
+        client.publish({'idx': 3})
+
+        self.conn.round_trips = 0
+        self.flush(client)
+
+        # All messages were sent in a single round-trip, in the order they were queued up in, no matter their topics
+        self.assertEquals(self.conn.round_trips, 1)
+
+        published = [(topic, loads(self.conn.data.get(msg, msg))['idx']) for topic, msg in self.conn.published]
+        self.assertListEqual(published, [
+            (TOPICS[MESSAGE_TYPE.TO_PARALLEL_ALL], 0),
+            (TOPICS[MESSAGE_TYPE.TO_SCHEDULER], 1),
+            (TOPICS[MESSAGE_TYPE.TO_PARALLEL_ANY], 2),
+            (TOPICS[MESSAGE_TYPE.TO_PARALLEL_ALL], 3),
+        ])
+
+        stats = client.get_pub_stats()
+        self.assertEquals(stats.batches, 1)
+        self.assertEquals(stats.messages, 4)
+        self.assertEquals(stats.queue_depth, 0)
+
+    def test_pub_stats_logged(self):
+        client = self.get_client('client')
+        client.pub_client.max_batch = 1
+
+        for idx in range(3):
+            client.publish({'idx': idx})
+
+        client.pub_client.send_batch(client.pub_client.get_batch())
+
+        with patch('zato.broker.client.logger') as logger:
+
+            # Messages are waiting to be sent
+            client.pub_client.log_pub_stats(lambda: 1000)
+            self.assertEquals(logger.info.call_count, 1)
+            self.assertEquals(logger.info.call_args[0][2], 2)
+
+            # Not logged again until PUB_STATS_INTERVAL passes
+            client.pub_client.log_pub_stats(lambda: 1001)
+            self.assertEquals(logger.info.call_count, 1)
+
+            # Nothing is waiting to be sent so there is nothing to log
+            client.pub_client.drain()
+            client.pub_client.log_pub_stats(lambda: 2000)
+            self.assertEquals(logger.info.call_count, 1)
+
+    def test_send_batch_error_per_message(self):
+        client = self.get_client('client')
+        self.consume(client)
+
+        # The work queue's key is not a list so pushing to it fails
+        self.conn.data[_queue_key] = b'abc'
+
+        result1 = client.publish({'idx': 1})
+        result2 = client.invoke_async({'idx': 2})
+        result3 = client.publish({'idx': 3})
+        self.flush(client)
+
+        # Only the message whose command failed gets an exception
+        self.assertEquals(result1.get(timeout=1), 0)
+        self.assertRaises(Exception, result2.get, timeout=1)
+        self.assertEquals(result3.get(timeout=1), 0)
+        self.assertEquals(client.get_pub_stats().errors, 1)
+
+    def test_send_batch_error_whole_batch(self):
+        client = self.get_client('client')
+
+        results = [client.publish({'idx': idx}) for idx in range(3)]
+
+        with patch.object(InRAMRedis.Pipeline, 'execute', side_effect=ResponseError('my.error')):
+            self.flush(client)
+
+        for result in results:
+            self.assertRaises(ResponseError, result.get, timeout=1)
+
+        self.assertEquals(client.get_pub_stats().errors, 3)
+
+    def test_is_sync(self):
+        client = self.get_client('client')
+        self.consume(client)
+        spawn(client.pub_client.run)
+        sleep(0)
+
+        self.assertEquals(client.publish({'idx': 1}, is_sync=True), 0)
+        self.assertEquals(client.invoke_async({'idx': 2}, is_sync=True), 1)
+
+        # Errors are raised to the sender
+        self.conn.data[_queue_key] = b'abc'
+        self.assertRaises(Exception, client.invoke_async, {'idx': 3}, is_sync=True)
+
+        client.close()
+
+    def test_close_drains_outbound(self):
+        client = self.get_client('client')
+        spawn(client.pub_client.run)
+        sleep(0)
+
+        results = [client.publish({'idx': idx}) for idx in range(10)]
+        client.close()
+
+        self.assertTrue(client.pub_client.has_stopped)
+        self.assertListEqual([result.get(timeout=1) for result in results], [0] * 10)
+        self.assertListEqual([loads(msg)['idx'] for _, msg in self.conn.published], list(range(10)))
+
+# ################################################################################################################################
@@ -59,6 +59,9 @@ redis_sentinels_master=
 shadow_password_in_logs=True
 log_connection_info_sleep_time=5 # In seconds
 
+[scheduler]
+use_dispatcher=True # If True, all jobs are run by a single dispatcher instead of each job in a greenlet of its own
+
 [secret_keys]
 key1={secret_key1}
 
@@ -118,6 +118,13 @@ aws_host=
 use_soap_envelope=True
 fifo_response_buffer_size=0.2 # In MB
 jwt_secret=zato+secret://zato.server_conf.misc.jwt_secret
+jwt_verified_time=5 # In seconds, how long a worker trusts tokens it validated without checking KVDB again
+jwt_renew_interval=5 # In seconds, how often expiration of tokens in use is renewed, in batches
+jwt_renew_odb=True # Whether token expiration is renewed in ODB too, not only in KVDB
+broker_pub_max_batch=500 # How many broker messages at most to send to Redis in one pipeline
+broker_pub_linger=0 # In milliseconds, how long to wait for more broker messages before a batch is sent
+use_shared_startup_config=True # Whether only the first worker loads configuration from ODB and shares it with other ones
+use_discovery_cache=True # Whether modules that did not change since the last startup skip introspection for services
 enforce_service_invokes=False
 return_tracebacks=True
 default_error_message="An error has occurred"
@@ -128,6 +135,11 @@ ipc_tcp_start_port=34567
 
 [stats]
 expire_after=168 # In hours, 168 = 7 days = 1 week
+flush_interval=5 # In seconds, how often each worker stores its statistics in KVDB
+
+[cache]
+sync_batch_window=10 # In milliseconds, used by caches whose sync method is 'batched'
+sync_batch_max_ops=500
 
 [kvdb]
 host={{kvdb_host}}
@@ -208,6 +220,9 @@ log_if_deliv_server_not_found=True
 log_if_wsx_deliv_server_not_found=False
 data_prefix_len=2048
 data_prefix_short_len=64
+gd_group_commit=False
+gd_group_commit_window=5
+gd_group_commit_max_msgs=500
 
 [pubsub_meta_topic]
 enabled=True
@@ -457,6 +457,8 @@ class CACHE:
     class DEFAULT:
         MAX_SIZE = 10000
         MAX_ITEM_SIZE = 1000 # In characters for string/unicode, bytes otherwise
+        SYNC_BATCH_WINDOW = 10 # In milliseconds
+        SYNC_BATCH_MAX_OPS = 500
 
     class PERSISTENT_STORAGE:
         NO_PERSISTENT_STORAGE = NameId('No persistent storage', 'no-persistent-storage')
@@ -467,12 +469,13 @@ class CACHE:
                 return iter((self.NO_PERSISTENT_STORAGE, self.SQL))
 
     class SYNC_METHOD:
-        NO_SYNC = NameId('No synchronization', 'no-sync')
+        NO_SYNC = NameId('Local only (no synchronization)', 'no-sync')
         IN_BACKGROUND = NameId('In background', 'in-background')
+        BATCHED = NameId('In background, batched', 'batched')
 
         class __metaclass__(type):
             def __iter__(self):
-                return iter((self.NO_SYNC, self.IN_BACKGROUND))
+                return iter((self.NO_SYNC, self.IN_BACKGROUND, self.BATCHED))
 
 class KVDB(Attrs):
     SEPARATOR = ':::'
@@ -504,6 +507,8 @@ class KVDB(Attrs):
     TRANSLATION = 'zato:kvdb:data-dict:translation'
     TRANSLATION_ID = TRANSLATION + ':id'
 
+    SERVICE_STATS_NAMES = 'zato:stats:service:names' # A set of all services that statistics exist for
+    SERVICE_STATS_NAMES_BACKFILLED = 'zato:stats:service:names:backfilled' # Set once older statistics are in the set above
     SERVICE_USAGE = 'zato:stats:service:usage:'
     SERVICE_TIME_BASIC = 'zato:stats:service:time:basic:'
     SERVICE_TIME_RAW = 'zato:stats:service:time:raw:'
@@ -1192,6 +1197,14 @@ class SourceInfo(object):
         self.hash_method = None
         self.server_name = None
 
+    def read_source(self):
+        """ Reads the source code from path unless it has been read already.
+        """
+        if self.source is None and self.path:
+            with open(self.path, 'rb') as f:
+                self.source = f.read()
+        return self.source
+
 class StatsElem(object):
     """ A single element of a statistics query result concerning a particular service.
     All values make sense only within the time interval of the original query, e.g. a 'min_resp_time'
@@ -33,8 +33,7 @@ class Request(object):
         self.data_format = DATA_FORMAT.DICT
         self.request_id = request_id or 'ipc.{}'.format(new_cid())
         self.target_pid = None
-        self.reply_to_tag = ''
-        self.reply_to_fifo = ''
+        self.reply_to_tag = '' # Address of the requesting process's reply channel, if it waits for a response
         self.in_reply_to = ''
         self.creation_time_utc = datetime.utcnow()
 
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+import os
+from collections import OrderedDict
+from tempfile import gettempdir
+from traceback import format_exc
+
+# gevent
+from gevent.event import AsyncResult
+from gevent.lock import RLock
+
+# ZeroMQ
+import zmq.green as zmq
+
+# Zato
+from zato.common.ipc import IPCBase
+
+# ################################################################################################################################
+
+# libzmq 2.x has a single high-water mark option, unlimited by default, newer versions have one for each direction
+_send_hwm = getattr(zmq, 'SNDHWM', None) or zmq.HWM
+
+# ################################################################################################################################
+
+class ReplyChannel(IPCBase):
+    """ A persistent channel through which a process receives replies to IPC requests it sent to other processes
+    and sends replies to requests that other processes sent to it. Each process binds a PULL socket of its own,
+    to which other processes connect PUSH sockets, once per process, reused for all replies. Each reply carries
+    the ID of the request it is a reply to.
+
+    PUSH sockets are closed if a reply cannot be sent through them and, because processes that sent requests
+    may be restarted under new PIDs, no more than max_reply_sockets of them are kept, least recently used ones
+    being closed first.
+    """
+    def __init__(self, name, pid, max_reply_sockets=100, reply_hwm=1000):
+        self.address = self.get_address(name, pid)
+
+        # Request ID -> AsyncResult that the reply will be set in
+        self.pending = {}
+
+        # Address -> PUSH socket to a process that sent requests to us
+        self.reply_sockets = OrderedDict()
+        self.max_reply_sockets = max_reply_sockets
+        self.reply_hwm = reply_hwm
+        self.reply_lock = RLock()
+
+        super(ReplyChannel, self).__init__(name, pid)
+
+    def get_address(self, name, pid):
+        return 'ipc://{}'.format(os.path.join(gettempdir(), 'zato-ipc-{}-reply-{}'.format(name, pid)))
+
+    def set_up_sockets(self):
+        self.socket = self.ctx.socket(zmq.PULL)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(self.address)
+
+    def log_connected(self):
+        self.logger.info('Established IPC reply channel at %s (pid: %s)', self.address, self.pid)
+
+# ################################################################################################################################
+
+    def serve_forever(self):
+        """ Receives replies and hands each one over to the greenlet waiting for it.
+        """
+        while self.keep_running:
+            try:
+                request_id, data = self.socket.recv_multipart()
+                result = self.pending.pop(request_id, None)
+
+                # There will be no result if the requesting greenlet has already given up waiting
+                if result:
+                    result.set(data)
+                else:
+                    self.logger.info('Ignoring reply to an IPC request no longer waited for `%s`', request_id)
+
+            except Exception:
+                if self.keep_running:
+                    self.logger.warn('Error in IPC reply channel, e:`%s`', format_exc())
+
+# ################################################################################################################################
+
+    def expect(self, request_id):
+        """ Returns an AsyncResult that a reply to the request will be set in. Must be called before the request is sent.
+        """
+        result = self.pending[request_id.encode('utf8')] = AsyncResult()
+        return result
+
+    def cancel(self, request_id):
+        """ Indicates that a reply to the request is no longer waited for.
+        """
+        self.pending.pop(request_id.encode('utf8'), None)
+
+# ################################################################################################################################
+
+    def send(self, address, request_id, data):
+        """ Sends a reply to a request to the reply channel of the process that sent it.
+        """
+        with self.reply_lock:
+
+            # Most recently used sockets are always at the end of the dict
+            socket = self.reply_sockets.pop(address, None)
+            if not socket:
+                socket = self.ctx.socket(zmq.PUSH)
+                socket.setsockopt(zmq.LINGER, 0)
+                socket.setsockopt(_send_hwm, self.reply_hwm)
+                socket.connect(address)
+
+                while len(self.reply_sockets) >= self.max_reply_sockets:
+                    _, oldest = self.reply_sockets.popitem(last=False)
+                    oldest.close()
+
+            # Never block - if the other process is gone, its replies will be queued up to the socket's high-water mark
+            # and then dropped instead of blocking the sender. The socket is closed so that a new one is connected
+            # if the process sends a request again.
+            try:
+                socket.send_multipart([request_id.encode('utf8'), data.encode('utf8') if isinstance(data, unicode) else data],
+                    zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                self.logger.warn('Could not send IPC reply to `%s` (%s), e:`%s`', address, request_id, e)
+                socket.close()
+            else:
+                self.reply_sockets[address] = socket
+
+# ################################################################################################################################
+
+    def close(self):
+        self.keep_running = False
+
+        with self.reply_lock:
+            for socket in self.reply_sockets.values():
+                socket.close()
+            self.reply_sockets.clear()
+
+        self.socket.close()
+        self.ctx.term()
+
+# ################################################################################################################################
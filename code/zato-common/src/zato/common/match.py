@@ -10,9 +10,10 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 import logging
+import re
 
 # globre
-from globre import match as globre_match
+from globre import compile as globre_compile, EXACT as GLOBRE_EXACT
 
 # Paste
 from paste.util.converters import asbool
@@ -22,16 +23,62 @@ from zato.common import FALSE_TRUE, TRUE_FALSE
 
 logger = logging.getLogger(__name__)
 
+# Python 2 regular expressions may have at most 100 groups
+_max_groups = 99
+
+# ################################################################################################################################
+
+class CombinedMatcher(object):
+    """ Matches values against a list of compiled regular expressions at once, returning the index of the first one
+    that matches, i.e. the same one that calling .match of each of them in turn would find. Expressions are combined
+    into as few alternations as the limit on the number of groups allows.
+    """
+    def __init__(self, compiled_list):
+        self.combined = []
+
+        chunk = []
+        len_groups = 0
+        flags = None
+
+        for idx, compiled in enumerate(compiled_list):
+            needs_groups = compiled.groups + 1
+
+            if chunk and (len_groups + needs_groups > _max_groups or compiled.flags != flags):
+                self.combined.append(re.compile('|'.join(chunk), flags))
+                chunk = []
+                len_groups = 0
+
+            chunk.append('(?P<p{}>{})'.format(idx, compiled.pattern))
+            len_groups += needs_groups
+            flags = compiled.flags
+
+        if chunk:
+            self.combined.append(re.compile('|'.join(chunk), flags))
+
+    def match(self, value):
+        """ Returns the index of the first expression matching value or None if none does.
+        """
+        for combined in self.combined:
+            result = combined.match(value)
+            if result:
+                return int(result.lastgroup[1:])
+
+# ################################################################################################################################
+
 class Matcher(object):
-    def __init__(self):
+    def __init__(self, cache_max_size=10000):
         self.config = None
         self.items = {True:[], False:[]}
         self.order1 = None
         self.order2 = None
         self.is_allowed_cache = {}
+        self.cache_max_size = cache_max_size
+        self.cache_size = 0
         self.special_case = None
+        self.combined = {True:None, False:None}
 
     def read_config(self, config):
+        is_reconfigured = self.config is not None
         self.config = config
         order = config.get('order', FALSE_TRUE)
         self.order1, self.order2 = (True, False) if order == TRUE_FALSE else (False, True)
@@ -56,6 +103,15 @@ class Matcher(object):
                 self.special_case = non_empty
                 break
 
+        # All patterns for each order are checked in one go
+        for key in self.items:
+            self.combined[key] = CombinedMatcher([globre_compile(pattern, GLOBRE_EXACT) for pattern in self.items[key]])
+
+        # Results for the previous configuration no longer apply
+        if is_reconfigured:
+            self.is_allowed_cache = {}
+            self.cache_size = 0
+
     def is_allowed(self, value):
         logger.debug('Cache:`%s`, value:`%s`', self.is_allowed_cache, value)
 
@@ -65,16 +121,24 @@ class Matcher(object):
         try:
             return self.is_allowed_cache[value]
         except KeyError:
-            _match = globre_match
-            is_allowed = None
 
-            for order in self.order1, self.order2:
-                for pattern in self.items[order]:
-                    if _match(pattern, value):
-                        is_allowed = order
+            # A match in order2 takes precedence over one in order1
+            if self.combined[self.order2].match(value) is not None:
+                is_allowed = self.order2
+
+            elif self.combined[self.order1].match(value) is not None:
+                is_allowed = self.order1
 
             # No match at all - we don't allow it in that case
-            is_allowed = is_allowed if (is_allowed is not None) else False
+            else:
+                is_allowed = False
+
+            # Keep the cache bounded in case values are arbitrary, e.g. they come from user input
+            if self.cache_size >= self.cache_max_size:
+                self.is_allowed_cache = {}
+                self.cache_size = 0
 
             self.is_allowed_cache[value] = is_allowed
+            self.cache_size += 1
+
             return is_allowed
@@ -23,7 +23,7 @@ from traceback import format_exc
 from springpython.context import DisposableObject
 
 # SQLAlchemy
-from sqlalchemy import create_engine, event
+from sqlalchemy import bindparam, create_engine, event
 from sqlalchemy.exc import IntegrityError, ProgrammingError
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.orm.query import Query
@@ -644,6 +644,122 @@ class ODBManager(SessionWrapper):
             logger.error('Could not add service, name:[%s], e:[%s]', name, format_exc(e).decode('utf-8'))
             self._session.rollback()
 
+# ################################################################################################################################
+
+    def add_services(self, items):
+        """ Adds information about the server's services into the ODB in bulk. Each item is an object with name, impl_name,
+        is_internal, deployment_time, details and source_info attributes, as add_service expects them. Returns a dictionary
+        of service names to (id, is_active, slow_threshold) tuples.
+        """
+        if not items:
+            return {}
+
+        try:
+            return self._add_services(items)
+        except(IntegrityError, ProgrammingError), e:
+
+            # Most likely, another server added some of the services in the meantime, which we will find in the second run
+            logger.log(TRACE1, 'IntegrityError (add_services), e:[%s]', format_exc(e).decode('utf-8'))
+            self._session.rollback()
+
+            try:
+                return self._add_services(items)
+            except Exception, e:
+                logger.warn('Could not add services in bulk, adding them one by one, e:[%s]', format_exc(e).decode('utf-8'))
+                self._session.rollback()
+
+        except Exception, e:
+            logger.warn('Could not add services in bulk, adding them one by one, e:[%s]', format_exc(e).decode('utf-8'))
+            self._session.rollback()
+
+        out = {}
+
+        for item in items:
+            result = self.add_service(item.name, item.impl_name, item.is_internal, item.deployment_time, item.details,
+                item.source_info)
+            if result:
+                out[item.name] = result
+
+        return out
+
+    def _get_services_by_name(self):
+        return dict((item.name, (item.id, item.is_active, item.slow_threshold)) for item in
+            self._session.query(Service.id, Service.name, Service.is_active, Service.slow_threshold).\
+            filter(Service.cluster_id==self.cluster.id))
+
+    def _add_services(self, items):
+        """ Low-level implementation of add_services which runs all SQL statements in a single transaction.
+        """
+        existing = self._get_services_by_name()
+
+        # Services that do not exist yet in the cluster
+        to_insert = {}
+        for item in items:
+            if item.name not in existing:
+                to_insert[item.name] = {
+                    'name': item.name,
+                    'is_active': True,
+                    'impl_name': item.impl_name,
+                    'is_internal': item.is_internal,
+                    'cluster_id': self.cluster.id,
+                }
+
+        if to_insert:
+            self._session.execute(Service.__table__.insert(), list(to_insert.values()))
+            existing = self._get_services_by_name()
+
+        # Services already deployed on this server are updated, the rest is inserted,
+        # and we need to know what hashes of their source code are stored already.
+        deployed = dict(self._session.query(DeployedService.service_id, DeployedService.source_hash).\
+            filter(DeployedService.server_id==self.server.id))
+
+        ds_insert = []
+        ds_update = []
+        ds_update_no_source = []
+
+        for item in items:
+            service_id = existing[item.name][0]
+            data = {
+                'deployment_time': item.deployment_time,
+                'details': item.details,
+                'source_path': item.source_info.path,
+                'source_hash': item.source_info.hash,
+                'source_hash_method': item.source_info.hash_method,
+            }
+
+            if service_id in deployed:
+                data['b_server_id'] = self.server.id
+                data['b_service_id'] = service_id
+
+                # Source code is stored only if it changed since the service was last deployed
+                if item.source_info.hash and deployed[service_id] == item.source_info.hash:
+                    ds_update_no_source.append(data)
+                else:
+                    data['source'] = item.source_info.read_source()
+                    ds_update.append(data)
+            else:
+                data['server_id'] = self.server.id
+                data['service_id'] = service_id
+                data['source'] = item.source_info.read_source()
+                ds_insert.append(data)
+
+                # The same service may be visited more than once, e.g. if it is imported by more than one module
+                deployed[service_id] = item.source_info.hash
+
+        if ds_insert:
+            self._session.execute(DeployedService.__table__.insert(), ds_insert)
+
+        table = DeployedService.__table__
+        for to_update in (ds_update, ds_update_no_source):
+            if to_update:
+                self._session.execute(table.update().\
+                    where(table.c.server_id==bindparam('b_server_id')).\
+                    where(table.c.service_id==bindparam('b_service_id')), to_update)
+
+        self._session.commit()
+
+        return dict((item.name, existing[item.name]) for item in items)
+
 # ################################################################################################################################
 
     def drop_deployed_services(self, server_id):
@@ -661,6 +777,7 @@ class ODBManager(SessionWrapper):
         """ Adds information about the server's deployed service into the ODB.
         """
         try:
+            source_info.read_source()
             ds = DeployedService(deployment_time, details, self.server.id, service,
                 source_info.source, source_info.path, source_info.hash, source_info.hash_method)
             self._session.add(ds)
@@ -6,6 +6,9 @@ Copyright (C) 2018, Zato Source s.r.o. https://zato.io
 Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 """
 
+# stdlib
+from collections import OrderedDict
+
 # SQLAlchemy
 from sqlalchemy.exc import IntegrityError
 
@@ -29,19 +32,27 @@ EndpointTopicTable = PubSubEndpointTopic.__table__
 # ################################################################################################################################
 
 _initialized=PUBSUB.DELIVERY_STATUS.INITIALIZED
+_msg_columns = frozenset(MsgTable.c.keys())
 
 # ################################################################################################################################
 
-def _sql_publish_with_retry(session, cid, cluster_id, topic_id, subscriptions_by_topic, gd_msg_list, now):
-    """ A low-level implementation of sql_publish_with_retry.
+def _sql_publish_group_with_retry(session, cid, cluster_id, topic_id, group):
+    """ A low-level implementation of sql_publish_group_with_retry.
     """
+    msg_list = []
+    queue_msgs = []
+
+    for subscriptions_by_topic, gd_msg_list, now in group:
+        msg_list.extend(gd_msg_list)
+        queue_msgs.extend(get_queue_messages(cluster_id, subscriptions_by_topic, gd_msg_list, topic_id, now))
+
     # Publish messages - INSERT rows, each representing an individual message
-    if insert_topic_messages(session, cid, gd_msg_list):
+    if insert_topic_messages(session, cid, msg_list):
 
         # Move messages to each subscriber's queue
-        if subscriptions_by_topic:
+        if queue_msgs:
             try:
-                insert_queue_messages(session, cluster_id, subscriptions_by_topic, gd_msg_list, topic_id, now, cid)
+                sql_op_with_deadlock_retry(cid, 'insert_queue_messages', _insert_queue_messages, session, queue_msgs)
 
                 # No integrity error / no deadlock = all good
                 return True
@@ -60,22 +71,39 @@ def _sql_publish_with_retry(session, cid, cluster_id, topic_id, subscriptions_by
 
 # ################################################################################################################################
 
-def sql_publish_with_retry(*args):
+def sql_publish_group_with_retry(session, cid, cluster_id, topic_id, group):
     """ Populates SQL structures with new messages for topics and their counterparts in subscriber queues.
-    In case of a deadlock will retry the whole transaction, per MySQL's requirements, which rolls back
-    the whole of it rather than a deadlocking statement only.
+    Each element of group is a tuple of subscriptions, messages and publication time, as given to sql_publish_with_retry,
+    and messages from all of them are inserted together. In case of a deadlock will retry the whole transaction,
+    per MySQL's requirements, which rolls back the whole of it rather than a deadlocking statement only.
     """
     is_ok = False
 
     while not is_ok:
-        is_ok = _sql_publish_with_retry(*args)
+        is_ok = _sql_publish_group_with_retry(session, cid, cluster_id, topic_id, group)
+
+# ################################################################################################################################
+
+def sql_publish_with_retry(session, cid, cluster_id, topic_id, subscriptions_by_topic, gd_msg_list, now):
+    """ Same as sql_publish_group_with_retry but for messages from a single publication.
+    """
+    sql_publish_group_with_retry(session, cid, cluster_id, topic_id, [(subscriptions_by_topic, gd_msg_list, now)])
 
 # ################################################################################################################################
 
 def _insert_topic_messages(session, msg_list):
-    """ A low-level implementation for insert_topic_messages.
+    """ A low-level implementation for insert_topic_messages. Runs a multi-row INSERT for each set of columns
+    that messages have because such an INSERT takes its columns from the first row only. Keys that are not
+    columns, e.g. sub_pattern_matched, are not given to the INSERT.
     """
-    session.execute(MsgInsert().values(msg_list))
+    by_columns = OrderedDict()
+
+    for msg in msg_list:
+        columns = tuple(sorted(key for key in msg if key in _msg_columns))
+        by_columns.setdefault(columns, []).append(dict((key, msg[key]) for key in columns))
+
+    for columns_msg_list in by_columns.itervalues():
+        session.execute(MsgInsert().values(columns_msg_list))
 
 # ################################################################################################################################
 
@@ -100,9 +128,8 @@ def _insert_queue_messages(session, queue_msgs):
 
 # ################################################################################################################################
 
-def insert_queue_messages(session, cluster_id, subscriptions_by_topic, msg_list, topic_id, now, cid, _initialized=_initialized):
-    """ Moves messages to each subscriber's queue, i.e. runs an INSERT that adds relevant references to the topic message.
-    Also, updates each message's is_in_sub_queue flag to indicate that it is no longer available for other subscribers.
+def get_queue_messages(cluster_id, subscriptions_by_topic, msg_list, topic_id, now):
+    """ Returns rows to be inserted to subscriber queues, one for each message and subscriber.
     """
     queue_msgs = []
 
@@ -120,6 +147,16 @@ def insert_queue_messages(session, cluster_id, subscriptions_by_topic, msg_list,
                 'sub_pattern_matched': msg['sub_pattern_matched'][sub.sub_key],
             })
 
+    return queue_msgs
+
+# ################################################################################################################################
+
+def insert_queue_messages(session, cluster_id, subscriptions_by_topic, msg_list, topic_id, now, cid, _initialized=_initialized):
+    """ Moves messages to each subscriber's queue, i.e. runs an INSERT that adds relevant references to the topic message.
+    Also, updates each message's is_in_sub_queue flag to indicate that it is no longer available for other subscribers.
+    """
+    queue_msgs = get_queue_messages(cluster_id, subscriptions_by_topic, msg_list, topic_id, now)
+
     # Move the message to endpoint queues
     return sql_op_with_deadlock_retry(cid, 'insert_queue_messages', _insert_queue_messages, session, queue_msgs)
 
@@ -47,8 +47,10 @@ def new_group_id(_new_cid=new_cid):
 class PubSubMessage(object):
     """ Base container class for pub/sub message wrappers.
     """
-    # We are not using __slots__ because they can't be inherited by subclasses
-    # and this class, as well as its subclasses, will be rewritten in Cython anyway.
+    # Delivery queues may hold millions of messages so there is no per-instance __dict__.
+    # Note that each subclass needs to declare its own __slots__, even if empty, for this to have any effect.
+    __slots__ = tuple(sorted(set(msg_pub_attrs)))
+
     pub_attrs = msg_pub_attrs
 
     def __init__(self):
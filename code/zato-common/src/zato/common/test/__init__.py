@@ -10,6 +10,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 from datetime import datetime
+from fnmatch import fnmatch
 from random import choice, randint
 from unittest import TestCase
 from uuid import uuid4
@@ -176,9 +177,9 @@ def enrich_with_static_config(object_):
 
     is_allowed = target_match
 
-    object_._worker_config = Bunch(out_odoo=None, out_soap=None)
+    object_._worker_config = Bunch(out_odoo=None, out_soap=None, out_sap=None)
     object_._worker_store = Bunch(
-        sql_pool_store=None, stomp_outconn_api=None, outgoing_web_sockets=None, cassandra_api=None,
+        sql_pool_store=None, stomp_outconn_api=None, outgoing_web_sockets=None, outconn_wsx=None, cassandra_api=None,
         cassandra_query_api=None, email_smtp_api=None, email_imap_api=None, search_es_api=None, search_solr_api=None,
         target_matcher=Bunch(target_match=target_match, is_allowed=is_allowed), invoke_matcher=Bunch(is_allowed=is_allowed),
         vault_conn_api=None, sms_twilio_api=None)
@@ -251,6 +252,167 @@ class FakeKVDB(object):
 
 # ################################################################################################################################
 
+class InRAMRedis(object):
+    """ A subset of the Redis API, kept in RAM, for tests that need to check what ends up in KVDB. Counts how many
+    round-trips to Redis would have been made - each pipeline executed is a single one.
+    """
+    class Pipeline(object):
+        def __init__(self, conn):
+            self.conn = conn
+            self.commands = []
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *ignored):
+            pass
+
+        def __getattr__(self, name):
+            func = getattr(self.conn, name)
+            def _record(*args):
+                self.commands.append((func, args))
+                return self
+            return _record
+
+        def execute(self, raise_on_error=True):
+            round_trips = self.conn.round_trips
+            out = []
+
+            for func, args in self.commands:
+                try:
+                    out.append(func(*args))
+                except Exception as e:
+                    if raise_on_error:
+                        raise
+                    out.append(e)
+
+            self.conn.round_trips = round_trips + 1
+            self.commands = []
+            return out
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.published = []
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return self.Pipeline(self)
+
+    def _get(self, key, default_type):
+        self.round_trips += 1
+        return self.data.setdefault(key, default_type())
+
+    def _cleanup(self, key):
+        if not self.data.get(key):
+            self.data.pop(key, None)
+
+    def keys(self, pattern='*'):
+        self.round_trips += 1
+        return [key for key in self.data if fnmatch(key, pattern)]
+
+    def scan_iter(self, match='*', count=None):
+        self.round_trips += 1
+        return iter(sorted(key for key in self.data if fnmatch(key, match)))
+
+    def get(self, key):
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.round_trips += 1
+        self.data[key] = value
+
+    def delete(self, *keys):
+        self.round_trips += 1
+        return len([self.data.pop(key) for key in keys if key in self.data])
+
+    def exists(self, *keys):
+        self.round_trips += 1
+        return len([key for key in keys if key in self.data])
+
+    def expire(self, key, seconds):
+        self.round_trips += 1
+        if key in self.data:
+            self.expiry[key] = seconds
+            return True
+        return False
+
+    def incrby(self, key, amount=1):
+        self.round_trips += 1
+        self.data[key] = str(int(self.data.get(key, 0)) + amount)
+        return int(self.data[key])
+
+    def sadd(self, key, *values):
+        self.round_trips += 1
+        self.data.setdefault(key, set()).update(values)
+
+    def srem(self, key, *values):
+        self.round_trips += 1
+        self.data.get(key, set()).difference_update(values)
+        self._cleanup(key)
+
+    def smembers(self, key):
+        self.round_trips += 1
+        return set(self.data.get(key, ()))
+
+    def hset(self, key, name, value):
+        self._get(key, dict)[name] = str(value)
+
+    def hmset(self, key, mapping):
+        self._get(key, dict).update((name, str(value)) for name, value in mapping.items())
+
+    def hget(self, key, name):
+        self.round_trips += 1
+        return self.data.get(key, {}).get(name)
+
+    def hmget(self, key, *names):
+        self.round_trips += 1
+        return [self.data.get(key, {}).get(name) for name in names]
+
+    def hgetall(self, key):
+        self.round_trips += 1
+        return dict(self.data.get(key, {}))
+
+    def rpush(self, key, *values):
+        self._get(key, list).extend(str(value) for value in values)
+
+    def lpush(self, key, *values):
+        values_ = self._get(key, list)
+        for value in values:
+            values_.insert(0, str(value))
+        return len(values_)
+
+    def brpop(self, keys, timeout=0):
+        """ Never blocks - returns None right away if all the lists are empty.
+        """
+        self.round_trips += 1
+        for key in keys:
+            if self.data.get(key):
+                value = self.data[key].pop()
+                self._cleanup(key)
+                return key, value
+
+    def llen(self, key):
+        self.round_trips += 1
+        return len(self.data.get(key, ()))
+
+    def lrange(self, key, start, stop):
+        self.round_trips += 1
+        values = self.data.get(key, [])
+        return values[start:] if stop == -1 else values[start:stop+1]
+
+    def ltrim(self, key, start, stop):
+        self.data[key] = self.lrange(key, start, stop)
+        self._cleanup(key)
+
+    def publish(self, channel, message):
+        self.round_trips += 1
+        self.published.append((channel, message))
+        return 0
+
+# ################################################################################################################################
+
 class FakeServices(object):
     def __getitem__(self, ignored):
         return {'slow_threshold': 1234}
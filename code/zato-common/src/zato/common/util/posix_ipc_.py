@@ -159,6 +159,7 @@ class ServerStartupIPC(SharedMemoryIPC):
     """ A shared memory-backed IPC object for server startup initialization.
     """
     pubsub_pid = '/pubsub/pid'
+    config_snapshot = '/config/snapshot'
 
     def create(self, deployment_key, size):
         super(ServerStartupIPC, self).create('server-{}'.format(deployment_key), size)
@@ -169,4 +170,61 @@ class ServerStartupIPC(SharedMemoryIPC):
     def get_pubsub_pid(self, timeout=10):
         return self.get_key(self.pubsub_pid, 'current', timeout)
 
+    def _get_config_snapshot_name(self):
+        return '{}-config'.format(self.shmem_name)
+
+    def set_config_snapshot(self, data):
+        """ Stores a serialized snapshot of configuration loaded from ODB. It can be much bigger than other startup data
+        so it is kept in a shared memory segment of its own, only with its name and size stored along with other data.
+        """
+        name = self._get_config_snapshot_name()
+        size = len(data)
+
+        mem = ipc.SharedMemory(name, ipc.O_CREAT, size=size)
+        try:
+            config_mmap = mmap(mem.fd, size)
+            config_mmap.write(data)
+            config_mmap.close()
+        finally:
+            mem.close_fd()
+
+        self.set_key(self.config_snapshot, 'current', {'name':name, 'size':size})
+
+    def get_config_snapshot(self, timeout=60):
+        """ Returns a configuration snapshot stored by another worker, waiting up to timeout seconds for it to be stored.
+        """
+        info = self.get_key(self.config_snapshot, 'current', timeout)
+
+        # It was already deleted
+        if not info:
+            raise KeyError('Configuration snapshot no longer exists')
+
+        mem = ipc.SharedMemory(info['name'])
+        try:
+            config_mmap = mmap(mem.fd, info['size'])
+            data = config_mmap.read(info['size'])
+            config_mmap.close()
+        finally:
+            mem.close_fd()
+
+        return data
+
+    def delete_config_snapshot(self):
+        """ Deletes a configuration snapshot, e.g. so that workers restarted later on do not read stale data.
+        """
+        self.set_key(self.config_snapshot, 'current', None)
+
+        try:
+            ipc.unlink_shared_memory(self._get_config_snapshot_name())
+        except ipc.ExistentialError:
+            pass
+
+    def close(self):
+        super(ServerStartupIPC, self).close()
+
+        try:
+            ipc.unlink_shared_memory(self._get_config_snapshot_name())
+        except ipc.ExistentialError:
+            pass
+
 # ################################################################################################################################
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from multiprocessing import Process
+from unittest import TestCase
+
+# gevent
+from gevent import sleep, spawn
+
+# Zato
+from zato.common import IPC
+from zato.common.ipc.api import IPCAPI
+from zato.common.ipc.forwarder import Forwarder
+from zato.common.ipc.reply import ReplyChannel
+from zato.common.util import new_cid
+
+# ################################################################################################################################
+
+class IPCTestCase(TestCase):
+    """ Runs a forwarder in a process of its own, as it is run by servers, and three IPC participants in this process,
+    each one with a different PID, as though each was a separate worker process.
+    """
+    pids = (11, 12, 13)
+
+    def setUp(self):
+        self.name = 'test-{}'.format(new_cid())
+
+        self.forwarder = Process(target=Forwarder, args=(self.name, 1))
+        self.forwarder.daemon = True
+        self.forwarder.start()
+
+        self.received = []
+        self.delay = {}
+        self.apis = {}
+
+        for pid in self.pids:
+            self.apis[pid] = IPCAPI(False, self.name, self._get_callback(pid), pid)
+            self.apis[pid].run()
+
+        # Give the forwarder and subscriber sockets time to connect
+        sleep(0.5)
+
+    def tearDown(self):
+        for api in self.apis.values():
+            api.subscriber.close()
+            api.publisher.close()
+            api.reply_channel.close()
+
+        self.forwarder.terminate()
+
+    def _get_callback(self, pid):
+        def on_message(msg):
+            if msg.target_pid and msg.target_pid != pid:
+                return
+
+            self.received.append((pid, msg.payload))
+
+            if msg.payload == 'error':
+                response = '{};{}'.format(IPC.STATUS.FAILURE, 'Error in {}'.format(pid))
+            else:
+                response = '{};{{"pid":{},"payload":"{}"}}'.format(IPC.STATUS.SUCCESS, pid, msg.payload)
+
+            # Replies are sent in background so as not to block the subscriber in tests that need a delay
+            spawn(self._reply, pid, msg, response)
+
+        return on_message
+
+    def _reply(self, pid, msg, response):
+        sleep(self.delay.get(msg.payload, 0))
+        self.apis[pid].reply(msg, response)
+
+# ################################################################################################################################
+
+    def test_invoke_by_pid(self):
+
+        is_ok, response = self.apis[11].invoke_by_pid('my.service', 'abc', 12, timeout=2)
+
+        self.assertTrue(is_ok)
+        self.assertDictEqual(response, {'pid': 12, 'payload': 'abc'})
+        self.assertListEqual(self.received, [(12, 'abc')])
+
+    def test_invoke_by_pid_error(self):
+
+        is_ok, response = self.apis[11].invoke_by_pid('my.service', 'error', 13, timeout=2)
+
+        self.assertFalse(is_ok)
+        self.assertEquals(response, 'Error in 13')
+
+    def test_invoke_by_pid_async(self):
+
+        self.assertIsNone(self.apis[11].invoke_by_pid('my.service', 'abc', 12, is_async=True))
+
+        sleep(0.1)
+        self.assertListEqual(self.received, [(12, 'abc')])
+        self.assertDictEqual(self.apis[11].reply_channel.pending, {})
+
+    def test_timeout(self):
+
+        self.delay['slow'] = 0.3
+
+        self.assertTupleEqual(self.apis[11].invoke_by_pid('my.service', 'slow', 12, timeout=0.1), (None, None))
+        self.assertDictEqual(self.apis[11].reply_channel.pending, {})
+
+        # The late reply is ignored and does not prevent next ones from being received
+        sleep(0.3)
+        is_ok, response = self.apis[11].invoke_by_pid('my.service', 'abc', 12, timeout=2)
+        self.assertDictEqual(response, {'pid': 12, 'payload': 'abc'})
+
+    def test_concurrent_requests(self):
+
+        # Replies arrive in a different order than requests were sent in
+        self.delay['first'] = 0.2
+
+        first = spawn(self.apis[11].invoke_by_pid, 'my.service', 'first', 12, timeout=2)
+        second = spawn(self.apis[11].invoke_by_pid, 'my.service', 'second', 12, timeout=2)
+        third = spawn(self.apis[13].invoke_by_pid, 'my.service', 'third', 12, timeout=2)
+
+        self.assertDictEqual(first.get()[1], {'pid': 12, 'payload': 'first'})
+        self.assertDictEqual(second.get()[1], {'pid': 12, 'payload': 'second'})
+        self.assertDictEqual(third.get()[1], {'pid': 12, 'payload': 'third'})
+
+# ################################################################################################################################
+
+class ReplyChannelTestCase(TestCase):
+    """ Tests how PUSH sockets to other processes' reply channels are cached.
+    """
+    def setUp(self):
+        self.name = 'test-{}'.format(new_cid())
+        self.channels = {}
+
+        # Replies are sent from 11 to the other three
+        for pid in (11, 12, 13, 14):
+            self.channels[pid] = ReplyChannel(self.name, pid, max_reply_sockets=2, reply_hwm=10)
+            spawn(self.channels[pid].serve_forever)
+
+        # Give the reply channels time to bind their sockets
+        sleep(0.1)
+
+    def tearDown(self):
+        for channel in self.channels.values():
+            channel.close()
+
+    def _send(self, pid):
+        address = self.channels[pid].address
+        result = self.channels[pid].expect('my.request')
+        self.channels[11].send(address, 'my.request', 'abc')
+
+        self.assertEquals(result.get(timeout=2), b'abc')
+
+# ################################################################################################################################
+
+    def test_sockets_reused(self):
+
+        self._send(12)
+        socket = self.channels[11].reply_sockets[self.channels[12].address]
+
+        self._send(12)
+        self.assertIs(self.channels[11].reply_sockets[self.channels[12].address], socket)
+
+    def test_least_recently_used_evicted(self):
+
+        self._send(12)
+        self._send(13)
+        self._send(12)
+        self._send(14)
+
+        reply_sockets = self.channels[11].reply_sockets
+        self.assertListEqual(list(reply_sockets), [self.channels[12].address, self.channels[14].address])
+        self.assertTrue(all(not socket.closed for socket in reply_sockets.values()))
+
+    def test_socket_closed_on_send_failure(self):
+
+        # Nothing is bound at this address so replies are queued up until the socket's high-water mark is reached
+        address = self.channels[11].get_address(self.name, 99)
+        self.channels[11].send(address, 'my.request', 'abc')
+        socket = self.channels[11].reply_sockets[address]
+
+        for idx in range(self.channels[11].reply_hwm):
+            self.channels[11].send(address, 'my.request', 'abc')
+
+        self.assertTrue(socket.closed)
+        self.assertDictEqual(self.channels[11].reply_sockets, {})
+
+# ################################################################################################################################
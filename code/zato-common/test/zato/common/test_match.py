@@ -9,6 +9,7 @@ Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 # stdlib
+import re
 from copy import deepcopy
 from unittest import TestCase
 
@@ -17,7 +18,7 @@ from bunch import Bunch
 
 # Zato
 from zato.common import FALSE_TRUE, TRUE_FALSE
-from zato.common.match import Matcher
+from zato.common.match import CombinedMatcher, Matcher
 
 default_config = Bunch({
     'order': FALSE_TRUE,
@@ -327,4 +328,64 @@ class MatcherTestCase(TestCase):
         m.is_allowed('aaa.zxc')
         self.assertEquals(m.is_allowed_cache, {})
 
+# ################################################################################################################################
+
+    def test_is_allowed_cache_is_bounded(self):
+
+        m = Matcher(cache_max_size=5)
+        m.read_config(default_config)
+
+        for idx in range(12):
+            m.is_allowed('abc.{}'.format(idx))
+            self.assertLessEqual(len(m.is_allowed_cache), 5)
+
+        self.assertIs(m.is_allowed('abc.11'), True)
+
+# ################################################################################################################################
+
+    def test_is_allowed_cache_reset_on_read_config(self):
+
+        m = Matcher()
+        m.read_config(default_config)
+        m.is_allowed('abc.qwe')
+        self.assertDictEqual(m.is_allowed_cache, {'abc.qwe':True})
+
+        m.read_config(Bunch({'order': TRUE_FALSE, 'abc.*': False}))
+        self.assertDictEqual(m.is_allowed_cache, {})
+
+# ################################################################################################################################
+
+class CombinedMatcherTestCase(TestCase):
+
+    def test_match(self):
+        compiled = [re.compile(pattern) for pattern in ('a(b)c', 'a.c', '(x)(y)(z)', 'ab')]
+        matcher = CombinedMatcher(compiled)
+
+        # Each time the first matching expression is found, as though each one was tried in turn
+        for value in ('abc', 'adc', 'xyz', 'abd', 'ab', 'zzz', ''):
+            expected = None
+            for idx, elem in enumerate(compiled):
+                if elem.match(value):
+                    expected = idx
+                    break
+
+            self.assertEquals(matcher.match(value), expected, value)
+
+# ################################################################################################################################
+
+    def test_many_expressions(self):
+        compiled = [re.compile('(item)\\.{}$'.format(idx)) for idx in range(250)]
+        compiled.append(re.compile('ITEM', re.IGNORECASE))
+
+        matcher = CombinedMatcher(compiled)
+
+        # Python 2 regular expressions may not have more than 100 groups, nor can they mix flags
+        self.assertEquals(len(matcher.combined), 7)
+
+        for idx in range(250):
+            self.assertEquals(matcher.match('item.{}'.format(idx)), idx)
+
+        self.assertEquals(matcher.match('item.250'), 250)
+        self.assertIsNone(CombinedMatcher([]).match('item.0'))
+
 # ################################################################################################################################
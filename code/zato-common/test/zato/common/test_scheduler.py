@@ -11,6 +11,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # stdlib
 import time
 from datetime import datetime, timedelta
+from heapq import heappop
 from random import choice, seed
 from unittest import TestCase
 
@@ -32,7 +33,7 @@ from mock import patch
 # Zato
 from zato.common import SCHEDULER
 from zato.common.test import is_like_cid, rand_bool, rand_date_utc, rand_int, rand_string
-from zato.scheduler.backend import Interval, Job, Scheduler
+from zato.scheduler.backend import Dispatcher, Interval, Job, Scheduler
 
 seed()
 
@@ -819,3 +820,159 @@ class SchedulerTestCase(TestCase):
 
         for idx, item in enumerate(data['runs']):
             self.assertEquals(data['ctx'][idx], item)
+
+class DispatcherTestCase(TestCase):
+
+    def get_job(self, name, start_time, interval_in_seconds=1, max_repeats=None):
+        return Job(rand_int(), name, SCHEDULER.JOB_TYPE.INTERVAL_BASED, Interval(in_seconds=interval_in_seconds),
+            start_time, clone_start_time=True, max_repeats=max_repeats)
+
+    def test_get_next_run_time_no_drift(self):
+        start_time = parse('2019-11-23 13:00:00')
+        job = self.get_job('a', start_time, 10)
+
+        # Next runs are computed from previous scheduled times no matter how late the job actually ran
+        self.assertEquals(job.get_next_run_time(start_time, parse('2019-11-23 13:00:00.9')), parse('2019-11-23 13:00:10'))
+        self.assertEquals(job.get_next_run_time(
+            parse('2019-11-23 13:00:10'), parse('2019-11-23 13:00:19.5')), parse('2019-11-23 13:00:20'))
+
+        # Runs that were missed altogether are skipped
+        self.assertEquals(job.get_next_run_time(start_time, parse('2019-11-23 13:00:35')), parse('2019-11-23 13:00:40'))
+        self.assertEquals(job.get_next_run_time(start_time, parse('2019-11-23 13:00:40')), parse('2019-11-23 13:00:50'))
+
+    def test_run_jobs_batched(self):
+
+        batches = []
+        dispatcher = Dispatcher(batches.append)
+
+        now = datetime.utcnow()
+        job1 = self.get_job('a', now, 10)
+        job2 = self.get_job('b', now, 20)
+        job3 = self.get_job('c', now + timedelta(seconds=5))
+
+        for job in job1, job2, job3:
+            dispatcher.add(job)
+
+        # Both of the jobs that are due run in a single batch, the third one does not run yet
+        dispatcher.run_jobs([heappop(dispatcher.heap)[::2], heappop(dispatcher.heap)[::2]], now)
+
+        self.assertEquals(len(batches), 1)
+        self.assertListEqual(sorted(ctx['name'] for ctx in batches[0]), ['a', 'b'])
+
+        # Their next runs were scheduled along with the third job's first one
+        self.assertListEqual(sorted((elem[0], elem[2].name) for elem in dispatcher.heap), [
+            (now + timedelta(seconds=5), 'c'),
+            (now + timedelta(seconds=10), 'a'),
+            (now + timedelta(seconds=20), 'b'),
+        ])
+
+    def test_max_repeats_and_unscheduled(self):
+
+        ctx_list = []
+        dispatcher = Dispatcher(ctx_list.extend)
+
+        job1 = self.get_job('a', datetime.utcnow(), 0.05, max_repeats=3)
+        job2 = self.get_job('b', datetime.utcnow(), 0.05)
+        job3 = self.get_job('c', datetime.utcnow(), 0.05)
+
+        for job in job1, job2, job3:
+            dispatcher.add(job)
+
+        greenlet = spawn(dispatcher.run)
+        sleep(0.12)
+
+        # The job was unscheduled and it will not run anymore
+        job3.keep_running = False
+        dispatcher.on_removed()
+
+        sleep(0.3)
+        dispatcher.keep_running = False
+        dispatcher.wake_up.set()
+        greenlet.join(1)
+
+        runs = {}
+        for ctx in ctx_list:
+            runs[ctx['name']] = runs.get(ctx['name'], 0) + 1
+
+        self.assertEquals(runs['a'], 3)
+        self.assertTrue(job1.max_repeats_reached)
+        self.assertGreaterEqual(runs['b'], 8)
+        self.assertEquals(runs['c'], 3)
+
+    def test_heap_compacted(self):
+
+        dispatcher = Dispatcher(None)
+        jobs = [self.get_job(str(idx), datetime.utcnow() + timedelta(seconds=10)) for idx in range(300)]
+
+        for job in jobs:
+            dispatcher.add(job)
+
+        for job in jobs[:200]:
+            job.keep_running = False
+            dispatcher.on_removed()
+
+        # The heap was compacted once more than half of it were unscheduled jobs
+        self.assertEquals(len(dispatcher.heap), 149)
+        self.assertEquals(len([elem for elem in dispatcher.heap if elem[2].keep_running]), 100)
+
+    def test_scheduler_with_dispatcher(self):
+
+        ctx_list = []
+
+        config = get_scheduler_config()
+        config.use_dispatcher = True
+        config.on_job_executed_cb = ctx_list.append
+
+        scheduler = Scheduler(config, None)
+        scheduler.iter_cb = iter_cb
+        scheduler.iter_cb_args = (scheduler, datetime.utcnow() + timedelta(seconds=0.5))
+
+        scheduler.create(self.get_job('a', datetime.utcnow(), 0.1), spawn=False)
+        scheduler.create(self.get_job('b', datetime.utcnow(), 0.1), spawn=False)
+        scheduler.run()
+
+        # There are no greenlets per job
+        self.assertDictEqual(scheduler.job_greenlets, {})
+        self.assertEquals(len(scheduler.dispatcher.heap), 2)
+        self.assertGreaterEqual(len([ctx for ctx in ctx_list if ctx['name'] == 'a']), 3)
+        self.assertGreaterEqual(len([ctx for ctx in ctx_list if ctx['name'] == 'b']), 3)
+
+        scheduler.dispatcher.keep_running = False
+        scheduler.dispatcher.wake_up.set()
+
+    def get_dispatcher_scheduler(self):
+        config = get_scheduler_config()
+        config.use_dispatcher = True
+
+        return Scheduler(config, None)
+
+    def get_running(self, scheduler):
+        return sorted((elem[2].name, elem[2].interval.in_seconds) for elem in scheduler.dispatcher.heap if elem[2].keep_running)
+
+    def test_scheduler_with_dispatcher_edit(self):
+
+        scheduler = self.get_dispatcher_scheduler()
+        start_time = datetime.utcnow() + timedelta(seconds=60)
+
+        scheduler.create(self.get_job('a', start_time, 5))
+
+        # Edits always create new instances of jobs, as the scheduler's API does it
+        scheduler.edit(self.get_job('a', start_time, 7))
+
+        # Only the new definition of the job will run
+        self.assertListEqual(self.get_running(scheduler), [('a', 7)])
+        self.assertEquals(scheduler.jobs['a'].interval.in_seconds, 7)
+
+    def test_scheduler_with_dispatcher_rename(self):
+
+        scheduler = self.get_dispatcher_scheduler()
+        start_time = datetime.utcnow() + timedelta(seconds=60)
+
+        scheduler.create(self.get_job('a', start_time, 5))
+
+        job = self.get_job('b', start_time, 5)
+        job.old_name = 'a'
+        scheduler.edit(job)
+
+        self.assertListEqual(self.get_running(scheduler), [('b', 5)])
+        self.assertListEqual(sorted(scheduler.jobs), ['b'])
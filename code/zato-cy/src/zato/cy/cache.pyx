@@ -16,10 +16,10 @@ from sys import getsizeof, maxint
 from cpython.dict cimport PyDict_Contains, PyDict_DelItem, PyDict_GetItem, PyDict_Items, PyDict_Keys, PyDict_SetItem, \
     PyDict_Values
 from cpython.int cimport PyInt_AS_LONG,  PyInt_FromLong, PyInt_GetMax
-from cpython.list cimport PyList_GET_SIZE, PyList_Insert, PyList_SetSlice
-from cpython.object cimport Py_EQ, PyObject, PyObject_RichCompareBool
-from cpython.sequence cimport PySequence_ITEM
+from cpython.mem cimport PyMem_Free, PyMem_Realloc
+from cpython.object cimport PyObject
 from libc.stdint cimport uint64_t
+from libc.string cimport memset
 from posix.time cimport timeval, timezone, gettimeofday
 
 # regex
@@ -48,6 +48,11 @@ class CACHE:
 
 # ################################################################################################################################
 
+# The smallest number of slots in Cache._stamp_tree
+cdef Py_ssize_t _min_stamp_capacity = 1024
+
+# ################################################################################################################################
+
 class KeyExpiredError(KeyError):
     """ Indicates that an operation would have succeeded had this key not expired before.
     """
@@ -87,6 +92,13 @@ cdef class Entry:
         # This entry's position in index
         public long position
 
+        # Neighbours of this entry in the LRU list - newer ones are closer to its head
+        Entry newer
+        Entry older
+
+        # When was this entry last used, relative to other entries - gives its position in the LRU list
+        Py_ssize_t stamp
+
     cpdef dict to_dict(self):
         return {
             'key': self.key,
@@ -106,6 +118,10 @@ cdef class Entry:
 cdef class Cache(object):
     """ An LRU cache that optionally rejects entries bigger than N bytes. Entries can have a TTL assigned - periodic processes
     will clean up entries older than allowed.
+
+    Entries are kept in a doubly linked list, from the most to the least recently used one, so that moving them around
+    or evicting them is O(1). Each time an entry is used, it receives a new stamp. A binary indexed tree of stamps
+    lets one find the position of an entry in the list in O(log n) without walking the list.
     """
     cdef:
         public long max_size
@@ -114,7 +130,11 @@ cdef class Cache(object):
         public bint extend_expiry_on_get
         public bint extend_expiry_on_set
         public dict _data
-        public list _index
+        Entry _head # The most recently used entry
+        Entry _tail # The least recently used one
+        Py_ssize_t *_stamp_tree # A binary indexed tree of stamps in use - _stamp_tree[stamp] is 1 if an entry holds it
+        Py_ssize_t _stamp_capacity
+        Py_ssize_t _next_stamp
         public uint64_t misses
         public uint64_t hits
         public uint64_t set_ops
@@ -127,7 +147,11 @@ cdef class Cache(object):
 
     def __cinit__(self):
         self._data = {}
-        self._index = []
+        self._head = None
+        self._tail = None
+        self._stamp_tree = NULL
+        self._stamp_capacity = 0
+        self._next_stamp = 1
         self.hits_per_position = {}
         self._expired_on_op = []
         self.hits = 0
@@ -136,6 +160,9 @@ cdef class Cache(object):
         self.get_ops = 0
         self._regex_cache = {}
 
+    def __dealloc__(self):
+        PyMem_Free(self._stamp_tree)
+
     def __init__(self, max_size=None, max_item_size=None, extend_expiry_on_get=True, extend_expiry_on_set=True, lock=None):
         self._lock = lock or RLock()
         self.default_get = object()
@@ -181,7 +208,7 @@ cdef class Cache(object):
 
     def __len__(self):
         with self._lock:
-            return PyList_GET_SIZE(self._index)
+            return len(self._data)
 
 # ################################################################################################################################
 
@@ -199,7 +226,7 @@ cdef class Cache(object):
 
     cpdef list keys_by_position(self):
         with self._lock:
-            return list(self._index)
+            return self._keys_by_position()
 
 # ################################################################################################################################
 
@@ -229,10 +256,11 @@ cdef class Cache(object):
 
     def get_slice(self, start, stop, step):
         with self._lock:
-            for key in self._index[start:stop:step]:
-                entry = self._data[key]
+            keys = self._keys_by_position()
+            for position in xrange(*slice(start, stop, step).indices(len(keys))):
+                entry = self._data[keys[position]]
                 as_dict = entry.to_dict()
-                as_dict['position'] = self._get_index(key)
+                as_dict['position'] = position
                 yield as_dict
 
 # ################################################################################################################################
@@ -241,10 +269,28 @@ cdef class Cache(object):
         """ Clears the cache - removes all entries and associated metadata.
         """
         # The attributes cleared below must be kept in sync with the ones from __cinit__.
+        cdef Entry entry
+        cdef Entry older
+
         with self._lock:
+
+            # Break references between entries so that they do not have to wait for the garbage collector
+            entry = self._head
+            while entry is not None:
+                older = entry.older
+                entry.newer = None
+                entry.older = None
+                entry = older
+
+            self._head = None
+            self._tail = None
+            self._next_stamp = 1
+            if self._stamp_tree is not NULL:
+                memset(self._stamp_tree, 0, (self._stamp_capacity + 1) * sizeof(Py_ssize_t))
+
             self._data.clear()
-            self._index[:] = []
-            self.hits_per_position.clear()
+            for key in self.hits_per_position:
+                self.hits_per_position[key] = 0
             self._expired_on_op[:] = []
             self.hits = 0
             self.misses = 0
@@ -254,11 +300,11 @@ cdef class Cache(object):
 # ################################################################################################################################
 
     cdef object _delete(self, object key):
-        cdef object out = self._data[key].value # raise Will KeyError on invalid key so _remove_from_index_by_idx is safe to call
+        cdef Entry entry = <Entry>self._data[key] # Will raise KeyError on invalid key so _unlink is safe to call
         del self._data[key]
-        self._remove_from_index_by_idx(self._get_index(key))
+        self._unlink(entry)
 
-        return out
+        return entry.value
 
 # ################################################################################################################################
 
@@ -484,38 +530,146 @@ cdef class Cache(object):
 
 # ################################################################################################################################
 
-    cdef inline long _get_index(self, object key):
-        """ C-only version of self.get_position that will always return a long - must be called only
-        if key is known to be in self._index or self._data and only with self._lock held.
+    cdef inline void _stamp_tree_add(self, Py_ssize_t stamp, Py_ssize_t value):
+        """ Adds value to a given stamp's slot in self._stamp_tree.
+        """
+        while stamp <= self._stamp_capacity:
+            self._stamp_tree[stamp] += value
+            stamp += stamp & -stamp
+
+# ################################################################################################################################
+
+    cdef inline Py_ssize_t _stamp_tree_sum(self, Py_ssize_t stamp):
+        """ Returns the number of entries whose stamps are not greater than the one given on input.
         """
-        cdef Py_ssize_t index_idx = 0
-        cdef Py_ssize_t cache_size = PyList_GET_SIZE(self._index)
-        cdef bint index_key_eq
+        cdef Py_ssize_t out = 0
 
-        while index_idx < cache_size:
-            if PyObject_RichCompareBool(PySequence_ITEM(self._index, index_idx), <object>key, Py_EQ):
-                return index_idx
-            index_idx += 1
+        while stamp > 0:
+            out += self._stamp_tree[stamp]
+            stamp -= stamp & -stamp
+
+        return out
 
 # ################################################################################################################################
 
-    cpdef object index(self, object key):
-        """ Returns position the key given on input currently holds or None if key is not found.
+    cdef _renumber_stamps(self):
+        """ Assigns consecutive stamps to all entries, starting from the least recently used one, and rebuilds
+        self._stamp_tree accordingly. Called when there are no more free stamps - since there is room for at least twice
+        as many stamps as there are entries, the cost of it is amortized over many subsequent operations.
         """
-        with self._lock:
-            if PyDict_Contains(self._data, key):
-                return self._get_index(key)
+        cdef Entry entry = self._tail
+        cdef Py_ssize_t capacity = max(2 * len(self._data), _min_stamp_capacity)
+        cdef Py_ssize_t *stamp_tree
+        cdef Py_ssize_t stamp = 0
+        cdef Py_ssize_t parent
+
+        if capacity != self._stamp_capacity:
+            stamp_tree = <Py_ssize_t *>PyMem_Realloc(self._stamp_tree, (capacity + 1) * sizeof(Py_ssize_t))
+            if stamp_tree is NULL:
+                raise MemoryError()
+            self._stamp_tree = stamp_tree
+            self._stamp_capacity = capacity
+
+        memset(self._stamp_tree, 0, (self._stamp_capacity + 1) * sizeof(Py_ssize_t))
+
+        while entry is not None:
+            stamp += 1
+            entry.stamp = stamp
+            self._stamp_tree[stamp] += 1
+
+            # Each slot covers a range of stamps that is part of a bigger range its parent covers
+            parent = stamp + (stamp & -stamp)
+            if parent <= self._stamp_capacity:
+                self._stamp_tree[parent] += self._stamp_tree[stamp]
+
+            entry = entry.newer
+
+        # Propagate the rest of values up the tree, i.e. for slots beyond the last stamp assigned
+        parent = stamp + 1
+        while parent <= self._stamp_capacity:
+            if self._stamp_tree[parent] and parent + (parent & -parent) <= self._stamp_capacity:
+                self._stamp_tree[parent + (parent & -parent)] += self._stamp_tree[parent]
+            parent += 1
+
+        self._next_stamp = stamp + 1
 
 # ################################################################################################################################
 
-    cdef inline object _remove_from_index_by_idx(self, long idx):
-        """ Remove object from from index by its position - this is what listremove in Objects/listobject.c does
-        and we use the same technique because there is no public PyList_Remove function. Returns the removed key.
+    cdef inline _push_head(self, Entry entry):
+        """ Makes entry the most recently used one. It must not be in the LRU list at the time of the call.
         """
-        cdef object index_key = PySequence_ITEM(self._index, idx)
-        PyList_SetSlice(self._index, idx, idx+1, <object>NULL)
+        entry.newer = None
+        entry.older = self._head
 
-        return index_key
+        if self._head is not None:
+            self._head.newer = entry
+        else:
+            self._tail = entry
+
+        self._head = entry
+
+        if self._next_stamp > self._stamp_capacity:
+            self._renumber_stamps()
+
+        # Renumbering may have assigned a stamp to this entry already
+        if entry.stamp:
+            self._stamp_tree_add(entry.stamp, -1)
+
+        entry.stamp = self._next_stamp
+        self._stamp_tree_add(entry.stamp, 1)
+        self._next_stamp += 1
+
+# ################################################################################################################################
+
+    cdef inline void _unlink(self, Entry entry):
+        """ Removes entry from the LRU list.
+        """
+        if entry.newer is not None:
+            entry.newer.older = entry.older
+        else:
+            self._head = entry.older
+
+        if entry.older is not None:
+            entry.older.newer = entry.newer
+        else:
+            self._tail = entry.newer
+
+        entry.newer = None
+        entry.older = None
+
+        self._stamp_tree_add(entry.stamp, -1)
+        entry.stamp = 0
+
+# ################################################################################################################################
+
+    cdef inline long _get_position(self, Entry entry):
+        """ Returns position of an entry in the LRU list, i.e. the number of entries used more recently than this one.
+        Must be called only for entries that are in the list and only with self._lock held.
+        """
+        return len(self._data) - self._stamp_tree_sum(entry.stamp)
+
+# ################################################################################################################################
+
+    cdef list _keys_by_position(self):
+        """ Returns all keys, starting from the most recently used one. Must be called only with self._lock held.
+        """
+        cdef list out = []
+        cdef Entry entry = self._head
+
+        while entry is not None:
+            out.append(entry.key)
+            entry = entry.older
+
+        return out
+
+# ################################################################################################################################
+
+    cpdef object index(self, object key):
+        """ Returns position the key given on input currently holds or None if key is not found.
+        """
+        with self._lock:
+            if PyDict_Contains(self._data, key):
+                return self._get_position(<Entry>self._data[key])
 
 # ################################################################################################################################
 
@@ -541,10 +695,6 @@ cdef class Cache(object):
         cdef object out = None
         cdef Entry entry
         cdef double _now = self._get_timestamp()
-        cdef Py_ssize_t cache_size = PyList_GET_SIZE(self._index)
-        cdef Py_ssize_t index_idx
-        cdef bint old_key_eq
-        cdef long hits_per_position
         cdef long len_value
 
         if not isinstance(key, _key_types):
@@ -595,8 +745,10 @@ cdef class Cache(object):
         else:
 
             # Make sure there is room for the new key
-            if cache_size == self.max_size:
-                PyDict_DelItem(self._data, self._index.pop())
+            while len(self._data) >= self.max_size:
+                entry = self._tail
+                PyDict_DelItem(self._data, entry.key)
+                self._unlink(entry)
 
             # Actually insert entry
             entry = Entry()
@@ -611,7 +763,7 @@ cdef class Cache(object):
             entry.expires_at = 0.0 if not expiry else _now + expiry
 
             PyDict_SetItem(self._data, key, entry)
-            PyList_Insert(self._index, 0, key)
+            self._push_head(entry)
 
         # If any output dict for metadata was passed in by reference, set its requires items.
         if meta_ref is not None:
@@ -818,9 +970,8 @@ cdef class Cache(object):
         """
         cdef object _item
         cdef Entry entry
-        cdef Py_ssize_t index_idx
-        cdef Py_ssize_t cache_size
-        cdef object index_key
+        cdef long index_idx
+        cdef long hits_per_position
         cdef double _now = self._get_timestamp()
 
         try:
@@ -849,7 +1000,7 @@ cdef class Cache(object):
             self.hits += 1
 
             # Current position of that key in index
-            index_idx = self._get_index(key)
+            index_idx = self._get_position(entry)
 
             # We have the key's position so we can now update per-position counter
             # to be able to offer statistics on how often a key is found at a given position.
@@ -857,11 +1008,10 @@ cdef class Cache(object):
             hits_per_position += 1
             PyDict_SetItem(self.hits_per_position, index_idx, PyInt_FromLong(hits_per_position))
 
-            # Remove key from index
-            index_key = self._remove_from_index_by_idx(index_idx)
-
-            # Now insert the key back at the head position.
-            PyList_Insert(self._index, 0, index_key)
+            # Move the entry to the head position, unless it is already there.
+            if entry is not self._head:
+                self._unlink(entry)
+                self._push_head(entry)
 
             # Update last/prev access information + hits
             entry.prev_read = entry.last_read
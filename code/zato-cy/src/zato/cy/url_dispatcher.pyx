@@ -35,6 +35,18 @@ target_separator = ':::'
 
 _internal_url_path_indicator = '{}/zato/'.format(target_separator)
 
+# Dynamic elements of URL paths, e.g. {cid} in /customer/{cid}
+_brace_pattern = re_compile('\{[a-zA-Z0-9 _\$.\-|=~^\/]+\}')
+
+# Characters that make a segment of a match target something other than a literal string
+_regex_special = frozenset('.^$*+?{}[]\\|()')
+
+# If any of these is found in a pattern, its literal prefix cannot be trusted, e.g. because of top-level alternatives
+_regex_prefix_breakers = frozenset('|()')
+
+# Quantifiers that may apply to the path separator preceding a segment
+_regex_quantifiers = frozenset('*+?{')
+
 # ################################################################################################################################
 
 cdef class Matcher(object):
@@ -56,7 +68,7 @@ cdef class Matcher(object):
         self.pattern = pattern
         self.matcher = None
         self.is_static = True
-        self._brace_pattern = re_compile('\{[a-zA-Z0-9 _\$.\-|=~^\/]+\}')
+        self._brace_pattern = _brace_pattern
         self._elem_re_template = r'(?P<{}>[a-zA-Z0-9 _\$.\-|=~^\/]+)'
         self._set_up_matcher(self.pattern)
 
@@ -99,11 +111,193 @@ cdef class Matcher(object):
 
 # ################################################################################################################################
 
+cdef class _RouterNode(object):
+    """ A single node of a URLRouter - keyed by one path segment of a match target.
+    """
+    cdef:
+        public dict children
+        public list exact
+        public list prefix
+
+    def __init__(self):
+        self.children = {}
+        self.exact = []
+        self.prefix = []
+
+# ################################################################################################################################
+
+cdef class URLRouter(object):
+    """ A segment-based radix tree of HTTP channels. Each channel is stored under the longest sequence of literal segments
+    of its match target - fully literal targets are kept as exact matches of the node they end at while those
+    with dynamic elements, e.g. '/customer/{cid}', are kept as prefix candidates of the node their literal part ends at.
+    Looking up a target returns only candidates whose literal prefix matches it, in the order of channel_data,
+    which makes finding them proportional to the depth of the path rather than to the number of channels.
+    Candidates are still confirmed by each channel's Matcher so that the first-match-wins semantics are kept.
+    """
+    cdef:
+        _RouterNode root
+        dict order
+        public int size
+
+    def __init__(self):
+        self.root = _RouterNode()
+        self.order = {}
+        self.size = 0
+
+# ################################################################################################################################
+
+    cdef tuple _get_path(self, unicode pattern):
+        """ Returns a list of literal segments under which a channel of the given pattern is to be stored
+        and a flag indicating if the whole pattern is made of literal segments only.
+        """
+        cdef list segments = pattern.split('/')
+        cdef list path = []
+        cdef unicode segment
+
+        # Alternatives and groups may make anything before them optional so there is no literal prefix at all
+        for char in pattern:
+            if char in _regex_prefix_breakers:
+                return [], False
+
+        for segment in segments:
+            for char in segment:
+                if char in _regex_special:
+                    break
+            else:
+                path.append(segment)
+                continue
+
+            # This segment is not a literal one. If it starts with something that may be a quantifier,
+            # it may apply to the separator preceding it, in which case the previous segment cannot be used either.
+            if path and segment[0] in _regex_quantifiers:
+                if not (segment[0] == '{' and _brace_pattern.match(segment)):
+                    path.pop()
+
+            return path, False
+
+        return path, True
+
+# ################################################################################################################################
+
+    cpdef add(self, object item):
+        """ Adds a channel to the tree.
+        """
+        cdef _RouterNode node = self.root
+        cdef _RouterNode child
+        cdef list path
+        cdef bint is_literal
+        cdef unicode segment
+        cdef object pattern = item.get('match_target')
+
+        self.size += 1
+
+        # Nothing to match against
+        if pattern is None:
+            return
+
+        path, is_literal = self._get_path(pattern)
+
+        for segment in path:
+            child = node.children.get(segment)
+            if child is None:
+                child = _RouterNode()
+                node.children[segment] = child
+            node = child
+
+        if is_literal:
+            node.exact.append(item)
+        else:
+            node.prefix.append(item)
+
+# ################################################################################################################################
+
+    cpdef remove(self, object item):
+        """ Removes a channel from the tree, including any nodes that are no longer needed.
+        """
+        cdef _RouterNode node = self.root
+        cdef list path
+        cdef list nodes = []
+        cdef list items
+        cdef bint is_literal
+        cdef unicode segment
+        cdef Py_ssize_t idx
+        cdef object pattern = item.get('match_target')
+
+        if pattern is None:
+            self.size -= 1
+            return
+
+        path, is_literal = self._get_path(pattern)
+
+        for segment in path:
+            nodes.append((node, segment))
+            node = node.children.get(segment)
+            if node is None:
+                return
+
+        items = node.exact if is_literal else node.prefix
+        for idx in range(len(items)):
+            if items[idx] is item:
+                del items[idx]
+                self.size -= 1
+                break
+        else:
+            return
+
+        # Prune all the nodes that became empty, starting from the deepest one
+        while nodes and not (node.children or node.exact or node.prefix):
+            node, segment = nodes.pop()
+            del node.children[segment]
+
+# ################################################################################################################################
+
+    cpdef set_order(self, object channel_data):
+        """ Stores the position of each channel in channel_data - a channel earlier in the list always wins
+        over one that is further away if both match the same target.
+        """
+        cdef Py_ssize_t idx
+
+        self.order = {}
+        for idx, item in enumerate(channel_data):
+            self.order[id(item)] = idx
+
+# ################################################################################################################################
+
+    cpdef list get_candidates(self, unicode target):
+        """ Returns all channels that may possibly match the target given, in the order of channel_data.
+        """
+        cdef _RouterNode node = self.root
+        cdef list candidates = []
+        cdef unicode segment
+        cdef dict order = self.order
+
+        if node.prefix:
+            candidates.extend(node.prefix)
+
+        for segment in target.split('/'):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.prefix:
+                candidates.extend(node.prefix)
+        else:
+            if node.exact:
+                candidates.extend(node.exact)
+
+        if len(candidates) > 1:
+            candidates = [elem[2] for elem in sorted(
+                [(order.get(id(item), -1), idx, item) for idx, item in enumerate(candidates)])]
+
+        return candidates
+
+# ################################################################################################################################
+
 cdef class CyURLData(object):
 
     cdef:
         public list channel_data
         public dict url_path_cache
+        public URLRouter router
         dict url_target_cache
         bint has_trace1
 
@@ -112,6 +306,19 @@ cdef class CyURLData(object):
         self.url_path_cache = {}
         self.url_target_cache = {}
         self.has_trace1 = logger.isEnabledFor(TRACE1)
+        self.rebuild_router()
+
+# ################################################################################################################################
+
+    cpdef rebuild_router(self):
+        """ Builds the URL router from scratch out of all the channels currently in channel_data.
+        """
+        self.router = URLRouter()
+
+        for item in (self.channel_data or []):
+            self.router.add(item)
+
+        self.router.set_order(self.channel_data or [])
 
 # ################################################################################################################################
 
@@ -123,6 +330,7 @@ cdef class CyURLData(object):
         cdef bint needs_user, has_target_in_cache=True
         cdef Matcher matcher
         cdef dict item
+        cdef list candidates
         cdef object item_bunch
         cdef unicode target
         cdef unicode target_cache_key = (url_path + soap_action) if has_soap_action else url_path
@@ -139,7 +347,13 @@ cdef class CyURLData(object):
         except KeyError:
             needs_user = not url_path.startswith('/zato')
 
-            for item in self.channel_data:
+            # Channels may have been added to channel_data directly rather than through the router
+            if self.router.size != len(self.channel_data):
+                self.rebuild_router()
+
+            candidates = self.router.get_candidates(target)
+
+            for item in candidates:
                 matcher = item['match_target_compiled']
                 if needs_user and matcher.is_internal:
                     continue
@@ -165,16 +379,17 @@ cdef class CyURLData(object):
 
 # ################################################################################################################################
 
-    def get_item(self, url_path, soap_action):
+    def get_item(self, url_path, soap_action, is_internal=True):
         match_target = '{}{}{}'.format(soap_action, target_separator, url_path)
         item = {}
         item['name'] = url_path[1:].replace('/', '.') + ('soap' if soap_action else '')
+        item['is_internal'] = is_internal
         item['match_target'] = match_target
         item['match_target_compiled'] = Matcher(item['match_target'])
 
         return item
 
-    def set_up_test_data(self):
+    def set_up_test_data(self, user_channels=0):
 
         channel_data = []
 
@@ -189,25 +404,46 @@ cdef class CyURLData(object):
                 url_path = '/zato/{}/{}'.format(prefix, str(uuid4()).replace('-', '/'))
                 channel_data.append(self.get_item(url_path, soap_action))
 
-        self.channel_data = tuple(sorted(channel_data, key=itemgetter('name')))
+        # User channels - every other one has a dynamic element in its path
+        for idx in xrange(user_channels):
+            if idx % 2:
+                url_path = '/api/v1/customer-{}/{{cid}}/order/{{oid}}'.format(idx)
+            else:
+                url_path = '/api/v1/product-{}/details'.format(idx)
+            channel_data.append(self.get_item(url_path, '', False))
 
-# ################################################################################################################################
+        user_data = sorted((item for item in channel_data if not item['is_internal']), key=itemgetter('name'))
+        internal_data = sorted((item for item in channel_data if item['is_internal']), key=itemgetter('name'))
 
-def run():
+        self.channel_data = user_data + internal_data
+        self.rebuild_router()
 
-    url_data = CyURLData()
-    url_data.set_up_test_data()
+# ################################################################################################################################
 
-    #print(url_data.channel_data)
+def _run_match(url_data, url_path, iters):
 
-    iters = 100000
     start = datetime.utcnow()
 
     for x in xrange(iters):
-        url_data.match('/zato/ping', '', False)
+        url_data.match(url_path, '', False)
+
+    return datetime.utcnow() - start
+
+def run(user_channels=10000, iters=100000):
+
+    url_data = CyURLData()
+    url_data.set_up_test_data(user_channels)
+
+    print('Channels: {}, iterations: {}'.format(len(url_data.channel_data), iters))
 
-    print(datetime.utcnow() - start)
+    # Static URL paths are served from url_path_cache after the first match
+    print('Static, internal:', _run_match(url_data, '/zato/ping', iters))
+    print('Static, user:    ', _run_match(url_data, '/api/v1/product-{}/details'.format(user_channels - 2), iters))
+
+    # Dynamic ones are always resolved through the router
+    print('Dynamic, first:  ', _run_match(url_data, '/api/v1/customer-1/123/order/456', iters))
+    print('Dynamic, last:   ', _run_match(url_data, '/api/v1/customer-{}/123/order/456'.format(user_channels - 1), iters))
+    print('No match:        ', _run_match(url_data, '/api/v1/customer-{}/123'.format(user_channels), iters))
 
 if __name__ == '__main__':
     run()
-
@@ -8,6 +8,7 @@ Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 
 # stdlib
 import sys
+from datetime import datetime
 from decimal import Decimal
 from time import sleep
 from unittest import TestCase
@@ -480,4 +481,121 @@ class CacheTestCace(TestCase):
         returned1 = c.get(key1, None, False)
         self.assertIs(returned1, expected1)
 
+# ################################################################################################################################
+
+    def test_lru_order_after_many_operations(self):
+
+        max_size = 100
+        c = Cache(max_size)
+
+        for idx in xrange(max_size * 50):
+            c.set('key{}'.format(idx % (max_size * 2)), idx, 0.0, None)
+            c.get('key{}'.format((idx * 7) % (max_size * 2)), None, False)
+
+        keys = c.keys_by_position()
+        self.assertEquals(len(keys), max_size)
+
+        for position, key in enumerate(keys):
+            self.assertEquals(c.index(key), position)
+
+        c.delete(keys[0])
+        self.assertEquals(c.index(keys[1]), 0)
+        self.assertEquals(c.keys_by_position(), keys[1:])
+
+# ################################################################################################################################
+
+    def test_eviction_order(self):
+
+        c = Cache(5)
+
+        for idx in xrange(5):
+            c.set('key{}'.format(idx), idx, 0.0, None)
+
+        # Both become the most recently used ones
+        c.get('key0', None, False)
+        c.get('key2', None, False)
+
+        self.assertEquals(c.keys_by_position(), ['key2', 'key0', 'key4', 'key3', 'key1'])
+
+        # The least recently used entries are evicted first, in order
+        c.set('new0', 'new0', 0.0, None)
+        self.assertNotIn('key1', c)
+
+        c.set('new1', 'new1', 0.0, None)
+        self.assertNotIn('key3', c)
+
+        self.assertEquals(c.keys_by_position(), ['new1', 'new0', 'key2', 'key0', 'key4'])
+
+# ################################################################################################################################
+
+    def test_stamps_consistent_after_renumbering(self):
+
+        max_size = 10
+        c = Cache(max_size)
+
+        for idx in xrange(max_size):
+            c.set('key{}'.format(idx), idx, 0.0, None)
+
+        # Each use of an entry consumes a stamp so this goes through all the stamps available many times over,
+        # with entries deleted and added in between.
+        for idx in xrange(5000):
+            key = 'key{}'.format((idx * 3) % max_size)
+            c.get(key, None, False)
+
+            if idx % 997 == 0:
+                c.delete(key)
+                c.set(key, idx, 0.0, None)
+
+            if idx % 499 == 0:
+                keys = c.keys_by_position()
+                self.assertEquals(keys[0], key)
+                for position, position_key in enumerate(keys):
+                    self.assertEquals(c.index(position_key), position)
+
+        keys = c.keys_by_position()
+        self.assertEquals(len(keys), max_size)
+
+        for position, key in enumerate(keys):
+            self.assertEquals(c.index(key), position)
+
+# ################################################################################################################################
+
+class CachePerfTestCase(TestCase):
+    """ Shows how long operations on entries take depending on how many entries there are in cache. Nothing is asserted
+    because timings depend on the machine, but they should be comparable for all the sizes.
+    """
+    def _check_perf(self, size, iters):
+
+        c = Cache(size)
+
+        start = datetime.utcnow()
+
+        for idx in xrange(size):
+            c.set(idx, idx, 0.0, None)
+
+        set_time = datetime.utcnow() - start
+        start = datetime.utcnow()
+
+        # Always get the least recently used key, i.e. the one at the very end of the LRU list
+        for idx in xrange(iters):
+            c.get(idx % size, None, False)
+
+        get_time = datetime.utcnow() - start
+        start = datetime.utcnow()
+
+        # Each of the new keys means that an existing one needs to be evicted
+        for idx in xrange(iters):
+            c.set(size + idx, idx, 0.0, None)
+
+        evict_time = datetime.utcnow() - start
+
+        print('Cache size:{}, set:{}, get x{}:{}, set+evict x{}:{}'.format(size, set_time, iters, get_time, iters, evict_time))
+
+    def test_perf(self):
+
+        iters = 100000
+
+        for size in (1000, 100000, 1000000):
+            self._check_perf(size, iters)
+
 # ################################################################################################################################
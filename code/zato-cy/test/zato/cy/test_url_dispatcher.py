@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# Zato
+from zato.url_dispatcher import CyURLData, Matcher, target_separator
+
+# ################################################################################################################################
+
+def get_item(name, url_path, soap_action=''):
+    match_target = '{}{}{}'.format(soap_action, target_separator, url_path)
+    return {
+        'name': name,
+        'match_target': match_target,
+        'match_target_compiled': Matcher(match_target),
+    }
+
+# ################################################################################################################################
+
+class URLRouterTestCase(TestCase):
+
+    def test_match_static_and_dynamic(self):
+
+        item1 = get_item('name-1', '/customer/{cid}/order/{oid}')
+        item2 = get_item('name-2', '/customer/list')
+        item3 = get_item('name-3', '/customer/list', 'my.soap.action')
+
+        url_data = CyURLData([item1, item2, item3])
+
+        match, info = url_data.match('/customer/123/order/456', '', False)
+        self.assertDictEqual(match, {'cid': '123', 'oid': '456'})
+        self.assertEquals(info.name, 'name-1')
+
+        match, info = url_data.match('/customer/list', '', False)
+        self.assertDictEqual(match, {})
+        self.assertEquals(info.name, 'name-2')
+
+        match, info = url_data.match('/customer/list', 'my.soap.action', True)
+        self.assertDictEqual(match, {})
+        self.assertEquals(info.name, 'name-3')
+
+        match, info = url_data.match('/customer', '', False)
+        self.assertIsNone(match)
+        self.assertIsNone(info)
+
+# ################################################################################################################################
+
+    def test_match_first_wins(self):
+
+        # Dynamic elements may span more than one segment of a path so the first item matches both URL paths below
+        item1 = get_item('name-1', '/customer/{cid}')
+        item2 = get_item('name-2', '/customer/{cid}/order/{oid}')
+
+        url_data = CyURLData([item1, item2])
+
+        match, info = url_data.match('/customer/123/order/456', '', False)
+        self.assertDictEqual(match, {'cid': '123/order/456'})
+        self.assertEquals(info.name, 'name-1')
+
+        url_data = CyURLData([item2, item1])
+
+        match, info = url_data.match('/customer/123/order/456', '', False)
+        self.assertDictEqual(match, {'cid': '123', 'oid': '456'})
+        self.assertEquals(info.name, 'name-2')
+
+# ################################################################################################################################
+
+    def test_match_regex_characters(self):
+
+        # A dot is matched as a regex character, not a literal one, which is why both URL paths match
+        item1 = get_item('name-1', '/api/v1.0/customer')
+
+        url_data = CyURLData([item1])
+
+        _, info = url_data.match('/api/v1.0/customer', '', False)
+        self.assertEquals(info.name, 'name-1')
+
+        _, info = url_data.match('/api/v1_0/customer', '', False)
+        self.assertEquals(info.name, 'name-1')
+
+# ################################################################################################################################
+
+    def test_router_add_remove(self):
+
+        item1 = get_item('name-1', '/customer/{cid}')
+        item2 = get_item('name-2', '/customer/{cid}/order/{oid}')
+
+        url_data = CyURLData([item1])
+        self.assertEquals(url_data.router.size, 1)
+
+        url_data.channel_data.insert(0, item2)
+        url_data.router.add(item2)
+        url_data.router.set_order(url_data.channel_data)
+        self.assertEquals(url_data.router.size, 2)
+
+        _, info = url_data.match('/customer/123/order/456', '', False)
+        self.assertEquals(info.name, 'name-2')
+
+        url_data.channel_data.remove(item2)
+        url_data.router.remove(item2)
+        url_data.router.set_order(url_data.channel_data)
+        self.assertEquals(url_data.router.size, 1)
+
+        _, info = url_data.match('/customer/123/order/456', '', False)
+        self.assertEquals(info.name, 'name-1')
+
+        url_data.channel_data.remove(item1)
+        url_data.router.remove(item1)
+        self.assertEquals(url_data.router.size, 0)
+        self.assertListEqual(url_data.router.get_candidates('{}/customer/123'.format(target_separator)), [])
+
+# ################################################################################################################################
+
+    def test_router_channel_data_changed_directly(self):
+
+        url_data = CyURLData([])
+        url_data.channel_data.append(get_item('name-1', '/customer/{cid}'))
+
+        _, info = url_data.match('/customer/123', '', False)
+        self.assertEquals(info.name, 'name-1')
+
+# ################################################################################################################################
@@ -11,21 +11,28 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # stdlib
 import logging
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 from errno import ENOENT
 from hashlib import sha256
+from heapq import heapify, heappop, heappush
+from itertools import count
 from pwd import getpwuid
+from random import uniform
 from tempfile import gettempdir
 from threading import current_thread
+from time import time
+from traceback import format_exc
 
 # gevent
 from gevent import sleep, spawn
+from gevent.event import Event
 
 # portalocker
 from portalocker import lock, LockException, LOCK_NB, LOCK_EX, unlock
 
 # SQLAlchemy
 from sqlalchemy import func
+from sqlalchemy.exc import DBAPIError
 
 # Zato
 from zato.common.util import make_repr
@@ -46,6 +53,9 @@ class DEFAULT:
     BLOCK = 10
     BLOCK_INTERVAL = 1
 
+class BACKOFF:
+    START = 0.005 # In seconds, how long to wait before the first retry if a lock is held by another process
+
 class LOCK_TYPE:
     PERMANENT = 'permanent'
     TRANSIENT = 'transient'
@@ -83,11 +93,73 @@ class LockInfo(object):
 
 # ################################################################################################################################
 
+class TTLReaper(object):
+    """ Releases permanent locks whose TTL passed. A single greenlet serves all the locks of a LockManager,
+    sleeping until the earliest of their expiration times, which are kept in a heap.
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = count()
+        self.wake_up = Event()
+        self.greenlet = None
+
+        # How many locks in the heap have not been released yet
+        self.len_held = 0
+
+    def add(self, lock, _time=time):
+        heappush(self.heap, (_time() + lock.ttl, next(self.counter), lock))
+        self.len_held += 1
+
+        if not self.greenlet:
+            self.greenlet = spawn(self.run)
+
+        # The new lock expires before all the other ones so the greenlet needs to sleep for a shorter time now
+        elif self.heap[0][2] is lock:
+            self.wake_up.set()
+
+    def on_released(self):
+
+        # Released locks are removed from the heap only when they reach its top, unless too many of them accumulated
+        self.len_held -= 1
+
+        if len(self.heap) > self.len_held * 2 + 100:
+            self.heap = [elem for elem in self.heap if not elem[2].released]
+            heapify(self.heap)
+
+    def run(self, _time=time):
+        while self.heap:
+            expires_at, _, lock = self.heap[0]
+
+            if lock.released:
+                heappop(self.heap)
+                continue
+
+            timeout = expires_at - _time()
+
+            if timeout > 0:
+                self.wake_up.clear()
+                self.wake_up.wait(timeout)
+                continue
+
+            heappop(self.heap)
+
+            try:
+                lock.release()
+            except Exception:
+                logger.warn('Could not release lock `%s` `%s` after its TTL, e:`%s`', lock.namespace, lock.name, format_exc())
+
+        self.greenlet = None
+
+# ################################################################################################################################
+
 class Lock(object):
     """ Base class for all backend-specific locks.
     """
-    def __init__(self, os_user_name, session, namespace, name, ttl, block, block_interval, _permanent=LOCK_TYPE.PERMANENT,
-            _transient=LOCK_TYPE.TRANSIENT):
+    def __init__(self, os_user_name, session, namespace, name, ttl, block, block_interval, manager=None,
+            _permanent=LOCK_TYPE.PERMANENT, _transient=LOCK_TYPE.TRANSIENT):
+
+        # May be None if the lock is created directly rather than by a LockManager
+        self.manager = manager
         self.os_user_name = os_user_name
         self.session = session() if session else None
         self.namespace = namespace
@@ -128,28 +200,19 @@ class Lock(object):
 
 # ################################################################################################################################
 
-    def _acquire(self, _utcnow=datetime.utcnow, _has_debug=has_debug):
+    def _acquire(self, _has_debug=has_debug):
         """ Try to acquire a lock by its ID. If not possible and block is not False
-        sleep for that many seconds as block points to.
+        wait for at most that many seconds as block points to.
         """
         acquired = self._acquire_impl()
 
         # Ok, we do not have the lock. If configured to, let's wait until we can obtain one or we time out.
 
         _block = self.block
-        _block_interval = self.block_interval
 
         if _block and not acquired:
 
-            now = _utcnow()
-            until = now + timedelta(seconds=_block)
-
-            while now < until:
-                sleep(_block_interval)
-                acquired = self._acquire_impl()
-                if acquired:
-                    break
-                now = _utcnow()
+            acquired = self._acquire_blocking(_block)
 
             if not acquired:
                 msg = 'Could not obtain lock for `{}` `{}` within {}s'.format(self.namespace, self.name, _block)
@@ -163,28 +226,53 @@ class Lock(object):
 
 # ################################################################################################################################
 
-    def _wait_in_greenlet(self, _utcnow=datetime.utcnow, _timedelta=timedelta):
-        """ Sleeps until self.ttl is reached or until the lock is released and then releases the lock if it is still held.
+    def _acquire_blocking(self, block, _time=time, _uniform=uniform):
+        """ Waits for the lock for up to block seconds. If it is released in this process, we are woken up
+        right away. Otherwise, it may be held by another process, so we retry with exponential backoff and jitter,
+        up to block_interval seconds between attempts.
         """
-        now = _utcnow()
-        until = now + _timedelta(seconds=self.ttl)
+        until = _time() + block
+        max_delay = max(self.block_interval, BACKOFF.START)
+        delay = BACKOFF.START
+
+        while True:
+            remaining = until - _time()
+            if remaining <= 0:
+                return False
 
-        while now < until:
-            if self.released:
-                break
-            now = _utcnow()
-            sleep(0.1)
+            wait_time = min(_uniform(delay / 2, delay), remaining)
+
+            # Without a manager there is no one to wake us up when the lock is released in this process
+            if self.manager:
+                self.manager.wait_for_release(self.priv_id, wait_time)
+            else:
+                sleep(wait_time)
 
-        if not self.released:
-            self.release()
+            if self._acquire_impl():
+                return True
+
+            delay = min(delay * 2, max_delay)
 
 # ################################################################################################################################
 
     def _sustain(self):
-        """ Spawns a greenlet that will sustain the lock for at least self.ttl,
-        possibly less if self.__exit__ is called earlier.
+        """ Lets the manager's reaper know that the lock is to be sustained for at least self.ttl,
+        possibly less if self.__exit__ is called earlier. A lock without a manager gets a reaper of its own.
         """
-        spawn(self._wait_in_greenlet)
+        reaper = self.manager.reaper if self.manager else TTLReaper()
+        reaper.add(self)
+
+# ################################################################################################################################
+
+    def _on_released(self, _permanent=LOCK_TYPE.PERMANENT):
+        """ Notifies the manager that a lock, acquired by us earlier, has just been released.
+        """
+        self.released = True
+
+        if self.manager:
+            if self.lock_type == _permanent:
+                self.manager.reaper.on_released()
+            self.manager.notify_released(self.priv_id)
 
 # ################################################################################################################################
 
@@ -203,7 +291,7 @@ class SQLLock(Lock):
         if self.acquired and not self.released:
 
             self.session.execute(self._release_func(self.priv_id))
-            self.released = True
+            self._on_released()
 
             if _has_debug:
                 logger.debug('Released %s', self.priv_id)
@@ -221,8 +309,30 @@ class MySQLLock(SQLLock):
     _acquire_func = func.get_lock
     _release_func = func.release_lock
 
-    def _acquire_impl(self):
-        return self.session.execute(self._acquire_func(self.priv_id, 0)).scalar()
+    def _acquire_impl(self, timeout=0):
+        return self.session.execute(self._acquire_func(self.priv_id, timeout)).scalar()
+
+    def _acquire_blocking(self, block):
+        """ MySQL itself can wait for a lock to be released so there is no need to poll for it.
+        """
+        return self._acquire_impl(block)
+
+# ################################################################################################################################
+
+def get_pg_error_code(e):
+    """ Returns the SQLSTATE code of an exception raised by a PostgreSQL driver, or None if there is none.
+    """
+    # psycopg2
+    code = getattr(e, 'pgcode', None)
+    if code:
+        return code
+
+    # pg8000 - either a dict of all the fields of an error response or its severity, code and message
+    args = getattr(e, 'args', ())
+    if args and isinstance(args[0], dict):
+        return args[0].get('C')
+    elif len(args) > 1:
+        return args[1]
 
 # ################################################################################################################################
 
@@ -235,6 +345,27 @@ class PostgresSQLLock(SQLLock):
     def _acquire_impl(self):
         return self.session.execute(self._acquire_func(self.priv_id)).scalar()
 
+    def _acquire_blocking(self, block):
+        """ Waits in PostgreSQL until the lock is released or lock_timeout passes, without polling for it.
+        Setting lock_timeout is local to the current transaction.
+        """
+        try:
+            self.session.execute(func.set_config('lock_timeout', '{}ms'.format(int(block * 1000)), True))
+            self.session.execute(func.pg_advisory_lock(self.priv_id))
+        except DBAPIError, e:
+
+            # The transaction is aborted either way
+            self.session.rollback()
+
+            # 55P03 = lock_not_available, which is what lock_timeout results in; anything else is an actual error
+            if get_pg_error_code(e.orig) != '55P03':
+                raise
+
+            return False
+        else:
+            self.session.execute(func.set_config('lock_timeout', '0', True))
+            return True
+
 # ################################################################################################################################
 
 class FCNTLLock(Lock):
@@ -277,6 +408,7 @@ user={}
         try:
             lock(self.tmp_file, _flags)
         except LockException:
+            self.tmp_file.close()
             return False
         else:
             return True
@@ -308,6 +440,8 @@ user={}
             if _has_debug:
                 logger.debug('Unlocked `%s`', self.tmp_file)
 
+            self._on_released()
+
 # ################################################################################################################################
 
 class LockManager(object):
@@ -326,6 +460,26 @@ class LockManager(object):
         self.session = session
         self._lock_class = self._lock_impl[backend_type]
         self.user_name = getpwuid(os.getuid()).pw_name
+        self.reaper = TTLReaper()
+
+        # Lock ID -> Event set when a lock of that ID is released in this process
+        self.release_events = {}
+
+    def wait_for_release(self, priv_id, timeout):
+        """ Waits until a lock of a given ID is released in this process or until timeout passes.
+        """
+        event = self.release_events.get(priv_id)
+        if not event:
+            event = self.release_events[priv_id] = Event()
+
+        event.wait(timeout)
+
+    def notify_released(self, priv_id):
+        """ Wakes up all greenlets waiting for a lock of a given ID.
+        """
+        event = self.release_events.pop(priv_id, None)
+        if event:
+            event.set()
 
     def __call__(self, name, namespace='', ttl=DEFAULT.TTL, block=DEFAULT.BLOCK, block_interval=DEFAULT.BLOCK_INTERVAL,
             max_len_ns=MAX.LEN_NS, max_len_name=MAX.LEN_NAME):
@@ -341,7 +495,7 @@ class LockManager(object):
             raise ValueError(msg)
 
         return self._lock_class(
-            self.user_name, self.session, namespace or self.default_namespace, name, ttl, block, block_interval)
+            self.user_name, self.session, namespace or self.default_namespace, name, ttl, block, block_interval, self)
 
     def acquire(self, *args, **kwargs):
         return self(*args, **kwargs).acquire()
@@ -7,14 +7,21 @@ Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 """
 
 # stdlib
+from time import time
 from unittest import TestCase
 
 # gevent
-from gevent import sleep
+from gevent import sleep, spawn, spawn_later
+
+# mock
+from mock import MagicMock
+
+# SQLAlchemy
+from sqlalchemy.exc import DBAPIError
 
 # Zato
 from zato.common.test import rand_int, rand_string
-from zato.distlock import DEFAULT, LockManager, LockTimeout, LOCK_TYPE
+from zato.distlock import DEFAULT, FCNTLLock, LockManager, LockTimeout, LOCK_TYPE, PostgresSQLLock
 
 # ################################################################################################################################
 
@@ -162,6 +169,65 @@ class _Base(TestCase):
         else:
             self.fail('Expected a LockTimeout here')
 
+# ################################################################################################################################
+
+    def test_acquire_waiter_notified_on_release(self):
+
+        if not self.is_set_up:
+            return
+
+        name = rand_string()
+        lock_manager = LockManager(self.backend_type, rand_string())
+
+        lock1 = lock_manager.acquire(name, ttl=10)
+        self.assertEquals(lock1.acquired, True)
+
+        # With a block_interval of 5 seconds the waiter would not retry for a long time without being notified
+        waiter = spawn(lock_manager.acquire, name, block=10, block_interval=5)
+        sleep(0.2)
+
+        start = time()
+        lock1.release()
+
+        lock2 = waiter.get()
+        self.assertEquals(lock2.acquired, True)
+        self.assertLess(time() - start, 0.1)
+
+        lock2.release()
+
+# ################################################################################################################################
+
+    def test_ttl_reaper(self):
+
+        if not self.is_set_up:
+            return
+
+        lock_manager = LockManager(self.backend_type, rand_string())
+
+        lock1 = lock_manager.acquire(rand_string(), ttl=3)
+        lock2 = lock_manager.acquire(rand_string(), ttl=1)
+        lock3 = lock_manager.acquire(rand_string(), ttl=10)
+
+        # A single greenlet sustains all of the locks
+        self.assertEquals(len(lock_manager.reaper.heap), 3)
+        self.assertIsNotNone(lock_manager.reaper.greenlet)
+
+        lock3.release()
+        self.assertEquals(lock_manager.reaper.len_held, 2)
+
+        # Only the one with the shortest TTL is released by now
+        sleep(1.5)
+        self.assertTrue(lock2.lock.released)
+        self.assertFalse(lock1.lock.released)
+
+        sleep(2)
+        self.assertTrue(lock1.lock.released)
+
+        # Nothing is left to wait for so the greenlet stops
+        sleep(0.1)
+        self.assertIsNone(lock_manager.reaper.greenlet)
+        self.assertListEqual(lock_manager.reaper.heap, [])
+
 # ################################################################################################################################
 
 class FCNTLLockTestCase(_Base):
@@ -172,6 +238,32 @@ class FCNTLLockTestCase(_Base):
 
 # ################################################################################################################################
 
+class NoManagerTestCase(TestCase):
+    """ Tests locks created directly rather than by a LockManager.
+    """
+    def get_lock(self, name, ttl=0, block=False):
+        return FCNTLLock('my.user', None, 'my.namespace', name, ttl, block, 0.1)
+
+    def test_ttl(self):
+        lock = self.get_lock(rand_string(), ttl=0.5)
+        self.assertTrue(lock.acquire().acquired)
+
+        sleep(1)
+        self.assertTrue(lock.released)
+
+    def test_blocking(self):
+        name = rand_string()
+
+        lock1 = self.get_lock(name, ttl=10)
+        self.assertTrue(lock1.acquire().acquired)
+        spawn_later(0.3, lock1.release)
+
+        lock2 = self.get_lock(name, block=5)
+        self.assertTrue(lock2.acquire().acquired)
+        lock2.release()
+
+# ################################################################################################################################
+
 class MySQLLockTestCase(_Base):
     backend_type = 'mysql+pymysql'
 
@@ -187,3 +279,51 @@ class PostgresSQLLockTestCase(_Base):
         self.is_set_up = False
 
 # ################################################################################################################################
+
+class PostgresSQLLockBlockingTestCase(TestCase):
+    """ Tests how lock_timeout errors are told apart from other ones, without a PostgreSQL server.
+    """
+    def get_lock(self, error=None):
+        session = MagicMock()
+        lock = PostgresSQLLock('my.user', lambda: session, 'my.namespace', 'my.name', 0, 5, 1)
+
+        # The first call sets lock_timeout and the second one waits for the lock
+        if error:
+            session.execute.side_effect = [None, DBAPIError('SELECT pg_advisory_lock(1)', {}, error)]
+
+        return lock, session
+
+    def get_psycopg2_error(self, code):
+        error = Exception('canceling statement due to lock timeout')
+        error.pgcode = code
+        return error
+
+    def test_acquired(self):
+        lock, session = self.get_lock()
+
+        self.assertTrue(lock._acquire_blocking(2))
+        self.assertFalse(session.rollback.called)
+
+    def test_lock_timeout(self):
+        for error in (
+            self.get_psycopg2_error('55P03'),
+            Exception({'S': 'ERROR', 'C': '55P03', 'M': 'canceling statement due to lock timeout'}), # pg8000
+            Exception('ERROR', '55P03', 'canceling statement due to lock timeout'), # Older pg8000
+            ):
+            lock, session = self.get_lock(error)
+
+            self.assertFalse(lock._acquire_blocking(2))
+            self.assertTrue(session.rollback.called)
+
+    def test_other_error(self):
+        for error in (
+            self.get_psycopg2_error('57014'),
+            Exception({'S': 'ERROR', 'C': '57014', 'M': 'canceling statement due to user request'}),
+            Exception('Connection reset'),
+            ):
+            lock, session = self.get_lock(error)
+
+            self.assertRaises(DBAPIError, lock._acquire_blocking, 2)
+            self.assertTrue(session.rollback.called)
+
+# ################################################################################################################################
@@ -10,6 +10,8 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 import datetime
+from heapq import heapify, heappop, heappush
+from itertools import count
 from logging import getLogger
 from traceback import format_exc
 
@@ -19,6 +21,7 @@ from dateutil.rrule import rrule, SECONDLY
 # gevent
 import gevent # Imported directly so it can be mocked out in tests
 from gevent import lock, sleep
+from gevent.event import Event
 
 # paodate
 from paodate import Delta
@@ -207,6 +210,45 @@ class Job(object):
         else:
             raise ValueError('Unsupported job type `{}` ({})'.format(self.type, self.name))
 
+    def get_next_run_time(self, run_time, now):
+        """ Returns the time the job should run at next, given the time it was scheduled to run at previously.
+        Next runs are computed from previous scheduled times rather than from the time a job actually ran at
+        so that there is no drift, no matter how late a given run was. Runs that were missed altogether,
+        e.g. because the process was suspended, are skipped rather than executed all at once.
+        """
+        if self.type == SCHEDULER.JOB_TYPE.INTERVAL_BASED:
+            in_seconds = self.interval.in_seconds
+            next_run_time = run_time + datetime.timedelta(seconds=in_seconds)
+
+            if next_run_time <= now:
+                missed = int((now - next_run_time).total_seconds() // in_seconds) + 1
+                next_run_time += datetime.timedelta(seconds=in_seconds * missed)
+
+            return next_run_time
+
+        elif self.type == SCHEDULER.JOB_TYPE.CRON_STYLE:
+            base = max(run_time, now)
+            return base + datetime.timedelta(seconds=(self.interval.next(base) or 1))
+
+        else:
+            raise ValueError('Unsupported job type `{}` ({})'.format(self.type, self.name))
+
+    def on_run(self):
+        """ Updates the job's state each time it runs and returns the context its callback should be invoked with.
+        """
+        self.current_run += 1
+
+        # Perhaps we've already been executed enough times
+        if self.max_repeats and self.current_run == self.max_repeats:
+            self.keep_running = False
+            self.max_repeats_reached = True
+            self.max_repeats_reached_at = datetime.datetime.utcnow()
+
+            if self.on_max_repeats_reached_cb:
+                self.on_max_repeats_reached_cb(self)
+
+        return self.get_context()
+
     def _spawn(self, *args, **kwargs):
         """ A thin wrapper so that it is easier to mock this method out in unit-tests.
         """
@@ -221,19 +263,10 @@ class Job(object):
         try:
             while self.keep_running:
                 try:
-                    self.current_run += 1
-
-                    # Perhaps we've already been executed enough times
-                    if self.max_repeats and self.current_run == self.max_repeats:
-                        self.keep_running = False
-                        self.max_repeats_reached = True
-                        self.max_repeats_reached_at = datetime.datetime.utcnow()
-
-                        if self.on_max_repeats_reached_cb:
-                            self.on_max_repeats_reached_cb(self)
+                    ctx = self.on_run()
 
                     # Invoke callback in a new greenlet so it doesn't block the current one.
-                    self._spawn(self.callback, **{'ctx':self.get_context()})
+                    self._spawn(self.callback, **{'ctx':ctx})
 
                 except Exception, e:
                     logger.warn(format_exc(e))
@@ -284,6 +317,101 @@ class Job(object):
 
 # ################################################################################################################################
 
+class Dispatcher(object):
+    """ Runs all jobs of a scheduler from a single greenlet instead of each job sleeping in a greenlet of its own.
+    Next run times of all jobs are kept in a heap and the dispatcher sleeps until the earliest of them. All jobs
+    whose time has come by the time it wakes up are handed over to a callback in one batch.
+    """
+    def __init__(self, on_jobs_due):
+        self.on_jobs_due = on_jobs_due
+        self.keep_running = True
+        self.wake_up = Event()
+
+        # Entries are (next run time, sequence number, job) - jobs that have been unscheduled are not removed
+        # from the heap until they reach its top, unless there are too many of them.
+        self.heap = []
+        self.counter = count()
+        self.len_removed = 0
+
+    def add(self, job, run_time=None):
+        """ Adds a job to run at run_time or at its start_time if run_time is not given.
+        """
+        run_time = run_time or job.start_time
+
+        if not run_time:
+            logger.warn('Job `%s` cannot start without start_time set', job.name)
+            return
+
+        heappush(self.heap, (run_time, next(self.counter), job))
+
+        # The job needs to run before all the other ones so the dispatcher needs to sleep for a shorter time now
+        if self.heap[0][2] is job:
+            self.wake_up.set()
+
+    def on_removed(self):
+        """ Notes that a job has been unscheduled and compacts the heap if more than half of it are such jobs.
+        """
+        self.len_removed += 1
+
+        if self.len_removed > 100 and self.len_removed * 2 > len(self.heap):
+            self.heap = [elem for elem in self.heap if elem[2].keep_running]
+            heapify(self.heap)
+            self.len_removed = 0
+
+    def run(self, _utcnow=datetime.datetime.utcnow):
+        while self.keep_running:
+            try:
+                if not self.heap:
+                    self.wake_up.clear()
+                    self.wake_up.wait()
+                    continue
+
+                run_time, _, job = self.heap[0]
+
+                if not job.keep_running:
+                    heappop(self.heap)
+                    continue
+
+                timeout = (run_time - _utcnow()).total_seconds()
+
+                if timeout > 0:
+                    self.wake_up.clear()
+                    self.wake_up.wait(timeout)
+                    continue
+
+                now = _utcnow()
+                due = []
+
+                while self.heap and self.heap[0][0] <= now:
+                    run_time, _, job = heappop(self.heap)
+                    if job.keep_running:
+                        due.append((run_time, job))
+
+                self.run_jobs(due, now)
+
+            except Exception:
+                logger.warn('Exception in scheduler dispatcher `%s`', format_exc())
+
+    def run_jobs(self, due, now, _one_time=SCHEDULER.JOB_TYPE.ONE_TIME):
+        """ Runs all jobs whose time has come and schedules their next runs.
+        """
+        ctx_list = []
+
+        for run_time, job in due:
+            try:
+                ctx_list.append(job.on_run())
+
+                if job.keep_running and job.type != _one_time:
+                    heappush(self.heap, (job.get_next_run_time(run_time, now), next(self.counter), job))
+
+            except Exception:
+                logger.warn('Could not run job `%s`, e:`%s`', job.name, format_exc())
+
+        if ctx_list:
+            self.on_jobs_due(ctx_list)
+
+# ################################################################################################################################
+
 class Scheduler(object):
     def __init__(self, config, api):
         self.config = config
@@ -303,6 +431,9 @@ class Scheduler(object):
         self._add_scheduler_jobs = config._add_scheduler_jobs
         self.job_log = getattr(logger, config.job_log_level)
 
+        # If there is a dispatcher, it runs all the jobs, otherwise each job runs in a greenlet of its own
+        self.dispatcher = Dispatcher(self.on_jobs_executed) if getattr(config, 'use_dispatcher', False) else None
+
     def on_max_repeats_reached(self, job):
         with self.lock:
             job.is_active = False
@@ -343,6 +474,10 @@ class Scheduler(object):
         job.keep_running = False
 
         if name in self.jobs.iterkeys():
+
+            # The job given on input may be a new instance, e.g. when it is edited, so it is the one scheduled earlier
+            # that needs to be stopped - otherwise the dispatcher would keep running it.
+            self.jobs[name].keep_running = False
             del self.jobs[name]
             found = True
 
@@ -351,6 +486,9 @@ class Scheduler(object):
             del self.job_greenlets[name]
             found = True
 
+        if found and self.dispatcher:
+            self.dispatcher.on_removed()
+
         return found
 
     def _unschedule_stop(self, job, message):
@@ -397,6 +535,10 @@ class Scheduler(object):
             for job in jobs:
                 self._unschedule_stop(job.clone(), 'stopped')
 
+            if self.dispatcher:
+                self.dispatcher.keep_running = False
+                self.dispatcher.wake_up.set()
+
     def sleep(self, value):
         """ A method introduced so the class is easier to mock out in tests.
         """
@@ -413,6 +555,17 @@ class Scheduler(object):
             else:
                 logger.warn('No such job `%s` in `%s`', name, [elem.get_context() for elem in self.jobs.itervalues()])
 
+    def on_jobs_executed(self, ctx_list):
+        """ Invoked by the dispatcher with contexts of all the jobs that ran at the same time. Their callbacks are invoked
+        one after another, without yielding to other greenlets in between, which means that broker messages they send
+        will go out in a single batch.
+        """
+        for ctx in ctx_list:
+            try:
+                self.on_job_executed(ctx)
+            except Exception:
+                logger.warn('Could not execute job `%s`, e:`%s`', ctx['name'], format_exc())
+
     def on_job_executed(self, ctx, unschedule_one_time=True):
         logger.debug('Executing `%s`, `%s`', ctx['name'], ctx)
         self.on_job_executed_cb(ctx)
@@ -427,11 +580,15 @@ class Scheduler(object):
         return spawn_greenlet(*args, **kwargs)
 
     def spawn_job(self, job):
-        """ Spawns a job's greenlet. Must be called with self.lock held.
+        """ Spawns a job's greenlet or adds it to the dispatcher, if there is one. Must be called with self.lock held.
         """
         job.callback = self.on_job_executed
         job.on_max_repeats_reached_cb = self.on_max_repeats_reached
-        self.job_greenlets[job.name] = self._spawn(job.run)
+
+        if self.dispatcher:
+            self.dispatcher.add(job)
+        else:
+            self.job_greenlets[job.name] = self._spawn(job.run)
 
     def add_startup_jobs(self):
         sleep(40) # To make sure that at least one server is running if the environment was started from quickstart scripts
@@ -453,6 +610,9 @@ class Scheduler(object):
             _sleep = self.sleep
             _sleep_time = self.sleep_time
 
+            if self.dispatcher:
+                self._spawn(self.dispatcher.run)
+
             with self.lock:
                 for job in sorted(self.jobs.itervalues()):
                     if job.max_repeats_reached:
@@ -22,6 +22,9 @@ from traceback import format_exc
 import cloghandler
 cloghandler = cloghandler # For pyflakes
 
+# Paste
+from paste.util.converters import asbool
+
 # YAML
 import yaml
 
@@ -50,6 +53,9 @@ def main():
     config.main = get_config(repo_location, 'scheduler.conf')
     config.main.odb.fs_sql_config = get_config(repo_location, 'sql.conf', needs_user_config=False)
 
+    # Older configuration files may not have it
+    config.use_dispatcher = asbool(config.main.get('scheduler', {}).get('use_dispatcher', False))
+
     # Make all paths absolute
     if config.main.crypto.use_tls:
         config.main.crypto.ca_certs_location = absjoin(repo_location, config.main.crypto.ca_certs_location)
@@ -49,6 +49,7 @@ class Config(object):
         self.broker_client = None
         self._add_startup_jobs = True
         self._add_scheduler_jobs = True
+        self.use_dispatcher = False
 
 # ################################################################################################################################
 
@@ -38,7 +38,7 @@ from springpython.context import DisposableObject
 
 # Zato
 from zato.broker import BrokerMessageReceiver
-from zato.broker.client import BrokerClient
+from zato.broker.client import BrokerClient, PUB_LINGER, PUB_MAX_BATCH
 from zato.bunch import Bunch
 from zato.common import DATA_FORMAT, KVDB, SECRETS, SERVER_STARTUP, SERVER_UP_STATUS, ZATO_ODB_POOL_NAME
 from zato.common.audit import audit_pii
@@ -59,6 +59,9 @@ from zato.server.base.parallel.config import ConfigLoader
 from zato.server.base.parallel.http import HTTPHandler
 from zato.server.base.parallel.wmq import WMQIPC
 from zato.server.pickup import PickupManager
+from zato.server.service.store import DiscoveryCache
+from zato.server.startup_callable import StartupProfile
+from zato.server.stats import ServiceStatsAggregator
 
 # ################################################################################################################################
 
@@ -109,6 +112,7 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver, ConfigLoader, HTTP
         self.cluster = None
         self.cluster_id = None
         self.kvdb = None
+        self.service_stats = None
         self.startup_jobs = None
         self.worker_store = None
         self.request_dispatcher_dispatch = None
@@ -239,12 +243,23 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver, ConfigLoader, HTTP
             # (re-)deploy the services from a clear state
             locally_deployed = []
 
+            # Modules that did not change since the last time they were imported need not be introspected again
+            if asbool(self.fs_server_config.misc.get('use_discovery_cache', False)):
+                self.service_store.discovery_cache = DiscoveryCache(
+                    os.path.join(self.base_dir, 'config', 'repo', 'discovery-cache.json'))
+                self.service_store.discovery_cache.load()
+
             locally_deployed.extend(self.service_store.import_internal_services(
                 self.internal_service_modules, self.base_dir, self.sync_internal, is_first))
 
             locally_deployed.extend(self.service_store.import_services_from_anywhere(
                 self.service_modules + self.service_sources, self.base_dir))
 
+            if self.service_store.discovery_cache:
+                self.service_store.discovery_cache.save()
+                logger.info('Discovery cache hits:%d, misses:%d (pid:%s)', self.service_store.discovery_cache.hits,
+                    self.service_store.discovery_cache.misses, self.pid)
+
             return set(locally_deployed)
 
         lock_name = '{}{}:{}'.format(KVDB.LOCK_SERVER_STARTING, self.fs_server_config.main.token, self.deployment_key)
@@ -370,6 +385,9 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver, ConfigLoader, HTTP
         # This also cannot be done in __init__ which doesn't have this variable yet
         self.is_first_worker = int(os.environ['ZATO_SERVER_WORKER_IDX']) == 0
 
+        # How long each phase of the startup takes
+        startup_profile = StartupProfile()
+
         # Used later on
         use_tls = asbool(self.fs_server_config.crypto.use_tls)
 
@@ -421,17 +439,29 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver, ConfigLoader, HTTP
                     self.cluster.name, self.pid, 's' if use_tls else '', self.preferred_address,
             self.port)
 
+        # Statistics of services invoked in this worker process, flushed to KVDB in background. Needs to exist
+        # before any service is invoked, including ones invoked when connectors are started.
+        self.service_stats = ServiceStatsAggregator(
+            self.kvdb, float(self.fs_server_config.get('stats', {}).get('flush_interval', 5)))
+
         # Reads in all configuration from ODB
         self.worker_store = WorkerStore(self.config, self)
         self.worker_store.invoke_matcher.read_config(self.fs_server_config.invoke_patterns_allowed)
         self.worker_store.target_matcher.read_config(self.fs_server_config.invoke_target_patterns_allowed)
-        self.set_up_config(server)
+
+        with startup_profile('config'):
+            self.set_up_config(server)
 
         # Deploys services
-        is_first, locally_deployed = self._after_init_common(server)
+        with startup_profile('services'):
+            is_first, locally_deployed = self._after_init_common(server)
+
+        # Part of the time above
+        startup_profile.add('services (ODB registration)', self.service_store.odb_registration_time)
 
         # Initializes worker store, including connectors
-        self.worker_store.init()
+        with startup_profile('connectors'):
+            self.worker_store.init()
         self.request_dispatcher_dispatch = self.worker_store.request_dispatcher.dispatch
 
         # Normalize hot-deploy configuration
@@ -465,9 +495,15 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver, ConfigLoader, HTTP
             TOPICS[MESSAGE_TYPE.TO_PARALLEL_ALL]: self.worker_store.on_broker_msg,
         }
 
-        self.broker_client = BrokerClient(self.kvdb, 'parallel', broker_callbacks, self.get_lua_programs())
+        self.broker_client = BrokerClient(self.kvdb, 'parallel', broker_callbacks, self.get_lua_programs(),
+            int(self.fs_server_config.misc.get('broker_pub_max_batch', PUB_MAX_BATCH)),
+            float(self.fs_server_config.misc.get('broker_pub_linger', PUB_LINGER)))
         self.worker_store.set_broker_client(self.broker_client)
 
+        # Services invoked before this point had their statistics collected already, now they can be flushed
+        if self.component_enabled.stats:
+            spawn_greenlet(self.service_stats.run)
+
         self._after_init_accepted(locally_deployed)
 
         self.odb.server_up_down(server.token, SERVER_UP_STATUS.RUNNING, True, self.host,
@@ -520,6 +556,8 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver, ConfigLoader, HTTP
         })
 
         logger.info('Started `%s@%s` (pid: %s)', server.name, server.cluster.name, self.pid)
+        logger.info('Startup profile of `%s@%s` (pid: %s)\n%s', server.name, server.cluster.name, self.pid,
+            startup_profile.get_report())
 
 # ################################################################################################################################
 
@@ -653,7 +691,7 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver, ConfigLoader, HTTP
         # Underlying IPC needs strings on input instead of None
         request = request or ''
 
-        for pid in pids:
+        def _invoke_pid(pid):
             response = {
                 'is_ok': False,
                 'pid_data': None,
@@ -670,6 +708,9 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver, ConfigLoader, HTTP
             finally:
                 out[pid] = response
 
+        # All processes are invoked concurrently so the whole call takes as long as the slowest of them does
+        gevent.joinall([gevent.spawn(_invoke_pid, pid) for pid in pids])
+
         return out
 
 # ################################################################################################################################
@@ -826,6 +867,19 @@ class ParallelServer(DisposableObject, BrokerMessageReceiver, ConfigLoader, HTTP
         # Per-worker cleanup
         else:
 
+            # Store statistics not flushed yet
+            if self.service_stats:
+                self.service_stats.stop()
+
+            # Store JWT renewals not flushed yet - there will be nothing to store if the worker
+            # did not get as far as creating its request dispatcher during startup.
+            request_dispatcher = getattr(self.worker_store, 'request_dispatcher', None)
+            url_data = getattr(request_dispatcher, 'url_data', None)
+            jwt_backend = getattr(url_data, 'jwt_backend', None)
+
+            if jwt_backend:
+                jwt_backend.stop()
+
             # Close all POSIX IPC structures
             self.server_startup_ipc.close()
 
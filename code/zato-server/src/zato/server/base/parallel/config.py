@@ -10,8 +10,14 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 from contextlib import closing
+from cPickle import dumps, HIGHEST_PROTOCOL, loads
+from logging import getLogger
+from traceback import format_exc
 import os
 
+# gevent
+from gevent import spawn_later
+
 # Paste
 from paste.util.converters import asbool
 
@@ -24,6 +30,18 @@ from zato.url_dispatcher import Matcher
 
 # ################################################################################################################################
 
+logger = getLogger(__name__)
+
+# ################################################################################################################################
+
+# How long, in seconds, workers wait for the first one to store a configuration snapshot
+CONFIG_SNAPSHOT_WAIT_TIME = 60
+
+# How long, in seconds, a configuration snapshot is kept for workers to read it in
+CONFIG_SNAPSHOT_KEEP_TIME = 30
+
+# ################################################################################################################################
+
 class ConfigLoader(object):
     """ Loads server's configuration.
     """
@@ -36,6 +54,47 @@ class ConfigLoader(object):
         self.component_enabled.stats = asbool(self.fs_server_config.component_enabled.stats)
         self.component_enabled.slow_response = asbool(self.fs_server_config.component_enabled.slow_response)
 
+        # With a shared startup configuration, only the first worker loads it from ODB and decrypts it,
+        # other ones read in a snapshot of what it loaded from shared memory.
+        if asbool(self.fs_server_config.misc.get('use_shared_startup_config', False)):
+            if self.is_first_worker:
+                self.set_up_odb_config(server)
+                self.store_config_snapshot()
+            elif not self.load_config_snapshot():
+                self.set_up_odb_config(server)
+        else:
+            self.set_up_odb_config(server)
+
+        # SimpleIO
+        # In preparation for a SIO rewrite, we loaded SIO config from a file
+        # but actual code paths require the pre-3.0 format so let's prepare it here.
+        self.config.simple_io = ConfigDict('simple_io', Bunch())
+
+        int_exact = self.sio_config.int.exact
+        int_suffix = self.sio_config.int.suffix
+        bool_prefix = self.sio_config.bool.prefix
+
+        self.config.simple_io['int_parameters'] = int_exact if isinstance(int_exact, list) else [int_exact]
+        self.config.simple_io['int_parameter_suffixes'] = int_suffix if isinstance(int_suffix, list) else [int_suffix]
+        self.config.simple_io['bool_parameter_prefixes'] = bool_prefix if isinstance(bool_prefix, list) else [bool_prefix]
+
+        # Pub/sub
+        self.config.pubsub = Bunch()
+
+        # Message paths
+        self.config.msg_ns_store = NamespaceStore()
+        self.config.json_pointer_store = JSONPointerStore()
+        self.config.xpath_store = XPathStore()
+
+        # Assign config to worker
+        self.worker_store.worker_config = self.config
+
+# ################################################################################################################################
+
+    def set_up_odb_config(self, server):
+        """ Loads configuration of all objects kept in ODB.
+        """
+
         #
         # Cassandra - start
         #
@@ -340,22 +399,6 @@ class ConfigLoader(object):
         query = self.odb.get_json_pointer_list(server.cluster.id, True)
         self.config.json_pointer = ConfigDict.from_query('json_pointer', query, decrypt_func=self.decrypt)
 
-        # SimpleIO
-        # In preparation for a SIO rewrite, we loaded SIO config from a file
-        # but actual code paths require the pre-3.0 format so let's prepare it here.
-        self.config.simple_io = ConfigDict('simple_io', Bunch())
-
-        int_exact = self.sio_config.int.exact
-        int_suffix = self.sio_config.int.suffix
-        bool_prefix = self.sio_config.bool.prefix
-
-        self.config.simple_io['int_parameters'] = int_exact if isinstance(int_exact, list) else [int_exact]
-        self.config.simple_io['int_parameter_suffixes'] = int_suffix if isinstance(int_suffix, list) else [int_suffix]
-        self.config.simple_io['bool_parameter_prefixes'] = bool_prefix if isinstance(bool_prefix, list) else [bool_prefix]
-
-        # Pub/sub
-        self.config.pubsub = Bunch()
-
         # Pub/sub - endpoints
         query = self.odb.get_pubsub_endpoint_list(server.cluster.id, True)
         self.config.pubsub_endpoint = ConfigDict.from_query('pubsub_endpoint', query, decrypt_func=self.decrypt)
@@ -376,13 +419,65 @@ class ConfigLoader(object):
         query = self.odb.get_email_imap_list(server.cluster.id, True)
         self.config.email_imap = ConfigDict.from_query('email_imap', query, decrypt_func=self.decrypt)
 
-        # Message paths
-        self.config.msg_ns_store = NamespaceStore()
-        self.config.json_pointer_store = JSONPointerStore()
-        self.config.xpath_store = XPathStore()
+# ################################################################################################################################
 
-        # Assign config to worker
-        self.worker_store.worker_config = self.config
+    def get_config_snapshot(self):
+        """ Returns configuration loaded from ODB, serialized so that other workers can use it without querying ODB.
+        """
+        config_dicts = {}
+        for key, value in vars(self.config).items():
+            if isinstance(value, ConfigDict):
+                config_dicts[key] = (value.name, value._impl)
+
+        # Compiled matchers are not serialized, each worker will build its own ones
+        http_soap = []
+        for item in self.config.http_soap:
+            item = dict(item)
+            del item['match_target_compiled']
+            http_soap.append(item)
+
+        return dumps({'config_dicts':config_dicts, 'http_soap':http_soap}, HIGHEST_PROTOCOL)
+
+    def set_config_snapshot(self, data):
+        """ Sets configuration from a snapshot returned by self.get_config_snapshot.
+        """
+        data = loads(data)
+
+        for key, (name, impl) in data['config_dicts'].items():
+            setattr(self.config, key, ConfigDict(name, impl))
+
+        for item in data['http_soap']:
+            item['match_target_compiled'] = Matcher(item['match_target'])
+
+        self.config.http_soap = data['http_soap']
+
+# ################################################################################################################################
+
+    def store_config_snapshot(self):
+        """ Stores in shared memory a snapshot of configuration for other workers to use.
+        """
+        try:
+            data = self.get_config_snapshot()
+            self.server_startup_ipc.set_config_snapshot(data)
+        except Exception:
+            logger.warn('Could not store configuration snapshot, e:`%s`', format_exc())
+        else:
+            logger.info('Stored configuration snapshot (%d bytes, pid:%s)', len(data), self.pid)
+
+            # Workers started later on, e.g. ones restarted by gunicorn, must not use a snapshot that may be stale by then
+            spawn_later(CONFIG_SNAPSHOT_KEEP_TIME, self.server_startup_ipc.delete_config_snapshot)
+
+    def load_config_snapshot(self):
+        """ Sets configuration from a snapshot stored by the first worker. Returns True if it could be done, False otherwise.
+        """
+        try:
+            self.set_config_snapshot(self.server_startup_ipc.get_config_snapshot(CONFIG_SNAPSHOT_WAIT_TIME))
+        except Exception:
+            logger.warn('Could not load configuration snapshot, reading configuration from ODB instead, e:`%s`', format_exc())
+            return False
+        else:
+            logger.info('Loaded configuration snapshot (pid:%s)', self.pid)
+            return True
 
 # ################################################################################################################################
 
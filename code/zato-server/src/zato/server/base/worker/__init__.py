@@ -2076,9 +2076,8 @@ class WorkerStore(_WorkerStoreBase, BrokerMessageReceiver):
             data = '{};{}'.format(status, response)
 
         try:
-            with open(msg.reply_to_fifo, 'wb') as fifo:
-                fifo.write(data)
+            self.server.ipc_api.reply(msg, data)
         except Exception:
-            logger.warn('Could not write to FIFO, m:`%s`, r:`%s`, s:`%s`, e:`%s`', msg, response, status, format_exc())
+            logger.warn('Could not send IPC reply, m:`%s`, r:`%s`, s:`%s`, e:`%s`', msg, response, status, format_exc())
 
 # ################################################################################################################################
@@ -147,4 +147,10 @@ class CacheBuiltin(WorkerImpl):
         if msg.source_worker_id != self.server.worker_id:
             self.cache_api.sync_after_clear(_BUILTIN, msg)
 
+# ################################################################################################################################
+
+    def on_broker_msg_CACHE_BUILTIN_STATE_CHANGED_BATCH(self, msg, _BUILTIN=CACHE.TYPE.BUILTIN):
+        if msg.source_worker_id != self.server.worker_id:
+            self.cache_api.sync_after_batch(_BUILTIN, msg)
+
 # ################################################################################################################################
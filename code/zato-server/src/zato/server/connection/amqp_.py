@@ -9,6 +9,7 @@ Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 # stdlib
+from collections import deque
 from datetime import datetime, timedelta
 from exceptions import IOError, OSError
 from logging import getLogger
@@ -20,6 +21,8 @@ from amqp.exceptions import ConnectionError as AMQPConnectionError
 
 # gevent
 from gevent import sleep, spawn
+from gevent.lock import RLock
+from gevent.pool import Pool
 
 # Kombu
 from kombu import Connection, Consumer as _Consumer, pools, Queue
@@ -47,6 +50,16 @@ no_ack = {
 
 # ################################################################################################################################
 
+# What to do with a message once its service has been invoked
+_action_ack = 'ack'
+_action_reject = 'reject'
+_action_settled = 'settled' # The service itself acked or rejected the message
+_action_none = 'none'       # The service raised an exception, the message is left unacknowledged
+
+_msg_received = 'RECEIVED'
+
+# ################################################################################################################################
+
 class _AMQPMessage(object):
     __slots__ = ('body', 'impl')
 
@@ -92,6 +105,8 @@ class _AMQPProducers(object):
 
 class Consumer(object):
     """ Consumes messages from AMQP queues. There is one Consumer object for each Zato AMQP channel.
+    Messages are processed concurrently by a pool of up to prefetch_count handlers and acknowledged in batches,
+    in the order of their delivery tags, using multiple-acks.
     """
     def __init__(self, config, on_amqp_message):
         # type: (dict, Callable)
@@ -104,11 +119,100 @@ class Consumer(object):
         self.is_connected = False # Instance-level flag indicating whether we have an active connection now.
         self.timeout = 0.35
 
+        # The broker will not send more than prefetch_count unacknowledged messages so this is also how many of them
+        # we process concurrently. Without a prefetch limit, messages are processed one by one.
+        self.max_in_flight = self.config.prefetch_count or 1
+        self.handlers = Pool(self.max_in_flight)
+
+        # Acks are sent when this many messages can be acknowledged or when there are no other messages being processed
+        self.ack_batch_size = max(1, self.max_in_flight // 2)
+
+        # Messages in the order of their delivery tags, each with an action to take once processed, or None if still in flight
+        self.to_ack = deque()
+        self.len_ready = 0
+        self.ack_lock = RLock()
+
+        # Once a message is left unacknowledged, e.g. because its service raised an exception, we cannot ack multiple
+        # messages in one go because it would ack that message too. This is reset each time a channel is opened.
+        self.can_ack_multiple = True
+
     def _on_amqp_message(self, body, msg):
+        """ Invoked by kombu for each message received - blocks until there is a free handler to process it.
+        """
+        entry = [msg, None]
+        self.to_ack.append(entry)
+        self.handlers.spawn(self._handle_message, body, msg, entry, self.to_ack)
+
+    def _handle_message(self, body, msg, entry, to_ack, _action_ack=_action_ack, _action_reject=_action_reject,
+            _msg_received=_msg_received, _ZATO_ACK_MODE_ACK=AMQP.ACK_MODE.ACK.id):
+        """ Invokes the channel's service for a message and marks it as ready to be acked or rejected.
+        """
         try:
-            return self.on_amqp_message(body, msg, self.name, self.config)
+            self.on_amqp_message(body, msg, self.name, self.config)
         except Exception, e:
             logger.warn(format_exc(e))
+            entry[1] = _action_none
+        else:
+            if msg._state != _msg_received:
+                entry[1] = _action_settled
+            else:
+                entry[1] = _action_ack if self.config.ack_mode == _ZATO_ACK_MODE_ACK else _action_reject
+
+        # The message was received in a channel that is already closed
+        if to_ack is not self.to_ack:
+            return
+
+        self.len_ready += 1
+
+        # Ack in batches when busy but without any delay if this was the only message being processed
+        if self.len_ready >= self.ack_batch_size or len(self.handlers) <= 1:
+            self._flush_acks()
+
+    def _flush_acks(self, _action_ack=_action_ack, _action_reject=_action_reject, _action_none=_action_none):
+        """ Acks or rejects all processed messages up to the first one still in flight. Consecutive acks are sent
+        as a single multiple-ack for the last message.
+        """
+        with self.ack_lock:
+            to_ack = self.to_ack
+            last_ack = None
+
+            try:
+                while to_ack and to_ack[0][1]:
+                    msg, action = to_ack.popleft()
+                    self.len_ready -= 1
+
+                    if action == _action_ack:
+                        if self.can_ack_multiple:
+                            last_ack = msg
+                        else:
+                            msg.ack()
+
+                    elif action == _action_reject:
+                        msg.reject()
+
+                    elif action == _action_none:
+
+                        # Ack everything before this message while it is still possible
+                        if last_ack:
+                            last_ack.ack(multiple=True)
+                            last_ack = None
+                        self.can_ack_multiple = False
+
+                if last_ack:
+                    last_ack.ack(multiple=True)
+
+            # Most likely the connection is broken, in which case the broker will redeliver the messages anyway
+            except Exception, e:
+                logger.warn('Could not ack messages in channel `%s`, e:`%s`', self.name, format_exc(e))
+
+    def _reset_acks(self):
+        """ Forgets about messages from a previous channel - delivery tags are channel-specific and the broker
+        will redeliver all the messages that were not acknowledged.
+        """
+        with self.ack_lock:
+            self.to_ack = deque()
+            self.len_ready = 0
+            self.can_ack_multiple = True
 
 # ################################################################################################################################
 
@@ -132,6 +236,7 @@ class Consumer(object):
                     no_ack=_no_ack[self.config.ack_mode], tag_prefix='{}/{}'.format(
                         self.config.consumer_tag_prefix, get_component_name('amqp-consumer')))
                 consumer.qos(prefetch_size=0, prefetch_count=self.config.prefetch_count, apply_global=False)
+                self._reset_acks()
                 consumer.consume()
             except Exception, e:
                 err_conn_attempts += 1
@@ -174,6 +279,10 @@ class Consumer(object):
 
                     connection = consumer.connection
 
+                    # Ack messages processed since the last iteration
+                    if self.len_ready:
+                        self._flush_acks()
+
                     # Do not assume the consumer still has the connection, it may have been already closed, we don't know.
                     # Unfortunately, the only way to check it is to invoke the method and catch AttributeError
                     # if connection is already None.
@@ -220,6 +329,9 @@ class Consumer(object):
 
             if connection:
                 logger.info('Closing connection for `%s`', consumer)
+
+                # Messages still being processed will be redelivered by the broker
+                self._flush_acks()
                 connection.close()
             self.is_stopped = True # Set to True if we break out of the main loop.
 
@@ -318,9 +430,9 @@ class ConnectorAMQP(Connector):
 
 # ################################################################################################################################
 
-    def on_amqp_message(self, body, msg, channel_name, channel_config, _AMQPMessage=_AMQPMessage, _CHANNEL_AMQP=CHANNEL.AMQP,
-        _RECEIVED='RECEIVED', _ZATO_ACK_MODE_ACK=AMQP.ACK_MODE.ACK.id):
-        """ Invoked each time a message is taken off an AMQP queue.
+    def on_amqp_message(self, body, msg, channel_name, channel_config, _AMQPMessage=_AMQPMessage, _CHANNEL_AMQP=CHANNEL.AMQP):
+        """ Invoked each time a message is taken off an AMQP queue. The message is acked or rejected by its consumer
+        unless the service already did it.
         """
         self.on_message_callback(
             channel_config['service_name'], body, channel=_CHANNEL_AMQP,
@@ -332,12 +444,6 @@ class ConnectorAMQP(Connector):
                 'amqp_msg': msg,
             }})
 
-        if msg._state == _RECEIVED:
-            if channel_config['ack_mode'] == _ZATO_ACK_MODE_ACK:
-                msg.ack()
-            else:
-                msg.reject()
-
 # ################################################################################################################################
 
     def _get_conn_string(self, needs_password=True):
@@ -12,8 +12,11 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from logging import getLogger
 from traceback import format_exc
 
+# Bunch
+from bunch import Bunch
+
 # gevent
-from gevent import sleep, spawn
+from gevent import sleep, spawn, spawn_later
 from gevent.lock import RLock
 
 # python-memcached
@@ -67,6 +70,113 @@ default_get = ZATO_NOT_GIVEN # A singleton to indicate that no default for Cache
 
 # ################################################################################################################################
 
+# Operations that replace the whole state of a single key - only the last one of them needs to be synchronized
+_key_replacing_ops = {CACHE.STATE_CHANGED.SET, CACHE.STATE_CHANGED.DELETE}
+
+# Operations that concern a single key
+_key_ops = {CACHE.STATE_CHANGED.SET, CACHE.STATE_CHANGED.DELETE, CACHE.STATE_CHANGED.EXPIRE}
+
+# ################################################################################################################################
+
+class StateChangedBuffer(object):
+    """ Collects state changes of a single built-in cache and hands them over to a callback in batches. A batch is flushed
+    once window seconds have elapsed since its first change or when it reaches max_ops changes, whichever comes first.
+    Only the last set or delete of each key is kept, whereas clear and operations matching keys by patterns
+    act as barriers which no change is moved across, so that receivers end up in the same state as the sender.
+    """
+    def __init__(self, cache_name, window, max_ops, callback):
+        self.cache_name = cache_name
+        self.window = window
+        self.max_ops = max_ops
+        self.callback = callback
+        self.lock = RLock()
+        self.flush_greenlet = None
+        self._reset()
+
+    def _reset(self):
+        self.ops = []      # A list of [op, data] elements, with None in place of ones superseded by later changes
+        self.by_key = {}   # Key -> indexes in self.ops of changes to that key since the most recent barrier
+        self.size = 0      # How many elements of self.ops are not None
+
+# ################################################################################################################################
+
+    def __len__(self):
+        return self.size
+
+# ################################################################################################################################
+
+    def add(self, op, data, _CLEAR=CACHE.STATE_CHANGED.CLEAR, _EXPIRE=CACHE.STATE_CHANGED.EXPIRE,
+        _key_ops=_key_ops, _key_replacing_ops=_key_replacing_ops):
+        """ Adds a new state change to the current batch, possibly superseding earlier changes.
+        """
+        with self.lock:
+
+            # Nothing from before a clear is of any interest to receivers
+            if op == _CLEAR:
+                self._reset()
+
+            elif op in _key_ops:
+                key = data['key']
+                indexes = self.by_key.get(key)
+
+                if indexes:
+                    ops = self.ops
+                    keep = []
+
+                    for idx in indexes:
+                        previous = ops[idx]
+                        if op in _key_replacing_ops or previous[0] == _EXPIRE:
+                            ops[idx] = None
+                            self.size -= 1
+                        else:
+                            keep.append(idx)
+
+                    indexes[:] = keep
+                else:
+                    indexes = self.by_key[key] = []
+
+                indexes.append(len(self.ops))
+
+            # Pattern-based operations may touch any key so earlier changes cannot be moved past them
+            else:
+                self.by_key.clear()
+
+            self.ops.append([op, data])
+            self.size += 1
+
+            if self.size >= self.max_ops:
+                self._flush_later(0)
+            elif not self.flush_greenlet:
+                self._flush_later(self.window)
+
+# ################################################################################################################################
+
+    def _flush_later(self, delay):
+        if self.flush_greenlet:
+            self.flush_greenlet.kill(block=False)
+        self.flush_greenlet = spawn_later(delay, self.flush) if delay else spawn(self.flush)
+
+# ################################################################################################################################
+
+    def flush(self):
+        """ Hands all the changes collected so far over to the callback.
+        """
+        with self.lock:
+            self.flush_greenlet = None
+
+            if not self.size:
+                return
+
+            ops = [elem for elem in self.ops if elem is not None]
+            self._reset()
+
+        try:
+            self.callback(self.cache_name, ops)
+        except Exception, e:
+            logger.warn('Could not flush state changes of cache `%s`, e:`%s`', self.cache_name, format_exc(e))
+
+# ################################################################################################################################
+
 class Cache(object):
     """ The cache API through which services access the built-in self.cache objects.
     Attribute self.impl is the actual Cython-based cache implementation.
@@ -74,11 +184,42 @@ class Cache(object):
     def __init__(self, config):
         self.config = config
         self.after_state_changed_callback = self.config.after_state_changed_callback
-        self.needs_sync = self.config.sync_method != CACHE.SYNC_METHOD.NO_SYNC.id
+        self.after_state_changed_batch_callback = self.config.get('after_state_changed_batch_callback')
+        self.sync_batch_window = self.config.get('sync_batch_window', CACHE.DEFAULT.SYNC_BATCH_WINDOW) / 1000.0
+        self.sync_batch_max_ops = self.config.get('sync_batch_max_ops', CACHE.DEFAULT.SYNC_BATCH_MAX_OPS)
+        self.sync_buffer = None
+        self._set_sync_method()
         self.impl = _CyCache(self.config.max_size, self.config.max_item_size, self.config.extend_expiry_on_get,
             self.config.extend_expiry_on_set)
         spawn(self._delete_expired)
 
+# ################################################################################################################################
+
+    def _set_sync_method(self, _NO_SYNC=CACHE.SYNC_METHOD.NO_SYNC.id, _BATCHED=CACHE.SYNC_METHOD.BATCHED.id):
+        """ Configures how state changes are synchronized with other workers, if at all, flushing out any changes
+        collected so far under the previous sync method.
+        """
+        if self.sync_buffer is not None:
+            self.sync_buffer.flush()
+
+        self.needs_sync = self.config.sync_method != _NO_SYNC
+
+        if self.config.sync_method == _BATCHED and self.after_state_changed_batch_callback:
+            self.sync_buffer = StateChangedBuffer(
+                self.config.name, self.sync_batch_window, self.sync_batch_max_ops, self.after_state_changed_batch_callback)
+        else:
+            self.sync_buffer = None
+
+# ################################################################################################################################
+
+    def _on_state_changed(self, op, data):
+        """ Notifies other workers of a state change, either immediately or as part of the next batch.
+        """
+        if self.sync_buffer is not None:
+            self.sync_buffer.add(op, data)
+        else:
+            spawn(self.after_state_changed_callback, op, self.config.name, data)
+
 # ################################################################################################################################
 
     def __getitem__(self, key):
@@ -172,7 +313,7 @@ class Cache(object):
         meta_ref = {'key':key, 'value':value, 'expiry':expiry} if self.needs_sync else None
         value = self.impl.set(key, value, expiry, meta_ref)
         if self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, meta_ref)
+            self._on_state_changed(_OP, meta_ref)
 
         return value
 
@@ -185,7 +326,7 @@ class Cache(object):
         """
         out = self.impl.set_by_prefix(key, value, expiry, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'value':value, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'value':value, 'expiry':expiry})
 
         return out
 
@@ -198,7 +339,7 @@ class Cache(object):
         """
         out = self.impl.set_by_suffix(key, value, expiry, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'value':value, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'value':value, 'expiry':expiry})
 
         return out
 
@@ -211,7 +352,7 @@ class Cache(object):
         """
         out = self.impl.set_by_regex(key, value, expiry, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'value':value, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'value':value, 'expiry':expiry})
 
         return out
 
@@ -224,7 +365,7 @@ class Cache(object):
         """
         out = self.impl.set_contains(key, value, expiry, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'value':value, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'value':value, 'expiry':expiry})
 
         return out
 
@@ -237,7 +378,7 @@ class Cache(object):
         """
         out = self.impl.set_not_contains(key, value, expiry, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'value':value, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'value':value, 'expiry':expiry})
 
         return out
 
@@ -250,7 +391,7 @@ class Cache(object):
         """
         out = self.impl.set_contains_all(key, value, expiry, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'value':value, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'value':value, 'expiry':expiry})
 
         return out
 
@@ -263,7 +404,7 @@ class Cache(object):
         """
         out = self.impl.set_contains_any(key, value, expiry, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'value':value, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'value':value, 'expiry':expiry})
 
         return out
 
@@ -279,7 +420,7 @@ class Cache(object):
                 raise
         else:
             if self.needs_sync:
-                spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key})
+                self._on_state_changed(_OP, {'key':key})
 
             return value
 
@@ -291,7 +432,7 @@ class Cache(object):
         """
         out = self.impl.delete_by_prefix(key, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key})
+            self._on_state_changed(_OP, {'key':key})
 
         return out
 
@@ -303,7 +444,7 @@ class Cache(object):
         """
         out = self.impl.delete_by_suffix(key, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key})
+            self._on_state_changed(_OP, {'key':key})
 
         return out
 
@@ -315,7 +456,7 @@ class Cache(object):
         """
         out = self.impl.delete_by_regex(key, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key})
+            self._on_state_changed(_OP, {'key':key})
 
         return out
 
@@ -327,7 +468,7 @@ class Cache(object):
         """
         out = self.impl.delete_contains(key, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key})
+            self._on_state_changed(_OP, {'key':key})
 
         return out
 
@@ -339,7 +480,7 @@ class Cache(object):
         """
         out = self.impl.delete_not_contains(key, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key})
+            self._on_state_changed(_OP, {'key':key})
 
         return out
 
@@ -351,7 +492,7 @@ class Cache(object):
         """
         out = self.impl.delete_contains_all(key, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key})
+            self._on_state_changed(_OP, {'key':key})
 
         return out
 
@@ -363,7 +504,7 @@ class Cache(object):
         """
         out = self.impl.delete_contains_any(key, return_found)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key})
+            self._on_state_changed(_OP, {'key':key})
 
         return out
 
@@ -376,7 +517,7 @@ class Cache(object):
         found_key = self.impl.expire(key, expiry, meta_ref)
 
         if self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, meta_ref)
+            self._on_state_changed(_OP, meta_ref)
 
         return found_key
 
@@ -387,7 +528,7 @@ class Cache(object):
         """
         out = self.impl.expire_by_prefix(key, expiry)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'expiry':expiry})
 
         return out
 
@@ -398,7 +539,7 @@ class Cache(object):
         """
         out = self.impl.expire_by_suffix(key, expiry)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'expiry':expiry})
 
         return out
 
@@ -409,7 +550,7 @@ class Cache(object):
         """
         out = self.impl.expire_by_regex(key, expiry)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'expiry':expiry})
 
         return out
 
@@ -420,7 +561,7 @@ class Cache(object):
         """
         out = self.impl.expire_contains(key, expiry)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'expiry':expiry})
 
         return out
 
@@ -431,7 +572,7 @@ class Cache(object):
         """
         out = self.impl.expire_not_contains(key, expiry)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'expiry':expiry})
 
         return out
 
@@ -442,7 +583,7 @@ class Cache(object):
         """
         out = self.impl.expire_contains_all(key, expiry)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'expiry':expiry})
 
         return out
 
@@ -453,7 +594,7 @@ class Cache(object):
         """
         out = self.impl.expire_contains_any(key, expiry)
         if out and self.needs_sync:
-            spawn(self.after_state_changed_callback, _OP, self.config.name, {'key':key, 'expiry':expiry})
+            self._on_state_changed(_OP, {'key':key, 'expiry':expiry})
 
         return out
 
@@ -507,13 +648,15 @@ class Cache(object):
         self.impl.clear()
 
         if self.needs_sync:
-            spawn(self.after_state_changed_callback, _CLEAR, self.config.name, {})
+            self._on_state_changed(_CLEAR, {})
 
 # ################################################################################################################################
 
     def update_config(self, config):
-        self.needs_sync = self.config.sync_method != CACHE.SYNC_METHOD.NO_SYNC.id
         self.impl.update_config(config)
+        self.config.name = config.name
+        self.config.sync_method = config.sync_method
+        self._set_sync_method()
 
 # ################################################################################################################################
 
@@ -584,7 +727,10 @@ class Cache(object):
     def sync_after_delete(self, data):
         """ Invoked by Cache API to synchronizes this worker's cache after a .delete operation in another worker process.
         """
-        self.impl.delete(data.key)
+        try:
+            self.impl.delete(data.key)
+        except KeyError:
+            pass # Already deleted or never set here, e.g. when its set was superseded by this delete in a batch
 
     def sync_after_delete_by_prefix(self, data):
         """ Invoked by Cache API to synchronizes this worker's cache after a .delete_by_prefix operation
@@ -684,6 +830,18 @@ class Cache(object):
         """
         self.impl.clear()
 
+# ################################################################################################################################
+
+    def sync_after_batch(self, ops, _CLEAR=CACHE.STATE_CHANGED.CLEAR):
+        """ Invoked by Cache API to synchronizes this worker's cache after a batch of operations in another worker process.
+        All of them are applied in order, without yielding to other greenlets in between.
+        """
+        for op, data in ops:
+            if op == _CLEAR:
+                self.sync_after_clear()
+            else:
+                getattr(self, 'sync_after_{}'.format(op.lower()))(Bunch(data))
+
 # ################################################################################################################################
 
 class _NotConfiguredAPI(object):
@@ -726,12 +884,32 @@ class CacheAPI(object):
             logger.warn('Could not run `%s` after_state_changed in cache `%s`, data:`%s`, e:`%s`',
                 op, cache_name, data, format_exc(e))
 
+# ################################################################################################################################
+
+    def after_state_changed_batch(self, cache_name, ops, _action=CACHE_BROKER_MSG.BUILTIN_STATE_CHANGED_BATCH.value):
+        """ Callback method invoked by each cache whose state changes are synchronized with other worker processes in batches.
+        """
+        try:
+            self.server.broker_client.publish({
+                'action': _action,
+                'cache_name': cache_name,
+                'source_worker_id': self.server.worker_id,
+                'ops': ops,
+            })
+        except Exception, e:
+            logger.warn('Could not publish a batch of %d state changes in cache `%s`, e:`%s`', len(ops), cache_name, format_exc(e))
+
 # ################################################################################################################################
 
     def _create_builtin(self, config):
         """ A low-level method building a bCache object for built-in caches. Must be called with self.lock held.
         """
+        cache_config = self.server.fs_server_config.get('cache', {})
+
         config.after_state_changed_callback = self.after_state_changed
+        config.after_state_changed_batch_callback = self.after_state_changed_batch
+        config.sync_batch_window = float(cache_config.get('sync_batch_window', CACHE.DEFAULT.SYNC_BATCH_WINDOW))
+        config.sync_batch_max_ops = int(cache_config.get('sync_batch_max_ops', CACHE.DEFAULT.SYNC_BATCH_MAX_OPS))
         return Cache(config)
 
 # ################################################################################################################################
@@ -988,4 +1166,12 @@ class CacheAPI(object):
         """
         self.caches[cache_type][data.cache_name].sync_after_clear()
 
+# ################################################################################################################################
+
+    def sync_after_batch(self, cache_type, data):
+        """ Synchronizes the state of this worker's cache after a batch of operations in another worker process.
+        """
+        with self.lock:
+            self.caches[cache_type][data.cache_name].sync_after_batch(data.ops)
+
 # ################################################################################################################################
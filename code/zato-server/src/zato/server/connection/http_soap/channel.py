@@ -53,6 +53,14 @@ _status_too_many_requests = b'{} {}'.format(TOO_MANY_REQUESTS, HTTP_RESPONSES[TO
 
 # ################################################################################################################################
 
+# Cached responses are stored as this prefix, JSON-encoded content type, headers and status code, a newline and payload bytes
+_cache_entry_prefix = b'zato.http.cache.1\n'
+
+# How many responses read from caches each worker keeps already parsed, along with their gzipped payloads
+_max_cached_responses = 1000
+
+# ################################################################################################################################
+
 status_response = {}
 for code, response in HTTP_RESPONSES.items():
     status_response[code] = b'{} {}'.format(code, response)
@@ -126,16 +134,37 @@ def get_client_error_wrapper(transport, data_format):
 
 # ################################################################################################################################
 
+def gzip_payload(payload, _stringio=StringIO, _gzipfile=GzipFile):
+    """ Returns input payload compressed with gzip.
+    """
+    s = _stringio()
+    with _gzipfile(fileobj=s, mode='w') as f:
+        f.write(payload)
+
+    out = s.getvalue()
+    s.close()
+
+    return out
+
+# ################################################################################################################################
+
 class _CachedResponse(object):
-    """ A wrapper for responses served from caches.
+    """ A wrapper for responses served from caches. Payload is compressed no more than once, the first time
+    it is needed in that form, after which the same bytes are served to all clients.
     """
-    __slots__ = ('payload', 'content_type', 'headers', 'status_code')
+    __slots__ = ('payload', 'content_type', 'headers', 'status_code', 'gzipped_payload')
 
     def __init__(self, payload, content_type, headers, status_code):
         self.payload = payload
         self.content_type = content_type
         self.headers = headers
         self.status_code = status_code
+        self.gzipped_payload = None
+
+    def get_gzipped_payload(self, _gzip_payload=gzip_payload):
+        if self.gzipped_payload is None:
+            self.gzipped_payload = _gzip_payload(self.payload)
+        return self.gzipped_payload
 
 # ################################################################################################################################
 
@@ -191,7 +220,7 @@ class RequestDispatcher(object):
 
     def dispatch(self, cid, req_timestamp, wsgi_environ, worker_store, _status_response=status_response,
         no_url_match=(None, False), _response_404=response_404, _has_debug=_has_debug,
-        _http_soap_action='HTTP_SOAPACTION', _stringio=StringIO, _gzipfile=GzipFile):
+        _http_soap_action='HTTP_SOAPACTION', _CachedResponse=_CachedResponse, _gzip_payload=gzip_payload):
         """ Base method for dispatching incoming HTTP/SOAP messages. If the security
         configuration is one of the technical account or HTTP basic auth,
         the security validation is being performed. Otherwise, that step
@@ -273,14 +302,14 @@ class RequestDispatcher(object):
 
                 if channel_item['content_encoding'] == 'gzip':
 
-                    s = _stringio()
-                    with _gzipfile(fileobj=s, mode='w') as f:
-                        f.write(response.payload)
-                    response.payload = s.getvalue()
-                    s.close()
-
                     wsgi_environ['zato.http.response.headers']['Content-Encoding'] = 'gzip'
 
+                    # Responses from caches are shared so they cannot be modified, but they keep their gzipped payloads
+                    if isinstance(response, _CachedResponse):
+                        return response.get_gzipped_payload()
+                    else:
+                        response.payload = _gzip_payload(response.payload)
+
                 # Finally return payload to the client
                 return response.payload
 
@@ -355,6 +384,9 @@ class RequestHandler(object):
         self.server = server # A ParallelServer instance
         self.use_soap_envelope = asbool(self.server.fs_server_config.misc.use_soap_envelope)
 
+        # Cache key -> (entry in cache, _CachedResponse built out of it)
+        self.cached_responses = {}
+
 # ################################################################################################################################
 
     def _set_response_data(self, service, **kwargs):
@@ -423,8 +455,8 @@ class RequestHandler(object):
 
 # ################################################################################################################################
 
-    def get_response_from_cache(self, service, raw_request, channel_item, channel_params, wsgi_environ, _loads=loads,
-        _CachedResponse=_CachedResponse, _HashCtx=_HashCtx, _sha256=sha256, split_re=regex_compile('........?').findall):
+    def get_response_from_cache(self, service, raw_request, channel_item, channel_params, wsgi_environ,
+        _HashCtx=_HashCtx, _sha256=sha256, split_re=regex_compile('........?').findall):
         """ Returns a cached response for incoming request or None if there is nothing cached for it.
         By default, an incoming request's hash is calculated by sha256 over a concatenation of:
           * WSGI REQUEST_METHOD   # E.g. GET or POST
@@ -437,7 +469,7 @@ class RequestHandler(object):
         if service.get_request_hash:
             hash_value = service.get_request_hash(_HashCtx(raw_request, channel_item, channel_params, wsgi_environ))
         else:
-            query_string = str(sorted(channel_params.items()))
+            query_string = str(sorted(channel_params.items())) if channel_params else '[]'
             data = '%s%s%s%s' % (wsgi_environ['REQUEST_METHOD'], wsgi_environ['PATH_INFO'], query_string, raw_request)
             hash_value = _sha256(data).hexdigest()
             hash_value = '-'.join(split_re(hash_value))
@@ -446,27 +478,67 @@ class RequestHandler(object):
         cache_key = 'http-channel-%s-%s' % (channel_item['id'], hash_value)
 
         # We have the key so now we can check if there is any matching response already stored in cache
-        response = self.server.get_from_cache(channel_item['cache_type'], channel_item['cache_name'], cache_key)
+        entry = self.server.get_from_cache(channel_item['cache_type'], channel_item['cache_name'], cache_key)
 
         # If there is any response, we can now load into a format that our callers expect
-        if response:
-            response = _loads(response)
-            response = _CachedResponse(response['payload'], response['content_type'], response['headers'],
-                response['status_code'])
+        response = self._get_cached_response(cache_key, entry) if entry else None
 
         return cache_key, response
 
 # ################################################################################################################################
 
-    def set_response_in_cache(self, channel_item, key, response, _dumps=dumps):
+    def _get_cached_response(self, cache_key, entry, _prefix=_cache_entry_prefix, _loads=loads):
+        """ Returns a response out of its cache entry, parsing the entry only if it has not been parsed before.
+        """
+        # Entries set in other processes may be given to us as unicode objects
+        if isinstance(entry, unicode):
+            entry = entry.encode('utf-8')
+
+        # If the entry is the same as last time, the response is ready to be returned as-is
+        cached = self.cached_responses.get(cache_key)
+        if cached and cached[0] == entry:
+            return cached[1]
+
+        # Ignore entries cached in a format that we do not know
+        if not entry.startswith(_prefix):
+            return
+
+        meta, payload = entry[len(_prefix):].split(b'\n', 1)
+        content_type, headers, status_code = _loads(meta)
+
+        response = _CachedResponse(payload, content_type, headers, status_code)
+        self._set_cached_response(cache_key, entry, response)
+
+        return response
+
+# ################################################################################################################################
+
+    def _set_cached_response(self, cache_key, entry, response, _max_cached_responses=_max_cached_responses):
+        if len(self.cached_responses) >= _max_cached_responses:
+            self.cached_responses.clear()
+
+        self.cached_responses[cache_key] = (entry, response)
+
+# ################################################################################################################################
+
+    def set_response_in_cache(self, channel_item, key, response, _prefix=_cache_entry_prefix, _dumps=dumps):
         """ Caches responses from this channel's invocation for as long as the cache is configured to keep it.
+        Returns the response as it will be served from the cache.
         """
-        self.server.set_in_cache(channel_item['cache_type'], channel_item['cache_name'], key, _dumps({
-            'payload': response.payload,
-            'content_type': response.content_type,
-            'headers': response.headers,
-            'status_code': response.status_code,
-        }))
+        payload = response.payload or b''
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+
+        headers = list(response.headers.items())
+        meta = _dumps([response.content_type, headers, response.status_code]).encode('utf-8')
+
+        entry = b'%s%s\n%s' % (_prefix, meta, payload)
+        self.server.set_in_cache(channel_item['cache_type'], channel_item['cache_name'], key, entry)
+
+        cached_response = _CachedResponse(payload, response.content_type, headers, response.status_code)
+        self._set_cached_response(key, entry, cached_response)
+
+        return cached_response
 
 # ################################################################################################################################
 
@@ -501,9 +573,10 @@ class RequestHandler(object):
             merge_channel_params=channel_item.merge_url_params_req,
             params_priority=channel_item.params_pri)
 
-        # Cache the response if needed (cache_key was already created on return from get_response_from_cache)
+        # Cache the response if needed (cache_key was already created on return from get_response_from_cache),
+        # from now on it will be served the same way as if it was found in the cache.
         if channel_item['cache_type']:
-            self.set_response_in_cache(channel_item, cache_key, response)
+            response = self.set_response_in_cache(channel_item, cache_key, response)
 
         # Having used the cache or not, we can return the response now
         return response
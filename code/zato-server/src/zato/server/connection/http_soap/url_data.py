@@ -18,6 +18,9 @@ from traceback import format_exc
 from oauth.oauth import OAuthDataStore, OAuthConsumer, OAuthRequest, OAuthServer, OAuthSignatureMethod_HMAC_SHA1, \
      OAuthSignatureMethod_PLAINTEXT, OAuthToken
 
+# Paste
+from paste.util.converters import asbool
+
 # sec-wall
 from secwall.server import on_basic_auth, on_wsse_pwd
 from secwall.wsse import WSSE
@@ -67,6 +70,7 @@ class URLData(CyURLData, OAuthDataStore):
         self.broker_client = broker_client
         self.odb = odb
         self.jwt_secret = jwt_secret
+        self.jwt_backend = None
         self.vault_conn_api = vault_conn_api
         self.rbac_auth_type_hooks = self.worker.server.fs_server_config.rbac.auth_type_hook
 
@@ -235,6 +239,17 @@ class URLData(CyURLData, OAuthDataStore):
 
 # ################################################################################################################################
 
+    def _set_up_jwt_backend(self):
+        """ Creates a JWT backend shared by all requests to this worker, along with its cache of validated tokens.
+        """
+        misc = self.worker.server.fs_server_config.misc
+
+        self.jwt_backend = JWT(self.kvdb, self.odb, self.jwt_secret,
+            float(misc.get('jwt_verified_time', 5)), float(misc.get('jwt_renew_interval', 5)),
+            asbool(misc.get('jwt_renew_odb', True)))
+
+        return self.jwt_backend
+
     def _handle_security_jwt(self, cid, sec_def, path_info, body, wsgi_environ, ignored_post_data=None, enforce_auth=True):
         """ Performs the authentication using a JavaScript Web Token (JWT).
         """
@@ -256,7 +271,7 @@ class URLData(CyURLData, OAuthDataStore):
                 return False
 
         token = authorization.split('Bearer ', 1)[1]
-        result = JWT(self.kvdb, self.odb, self.jwt_secret).validate(sec_def.username, token.encode('utf8'))
+        result = (self.jwt_backend or self._set_up_jwt_backend()).validate(sec_def.username, token.encode('utf8'))
 
         if not result.valid:
             if enforce_auth:
@@ -630,7 +645,8 @@ class URLData(CyURLData, OAuthDataStore):
 
         # No error, let's delete channel info
         if match_idx != ZATO_NONE:
-            self.channel_data.pop(match_idx)
+            self.router.remove(self.channel_data.pop(match_idx))
+            self.router.set_order(self.channel_data)
 
 # ################################################################################################################################
 
@@ -1112,7 +1128,7 @@ class URLData(CyURLData, OAuthDataStore):
 
     def sort_channel_data(self):
         """ Sorts channel items by name and then re-arranges the result so that user-facing services are closer to the begining
-        of the list which makes it faster to look them up - searches in the list are O(n).
+        of the list. The order is then stored in the URL router so that the first channel matching a given URL path wins.
         """
         channel_data = []
         user_services = []
@@ -1131,6 +1147,7 @@ class URLData(CyURLData, OAuthDataStore):
         channel_data.extend(internal_services)
 
         self.channel_data[:] = channel_data
+        self.router.set_order(self.channel_data)
 
 # ################################################################################################################################
 
@@ -1183,7 +1200,9 @@ class URLData(CyURLData, OAuthDataStore):
         Clears out URL cache for that entry, if it existed at all.
         """
         match_target = '{}{}{}'.format(msg.soap_action, MISC.SEPARATOR, msg.url_path)
-        self.channel_data.append(self._channel_item_from_msg(msg, match_target, old_data))
+        channel_item = self._channel_item_from_msg(msg, match_target, old_data)
+        self.channel_data.append(channel_item)
+        self.router.add(channel_item)
         self.url_sec[match_target] = self._sec_info_from_msg(msg)
         self.url_path_cache.pop(match_target, None)
         self.sort_channel_data()
@@ -1204,6 +1223,7 @@ class URLData(CyURLData, OAuthDataStore):
         # No error, let's delete channel info
         if match_idx != ZATO_NONE:
             old_data = self.channel_data.pop(match_idx)
+            self.router.remove(old_data)
         else:
             old_data = {}
 
@@ -11,12 +11,14 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # stdlib
 import logging
 from datetime import datetime, timedelta
+from time import time
 from traceback import format_exc
 
 # gevent
 import gevent
+from gevent.event import Event
 from gevent.lock import RLock
-from gevent.queue import Empty, Queue
+from gevent.queue import Empty, LifoQueue
 
 # A set of utilities for constructing greenlets-safe outgoing connection objects.
 # Used, for instance, in SOAP Suds and OpenStack Swift outconns.
@@ -25,38 +27,51 @@ logger = logging.getLogger(__name__)
 
 # ################################################################################################################################
 
+# How long, in seconds, to wait for a free connection by default
+ACQUIRE_TIMEOUT = 10
+
+# Clients idle for longer than that many seconds are pinged before they are checked out, if there is a ping function
+PING_IDLE_TIME = 5
+
+# If any greenlets had to wait for clients, metrics of the queue are logged at most that often, in seconds
+STATS_INTERVAL = 60
+
+# ################################################################################################################################
+
 class _Connection(object):
-    """ Meant to be used as a part of a 'with' block - returns a connection from its queue each time 'with' is entered
-    assuming the queue isn't empty.
+    """ Meant to be used as a part of a 'with' block - returns a connection from its queue each time 'with' is entered,
+    waiting until one is available if all of them are currently in use.
     """
-    def __init__(self, client_queue, conn_name):
-        self.queue = client_queue
+    def __init__(self, conn_queue, conn_name):
+        self.conn_queue = conn_queue
         self.conn_name = conn_name
         self.client = None
 
     def __enter__(self):
-        try:
-            self.client = self.queue.get(block=False)
-        except Empty:
-            self.client = None
-            msg = 'No free connections to `{}`'.format(self.conn_name)
-            logger.error(msg)
-            raise Exception(msg)
-        else:
-            return self.client
+        self.client = self.conn_queue.acquire()
+        return self.client
 
     def __exit__(self, type, value, traceback):
         if self.client:
-            self.queue.put(self.client)
+            self.conn_queue.release(self.client)
 
 # ################################################################################################################################
 
 class ConnectionQueue(object):
-    """ Holds connections to resources. Each time it's called a connection is fetched from its underlying queue
-    assuming any connection is still available.
+    """ Holds connections to resources. Each time it's called a connection is fetched from its underlying queue,
+    possibly after waiting for one to be returned by other greenlets or to be created. Greenlets waiting for connections
+    are given them in the order they started to wait in.
+
+    The queue starts with min_size connections and grows on demand up to pool_size ones. Connections idle for longer
+    than idle_timeout seconds are closed, though never below min_size. So are connections that could not be pinged.
+    Closing a connection means calling close_func with it, if there is one, and no longer holding a reference to it.
     """
-    def __init__(self, pool_size, queue_build_cap, conn_name, conn_type, address, add_client_func):
-        self.queue = Queue(pool_size)
+    def __init__(self, pool_size, queue_build_cap, conn_name, conn_type, address, add_client_func, min_size=None,
+            acquire_timeout=ACQUIRE_TIMEOUT, idle_timeout=None, ping_func=None, ping_idle_time=PING_IDLE_TIME,
+            close_func=None):
+
+        # Most recently returned clients are checked out first so that with idle eviction the rarely used ones are closed
+        self.queue = LifoQueue(pool_size)
         self.queue_build_cap = queue_build_cap
         self.conn_name = conn_name
         self.conn_type = conn_type
@@ -64,49 +79,271 @@ class ConnectionQueue(object):
         self.add_client_func = add_client_func
         self.keep_connecting = True
 
+        self.max_size = pool_size
+        self.min_size = min(pool_size, pool_size if min_size is None else min_size)
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+        self.ping_func = ping_func
+        self.ping_idle_time = ping_idle_time
+        self.close_func = close_func
+
+        # How many clients exist, no matter if in the queue or in use, and how many are being created
+        self.size = 0
+        self.len_pending = 0
+
+        # id(client) -> when it was last returned to the queue
+        self.last_used = {}
+
+        # Set each time a new client is added
+        self.client_added = Event()
+
+        # Metrics
+        self.len_waiters = 0
+        self.len_waited = 0
+        self.len_waited_logged = 0
+        self.len_acquired = 0
+        self.len_timeouts = 0
+        self.len_ping_failed = 0
+        self.len_evicted = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def __call__(self):
-        return _Connection(self.queue, self.conn_name)
+        return _Connection(self, self.conn_name)
+
+# ################################################################################################################################
 
     def put_client(self, client):
+        """ Adds a newly created client to the queue.
+        """
+        self.size += 1
+        self.last_used[id(client)] = time()
         self.queue.put(client)
+        self.client_added.set()
+
         self.logger.info('Added `%s` client to %s (%s)', self.conn_name, self.address, self.conn_type)
 
+# ################################################################################################################################
+
+    def acquire(self, _time=time):
+        """ Returns a client from the queue, waiting up to self.acquire_timeout seconds for one to become available.
+        """
+        start = _time()
+
+        while True:
+
+            # Unless there are other greenlets waiting already, in which case it is their turn first,
+            # a client may be available immediately ..
+            client = None
+
+            if not self.len_waiters:
+                try:
+                    client = self.queue.get(block=False)
+                except Empty:
+                    pass
+
+            # .. if not, we wait for one to be returned or created, growing the queue if it is still allowed to.
+            if client is None:
+                self._grow()
+
+                remaining = self.acquire_timeout - (_time() - start)
+                self.len_waiters += 1
+                self.len_waited += 1
+
+                try:
+                    client = self.queue.get(timeout=max(remaining, 0))
+                except Empty:
+                    self.len_timeouts += 1
+                    msg = 'No free connections to `{}` after {}s (size:{}/{}, waiters:{})'.format(
+                        self.conn_name, self.acquire_timeout, self.size, self.max_size, self.len_waiters - 1)
+                    logger.error(msg)
+                    raise Exception(msg)
+                finally:
+                    self.len_waiters -= 1
+
+            # Clients idle for a while may have been disconnected by the remote end in the meantime
+            if self.ping_func and _time() - self.last_used.get(id(client), 0) > self.ping_idle_time:
+                try:
+                    self.ping_func(client)
+                except Exception:
+                    self.len_ping_failed += 1
+                    logger.warn('Discarding `%s` client to `%s` (%s), e:`%s`', self.conn_name, self.address, self.conn_type,
+                        format_exc())
+                    self._discard(client)
+                    continue
+
+            wait_time = _time() - start
+            self.len_acquired += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+            return client
+
+    def release(self, client):
+        """ Returns a client to the queue, handing it over to the longest waiting greenlet, if there are any.
+        """
+        self.last_used[id(client)] = time()
+        self.queue.put(client)
+
+# ################################################################################################################################
+
+    def _close(self, client):
+        """ Closes a client that will not be used anymore, if there is a function to do it with.
+        """
+        self.last_used.pop(id(client), None)
+
+        if self.close_func:
+            try:
+                self.close_func(client)
+            except Exception:
+                self.logger.warn('Could not close `%s` client to `%s` (%s), e:`%s`', self.conn_name, self.address,
+                    self.conn_type, format_exc())
+
+    def _discard(self, client):
+        """ Removes a client that will not be used anymore.
+        """
+        self.size -= 1
+        self._close(client)
+
+        # Replace the client if it is needed to keep up the minimum size or if anyone is waiting for it
+        if self.keep_connecting and (self.size + self.len_pending < self.min_size or self.len_waiters):
+            self._spawn_add_client_func(1)
+
+    def _grow(self):
+        """ Creates one more client if the queue has not reached its maximum size yet.
+        """
+        if self.keep_connecting and self.size + self.len_pending < self.max_size:
+            self._spawn_add_client_func(1)
+
+# ################################################################################################################################
+
+    def evict_idle(self, _time=time):
+        """ Closes clients idle for longer than self.idle_timeout seconds, keeping at least self.min_size of them.
+        """
+        now = _time()
+        to_keep = []
+        to_evict = []
+
+        # Get all the idle clients at once - no other greenlet runs in the meantime
+        while self.queue.qsize():
+            to_keep.append(self.queue.get(block=False))
+
+        # The least recently used ones are first
+        to_keep.reverse()
+
+        for client in to_keep[:]:
+            if self.size - len(to_evict) <= self.min_size:
+                break
+            if now - self.last_used.get(id(client), now) > self.idle_timeout:
+                to_evict.append(client)
+                to_keep.remove(client)
+
+        # Put back oldest first so that the most recently used ones are still checked out first
+        for client in to_keep:
+            self.queue.put(client)
+
+        for client in to_evict:
+            self.len_evicted += 1
+            self.size -= 1
+            self._close(client)
+
+        if to_evict:
+            self.logger.info('Evicted %d idle `%s` client(s) to `%s` (%s), size:%d/%d',
+                len(to_evict), self.conn_name, self.address, self.conn_type, self.size, self.max_size)
+
+        return to_evict
+
+    def _evict_idle_forever(self):
+        while self.keep_connecting:
+            gevent.sleep(self.idle_timeout / 2.0)
+            try:
+                self.evict_idle()
+            except Exception:
+                self.logger.warn('Could not evict idle clients to `%s`, e:`%s`', self.address, format_exc())
+
+# ################################################################################################################################
+
+    def get_stats(self):
+        """ Returns current metrics of the queue.
+        """
+        return {
+            'size': self.size,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'in_use': self.size - self.queue.qsize(),
+            'idle': self.queue.qsize(),
+            'pending': self.len_pending,
+            'waiters': self.len_waiters,
+            'waited': self.len_waited,
+            'acquired': self.len_acquired,
+            'timeouts': self.len_timeouts,
+            'ping_failed': self.len_ping_failed,
+            'evicted': self.len_evicted,
+            'wait_time_avg': self.wait_time_total / self.len_acquired if self.len_acquired else 0.0,
+            'wait_time_max': self.wait_time_max,
+        }
+
+    def log_stats(self):
+        """ Logs current metrics of the queue if any greenlets had to wait for clients since they were last logged.
+        """
+        if self.len_waited == self.len_waited_logged:
+            return
+
+        stats = self.get_stats()
+        self.len_waited_logged = self.len_waited
+
+        self.logger.info('Queue of `%s` clients to `%s` (%s), waited:%d, timeouts:%d, waiters:%d, in use:%d, size:%d/%d, '
+            'wait time avg:%.3fs, max:%.3fs', self.conn_name, self.address, self.conn_type, stats['waited'], stats['timeouts'],
+            stats['waiters'], stats['in_use'], stats['size'], stats['max_size'], stats['wait_time_avg'], stats['wait_time_max'])
+
+    def _log_stats_forever(self):
+        while self.keep_connecting:
+            gevent.sleep(STATS_INTERVAL)
+            try:
+                self.log_stats()
+            except Exception:
+                self.logger.warn('Could not log statistics of clients to `%s`, e:`%s`', self.address, format_exc())
+
+# ################################################################################################################################
+
     def _build_queue(self):
 
         start = datetime.utcnow()
         build_until = start + timedelta(seconds=self.queue_build_cap)
-        suffix = 's ' if self.queue.maxsize > 1 else ' '
+        suffix = 's ' if self.min_size > 1 else ' '
 
         try:
-            while self.keep_connecting and not self.queue.full():
+            while self.keep_connecting and self.size < self.min_size:
 
-                gevent.sleep(0.5)
+                # Wake up as soon as a new client is added rather than after a fixed sleep
+                self.client_added.wait(0.5)
+                self.client_added.clear()
                 now = datetime.utcnow()
 
                 self.logger.info('%d/%d %s clients obtained to `%s` (%s) after %s (cap: %ss)',
-                    self.queue.qsize(), self.queue.maxsize,
+                    self.size, self.min_size,
                     self.conn_type, self.address, self.conn_name, now - start, self.queue_build_cap)
 
-                if now >= build_until:
+                if self.size < self.min_size and now >= build_until:
 
                     # Log the fact that the queue is not full yet
                     self.logger.warn('Built %s/%s %s clients to `%s` within %s seconds, sleeping until %s (UTC)',
-                        self.queue.qsize(), self.queue.maxsize, self.conn_type, self.address, self.queue_build_cap,
+                        self.size, self.min_size, self.conn_type, self.address, self.queue_build_cap,
                         datetime.utcnow() + timedelta(seconds=self.queue_build_cap))
 
                     # Sleep for a predetermined time
                     gevent.sleep(self.queue_build_cap)
 
                     # Spawn additional greenlets to fill up the queue
-                    self._spawn_add_client_func(self.queue.maxsize - self.queue.qsize())
+                    self._spawn_add_client_func(self.min_size - self.size - self.len_pending)
 
                     start = datetime.utcnow()
                     build_until = start + timedelta(seconds=self.queue_build_cap)
 
             if self.keep_connecting:
-                self.logger.info('Obtained %d %s client%sto `%s` for `%s`', self.queue.maxsize, self.conn_type, suffix,
+                self.logger.info('Obtained %d %s client%sto `%s` for `%s`', self.size, self.conn_type, suffix,
                     self.address, self.conn_name)
             else:
                 self.logger.info('Skipped building a queue to `%s` for `%s`', self.address, self.conn_name)
@@ -116,21 +353,35 @@ class ConnectionQueue(object):
         except KeyboardInterrupt:
             self.keep_connecting = False
 
+    def _add_client(self):
+        try:
+            self.add_client_func()
+        finally:
+            self.len_pending -= 1
+
     def _spawn_add_client_func(self, count):
         """ Spawns as many greenlets to populate the connection queue as there are free slots in the queue available.
         """
         for x in range(count):
-            gevent.spawn(self.add_client_func)
+            self.len_pending += 1
+            gevent.spawn(self._add_client)
 
     def build_queue(self):
         """ Spawns greenlets to populate the queue and waits up to self.queue_build_cap seconds until the queue is full.
         If it never is, raises an exception stating so.
         """
-        self._spawn_add_client_func(self.queue.maxsize)
+        self._spawn_add_client_func(self.min_size)
 
         # Build the queue in background
         gevent.spawn(self._build_queue)
 
+        # Close idle clients in background, if it is needed at all
+        if self.idle_timeout and self.min_size < self.max_size:
+            gevent.spawn(self._evict_idle_forever)
+
+        # Let users know if the queue is too small for its load
+        gevent.spawn(self._log_stats_forever)
+
 # ################################################################################################################################
 
 class Wrapper(object):
@@ -144,7 +395,8 @@ class Wrapper(object):
 
         self.client = ConnectionQueue(
             self.config.pool_size, self.config.queue_build_cap, self.config.name, self.conn_type, self.config.auth_url,
-            self.add_client)
+            self.add_client, self.config.get('pool_min_size'), self.config.get('pool_acquire_timeout') or ACQUIRE_TIMEOUT,
+            self.config.get('pool_idle_timeout'), close_func=self.delete_client)
 
         self.delete_requested = False
         self.update_lock = RLock()
@@ -164,6 +416,12 @@ class Wrapper(object):
 
 # ################################################################################################################################
 
+    def delete_client(self, client):
+        """ Deletes a single connection, e.g. one that the queue evicted.
+        """
+        logger.info('Deleting connection from queue for `%s`', self.config.name)
+        client.delete()
+
     def delete(self):
         with self.update_lock:
 
@@ -172,8 +430,7 @@ class Wrapper(object):
 
             for item in self.client.queue.queue:
                 try:
-                    logger.info('Deleting connection from queue for `%s`', self.config.name)
-                    item.delete()
+                    self.delete_client(item)
                 except Exception:
                     logger.warn('Could not delete connection from queue for `%s`, e:`%s`', self.config.name, format_exc())
 
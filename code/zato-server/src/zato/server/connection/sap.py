@@ -37,7 +37,8 @@ class SAPWrapper(object):
         self.server = server
         self.url = 'rfc://{user}@{host}:{sysnr}/{client}'.format(**self.config)
         self.client = ConnectionQueue(
-            self.config.pool_size, self.config.queue_build_cap, self.config.name, 'SAP', self.url, self.add_client)
+            self.config.pool_size, self.config.queue_build_cap, self.config.name, 'SAP', self.url, self.add_client,
+            ping_func=ping_sap, close_func=self.close_client)
 
         self.update_lock = RLock()
         self.logger = getLogger(self.__class__.__name__)
@@ -57,4 +58,7 @@ class SAPWrapper(object):
 
         self.client.put_client(conn)
 
+    def close_client(self, conn):
+        conn.close()
+
 # ################################################################################################################################
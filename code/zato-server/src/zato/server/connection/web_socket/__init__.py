@@ -15,6 +15,7 @@ from errno import EADDRINUSE
 from httplib import BAD_REQUEST, INTERNAL_SERVER_ERROR, NOT_FOUND, responses
 from logging import getLogger
 from socket import error as SocketError
+from time import time
 from traceback import format_exc
 from urlparse import urlparse
 
@@ -23,6 +24,7 @@ from bunch import bunchify
 
 # gevent
 from gevent import sleep, socket, spawn
+from gevent.event import AsyncResult, Event
 from gevent.lock import RLock
 
 # pyrapidjson
@@ -63,6 +65,17 @@ VAULT_TOKEN_HEADER=VAULT.HEADERS.TOKEN_RESPONSE
 
 # ################################################################################################################################
 
+# How often to ping each client, in seconds
+PING_INTERVAL = 30
+
+# How long to wait for each pong, in seconds
+PING_RESPONSE_WAIT_TIME = 5
+
+# How long to wait for responses to requests sent to clients, in seconds
+CLIENT_RESPONSE_WAIT_TIME = 5
+
+# ################################################################################################################################
+
 class TokenInfo(object):
     def __init__(self, value, ttl, _now=datetime.utcnow):
         self.value = value
@@ -76,6 +89,123 @@ class TokenInfo(object):
 
 # ################################################################################################################################
 
+class KeepAliveScheduler(object):
+    """ Sends background pings to all clients of a WebSocket channel from a single greenlet. Each client is kept
+    in a bucket, covering bucket_size seconds, according to when its next ping is due and all clients from a bucket
+    are pinged in one batch. Pongs from an entire batch are then waited for by a single greenlet too.
+    """
+    def __init__(self, ping_interval=PING_INTERVAL, response_wait_time=PING_RESPONSE_WAIT_TIME, bucket_size=1):
+        self.ping_interval = ping_interval
+        self.response_wait_time = response_wait_time
+        self.bucket_size = bucket_size
+        self.keep_running = False
+
+        # Bucket number -> set of clients due to be pinged within that bucket
+        self.buckets = {}
+
+        # Client -> its bucket number
+        self.clients = {}
+
+        # The most recent bucket whose clients were already pinged
+        self.last_bucket = self._get_bucket(time())
+
+    def _get_bucket(self, due):
+        return int(due // self.bucket_size)
+
+    def add(self, web_socket, _time=time):
+        """ Schedules the next ping to a client, ping_interval seconds from now.
+        """
+        self.remove(web_socket)
+
+        bucket = self._get_bucket(_time() + self.ping_interval)
+        self.buckets.setdefault(bucket, set()).add(web_socket)
+        self.clients[web_socket] = bucket
+
+    def remove(self, web_socket):
+        """ Stops pinging a client, e.g. because it disconnected.
+        """
+        bucket = self.clients.pop(web_socket, None)
+        if bucket is not None:
+            clients = self.buckets[bucket]
+            clients.discard(web_socket)
+            if not clients:
+                del self.buckets[bucket]
+
+    def get_due(self, now):
+        """ Returns all clients whose pings are due as of now, removing them from their buckets.
+        """
+        out = []
+        current = self._get_bucket(now)
+
+        for bucket in xrange(self.last_bucket + 1, current + 1):
+            clients = self.buckets.pop(bucket, None)
+            if clients:
+                for web_socket in clients:
+                    del self.clients[web_socket]
+                out.extend(clients)
+
+        self.last_bucket = max(self.last_bucket, current)
+        return out
+
+    def run_once(self, _time=time):
+        """ Pings all clients that are due and schedules their next pings.
+        """
+        batch = []
+
+        try:
+            for web_socket in self.get_due(_time()):
+
+                # No stream = already disconnected, no need to ping this client anymore
+                if not web_socket.stream:
+                    continue
+
+                # Any client may fail, e.g. with a socket.error if its peer is gone, and this must not
+                # stop other clients from this batch from being pinged and scheduled for their next pings.
+                try:
+                    request_id, response = web_socket.send_ping()
+                except Exception:
+                    logger.warn('Closing connection due to `%s`', format_exc())
+                    try:
+                        web_socket.on_socket_terminated()
+                    except Exception:
+                        logger.warn('Could not close connection, e:`%s`', format_exc())
+                else:
+                    batch.append((web_socket, request_id, response))
+                    self.add(web_socket, _time)
+
+        finally:
+            # Pongs to pings already sent are always waited for, otherwise their responses would never be cleaned up
+            if batch:
+                spawn(self._wait_for_pongs, batch, _time)
+
+        return batch
+
+    def _wait_for_pongs(self, batch, _time=time):
+        until = _time() + self.response_wait_time
+
+        for web_socket, request_id, response in batch:
+            try:
+                web_socket.on_ping_response(request_id, response.wait(max(until - _time(), 0)), self.ping_interval)
+            except Exception, e:
+                logger.warn(format_exc(e))
+
+    def run(self):
+        while self.keep_running:
+            try:
+                self.run_once()
+            except Exception, e:
+                logger.warn(format_exc(e))
+            sleep(self.bucket_size)
+
+    def start(self):
+        self.keep_running = True
+        spawn(self.run)
+
+    def stop(self):
+        self.keep_running = False
+
+# ################################################################################################################################
+
 class WebSocket(_WebSocket):
     """ Encapsulates information about an individual connection from a WebSocket client.
     """
@@ -85,6 +215,7 @@ class WebSocket(_WebSocket):
         self.config = config
         self.initial_http_wsgi_environ = wsgi_environ
         self.has_session_opened = False
+        self.session_opened_event = Event()
         self._token = None
         self.update_lock = RLock()
         self.pub_client_id = 'ws.{}'.format(new_cid())
@@ -111,7 +242,7 @@ class WebSocket(_WebSocket):
         for name in _wsgi_drop_keys:
             self.initial_http_wsgi_environ.pop(name, None)
 
-        # Responses to previously sent requests - keyed by request IDs
+        # Responses to previously sent requests - keyed by request IDs, each response will be set in its AsyncResult
         self.responses_received = {}
 
         _local_address = self.sock.getsockname()
@@ -278,6 +409,7 @@ class WebSocket(_WebSocket):
                 self.token = 'ws.token.{}'.format(self_token)
 
                 self.has_session_opened = True
+                self.session_opened_event.set()
                 self.ext_client_id = request.ext_client_id
                 self.ext_client_name = request.ext_client_name
 
@@ -300,51 +432,53 @@ class WebSocket(_WebSocket):
 
 # ################################################################################################################################
 
-    def send_background_pings(self, ping_extend=30):
+    def send_ping(self, _Class=ClientInvokeRequest):
+        """ Sends a ping to the client without waiting for its pong. Returns the ping's ID and an AsyncResult
+        that will be set once the pong arrives.
+        """
+        msg = _Class(new_cid(), None)
+        response = self.responses_received[msg.id] = AsyncResult()
+
         try:
-            while self.stream:
+            self.ping(msg.serialize())
+        except Exception:
+            self.responses_received.pop(msg.id, None)
+            raise
 
-                # Sleep for N seconds before sending a ping but check if we are connected upfront because
-                # we could have disconnected in between while and sleep calls.
-                sleep(ping_extend)
+        return msg.id, response
 
-                # Ok, still connected
-                if self.stream:
-                    try:
-                        response = self.invoke_client(new_cid(), None, False)
-                    except RuntimeError:
-                        logger.warn('Closing connection due to `%s`', format_exc())
-                        self.on_socket_terminated()
-
-                    with self.update_lock:
-                        if response:
-                            self.pings_missed = 0
-                            self.ping_last_response_time = datetime.utcnow()
-                            self.token.extend(ping_extend)
-                        else:
-                            # self._peer_address, action, self._local_address, self.config.name
-                            self.pings_missed += 1
-                            if self.pings_missed < self.pings_missed_threshold:
-                                logger.warn(
-                                    'Peer %s (%s) missed %s/%s ping messages from %s (%s). Last response time: %s{}'.format(
-                                        ' UTC' if self.ping_last_response_time else ''),
-                                    self._peer_address, self._peer_fqdn, self.pings_missed, self.pings_missed_threshold,
-                                    self._local_address, self.config.name, self.ping_last_response_time)
-                            else:
-                                self.on_forbidden('missed {}/{} ping messages'.format(
-                                    self.pings_missed, self.pings_missed_threshold))
-
-                # No stream = already disconnected, we can quit
-                else:
-                    return
+# ################################################################################################################################
 
-        except Exception, e:
-            logger.warn(format_exc(e))
+    def on_ping_response(self, request_id, response, ping_extend=PING_INTERVAL):
+        """ Called by the keep-alive scheduler with the outcome of a ping previously sent by self.send_ping.
+        """
+        self.responses_received.pop(request_id, None)
+
+        # Already disconnected, nothing to do
+        if not self.stream:
+            return
+
+        with self.update_lock:
+            if response:
+                self.pings_missed = 0
+                self.ping_last_response_time = datetime.utcnow()
+                self.token.extend(ping_extend)
+            else:
+                self.pings_missed += 1
+                if self.pings_missed < self.pings_missed_threshold:
+                    logger.warn(
+                        'Peer %s (%s) missed %s/%s ping messages from %s (%s). Last response time: %s{}'.format(
+                            ' UTC' if self.ping_last_response_time else ''),
+                        self._peer_address, self._peer_fqdn, self.pings_missed, self.pings_missed_threshold,
+                        self._local_address, self.config.name, self.ping_last_response_time)
+                else:
+                    self.on_forbidden('missed {}/{} ping messages'.format(
+                        self.pings_missed, self.pings_missed_threshold))
 
 # ################################################################################################################################
 
     def register_auth_client(self):
-        """ Registers peer in ODB and sets up background pings to keep its connection alive.
+        """ Registers peer in ODB and schedules background pings to keep its connection alive.
         Called only if authentication succeeded.
         """
         self.sql_ws_client_id = self.invoke_service(new_cid(), 'zato.channel.web-socket.client.create', {
@@ -360,7 +494,7 @@ class WebSocket(_WebSocket):
             'channel_name': self.config.name,
         }, needs_response=True).ws_client_id
 
-        spawn(self.send_background_pings)
+        self.container.keep_alive.add(self)
 
 # ################################################################################################################################
 
@@ -475,32 +609,17 @@ class WebSocket(_WebSocket):
 
 # ################################################################################################################################
 
-    def _wait_for_event(self, wait_time, condition_callable, _now=datetime.utcnow, _delta=timedelta,
-                        _sleep=sleep, *args, **kwargs):
-        now = _now()
-        until = now + _delta(seconds=wait_time)
-
-        while now < until:
-
-            response = condition_callable(*args, **kwargs)
-            if response:
-                return response
-            else:
-                _sleep(0.01)
-                now = _now()
-
-# ################################################################################################################################
+    def _set_client_response(self, request_id, response):
+        """ Wakes up whoever waits for a response to request_id. Responses that arrive after the waiter gave up are ignored.
+        """
+        async_result = self.responses_received.get(request_id)
+        if async_result is not None:
+            async_result.set(response)
+        else:
+            logger.info('Ignoring late or unexpected response to `%s` from `%s`', request_id, self.pub_client_id)
 
     def _handle_client_response(self, cid, msg):
-        self.responses_received[msg.in_reply_to] = msg
-
-    def _has_client_response(self, request_id):
-        return self.responses_received.get(request_id)
-
-    def _wait_for_client_response(self, request_id, wait_time=5):
-        """ Wait until a response from client arrives and return it or return None if there is no response up to wait_time.
-        """
-        return self._wait_for_event(wait_time, self._has_client_response, request_id=request_id)
+        self._set_client_response(msg.in_reply_to, msg)
 
 # ################################################################################################################################
 
@@ -575,7 +694,7 @@ class WebSocket(_WebSocket):
         which is a timestamp object. If self.has_session_opened is not True by that time, connection to the remote end
         is closed.
         """
-        if self._wait_for_event(self.config.new_token_wait_time, lambda: self.has_session_opened):
+        if self.session_opened_event.wait(self.config.new_token_wait_time):
             return
 
         # We get here if self.has_session_opened has not been set to True by self.create_session_by
@@ -583,17 +702,28 @@ class WebSocket(_WebSocket):
 
 # ################################################################################################################################
 
-    def invoke_client(self, cid, request, use_send=True, _Class=ClientInvokeRequest):
+    def invoke_client(self, cid, request, use_send=True, _Class=ClientInvokeRequest, wait_time=CLIENT_RESPONSE_WAIT_TIME):
         """ Invokes a remote WSX client with request given on input, returning its response,
         if any was produced in the expected time.
         """
         msg = _Class(cid, request)
-        (self.send if use_send else self.ping)(msg.serialize())
 
-        if _Class is not PubSubClientInvokeRequest:
-            response = self._wait_for_client_response(msg.id)
-            if response:
-                return response if isinstance(response, bool) else response.data # It will be bool in pong responses
+        # Pub/sub messages are not responded to
+        if _Class is PubSubClientInvokeRequest:
+            self.send(msg.serialize())
+            return
+
+        # Register interest in the response before sending the request so that the response is not missed
+        async_result = self.responses_received[msg.id] = AsyncResult()
+
+        try:
+            (self.send if use_send else self.ping)(msg.serialize())
+            response = async_result.wait(wait_time)
+        finally:
+            self.responses_received.pop(msg.id, None)
+
+        if response:
+            return response if isinstance(response, bool) else response.data # It will be bool in pong responses
 
 # ################################################################################################################################
 
@@ -609,6 +739,7 @@ class WebSocket(_WebSocket):
         logger.info('Closing connection from %s (%s) to %s (%s %s %s)',
             self._peer_address, self._peer_fqdn, self._local_address, self.ext_client_id, self.config.name, self.pub_client_id)
 
+        self.container.keep_alive.remove(self)
         self.unregister_auth_client()
         del self.container.clients[self.pub_client_id]
 
@@ -621,14 +752,15 @@ class WebSocket(_WebSocket):
         # Pretend it's an actual response from the client,
         # we cannot use in_reply_to because pong messages are 1:1 copies of ping ones.
         # TODO: Use lxml for XML eventually but for now we are always using JSON
-        self.responses_received[_loads(msg.data)['meta']['id']] = True
+        self._set_client_response(_loads(msg.data)['meta']['id'], True)
 
 # ################################################################################################################################
 
 class WebSocketContainer(WebSocketWSGIApplication):
 
-    def __init__(self, config, *args, **kwargs):
+    def __init__(self, config, keep_alive, *args, **kwargs):
         self.config = config
+        self.keep_alive = keep_alive
         self.clients = {}
         super(WebSocketContainer, self).__init__(*args, **kwargs)
 
@@ -663,7 +795,7 @@ class WebSocketContainer(WebSocketWSGIApplication):
 class WebSocketServer(WSGIServer):
     """ A WebSocket server exposing Zato services to client applications.
     """
-    def __init__(self, config, auth_func, on_message_callback):
+    def __init__(self, config, auth_func, on_message_callback, keep_alive):
 
         address_info = urlparse(config.address)
 
@@ -676,7 +808,8 @@ class WebSocketServer(WSGIServer):
         config.on_message_callback = on_message_callback
         config.needs_auth = bool(config.sec_name)
 
-        super(WebSocketServer, self).__init__((config.host, config.port), WebSocketContainer(config, handler_cls=WebSocket))
+        super(WebSocketServer, self).__init__((config.host, config.port), WebSocketContainer(config, keep_alive,
+            handler_cls=WebSocket))
 
     def invoke_client(self, cid, pub_client_id, request):
         return self.application.invoke_client(cid, pub_client_id, request)
@@ -692,7 +825,10 @@ class ChannelWebSocket(Connector):
     start_in_greenlet = True
 
     def _start(self):
-        self.server = WebSocketServer(self.config, self.auth_func, self.on_message_callback)
+        self.keep_alive = KeepAliveScheduler(self.config.get('ping_interval', PING_INTERVAL))
+        self.keep_alive.start()
+
+        self.server = WebSocketServer(self.config, self.auth_func, self.on_message_callback, self.keep_alive)
         self.is_connected = True
         try:
             self.server.serve_forever()
@@ -703,6 +839,7 @@ class ChannelWebSocket(Connector):
                 raise
 
     def _stop(self):
+        self.keep_alive.stop()
         self.server.stop(3)
 
     def get_log_details(self):
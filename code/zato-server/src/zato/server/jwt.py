@@ -11,8 +11,14 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # stdlib
 import uuid
 from contextlib import closing
-from datetime import datetime
+from datetime import datetime, timedelta
+from hashlib import sha256
 from logging import getLogger
+from time import time
+
+# gevent
+from gevent import spawn, spawn_later
+from gevent.lock import RLock
 
 # Bunch
 from bunch import bunchify, Bunch
@@ -24,7 +30,7 @@ from cryptography.fernet import Fernet
 import jwt
 
 # Zato
-from zato.common.odb.model import JWT as JWT_
+from zato.common.odb.model import JWT as JWT_, KVData
 from zato.server.cache import RobustCache
 
 # ################################################################################################################################
@@ -33,6 +39,132 @@ logger = getLogger(__name__)
 
 # ################################################################################################################################
 
+class TokenCache(object):
+    """ Tokens that a worker recently validated, keyed by their digests. Such tokens are trusted without checking KVDB,
+    decrypting or decoding them again until they are older than verified_time or than the token's own TTL.
+    """
+    def __init__(self, verified_time, max_size=10000):
+        self.verified_time = verified_time
+        self.max_size = max_size
+
+        # Token digest -> (expiration time, token data)
+        self.tokens = {}
+
+    def get_key(self, token):
+        return sha256(token).hexdigest()
+
+    def get(self, key, now):
+        entry = self.tokens.get(key)
+        if entry:
+            if entry[0] > now:
+                return entry[1]
+            else:
+                self.tokens.pop(key, None)
+
+    def set(self, key, token_data, now):
+        if len(self.tokens) >= self.max_size:
+            self.remove_expired(now)
+
+            # All of the tokens are still valid so it is not possible to keep the cache from growing in other ways
+            if len(self.tokens) >= self.max_size:
+                self.tokens.clear()
+
+        self.tokens[key] = (now + min(self.verified_time, token_data.ttl), token_data)
+
+    def remove_expired(self, now):
+        for key, (expires_at, _) in self.tokens.items():
+            if expires_at <= now:
+                del self.tokens[key]
+
+    def delete(self, key):
+        self.tokens.pop(key, None)
+
+# ################################################################################################################################
+
+class TokenRenewer(object):
+    """ Renews expiration of tokens in KVDB, and optionally ODB, in batches. No matter how many times a token was used
+    in a given interval, its expiration is renewed only once, with one pipelined KVDB call and at most one SQL transaction
+    for all the tokens. Tokens are never recreated, only their expiration is extended, which means that a renewal
+    will not bring back a token that was deleted in the meantime. Tokens whose TTL is not longer than the interval
+    would expire before the next flush so they are renewed right away.
+    """
+    def __init__(self, kvdb, odb, interval, needs_odb):
+        self.kvdb = kvdb
+        self.odb = odb
+        self.interval = interval
+        self.needs_odb = needs_odb
+        self.lock = RLock()
+
+        # Token -> its TTL
+        self.pending = {}
+        self.is_scheduled = False
+
+# ################################################################################################################################
+
+    def renew(self, token, ttl):
+        with self.lock:
+            self.pending[token] = ttl
+
+            # Any other renewals pending are written along with this one
+            if ttl <= self.interval:
+                spawn(self.flush)
+
+            # The first renewal since the last flush - all the ones that arrive until the interval passes
+            # will be written along with it.
+            elif not self.is_scheduled:
+                self.is_scheduled = True
+                spawn_later(self.interval, self.flush)
+
+    def cancel(self, token):
+        with self.lock:
+            self.pending.pop(token, None)
+
+# ################################################################################################################################
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.is_scheduled = False
+
+        if not pending:
+            return
+
+        try:
+            pipeline = self.kvdb.conn.pipeline(transaction=False)
+            for token, ttl in pending.iteritems():
+                pipeline.expire(token, ttl)
+            pipeline.execute()
+        except Exception:
+            logger.exception('KVDB exception while renewing %d token(s)', len(pending))
+
+        if self.needs_odb:
+            self._odb_renew(pending)
+
+    def stop(self):
+        self.flush()
+
+    def _odb_renew(self, pending):
+
+        # Tokens with the same TTL will have the same expiration time so they can be updated in one statement
+        by_ttl = {}
+        for token, ttl in pending.iteritems():
+            by_ttl.setdefault(ttl, []).append(token)
+
+        now = datetime.utcnow()
+
+        with closing(self.odb.session()) as session:
+            try:
+                for ttl, tokens in by_ttl.iteritems():
+                    session.query(KVData).\
+                        filter(KVData.key.in_(tokens)).\
+                        update({'expiry_time': now + timedelta(seconds=ttl)}, synchronize_session=False)
+                session.commit()
+            except Exception:
+                logger.exception('ODB exception while renewing %d token(s)', len(pending))
+                session.rollback()
+
+# ################################################################################################################################
+
 class JWT(object):
     """ JWT authentication backend.
     """
@@ -40,13 +172,17 @@ class JWT(object):
 
 # ################################################################################################################################
 
-    def __init__(self, kvdb, odb, secret):
+    def __init__(self, kvdb, odb, secret, verified_time=0, renew_interval=0, renew_odb=True):
         self.odb = odb
         self.cache = RobustCache(kvdb, odb)
 
         self.secret = secret
         self.fernet = Fernet(self.secret)
 
+        # Both are optional - without them, each validation checks KVDB and renews the token immediately
+        self.token_cache = TokenCache(verified_time) if verified_time > 0 else None
+        self.renewer = TokenRenewer(kvdb, odb, renew_interval, renew_odb) if renew_interval > 0 else None
+
 # ################################################################################################################################
 
     def _lookup_jwt(self, username, password):
@@ -88,25 +224,50 @@ class JWT(object):
 
 # ################################################################################################################################
 
-    def validate(self, expected_username, token):
-        """ Check if the given token is (still) valid.
-
-        1. Look for the token in Cache without decrypting/decoding it.
-        2.a If not found, return "Invalid"
-        2.b If found:
-            3. decrypt
-            4. decode
-            5. renew the cache expiration asyncronouysly (do not wait for the update confirmation).
-            5. return "valid" + the token contents
+    def _get_token_data(self, token):
+        """ Returns decoded token data if the token exists in Cache, None otherwise.
         """
         if self.cache.get(token):
             decrypted = self.fernet.decrypt(token)
-            token_data = bunchify(jwt.decode(decrypted, self.secret))
+            return bunchify(jwt.decode(decrypted, self.secret))
+
+# ################################################################################################################################
+
+    def validate(self, expected_username, token, _time=time):
+        """ Check if the given token is (still) valid.
+
+        1. Look for the token among the ones this worker recently validated, if there are any.
+        2. If not found there, look for the token in Cache without decrypting/decoding it.
+        3.a If not found, return "Invalid"
+        3.b If found:
+            4. decrypt
+            5. decode
+            6. renew the cache expiration asyncronouysly (do not wait for the update confirmation),
+               possibly in a batch along with other tokens.
+            7. return "valid" + the token contents
+        """
+        if self.token_cache:
+            now = _time()
+            key = self.token_cache.get_key(token)
+            token_data = self.token_cache.get(key, now)
+
+            if not token_data:
+                token_data = self._get_token_data(token)
+                if token_data:
+                    self.token_cache.set(key, token_data, now)
+        else:
+            token_data = self._get_token_data(token)
+
+        if token_data:
 
             if token_data.username == expected_username:
 
                 # Renew the token expiration
-                self.cache.put(token, token, token_data.ttl, async=True)
+                if self.renewer:
+                    self.renewer.renew(token, token_data.ttl)
+                else:
+                    self.cache.put(token, token, token_data.ttl, async=True)
+
                 return Bunch(valid=True, token=token_data)
 
             else:
@@ -115,11 +276,25 @@ class JWT(object):
         else:
             return Bunch(valid=False, message='Invalid token')
 
+# ################################################################################################################################
+
+    def stop(self):
+        """ Writes out token renewals not flushed yet.
+        """
+        if self.renewer:
+            self.renewer.stop()
+
 # ################################################################################################################################
 
     def delete(self, token):
         """ Deletes a token in both KVDB and ODB.
         """
+        if self.renewer:
+            self.renewer.cancel(token)
+
+        if self.token_cache:
+            self.token_cache.delete(self.token_cache.get_key(token))
+
         self.cache.delete(token)
 
 # ################################################################################################################################
@@ -11,19 +11,25 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # stdlib
 import logging
 from contextlib import closing
+from heapq import heapify, heappop, heappush
 from traceback import format_exc
 
 # gevent
 from gevent import sleep, spawn
+from gevent.event import Event
 from gevent.lock import RLock
 
 # globre
 from globre import compile as globre_compile
 
+# Paste
+from paste.util.converters import asbool
+
 # Zato
 from zato.common import DATA_FORMAT, PUBSUB, SEARCH
 from zato.common.broker_message import PUBSUB as BROKER_MSG_PUBSUB
 from zato.common.exception import BadRequest
+from zato.common.match import CombinedMatcher
 from zato.common.odb.model import WebSocketClientPubSubKeys
 from zato.common.odb.query.pubsub.delivery import confirm_pubsub_msg_delivered as _confirm_pubsub_msg_delivered, \
      get_delivery_server_for_sub_key, get_sql_messages_by_msg_id_list as _get_sql_messages_by_msg_id_list, \
@@ -33,6 +39,7 @@ from zato.common.pubsub import skip_to_external
 from zato.common.util import is_func_overridden, make_repr, new_cid, spawn_greenlet
 from zato.common.util.pubsub import make_short_msg_copy_from_dict
 from zato.common.util.time_ import utcnow_as_ms
+from zato.server.pubsub.publisher import GDPublisher
 
 # ################################################################################################################################
 
@@ -73,6 +80,15 @@ _update_attrs = ('data', 'size', 'expiration', 'priority', 'pub_correl_id', 'in_
 
 _default_expiration = 2147483647 * 1000 # (2 ** 31 - 1) * 1000 milliseconds
 
+# How many topic names, separately for publications and subscriptions, each endpoint caches permission checks for
+_allowed_cache_max_size = 10000
+
+# How many expired messages at most to delete from in-RAM backlog while holding its lock
+_max_expired_per_pass = 5000
+
+# The expiry index is rebuilt if it has this many entries at least and more than twice as many as there are messages
+_expiry_compact_min = 1000
+
 # ################################################################################################################################
 
 _PRIORITY=PUBSUB.PRIORITY
@@ -124,6 +140,12 @@ class Endpoint(object):
         self.pub_topic_patterns = []
         self.sub_topic_patterns = []
 
+        # is_pub -> all patterns combined into a single matcher
+        self.topic_matcher = {}
+
+        # is_pub -> topic name -> pattern that allowed it, or None if none did
+        self.allowed_cache = {True:{}, False:{}}
+
         self.pub_topics = {}
         self.sub_topics = {}
 
@@ -164,6 +186,38 @@ class Endpoint(object):
                     logger.warn('Ignoring invalid {} pattern `{}` for `{}` (role:{}) (reason: no pub=/sub= prefix found)'.format(
                         key, line, self.name, self.role))
 
+        for is_pub, patterns in ((True, self.pub_topic_patterns), (False, self.sub_topic_patterns)):
+            self.topic_matcher[is_pub] = CombinedMatcher([compiled for _, compiled in patterns])
+
+        self.clear_allowed_cache()
+
+# ################################################################################################################################
+
+    def get_allowed_topic_pattern(self, name, is_pub, _max_size=_allowed_cache_max_size):
+        """ Returns the first pattern allowing this endpoint to publish or subscribe to topic by its name,
+        or None if there is no such pattern.
+        """
+        cache = self.allowed_cache[is_pub]
+
+        try:
+            return cache[name]
+        except KeyError:
+            idx = self.topic_matcher[is_pub].match(name)
+            pattern = None if idx is None else (self.pub_topic_patterns if is_pub else self.sub_topic_patterns)[idx][0]
+
+            # Topic names may be arbitrary so the cache cannot grow indefinitely
+            if len(cache) >= _max_size:
+                cache.clear()
+
+            cache[name] = pattern
+            return pattern
+
+# ################################################################################################################################
+
+    def clear_allowed_cache(self):
+        for cache in self.allowed_cache.values():
+            cache.clear()
+
 # ################################################################################################################################
 
 class Topic(object):
@@ -239,6 +293,13 @@ class Topic(object):
     def needs_task_sync(self, _utcnow_as_ms=utcnow_as_ms):
         return _utcnow_as_ms() - self.last_synced >= self.task_sync_interval
 
+# ################################################################################################################################
+
+    def get_task_sync_wait_time(self, now):
+        """ Returns in how many seconds from now the topic will need task synchronization, 0 if it needs it already.
+        """
+        return max(self.task_sync_interval - (now - self.last_synced), 0)
+
 # ################################################################################################################################
 
     def needs_msg_cleanup(self):
@@ -314,6 +375,7 @@ class InRAMSyncBacklog(object):
         self.msg_id_to_sub_key = {} # Msg ID   -> Sub key set  - What subscribers are interested in a given message
         self.msg_id_to_msg = {}     # Msg ID   -> Message data - What is the actual contents of each message
         self.topic_msg_id = {}      # Topic ID -> Msg ID set --- What messages are available for each topic (no matter sub_key)
+        self.msg_expiry = []        # (Expiration time, Msg ID) heap - In what order messages expire
         self.lock = RLock()
 
         # Start in background a cleanup task that deletes all expired and removed messages
@@ -321,7 +383,8 @@ class InRAMSyncBacklog(object):
 
 # ################################################################################################################################
 
-    def add_messages(self, cid, topic_id, topic_name, max_depth, sub_keys, messages, _default_pri=PUBSUB.PRIORITY.DEFAULT):
+    def add_messages(self, cid, topic_id, topic_name, max_depth, sub_keys, messages, _default_pri=PUBSUB.PRIORITY.DEFAULT,
+            _heappush=heappush):
         """ Adds all input messages to sub_keys for the topic.
         """
         with self.lock:
@@ -362,6 +425,9 @@ class InRAMSyncBacklog(object):
                 msg_sub_key = self.msg_id_to_sub_key.setdefault(msg['pub_msg_id'], set())
                 msg_sub_key.update(sub_keys)
 
+                # .. make it known when it expires ..
+                _heappush(self.msg_expiry, (msg['expiration_time'], msg['pub_msg_id']))
+
             # .. and add a reference to it to the topic.
             topic_messages.update(msg_ids)
 
@@ -375,9 +441,15 @@ class InRAMSyncBacklog(object):
                 logger_zato.warn(_warn, msg['msg_id'])
                 return False # No such message
             else:
+                expiration_time = _msg['expiration_time']
+
                 for attr in _update_attrs:
                     _msg[attr] = msg[attr]
 
+                # The entry with the previous expiration time will be skipped by the cleanup task
+                if _msg['expiration_time'] != expiration_time:
+                    heappush(self.msg_expiry, (_msg['expiration_time'], _msg['pub_msg_id']))
+
                 # Ok, found and updated
                 return True
 
@@ -601,63 +673,115 @@ class InRAMSyncBacklog(object):
 
 # ################################################################################################################################
 
-    def run_cleanup_task(self, _utcnow=utcnow_as_ms, _sleep=sleep):
-        """ A background task waking up periodically to remove all expired and retrieved messages from backlog.
+    def _compact_expiry_index(self):
+        """ Rebuilds the expiry index if most of its entries point to messages that are no longer in the backlog,
+        e.g. because they were already delivered. Must be called with self.lock held.
         """
-        while True:
-            try:
-                with self.lock:
+        len_expiry = len(self.msg_expiry)
+        if len_expiry >= _expiry_compact_min and len_expiry > 2 * len(self.msg_id_to_msg):
+            self.msg_expiry = [(msg['expiration_time'], msg_id) for msg_id, msg in self.msg_id_to_msg.iteritems()]
+            heapify(self.msg_expiry)
 
-                    # Local alias
-                    publishers = {}
+# ################################################################################################################################
 
-                    # We keep them separate so as not to modify any objects during iteration.
-                    expired_msg = []
+    def _delete_expired(self, now, max_expired=_max_expired_per_pass, _heappop=heappop):
+        """ Deletes up to max_expired messages that expired as of now and returns them. Must be called with self.lock held.
+        Only messages that actually expired are visited, in the order of their expiration time.
+        """
+        out = []
+        msg_expiry = self.msg_expiry
+
+        while msg_expiry and msg_expiry[0][0] <= now and len(out) < max_expired:
+            expiration_time, msg_id = _heappop(msg_expiry)
+
+            # The message was already deleted or its expiration time changed since this entry was added
+            msg = self.msg_id_to_msg.get(msg_id)
+            if msg is None or msg['expiration_time'] != expiration_time:
+                continue
+
+            # Get all sub_keys waiting for this message and delete the message from each one,
+            # but note that there may be possibly no subscribers at all if the message was published
+            # to a topic without any subscribers.
+            for sub_key in self.msg_id_to_sub_key.pop(msg_id, None) or []:
+                sub_key_msg = self.sub_key_to_msg_id.get(sub_key)
+                if sub_key_msg:
+                    sub_key_msg.discard(msg_id)
+
+            # Remove all references to the message from topic
+            topic_msg = self.topic_msg_id.get(msg['topic_id'])
+            if topic_msg:
+                topic_msg.discard(msg_id)
+
+            # And finally, remove the message's contents
+            del self.msg_id_to_msg[msg_id]
 
-                    # Calling it once will suffice.
-                    now = _utcnow()
+            out.append(msg)
 
-                    for msg_id, msg in self.msg_id_to_msg.iteritems():
+        self._compact_expiry_index()
 
-                        if now >= msg['expiration_time']:
+        return out
 
-                            # It's possible that there will be many expired messages all sent by the same publisher
-                            # so there is no need to query self.pubsub for each message.
-                            if msg['published_by_id'] not in publishers:
-                                publishers[msg['published_by_id']] = self.pubsub.get_endpoint_by_id(msg['published_by_id'])
+# ################################################################################################################################
 
-                            # We can be sure that it is always found
-                            publisher = publishers[msg['published_by_id']]
+    def _log_expired(self, expired):
+        """ Logs each expired message to make sure the expiration event is always logged.
+        """
+        publishers = {}
 
-                            # Log the message to make sure the expiration event is always logged ..
-                            logger_zato.info('Found an expired msg:`%s`, topic:`%s`, publisher:`%s`, pub_time:`%s`, exp:`%s`',
-                                msg['pub_msg_id'], msg['topic_name'], publisher.name, msg['pub_time'], msg['expiration'])
+        for msg in expired:
 
-                            # .. and append it to the list of messages to be deleted.
-                            expired_msg.append((msg['pub_msg_id'], msg['topic_id']))
+            # It's possible that there will be many expired messages all sent by the same publisher
+            # so there is no need to query self.pubsub for each message.
+            if msg['published_by_id'] not in publishers:
+                publishers[msg['published_by_id']] = self.pubsub.get_endpoint_by_id(msg['published_by_id'])
 
-                    # For logging what was done
-                    len_expired = len(expired_msg)
+            # We can be sure that it is always found
+            publisher = publishers[msg['published_by_id']]
 
-                    # Iterate over all the expired messages found and delete them from in-RAM structures
-                    for msg_id, topic_id in expired_msg:
+            logger_zato.info('Found an expired msg:`%s`, topic:`%s`, publisher:`%s`, pub_time:`%s`, exp:`%s`',
+                msg['pub_msg_id'], msg['topic_name'], publisher.name, msg['pub_time'], msg['expiration'])
 
-                        # Get all sub_keys waiting for these messages and delete the message from each one,
-                        # but note that there may be possibly no subscribers at all if the message was published
-                        # to a topic without any subscribers.
-                        for sub_key in self.msg_id_to_sub_key.pop(msg_id):
-                            self.sub_key_to_msg_id[sub_key].remove(msg_id)
+# ################################################################################################################################
 
-                        # Remove all references to the message from topic
-                        self.topic_msg_id[topic_id].remove(msg_id)
+    def run_cleanup(self, _utcnow=utcnow_as_ms, _sleep=sleep, max_expired=_max_expired_per_pass):
+        """ Deletes all messages expired as of now, holding self.lock only for max_expired messages at a time,
+        and returns the number of messages deleted.
+        """
+        len_expired = 0
 
-                        # And finally, remove the message's contents
-                        del self.msg_id_to_msg[msg_id]
+        # Calling it once will suffice.
+        now = _utcnow()
+
+        while True:
+
+            with self.lock:
+                expired = self._delete_expired(now, max_expired)
+
+            len_expired += len(expired)
+
+            # Logging is done without holding self.lock
+            self._log_expired(expired)
+
+            # There are no more expired messages ..
+            if len(expired) < max_expired:
+                return len_expired
+
+            # .. otherwise, let publishers and delivery tasks acquire the lock before we continue.
+            _sleep(0)
+
+# ################################################################################################################################
+
+    def run_cleanup_task(self, _sleep=sleep):
+        """ A background task waking up periodically to remove all expired and retrieved messages from backlog.
+        """
+        while True:
+            try:
+                len_expired = self.run_cleanup()
 
                 suffix = 's' if (len_expired==0 or len_expired > 1) else ''
                 logger.info('In-RAM. Deleted %s pub/sub message%s. Left:%s' % (len_expired, suffix, len(self.msg_id_to_msg)))
 
-                # Sleep for a moment before checking again but don't do it with self.lock held.
+                # Sleep for a moment before checking again
                 _sleep(2)
 
             except Exception:
@@ -722,6 +846,11 @@ class PubSub(object):
         # A backlog of messages that have at least one subscription, i.e. this is what delivery servers use.
         self.sync_backlog = InRAMSyncBacklog(self)
 
+        # IDs of topics that have had messages published since they were last synced with delivery tasks
+        # and an event set each time a new ID is added, which is what self.trigger_notify_pubsub_tasks waits for.
+        self.topics_to_sync = set()
+        self.sync_event = Event()
+
         # Getter methods for each endpoint type that return actual endpoints,
         # e.g. REST outgoing connections. Values are set by worker store.
         self.endpoint_impl_getter = dict.fromkeys(PUBSUB.ENDPOINT_TYPE)
@@ -745,6 +874,14 @@ class PubSub(object):
         self.data_prefix_len = server.fs_server_config.pubsub.data_prefix_len
         self.data_prefix_short_len = server.fs_server_config.pubsub.data_prefix_short_len
 
+        # If enabled, concurrent publications of GD messages to the same topic are committed to SQL together
+        if asbool(server.fs_server_config.pubsub.get('gd_group_commit', False)):
+            self.gd_publisher = GDPublisher(server.odb,
+                float(server.fs_server_config.pubsub.get('gd_group_commit_window', 5)),
+                int(server.fs_server_config.pubsub.get('gd_group_commit_max_msgs', 500)))
+        else:
+            self.gd_publisher = None
+
         spawn_greenlet(self.trigger_notify_pubsub_tasks)
 
 # ################################################################################################################################
@@ -973,6 +1110,12 @@ class PubSub(object):
             for key, value in config.iteritems():
                 sub.config[key] = value
 
+            pubsub_tool = self.pubsub_tool_by_sub_key.get(config.sub_key)
+
+        # A delivery task, if we have one, needs to notice a possible change to its delivery_method
+        if pubsub_tool:
+            pubsub_tool.wake_delivery_task(config.sub_key)
+
 # ################################################################################################################################
 
     def _add_subscription(self, config):
@@ -1102,6 +1245,10 @@ class PubSub(object):
         self.subscriptions_by_topic.pop(topic_name, None) # May have no subscriptions hence .pop instead of del
         del self.topics[topic_id]
 
+        # Permissions for this topic's name should not outlive it in endpoints' caches
+        for endpoint in self.endpoints.values():
+            endpoint.clear_allowed_cache()
+
 # ################################################################################################################################
 
     def delete_topic(self, topic_id):
@@ -1149,9 +1296,7 @@ class PubSub(object):
                 return
 
         # Alright, this endpoint has the correct role, but are there are any matching patterns for this topic?
-        for orig, matcher in getattr(endpoint, target):
-            if matcher.match(name):
-                return orig
+        return endpoint.get_allowed_topic_pattern(name, is_pub)
 
 # ################################################################################################################################
 
@@ -1658,6 +1803,13 @@ class PubSub(object):
         else:
             topic.sync_has_non_gd_msg = value
 
+        if value:
+            self.topics_to_sync.add(topic_id)
+            self.sync_event.set()
+
+        elif not (topic.sync_has_gd_msg or topic.sync_has_non_gd_msg):
+            self.topics_to_sync.discard(topic_id)
+
 # ################################################################################################################################
 
     def set_sync_has_msg(self, topic_id, is_gd, value, gd_pub_time_max):
@@ -1666,49 +1818,64 @@ class PubSub(object):
 
 # ################################################################################################################################
 
-    def trigger_notify_pubsub_tasks(self):
-        """ A background greenlet which periodically lets delivery tasks that there are perhaps
-        new GD messages for the topic this class represents.
+    def trigger_notify_pubsub_tasks(self, _utcnow_as_ms=utcnow_as_ms):
+        """ A background greenlet which lets delivery tasks know that there are perhaps new messages for topics
+        they are subscribed to. It sleeps until a message is published and each topic is synced
+        no more frequently than once in its task_sync_interval.
         """
 
         # Let that be a local object
         def _cmp_non_gd_msg(elem):
             return elem['pub_time']
 
+        # For how long to sleep before the next topic is due to be synced, None = until a new message is published
+        timeout = None
+
         # Loop forever or until stopped
         while self.keep_running:
 
-            # Sleep for a while before continuing - the call to sleep is here because this while loop is quite long
-            # so it would be inconvenient to have it down below.
-            sleep(0.01)
+            self.sync_event.wait(timeout)
 
             # Blocks other pub/sub processes for a moment
             with self.lock:
 
+                self.sync_event.clear()
+                timeout = None
+                now = _utcnow_as_ms()
+
                 # Will map a few temporary objects down below
                 topic_id_dict = {}
 
-                # Get all topics ..
-                for _topic in self.topics.itervalues(): # type: Topic
+                # Get all topics that have had messages published to them since the last time ..
+                for topic_id in list(self.topics_to_sync):
+
+                    _topic = self.topics.get(topic_id) # type: Topic
 
-                    # Does the topic require task synchronization now?
-                    if not _topic.needs_task_sync():
+                    # .. the topic may have been deleted in the meantime ..
+                    if not _topic:
+                        self.topics_to_sync.discard(topic_id)
                         continue
-                    else:
-                        _topic.update_task_sync_time()
 
-                    # OK, the time has come for this topic to sync its state with subscribers
-                    # but still skip it if we know that there have been no messages published to it since the last time.
-                    if not (_topic.sync_has_gd_msg or _topic.sync_has_non_gd_msg):
+                    # .. does the topic require task synchronization now? If not, find out when it will.
+                    wait_time = _topic.get_task_sync_wait_time(now)
+                    if wait_time:
+                        timeout = wait_time if timeout is None else min(timeout, wait_time)
                         continue
+                    else:
+                        _topic.update_task_sync_time()
 
-                    # If it does, get subscriptions for it ..
+                    # OK, the time has come for this topic to sync its state with subscribers, so get subscriptions for it ..
                     subs = self.get_subscriptions_by_topic(_topic.name)
 
-                    # .. if there are any subscriptions at all, we store that information for later use.
+                    # .. if there are any subscriptions at all, we store that information for later use ..
                     if subs:
                         topic_id_dict[_topic.id] = (_topic.name, subs)
 
+                    # .. otherwise, we will check again in the next interval - perhaps someone will subscribe by then.
+                    else:
+                        wait_time = max(_topic.task_sync_interval, 0.01)
+                        timeout = wait_time if timeout is None else min(timeout, wait_time)
+
                 # OK, if we had any subscriptions for at least one topic and there are any messages waiting,
                 # we can continue.
                 try:
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from contextlib import closing
+from logging import getLogger
+from traceback import format_exc
+
+# gevent
+from gevent import spawn, spawn_later
+from gevent.event import AsyncResult
+from gevent.lock import RLock
+
+# Zato
+from zato.common.exception import ServiceUnavailable
+from zato.common.odb.query.pubsub.cleanup import delete_enq_delivered, delete_enq_marked_deleted, delete_msg_delivered, \
+     delete_msg_expired
+from zato.common.odb.query.pubsub.publish import sql_publish_group_with_retry
+from zato.common.odb.query.pubsub.topic import get_gd_depth_topic
+
+# ################################################################################################################################
+
+logger = getLogger('zato_pubsub')
+
+# ################################################################################################################################
+
+def cleanup_sql_data(session, cluster_id, topic_id, now):
+    """ Deletes from SQL messages that were already delivered or that expired, along with their subscriber queue entries.
+    """
+    delete_msg_delivered(session, cluster_id, topic_id)
+    delete_msg_expired(session, cluster_id, topic_id, now)
+    delete_enq_delivered(session, cluster_id, topic_id)
+    delete_enq_marked_deleted(session, cluster_id, topic_id)
+
+# ################################################################################################################################
+
+def reject_publication(cid, topic_name, is_gd):
+    """ Raises an exception to indicate that a publication was rejected.
+    """
+    raise ServiceUnavailable(cid,
+        'Publication rejected - would exceed {} max depth for `{}`'.format('GD' if is_gd else 'non-GD', topic_name))
+
+# ################################################################################################################################
+
+class PubRequest(object):
+    """ GD messages from a single publication waiting to be inserted to SQL along with other publications to the same topic.
+    """
+    __slots__ = ('cid', 'subscriptions_by_topic', 'gd_msg_list', 'now', 'needs_cleanup', 'needs_depth_check', 'result')
+
+    def __init__(self, cid, subscriptions_by_topic, gd_msg_list, now, needs_cleanup, needs_depth_check):
+        self.cid = cid
+        self.subscriptions_by_topic = subscriptions_by_topic
+        self.gd_msg_list = gd_msg_list
+        self.now = now
+        self.needs_cleanup = needs_cleanup
+        self.needs_depth_check = needs_depth_check
+        self.result = AsyncResult()
+
+# ################################################################################################################################
+
+class PubGroup(object):
+    """ All publications to a given topic that will be committed to SQL in one transaction.
+    """
+    __slots__ = ('cluster_id', 'topic', 'requests', 'len_msg_list')
+
+    def __init__(self, cluster_id, topic):
+        self.cluster_id = cluster_id
+        self.topic = topic
+        self.requests = []
+        self.len_msg_list = 0
+
+# ################################################################################################################################
+
+class GDPublisher(object):
+    """ Group-commits GD messages - publications to the same topic that arrive within a window of a few milliseconds
+    from each other are inserted to SQL with a single multi-row INSERT for topic messages and one for subscriber queues,
+    all in one transaction. Each publisher waits until its messages are committed and receives its own result or error.
+    """
+    def __init__(self, odb, window, max_msgs):
+        self.odb = odb
+        self.window = window / 1000.0 # In milliseconds on input
+        self.max_msgs = max_msgs
+        self.lock = RLock()
+
+        # Topic ID -> PubGroup waiting to be committed
+        self.groups = {}
+
+# ################################################################################################################################
+
+    def publish(self, cid, cluster_id, topic, subscriptions_by_topic, gd_msg_list, now, needs_cleanup, needs_depth_check):
+        """ Enqueues GD messages to be committed with other publications to the same topic and waits until they are.
+        Returns the topic's new GD depth if it was checked in this transaction, None otherwise. Raises an exception
+        if the messages could not be published.
+        """
+        request = PubRequest(cid, subscriptions_by_topic, gd_msg_list, now, needs_cleanup, needs_depth_check)
+
+        with self.lock:
+            group = self.groups.get(topic.id)
+
+            # The first publication to the topic since the last commit - it will be committed in a moment,
+            # along with any other ones that arrive in the meantime.
+            if not group:
+                group = self.groups[topic.id] = PubGroup(cluster_id, topic)
+                spawn_later(self.window, self.commit, group)
+
+            group.requests.append(request)
+            group.len_msg_list += len(gd_msg_list)
+
+            # There are enough messages to commit them without waiting until the end of the window
+            if group.len_msg_list >= self.max_msgs:
+                spawn(self.commit, group)
+
+        return request.result.get()
+
+# ################################################################################################################################
+
+    def commit(self, group):
+        """ Inserts to SQL all the messages from a group of publications to a single topic.
+        """
+        with self.lock:
+
+            # Already committed because it reached max_msgs before the window passed
+            if self.groups.get(group.topic.id) is not group:
+                return
+
+            del self.groups[group.topic.id]
+
+        try:
+            self._commit(group.cluster_id, group.topic, group.requests)
+        except Exception:
+
+            # With only one publication in the group, its publisher already received the error
+            if len(group.requests) > 1:
+                logger.info('Group commit failed, committing %d publications to `%s` one by one, e:`%s`',
+                    len(group.requests), group.topic.name, format_exc())
+
+                # Something in the group was not accepted by SQL so we need to commit each publication
+                # in its own transaction to find out which ones it was about.
+                for request in group.requests:
+                    if not request.result.ready():
+                        try:
+                            self._commit(group.cluster_id, group.topic, [request])
+                        except Exception:
+                            pass # The publisher has already been given its exception
+        finally:
+
+            # Publishers wait for their results so there must not be any left without one, no matter what happened above
+            for request in group.requests:
+                if not request.result.ready():
+                    request.result.set_exception(Exception('Messages could not be published to `{}`'.format(group.topic.name)))
+
+# ################################################################################################################################
+
+    def _commit(self, cluster_id, topic, requests, _reject=reject_publication):
+        """ Commits messages from input publications in a single SQL transaction.
+        """
+        to_publish = []
+        current_depth = None
+
+        with closing(self.odb.session()) as session:
+
+            try:
+                # No matter if we can publish or not, we may possibly cleanup old messages first.
+                if any(request.needs_cleanup for request in requests):
+                    cleanup_sql_data(session, cluster_id, topic.id, requests[-1].now)
+
+                # Check the depth only once for the whole group and then count messages from each publication,
+                # rejecting these that would exceed the topic's max depth.
+                if any(request.needs_depth_check for request in requests):
+                    current_depth = get_gd_depth_topic(session, cluster_id, topic.id)
+
+                for request in requests:
+                    len_msg_list = len(request.gd_msg_list)
+
+                    if current_depth is not None:
+                        if request.needs_depth_check and current_depth + len_msg_list > topic.max_depth_gd:
+                            try:
+                                _reject(request.cid, topic.name, True)
+                            except Exception as e:
+                                request.result.set_exception(e)
+                                continue
+
+                        current_depth += len_msg_list
+
+                    # Each publisher learns what the depth was right after its own messages were added
+                    to_publish.append((request, current_depth if request.needs_depth_check else None))
+
+                if to_publish:
+
+                    logger.info('Inserting GD messages for topic `%s` `%s` in a group of %d (cids:%s)', topic.name,
+                        [elem['pub_msg_id'] for request, _ in to_publish for elem in request.gd_msg_list],
+                        len(to_publish), [request.cid for request, _ in to_publish])
+
+                    # This is the call that runs SQL INSERT statements with messages for topics and subscriber queues
+                    sql_publish_group_with_retry(session, to_publish[0][0].cid, cluster_id, topic.id,
+                        [(request.subscriptions_by_topic, request.gd_msg_list, request.now) for request, _ in to_publish])
+
+                # Run an SQL commit for all queries above ..
+                session.commit()
+
+            except Exception as e:
+                session.rollback()
+
+                # .. if there is only one publication, we can report the error directly to its publisher.
+                if len(requests) == 1:
+                    requests[0].result.set_exception(e)
+                raise
+
+        # .. the commit was successful, let all publishers know about it.
+        for request, request_depth in to_publish:
+            request.result.set(request_depth)
+
+# ################################################################################################################################
@@ -9,18 +9,20 @@ Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 # stdlib
-from bisect import bisect_left
 from copy import deepcopy
+from itertools import count
 from logging import getLogger
+from operator import attrgetter
 from socket import error as SocketError
 from traceback import format_exc
 
 # gevent
 from gevent import sleep, spawn
+from gevent.event import Event
 from gevent.lock import RLock
 
 # sortedcontainers
-from sortedcontainers import SortedList as _SortedList
+from sortedcontainers import SortedListWithKey
 
 # Zato
 from zato.common import PUBSUB
@@ -42,28 +44,49 @@ logger_zato = getLogger('zato')
 _hook_action = PUBSUB.HOOK_ACTION
 _notify_methods = (PUBSUB.DELIVERY_METHOD.NOTIFY.id, PUBSUB.DELIVERY_METHOD.WEB_SOCKET.id)
 
+_get_sort_key = attrgetter('sort_key')
+
+# Breaks ties between messages of the same priority and publication times, keeping them in the order they were enqueued in
+_msg_seq = count()
+
 # ################################################################################################################################
 
-class SortedList(_SortedList):
-    """ A custom subclass that knows how to remove pubsub messages from SortedList instances.
+class SortedList(SortedListWithKey):
+    """ A list of pubsub messages sorted by their precomputed sort keys, which are unique, with a look-up dict
+    of messages by their IDs. Thanks to both, finding and removing a message takes O(log n) instead of a scan.
     """
-    def remove_pubsub_msg(self, msg):
-        """ Removes a pubsub message from a SortedList instance - we cannot use the regular .remove method
-        because it may triggger __cmp__ per https://github.com/grantjenks/sorted_containers/issues/81.
+    def __init__(self, iterable=None):
+        self.msg_id_to_msg = {}
+        super(SortedList, self).__init__(key=_get_sort_key)
+
+        if iterable is not None:
+            for msg in iterable:
+                self.add(msg)
+
+    def add(self, msg):
+        """ Adds a message unless one with the same ID is already enqueued.
         """
-        pos = bisect_left(self._maxes, msg)
+        if msg.pub_msg_id not in self.msg_id_to_msg:
+            self.msg_id_to_msg[msg.pub_msg_id] = msg
+            super(SortedList, self).add(msg)
 
-        if pos == len(self._maxes):
-            raise ValueError('{0!r} not in list'.format(msg))
+    def clear(self):
+        self.msg_id_to_msg.clear()
+        super(SortedList, self).clear()
 
-        for _list_idx, _list_msg in enumerate(self._lists[pos]):
-            if msg.pub_msg_id == _list_msg.pub_msg_id:
-                idx = _list_idx
-                break
-        else:
+    def get_pubsub_msg(self, msg_id):
+        """ Returns a message by its ID or None if there is no such message.
+        """
+        return self.msg_id_to_msg.get(msg_id)
+
+    def remove_pubsub_msg(self, msg):
+        """ Removes a pubsub message from a SortedList instance, raising ValueError if it is not there.
+        """
+        _msg = self.msg_id_to_msg.pop(msg.pub_msg_id, None)
+        if _msg is None:
             raise ValueError('{0!r} not in list'.format(msg))
 
-        self._delete(pos, idx)
+        self.remove(_msg)
 
 # ################################################################################################################################
 
@@ -99,6 +122,10 @@ class DeliveryTask(object):
         # This is a lock used for micro-operations such as changing or consulting the contents of self.delete_requested.
         self.interrupt_lock = RLock()
 
+        # Set each time there are new messages to deliver, our configuration changes or we are to stop,
+        # which lets the task sleep for as long as it has nothing to do.
+        self.wake_event = Event()
+
         # If self.wrap_in_list is True, messages will be always wrapped in a list,
         # even if there is only one message to send. Note that self.wrap_in_list will be False
         # only if both batch_size is 1 and wrap_one_msg_in_list is True.
@@ -138,12 +165,11 @@ class DeliveryTask(object):
 
             # Build a list of actual messages to be deleted - we cannot use a msg_id list only
             # because the SortedList always expects actual message objects for comparison purposes.
-            # This will not be called too often so it is fine to iterate over self.delivery_list
-            # instead of employing look up dicts just in case a message would have to be deleted.
             to_delete = []
-            for msg in self.delivery_list:
-                if msg.pub_msg_id in msg_list:
-                    msg_list.remove(msg.pub_msg_id) # We can trim it since we know it won't appear again
+            for msg_id in msg_list[:]:
+                msg = self.delivery_list.get_pubsub_msg(msg_id)
+                if msg:
+                    msg_list.remove(msg_id) # We can trim it since we know it won't appear again
                     to_delete.append(msg)
 
             # We are a task that sends out notifications
@@ -208,9 +234,7 @@ class DeliveryTask(object):
     def get_message(self, msg_id):
         """ Returns a particular message enqueued by this delivery task.
         """
-        for msg in self.delivery_list:
-            if msg.pub_msg_id == msg_id:
-                return msg
+        return self.delivery_list.get_pubsub_msg(msg_id)
 
 # ################################################################################################################################
 
@@ -322,18 +346,34 @@ class DeliveryTask(object):
 
 # ################################################################################################################################
 
-    def _should_wake(self, _now=utcnow_as_ms):
-        """ Returns True if the task should be woken up g. because its time has come already to process messages,
-        assumming there are any waiting for it.
+    def wake(self):
+        """ Lets the task know that there are new messages for it or that its configuration has changed.
+        """
+        self.wake_event.set()
+
+# ################################################################################################################################
+
+    def _wait_for_wake_up(self, timeout=None):
+        """ Sleeps until self.wake is called or until timeout seconds pass, if timeout is given.
+        """
+        self.wake_event.wait(timeout)
+        self.wake_event.clear()
+
+# ################################################################################################################################
+
+    def _get_wait_time(self, _now=utcnow_as_ms):
+        """ Returns for how many seconds the task should still wait before it can process messages, so as not to run
+        more frequently than once in self.delivery_interval. Returns 0 if the time has come already.
         """
         now = _now()
         diff = round(now - self.last_run, 2)
 
         if diff >= self.delivery_interval:
-            if self.delivery_list:
-                logger.info('Waking task:%s now:%s last:%s diff:%s interval:%s len-list:%d',
-                    self.sub_key, now, self.last_run, diff, self.delivery_interval, len(self.delivery_list))
-                return True
+            logger.info('Waking task:%s now:%s last:%s diff:%s interval:%s len-list:%d',
+                self.sub_key, now, self.last_run, diff, self.delivery_interval, len(self.delivery_list))
+            return 0
+
+        return self.delivery_interval - diff
 
 # ################################################################################################################################
 
@@ -361,10 +401,8 @@ class DeliveryTask(object):
             while self.keep_running:
 
                 # We are a task that does not notify endpoints of nothing - they will query us themselves
-                # so in such a case we can sleep for a while and repeat the loop - perhaps in the meantime
+                # so in such a case we can sleep until woken up and repeat the loop - perhaps in the meantime
                 # someone will change delivery_method to one that allows for notifications to be sent.
-                # If not, we will be simply looping forever, checking periodically
-                # if we can send notifications already.
 
                 # Apparently, our delivery method has changed since the last time our self.sub_config
                 # was modified, so we can log this fact and store it for later use.
@@ -377,10 +415,21 @@ class DeliveryTask(object):
                     self.previous_delivery_method = self.sub_config.delivery_method
 
                 if self.sub_config.delivery_method not in _notify_methods:
-                    sleep(5)
+                    self._wait_for_wake_up()
+                    continue
+
+                # Nothing to deliver - sleep until there are new messages for us
+                if not self.delivery_list:
+                    self._wait_for_wake_up()
                     continue
 
-                if self._should_wake():
+                # There are messages but it is not our turn yet
+                wait_time = self._get_wait_time()
+                if wait_time:
+                    sleep(wait_time)
+                    continue
+
+                else:
 
                     with self.delivery_lock:
 
@@ -392,7 +441,7 @@ class DeliveryTask(object):
                         # successfully delivered.
                         result = self.run_delivery()
 
-                        # On success, sleep for a moment because we have just run out of all messages.
+                        # On success, check at once if there are any new messages, sleeping if there are none.
                         if result == _status.OK:
                             continue
 
@@ -410,11 +459,6 @@ class DeliveryTask(object):
                             logger_zato.warn(msg)
                             sleep(sleep_time)
 
-                else:
-
-                    # Wait for our turn
-                    sleep(default_sleep_time)
-
 # ################################################################################################################################
 
         except Exception, e:
@@ -429,6 +473,7 @@ class DeliveryTask(object):
         if self.keep_running:
             logger.info('Stopping delivery task for sub_key:`%s`', self.sub_key)
             self.keep_running = False
+            self.wake()
 
 # ################################################################################################################################
 
@@ -465,9 +510,11 @@ class DeliveryTask(object):
 # ################################################################################################################################
 
 class Message(PubSubMessage):
-    """ Wrapper for messages adding __cmp__ which uses a custom comparison protocol,
-    by priority, then ext_pub_time, then pub_time.
+    """ Wrapper for messages adding a precomputed sort key which orders them by priority, then ext_pub_time,
+    then pub_time and finally by the order they were enqueued in.
     """
+    __slots__ = ('sort_key',)
+
     def __init__(self):
         super(Message, self).__init__()
         self.sub_key = None
@@ -489,14 +536,17 @@ class Message(PubSubMessage):
         self.pub_time_iso = None
         self.ext_pub_time_iso = None
         self.expiration_time_iso = None
+        self.sort_key = None
 
 # ################################################################################################################################
 
-    def __cmp__(self, other, max_pri=9):
-        return cmp(
-            (max_pri - self.priority, self.ext_pub_time, self.pub_time),
-            (max_pri - other.priority, other.ext_pub_time, other.pub_time)
-        )
+    def set_sort_key(self, _max_pri=PUBSUB.PRIORITY.MAX, _msg_seq=_msg_seq):
+        """ Computes the key that delivery lists sort messages by - must be called once all attributes are set.
+        """
+        self.sort_key = (_max_pri - self.priority, self.ext_pub_time, self.pub_time, next(_msg_seq))
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
 
 # ################################################################################################################################
 
@@ -522,6 +572,8 @@ class Message(PubSubMessage):
 class GDMessage(Message):
     """ A guaranteed delivery message initialized from SQL data.
     """
+    __slots__ = ('endp_msg_queue_id',)
+
     is_gd_message = True
 
     def __init__(self, sub_key, topic_name, msg):
@@ -549,11 +601,16 @@ class GDMessage(Message):
         # Add times in ISO-8601 for external subscribers
         self.add_iso_times()
 
+        # Needed by delivery lists
+        self.set_sort_key()
+
 # ################################################################################################################################
 
 class NonGDMessage(Message):
     """ A non-guaranteed delivery message initialized from a Python dict.
     """
+    __slots__ = ()
+
     is_gd_message = False
 
     def __init__(self, sub_key, server_name, server_pid, msg, _def_priority=PUBSUB.PRIORITY.DEFAULT,
@@ -589,6 +646,9 @@ class NonGDMessage(Message):
         # Add times in ISO-8601 for external subscribers
         self.add_iso_times()
 
+        # Needed by delivery lists
+        self.set_sort_key()
+
 # ################################################################################################################################
 
 class PubSubTool(object):
@@ -744,6 +804,8 @@ class PubSubTool(object):
         for msg in messages:
             self.delivery_lists[sub_key].add(NonGDMessage(sub_key, self.server_name, self.server_pid, msg))
 
+        self.delivery_tasks[sub_key].wake()
+
 # ################################################################################################################################
 
     def add_non_gd_messages_by_sub_key(self, sub_key, messages):
@@ -845,7 +907,7 @@ class PubSubTool(object):
         # in the database, they should be ignored.
         ignore_list = set()
         for sub_key in sub_key_list:
-            ignore_list.update([msg.endp_msg_queue_id for msg in self.delivery_lists[sub_key] if msg.has_gd])
+            ignore_list.update(msg.endp_msg_queue_id for msg in self.delivery_lists[sub_key] if msg.has_gd)
 
         if self.last_gd_run:
             if len(sub_key_list) == 1:
@@ -874,6 +936,9 @@ class PubSubTool(object):
             self.delivery_lists[sub_key].add(GDMessage(sub_key, topic_name, msg))
             count += 1
 
+        if count:
+            self.delivery_tasks[sub_key].wake()
+
         logger.info('Pushing %d GD message{}to task:%s msg_ids:%s'.format(
             ' ' if count==1 else 's '), count, sub_key, msg_ids)
 
@@ -968,6 +1033,16 @@ class PubSubTool(object):
         with self.lock:
             return self.delivery_tasks[sub_key]
 
+# ################################################################################################################################
+
+    def wake_delivery_task(self, sub_key):
+        """ Wakes up a delivery task for input sub_key, if there is one, e.g. because its configuration has changed.
+        """
+        with self.lock:
+            task = self.delivery_tasks.get(sub_key)
+            if task:
+                task.wake()
+
 # ################################################################################################################################
 
     def delete_messages(self, sub_key, msg_list):
@@ -197,6 +197,8 @@ class Service(object):
     _out_plain_http = None
 
     _req_resp_freq = 0
+    _sio_input_plan = None
+    _sio_output_plan = None
     _has_before_job_hooks = None
     _has_after_job_hooks = None
     _before_job_hooks = []
@@ -350,8 +352,8 @@ class Service(object):
         # self.is_sio attribute is set by ServiceStore during deployment
         if self.has_sio:
             self.request.init(True, self.cid, self.SimpleIO, self.data_format, self.transport, self.wsgi_environ,
-                self.server.encrypt)
-            self.response.init(self.cid, self.SimpleIO, self.data_format)
+                self.server.encrypt, self._sio_input_plan)
+            self.response.init(self.cid, self.SimpleIO, self.data_format, self._sio_output_plan)
 
         # Cache is always enabled
         self.cache = self._worker_store.cache_api
@@ -453,7 +455,7 @@ class Service(object):
             try:
 
                 if service.server.component_enabled.stats:
-                    service.usage = service.kvdb.conn.incr('{}{}'.format(KVDB.SERVICE_USAGE, service.name))
+                    service.usage = service.server.service_stats.incr_usage(service.name)
                 service.invocation_time = _utcnow()
 
                 # All hooks are optional so we check if they have not been replaced with None by ServiceStore.
@@ -665,9 +667,7 @@ class Service(object):
 
         return cid
 
-    def post_handle(self, _get_response_value=get_response_value, _utcnow=datetime.utcnow,
-        _service_time_basic=KVDB.SERVICE_TIME_BASIC, _service_time_raw=KVDB.SERVICE_TIME_RAW,
-        _service_time_raw_by_minute=KVDB.SERVICE_TIME_RAW_BY_MINUTE):
+    def post_handle(self, _get_response_value=get_response_value, _utcnow=datetime.utcnow, _req_resp_sample=KVDB.REQ_RESP_SAMPLE):
         """ An internal method executed after the service has completed and has
         a response ready to return. Updates its statistics and, optionally, stores
         a sample request/response pair.
@@ -680,28 +680,15 @@ class Service(object):
         self.handle_return_time = _utcnow()
         self.processing_time_raw = self.handle_return_time - self.invocation_time
 
-        if self.server.component_enabled.stats:
-
-            proc_time = self.processing_time_raw.total_seconds() * 1000.0
-            proc_time = proc_time if proc_time > 1 else 0
-
-            self.processing_time = int(round(proc_time))
-
-            with self.kvdb.conn.pipeline() as pipe:
+        proc_time = self.processing_time_raw.total_seconds() * 1000.0
+        proc_time = proc_time if proc_time > 1 else 0
 
-                pipe.hset('%s%s' % (_service_time_basic, self.name), 'last', self.processing_time)
-                pipe.rpush('%s%s' % (_service_time_raw, self.name), self.processing_time)
+        self.processing_time = int(round(proc_time))
 
-                key = '%s%s:%s' % (_service_time_raw_by_minute,
-                    self.name, self.handle_return_time.strftime('%Y:%m:%d:%H:%M'))
-                pipe.rpush(key, self.processing_time)
-
-                # .. we'll have 5 minutes (5 * 60 seconds = 300 seconds)
-                # to aggregate processing times for a given minute and then it will expire
-
-                # Note that we need Redis 2.1.3+ otherwise the key has just been overwritten
-                pipe.expire(key, 300)
-                pipe.execute()
+        # Only in-RAM data is updated here, it is the aggregator that will flush it to KVDB in background
+        if self.server.component_enabled.stats:
+            self.server.service_stats.record(
+                self.name, self.processing_time, self.handle_return_time.strftime('%Y:%m:%d:%H:%M'))
 
         #
         # Sample requests/responses
@@ -716,7 +703,7 @@ class Service(object):
                 'req': self.request.raw_request or '',
                 'resp':_get_response_value(self.response), # TODO: Don't parse it here and a moment later below
             }
-            self.kvdb.conn.hmset(key, data)
+            self.kvdb.conn.hmset('%s%s' % (_req_resp_sample, self.name), data)
 
         #
         # Slow responses
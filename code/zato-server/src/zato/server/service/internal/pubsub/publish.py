@@ -24,14 +24,13 @@ from gevent import spawn
 # Zato
 from zato.common import DATA_FORMAT, PUBSUB, ZATO_NONE
 from zato.common.exception import Forbidden, NotFound, ServiceUnavailable
-from zato.common.odb.query.pubsub.cleanup import delete_enq_delivered, delete_enq_marked_deleted, delete_msg_delivered, \
-     delete_msg_expired
 from zato.common.odb.query.pubsub.publish import sql_publish_with_retry
 from zato.common.odb.query.pubsub.topic import get_gd_depth_topic
 from zato.common.pubsub import PubSubMessage
 from zato.common.pubsub import new_msg_id
 from zato.common.util.time_ import datetime_to_ms, utcnow_as_ms
 from zato.server.pubsub import get_expiration, get_priority, PubSub, Topic
+from zato.server.pubsub.publisher import cleanup_sql_data, reject_publication
 from zato.server.service import AsIs, Int, List
 from zato.server.service.internal import AdminService
 
@@ -353,10 +352,44 @@ class Publish(AdminService):
 # ################################################################################################################################
 
     def _cleanup_sql_data(self, session, cluster_id, topic_id, now):
-        delete_msg_delivered(session, cluster_id, topic_id)
-        delete_msg_expired(session, cluster_id, topic_id, now)
-        delete_enq_delivered(session, cluster_id, topic_id)
-        delete_enq_marked_deleted(session, cluster_id, topic_id)
+        cleanup_sql_data(session, cluster_id, topic_id, now)
+
+# ################################################################################################################################
+
+    def _publish_gd(self, ctx, len_gd_msg_list):
+        # Type: PubCtx
+        """ Inserts GD messages to SQL in a transaction of their own.
+        """
+        with closing(self.odb.session()) as session:
+
+            # No matter if we can publish or not, we may possibly cleanup old messages first.
+            if ctx.topic.needs_msg_cleanup():
+                self._cleanup_sql_data(session, ctx.cluster_id, ctx.topic.id, ctx.now)
+
+            # .. test first if we should check the depth in this iteration.
+            if ctx.topic.needs_depth_check():
+
+                # Get current depth of this topic ..
+                ctx.current_depth = get_gd_depth_topic(session, ctx.cluster_id, ctx.topic.id)
+
+                # .. and abort if max depth is already reached.
+                if ctx.current_depth + len_gd_msg_list > ctx.topic.max_depth_gd:
+                    self.reject_publication(ctx.topic.name, True)
+                else:
+
+                    # This only updates the local ctx variable
+                    ctx.current_depth = ctx.current_depth + len_gd_msg_list
+
+            logger_pubsub.info('Inserting GD messages for topic `%s` `%s` published by `%s` (ext:%s) (cid:%s)',
+                ctx.topic.name, [elem['pub_msg_id'] for elem in ctx.gd_msg_list], ctx.endpoint_name,
+                ctx.ext_client_id, self.cid)
+
+            # This is the call that runs SQL INSERT statements with messages for topics and subscriber queues
+            sql_publish_with_retry(session, self.cid, ctx.cluster_id, ctx.topic.id, ctx.subscriptions_by_topic,
+                ctx.gd_msg_list, ctx.now)
+
+            # Run an SQL commit for all queries above
+            session.commit()
 
 # ################################################################################################################################
 
@@ -383,36 +416,15 @@ class Publish(AdminService):
         # We don't always have GD messages on input so there is no point in running an SQL transaction otherwise.
         if has_gd_msg_list:
 
-            with closing(self.odb.session()) as session:
-
-                # No matter if we can publish or not, we may possibly cleanup old messages first.
-                if ctx.topic.needs_msg_cleanup():
-                    self._cleanup_sql_data(session, ctx.cluster_id, ctx.topic.id, ctx.now)
-
-                # .. test first if we should check the depth in this iteration.
-                if ctx.topic.needs_depth_check():
-
-                    # Get current depth of this topic ..
-                    ctx.current_depth = get_gd_depth_topic(session, ctx.cluster_id, ctx.topic.id)
+            # In group-commit mode, messages are inserted to SQL in one transaction with other publications to the same topic,
+            # and we wait here until it is committed or until we are told why our messages were not accepted.
+            if ctx.pubsub.gd_publisher:
+                ctx.current_depth = ctx.pubsub.gd_publisher.publish(self.cid, ctx.cluster_id, ctx.topic,
+                    ctx.subscriptions_by_topic, ctx.gd_msg_list, ctx.now, ctx.topic.needs_msg_cleanup(),
+                    ctx.topic.needs_depth_check())
 
-                    # .. and abort if max depth is already reached.
-                    if ctx.current_depth + len_gd_msg_list > ctx.topic.max_depth_gd:
-                        self.reject_publication(ctx.topic.name, True)
-                    else:
-
-                        # This only updates the local ctx variable
-                        ctx.current_depth = ctx.current_depth + len_gd_msg_list
-
-                logger_pubsub.info('Inserting GD messages for topic `%s` `%s` published by `%s` (ext:%s) (cid:%s)',
-                    ctx.topic.name, [elem['pub_msg_id'] for elem in ctx.gd_msg_list], ctx.endpoint_name,
-                    ctx.ext_client_id, self.cid)
-
-                # This is the call that runs SQL INSERT statements with messages for topics and subscriber queues
-                sql_publish_with_retry(session, self.cid, ctx.cluster_id, ctx.topic.id, ctx.subscriptions_by_topic,
-                    ctx.gd_msg_list, ctx.now)
-
-                # Run an SQL commit for all queries above ..
-                session.commit()
+            else:
+                self._publish_gd(ctx, len_gd_msg_list)
 
             # .. and set a flag to signal that there are some GD messages available
             ctx.pubsub.set_sync_has_msg(ctx.topic.id, True, True, ctx.now)
@@ -496,8 +508,7 @@ class Publish(AdminService):
     def reject_publication(self, topic_name, is_gd):
         """ Raises an exception to indicate that a publication was rejected.
         """
-        raise ServiceUnavailable(self.cid,
-            'Publication rejected - would exceed {} max depth for `{}`'.format('GD' if is_gd else 'non-GD', topic_name))
+        reject_publication(self.cid, topic_name, is_gd)
 
 # ################################################################################################################################
 
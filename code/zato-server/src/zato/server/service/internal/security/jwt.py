@@ -234,7 +234,11 @@ class LogOut(AdminService):
             self.response.payload.result = 'No JWT found'
 
         try:
-            JWTBackend(self.kvdb, self.odb, self.server.fs_server_config.misc.jwt_secret).delete(token)
+            # Use this worker's backend, if it has one, because it may have the token among the ones it recently validated.
+            # Other workers will stop accepting it after the time they keep validated tokens for.
+            jwt_backend = self.server.worker_store.request_dispatcher.url_data.jwt_backend or \
+                JWTBackend(self.kvdb, self.odb, self.server.fs_server_config.misc.jwt_secret)
+            jwt_backend.delete(token)
         except Exception, e:
             self.logger.warn(format_exc(e))
             self.response.status_code = BAD_REQUEST
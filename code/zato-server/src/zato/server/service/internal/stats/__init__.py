@@ -9,7 +9,7 @@ Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 # stdlib
-from calendar import mdays
+from calendar import monthrange
 from collections import OrderedDict
 from contextlib import closing
 from datetime import datetime, timedelta
@@ -25,18 +25,19 @@ from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from dateutil.rrule import MINUTELY, rrule, rruleset
 
-# SciPy
-from scipy import stats as sp_stats
-
 # Zato
 from zato.common import KVDB, SECONDS_IN_DAY, StatsElem, ZatoException
 from zato.common.broker_message import STATS
 from zato.common.odb.model import Service
 from zato.server.service import Integer, UTC
 from zato.server.service.internal import AdminService, AdminSIO
+from zato.server.stats import get_many, get_mean_percentiles, get_service_names, LatencyHistogram, prune_service_names
 
 STATS_KEYS = ('usage', 'max', 'rate', 'mean', 'min')
 
+def _mean(values):
+    return sum(values) / len(values)
+
 def stop_excluding_rrset(freq, start, stop):
     rrs = rruleset()
     rrs.rrule(rrule(freq, dtstart=start, until=stop))
@@ -66,87 +67,111 @@ class BaseAggregatingService(AdminService):
     def stats_enabled(self):
         return self.server.component_enabled.stats
 
-    def aggregate_raw_times(self, key, service_name, max_batch_size=None):
-        """ Aggregates values from a list living under a given key. Returns its
-        min, max, mean and an overall usage count. 'max_batch_size' controls how
-        many items will be fetched from the list so it's possible to fetch less
-        items than its LLEN returns.
+    def get_raw_times(self, keys, mean_percentiles, names, batch_sizes=None):
+        """ Aggregates values from lists living under given keys, one list per service. Returns, for each list,
+        its min, max, mean, an overall usage count, the number of list elements processed and a histogram
+        of all the processing times. Each element is either a single processing time or a histogram of processing times.
+        'batch_sizes' control how many elements will be fetched from each list so it's possible
+        to fetch less items than its LLEN returns.
         """
-        key_len = self.server.kvdb.conn.llen(key)
-        if max_batch_size:
-            batch_size = min(key_len, max_batch_size)
-            if batch_size < key_len:
-                msg = 'batch_size:`%s` < key_len:`%s`, max_batch_size:`%s`, key:`%s`, ' \
-                'consider decreasing the job interval or increasing max_batch_size'
-                self.logger.warn(msg, batch_size, key_len, max_batch_size, key)
-        else:
-            batch_size = key_len
+        conn = self.server.kvdb.conn
+        out = []
 
-        times = [int(elem) for elem in self.server.kvdb.conn.lrange(key, 0, batch_size)]
+        with conn.pipeline(False) as pipe:
+            for idx, key in enumerate(keys):
+                pipe.lrange(key, 0, (batch_sizes[idx] - 1) if batch_sizes else -1)
+            all_elems = pipe.execute() if keys else []
 
-        if times:
-            mean_percentile = int(self.server.kvdb.conn.hget(KVDB.SERVICE_TIME_BASIC + service_name, 'mean_percentile') or 0)
-            max_score = int(sp_stats.scoreatpercentile(times, mean_percentile))
+        for name, elems in zip(names, all_elems):
+            hist = LatencyHistogram.from_raw(elems)
 
-            return min(times), max(times), (sp_stats.tmean(times, (None, max_score)) or 0), len(times)
-        else:
-            return 0, 0, 0, 0
+            if hist.count:
+                out.append((hist.min, hist.max, hist.trimmed_mean(mean_percentiles[name]), hist.count, len(elems), hist))
+            else:
+                out.append((0, 0, 0, 0, len(elems), hist))
 
-    def collect_service_stats(self, keys_pattern, key_prefix, key_suffix, total_seconds,
-                              suffix_needs_colon=True, chop_off_service_name=True, needs_rate=True):
+        return out
 
-        service_stats = {}
-        if suffix_needs_colon:
-            key_suffix = ':' + key_suffix
+    def merge_stats(self, parts, mean_percentile):
+        """ Merges statistics of a single service from many time periods into one. Mean processing time is computed
+        from histograms kept along with the statistics, if all the periods have them, or it is a mean weighted
+        by usage otherwise.
+        """
+        usage = 0
+        time = 0.0
+        min_resp_time = maxint
+        max_resp_time = 0
+        hist = LatencyHistogram()
+        has_hist = True
+
+        for part in parts:
+
+            part_usage = int(float(part.get('usage') or 0))
+            if not part_usage:
+                continue
+
+            usage += part_usage
+            time += part_usage * float(part.get('mean') or 0)
+            min_resp_time = min(min_resp_time, int(float(part.get('min') or 0)))
+            max_resp_time = max(max_resp_time, int(float(part.get('max') or 0)))
+
+            if has_hist and part.get('hist'):
+                hist.merge(LatencyHistogram.from_raw([part['hist']]))
+            else:
+                has_hist = False
+
+        out = {
+            'usage': usage,
+            'min': min_resp_time if usage else 0,
+            'max': max_resp_time,
+            'mean': 0,
+            'rate': 0,
+        }
+
+        if usage:
+            if has_hist:
+                out['mean'] = hist.trimmed_mean(mean_percentile)
+                out['hist'] = hist.to_json()
+            else:
+                out['mean'] = time / usage
+
+        return out
+
+    def collect_service_stats(self, key_prefix, suffixes, total_seconds, needs_rate=True):
+        """ Collects statistics stored under a given key prefix for each of the time periods given on input
+        and merges them into one set of statistics per service.
+        """
+        conn = self.server.kvdb.conn
+        names = sorted(get_service_names(conn))
+        suffixes = list(suffixes)
+        len_suffixes = len(suffixes)
 
-        for key in self.kvdb.conn.keys(keys_pattern):
-            service_name = key.replace(key_prefix, '').replace(key_suffix, '')
-            if chop_off_service_name:
-                service_name = service_name[:-3]
+        keys = ['{}{}:{}'.format(key_prefix, name, suffix) for name in names for suffix in suffixes]
+        values = get_many(conn, 'hgetall', keys)
 
-            values = self.kvdb.conn.hgetall(key)
+        all_parts = {}
+        for idx, name in enumerate(names):
+            parts = [elem for elem in values[idx * len_suffixes:(idx + 1) * len_suffixes] if elem]
+            if parts:
+                all_parts[name] = parts
 
-            stats = service_stats.setdefault(service_name, {})
+        service_stats = {}
+        mean_percentiles = get_mean_percentiles(conn, list(all_parts))
 
-            for name in STATS_KEYS:
-
-                value = values.get(name)
-                if value:
-                    if name in('rate', 'mean'):
-                        value = float(value)
-                    else:
-                        value = int(value)
-
-                    if not name in stats:
-                        if name == 'mean':
-                            stats[name] = []
-                        elif name == 'min':
-                            stats[name] = maxint
-                        else:
-                            stats[name] = 0
-
-                    if name == 'usage':
-                        stats[name] += value
-                    elif name == 'max':
-                        stats[name] = max(stats[name], value)
-                    elif name == 'mean':
-                        stats[name].append(value)
-                    elif name == 'min':
-                        stats[name] = min(stats[name], value)
-
-        for service_name, values in service_stats.items():
-            mean = values.get('mean')
-            if mean:
-                values['mean'] = sp_stats.tmean(mean)
+        for name, parts in all_parts.iteritems():
+            stats = self.merge_stats(parts, mean_percentiles[name])
 
             if needs_rate:
-                values['rate'] = values['usage'] / total_seconds
+                stats['rate'] = stats['usage'] / total_seconds
+
+            service_stats[name] = stats
 
         return service_stats
 
-    def aggregate_partly_aggregated(self, delta, source_strftime_format, source, target, now=None):
+    def aggregate_partly_aggregated(self, delta, source_strftime_format, source, target, sub_suffixes, now=None):
         """ Further aggregates service statistics, e.g. turns per-minute statistics
-        into per-hour statistcs.
+        into per-hour statistcs. 'sub_suffixes' is a callable returning the suffixes of all the source keys
+        that a target key's suffix consists of.
         """
         if not now:
             now = datetime.utcnow()
@@ -156,35 +181,36 @@ class BaseAggregatingService(AdminService):
             total_seconds = delta.total_seconds()
         else:
             # I.e. number of days in the month * seconds a day has
-            total_seconds = mdays[delta_diff.month] * SECONDS_IN_DAY # TODO: Use calendar.monthrange instead of mdays so leap years are taken into account
+            total_seconds = monthrange(delta_diff.year, delta_diff.month)[1] * SECONDS_IN_DAY
 
         key_suffix = delta_diff.strftime(source_strftime_format)
-        service_stats = self.collect_service_stats(
-            '{}*:{}*'.format(source, key_suffix), source, key_suffix, total_seconds)
+        service_stats = self.collect_service_stats(source, sub_suffixes(delta_diff, key_suffix), total_seconds)
 
         self.hset_aggr_keys(service_stats, target, key_suffix)
 
     def hset_aggr_keys(self, service_stats, key_prefix, key_suffix):
-        for service_name, values in service_stats.items():
-            if service_name.endswith(':'):
-                service_name = service_name[:-1]
-
-            aggr_key = '{}{}:{}'.format(key_prefix, service_name, key_suffix)
-            for name in STATS_KEYS:
-                self.hset_aggr_key(aggr_key, name, values[name])
 
-    def hset_aggr_key(self, aggr_key, hash_key, hash_value):
-        self.server.kvdb.conn.hset(aggr_key, hash_key, hash_value)
-
-        # Expire the aggregated key after that many hours
+        # Expire the aggregated keys after that many hours
         expire_after = int(self.server.fs_server_config.get('stats', {}).get('expire_after', 24))
         expire_after = expire_after * 60 * 60 # Hours times minutes in an hour and seconds in a minute
-        self.server.kvdb.conn.expire(aggr_key, expire_after)
+
+        with self.server.kvdb.conn.pipeline(False) as pipe:
+            for service_name, values in service_stats.items():
+                aggr_key = '{}{}:{}'.format(key_prefix, service_name, key_suffix)
+
+                mapping = dict((name, values[name]) for name in STATS_KEYS)
+                if values.get('hist'):
+                    mapping['hist'] = values['hist']
+
+                pipe.hmset(aggr_key, mapping)
+                pipe.expire(aggr_key, expire_after)
+
+            pipe.execute()
 
 # ##############################################################################
 
 class ProcessRawTimes(BaseAggregatingService):
-    def handle(self):
+    def handle(self, _basic=KVDB.SERVICE_TIME_BASIC, _raw=KVDB.SERVICE_TIME_RAW):
 
         if not self.stats_enabled():
             return
@@ -200,35 +226,72 @@ class ProcessRawTimes(BaseAggregatingService):
             key, value = item.split('=')
             config[key] = int(value)
 
-        for key in self.server.kvdb.conn.keys(KVDB.SERVICE_TIME_RAW + '*'):
+        conn = self.server.kvdb.conn
+        names = sorted(get_service_names(conn))
 
-            service_name = key.replace(KVDB.SERVICE_TIME_RAW, '')
+        basic_keys = ['{}{}'.format(_basic, name) for name in names]
+        raw_keys = ['{}{}'.format(_raw, name) for name in names]
 
-            current_mean = float(
-                self.server.kvdb.conn.hget(KVDB.SERVICE_TIME_BASIC + service_name, 'mean_all_time') or 0)
-            current_min = float(self.server.kvdb.conn.hget(KVDB.SERVICE_TIME_BASIC + service_name, 'min_all_time') or 0)
-            current_max = float(self.server.kvdb.conn.hget(KVDB.SERVICE_TIME_BASIC + service_name, 'max_all_time') or 0)
+        current = get_many(conn, 'hmget', basic_keys, 'mean_all_time', 'min_all_time', 'max_all_time', 'usage_all_time')
+        key_lens = get_many(conn, 'llen', raw_keys)
 
-            batch_min, batch_max, batch_mean, batch_total = self.aggregate_raw_times(
-                key, service_name, config.max_batch_size)
+        batch_sizes = []
+        for key, key_len in zip(raw_keys, key_lens):
+            batch_size = min(key_len, config.max_batch_size)
+            if batch_size < key_len:
+                msg = 'batch_size:`%s` < key_len:`%s`, max_batch_size:`%s`, key:`%s`, ' \
+                'consider decreasing the job interval or increasing max_batch_size'
+                self.logger.warn(msg, batch_size, key_len, config.max_batch_size, key)
+            batch_sizes.append(batch_size)
+
+        # Services that have neither basic statistics nor anything to process may have had their keys deleted
+        prune_service_names(conn, [name for name, values, size in zip(names, current, batch_sizes)
+            if not (size or any(values))])
+
+        # Only lists that have anything to process
+        to_process = [idx for idx, size in enumerate(batch_sizes) if size]
+        names = [names[idx] for idx in to_process]
 
-            self.server.kvdb.conn.hset(
-               KVDB.SERVICE_TIME_BASIC + service_name, 'mean_all_time', sp_stats.tmean((batch_mean, current_mean)))
-            self.server.kvdb.conn.hset(
-               KVDB.SERVICE_TIME_BASIC + service_name, 'min_all_time', min(current_min, batch_min))
-            self.server.kvdb.conn.hset(
-                KVDB.SERVICE_TIME_BASIC + service_name, 'max_all_time', max(current_max, batch_max))
+        mean_percentiles = get_mean_percentiles(conn, names)
+        raw_times = self.get_raw_times(
+            [raw_keys[idx] for idx in to_process], mean_percentiles, names, [batch_sizes[idx] for idx in to_process])
 
-            # Services use RPUSH for storing raw times so we are safe to use LTRIM
-            # in order to do away with the already processed ones
-            self.server.kvdb.conn.ltrim(key, batch_total, -1)
+        with conn.pipeline(False) as pipe:
+            for idx, (batch_min, batch_max, batch_mean, batch_usage, batch_elems, _) in zip(to_process, raw_times):
+
+                current_mean, current_min, current_max, current_usage = current[idx]
+
+                if batch_usage:
+                    if current_min is None:
+                        mean, min_resp_time, max_resp_time, usage = batch_mean, batch_min, batch_max, batch_usage
+                    else:
+                        # Statistics from before usage_all_time existed are given the same weight the current batch has
+                        current_usage = int(current_usage or batch_usage)
+                        usage = current_usage + batch_usage
+
+                        mean = (float(current_mean) * current_usage + batch_mean * batch_usage) / usage
+                        min_resp_time = min(float(current_min), batch_min)
+                        max_resp_time = max(float(current_max), batch_max)
+
+                    pipe.hmset(basic_keys[idx], {
+                        'mean_all_time': mean,
+                        'min_all_time': min_resp_time,
+                        'max_all_time': max_resp_time,
+                        'usage_all_time': usage,
+                    })
+
+                # Services use RPUSH for storing raw times so we are safe to use LTRIM
+                # in order to do away with the already processed ones
+                pipe.ltrim(raw_keys[idx], batch_elems, -1)
+
+            pipe.execute()
 
 # ##############################################################################
 
 class AggregateByMinute(BaseAggregatingService):
     """ Aggregates per-minute times.
     """
-    def handle(self):
+    def handle(self, _raw_by_minute=KVDB.SERVICE_TIME_RAW_BY_MINUTE):
 
         if not self.stats_enabled():
             return
@@ -236,26 +299,48 @@ class AggregateByMinute(BaseAggregatingService):
         # Get all keys from a minute that is sure to have passed, for instance,
         # say it's 13:19 right now (regardless of the seconds part), we'll process everything
         # that happened in 13:17. Hence it's also important that any changes in the minutes
-        # to be picked up here below be kept in sync with the EXPIRE command Service._post_handle uses.
+        # to be picked up here below be kept in sync with the EXPIRE command ServiceStatsAggregator.flush uses.
 
         now = datetime.utcnow()
         key_suffix = (now - timedelta(minutes=2)).strftime('%Y:%m:%d:%H:%M')
 
-        for key in self.server.kvdb.conn.keys('{}*:{}'.format(KVDB.SERVICE_TIME_RAW_BY_MINUTE, key_suffix)):
+        conn = self.server.kvdb.conn
+        names = sorted(get_service_names(conn))
+        keys = ['{}{}:{}'.format(_raw_by_minute, name, key_suffix) for name in names]
 
-            service_name = key.replace(KVDB.SERVICE_TIME_RAW_BY_MINUTE, '').replace(':' + key_suffix, '')
-            aggr_key = '{}{}:{}'.format(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, service_name, key_suffix)
+        # Only services that were invoked in that minute
+        key_lens = get_many(conn, 'llen', keys)
+        to_process = [idx for idx, key_len in enumerate(key_lens) if key_len]
+        names = [names[idx] for idx in to_process]
 
-            batch_min, batch_max, batch_mean, batch_total = self.aggregate_raw_times(key, service_name)
+        mean_percentiles = get_mean_percentiles(conn, names)
+        raw_times = self.get_raw_times([keys[idx] for idx in to_process], mean_percentiles, names)
 
-            self.hset_aggr_key(aggr_key, 'min', batch_min)
-            self.hset_aggr_key(aggr_key, 'max', batch_max)
-            self.hset_aggr_key(aggr_key, 'mean', batch_mean)
-            self.hset_aggr_key(aggr_key, 'usage', batch_total)
-            self.hset_aggr_key(aggr_key, 'rate', batch_total / 60.0) # I.e. req/s
+        service_stats = {}
+
+        for name, (batch_min, batch_max, batch_mean, batch_usage, _, hist) in zip(names, raw_times):
+            service_stats[name] = {
+                'min': batch_min,
+                'max': batch_max,
+                'mean': batch_mean,
+                'usage': batch_usage,
+                'rate': batch_usage / 60.0, # I.e. req/s
+                'hist': hist.to_json(),
+            }
+
+        self.hset_aggr_keys(service_stats, KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, key_suffix)
+
+        # Raw per-minute statistics keys will expire by themselves, we don't need
+        # to delete them manually.
+
+def _get_minutes(_ignored, key_suffix):
+    return ['{}:{:02}'.format(key_suffix, idx) for idx in range(60)]
+
+def _get_hours(_ignored, key_suffix):
+    return ['{}:{:02}'.format(key_suffix, idx) for idx in range(24)]
 
-            # Raw per-minute statistics keys will expire by themselves, we don't need
-            # to delete them manually.
+def _get_days(delta_diff, key_suffix):
+    return ['{}:{:02}'.format(key_suffix, idx) for idx in range(1, monthrange(delta_diff.year, delta_diff.month)[1] + 1)]
 
 class AggregateByHour(BaseAggregatingService):
     """ Creates per-hour stats.
@@ -270,7 +355,7 @@ class AggregateByHour(BaseAggregatingService):
         source = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE
         target = KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR
 
-        self.aggregate_partly_aggregated(delta, source_strftime_format, source, target)
+        self.aggregate_partly_aggregated(delta, source_strftime_format, source, target, _get_minutes)
 
 class AggregateByDay(BaseAggregatingService):
     """ Creates per-day stats.
@@ -285,7 +370,7 @@ class AggregateByDay(BaseAggregatingService):
         source = KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR
         target = KVDB.SERVICE_TIME_AGGREGATED_BY_DAY
 
-        self.aggregate_partly_aggregated(delta, source_strftime_format, source, target)
+        self.aggregate_partly_aggregated(delta, source_strftime_format, source, target, _get_hours)
 
 class AggregateByMonth(BaseAggregatingService):
     """ Creates per-month stats.
@@ -300,7 +385,7 @@ class AggregateByMonth(BaseAggregatingService):
         source = KVDB.SERVICE_TIME_AGGREGATED_BY_DAY
         target = KVDB.SERVICE_TIME_AGGREGATED_BY_MONTH
 
-        self.aggregate_partly_aggregated(delta, source_strftime_format, source, target)
+        self.aggregate_partly_aggregated(delta, source_strftime_format, source, target, _get_days)
 
 # ##############################################################################
 
@@ -379,43 +464,49 @@ class StatsReturningService(AdminService):
 
         if not suffixes:
             suffixes = self.get_suffixes(start, stop)
+        suffixes = list(suffixes)
 
-        # We make several passes. First two passes are made over Redis keys, one gathers the services, if any at all,
-        # and another one actually collects statistics for each service found. Next pass, a partly optional one,
-        # computes trends for mean response time and service usage. Another one computes each of the service's
-        # average rate and updates other attributes basing on values collected in the previous step.
+        # We make several passes. The first one reads all the keys of the services requested, or of all of them
+        # if none was given on input, and the second one collects statistics of each service found. Next pass,
+        # a partly optional one, computes trends for mean response time and service usage. Another one computes
+        # each of the service's average rate and updates other attributes basing on values collected in the previous step.
         # Optionally, the last one will pick only top n elements of a given type (top mean response time
         # or top usage).
 
         # 1st pass
-        for suffix in suffixes:
-            keys = self.server.kvdb.conn.keys('{}{}:{}'.format(stats_key_prefix, service, suffix))
-            for key in keys:
-                service_name = key.replace(stats_key_prefix, '').replace(':{}'.format(suffix), '')
-
-                stats_elem = StatsElem(service_name)
-                stats_elems[service_name] = stats_elem
-
-                # When building statistics, we can't expect there will be data for all the time
-                # elems built above so to guard against it, this is a dictionary whose keys are the
-                # said elems and values are mean/usage for each elem. The values will remain
-                # 0/0.0 if there is no data for the time elem, which may mean that in this
-                # particular time slice the service wasn't invoked at all.
-                stats_elem.expected_time_elems = OrderedDict(
-                    (elem, Bunch({'mean':0, 'usage':0.0})) for elem in suffixes)
+        conn = self.server.kvdb.conn
+        names = sorted(get_service_names(conn)) if service == '*' else [service]
+        len_suffixes = len(suffixes)
+
+        keys = ['{}{}:{}'.format(stats_key_prefix, name, suffix) for name in names for suffix in suffixes]
+        values = get_many(conn, 'hgetall', keys)
 
         # 2nd pass
-        for service, stats_elem in stats_elems.items():
-            for suffix in suffixes:
-                key = '{}{}:{}'.format(stats_key_prefix, service, suffix)
+        for idx, service_name in enumerate(names):
+
+            service_values = values[idx * len_suffixes:(idx + 1) * len_suffixes]
+            if not any(service_values):
+                continue
+
+            stats_elem = StatsElem(service_name)
+            stats_elems[service_name] = stats_elem
 
-                # We can convert all the values to floats here to ease with computing
-                # all the stuff and convert them still to integers later on, when necessary.
-                key_values = Bunch(
-                    ((name, float(value)) for (name, value) in self.server.kvdb.conn.hgetall(key).items()))
+            # When building statistics, we can't expect there will be data for all the time
+            # elems built above so to guard against it, this is a dictionary whose keys are the
+            # said elems and values are mean/usage for each elem. The values will remain
+            # 0/0.0 if there is no data for the time elem, which may mean that in this
+            # particular time slice the service wasn't invoked at all.
+            stats_elem.expected_time_elems = OrderedDict(
+                (elem, Bunch({'mean':0, 'usage':0.0})) for elem in suffixes)
+
+            for suffix, key_values in zip(suffixes, service_values):
 
                 if key_values:
 
+                    # We can convert all the values to floats here to ease with computing
+                    # all the stuff and convert them still to integers later on, when necessary.
+                    key_values = Bunch((name, float(key_values[name])) for name in STATS_KEYS if name in key_values)
+
                     time = (key_values.usage * key_values.mean)
                     stats_elem.time += time
 
@@ -429,7 +520,7 @@ class StatsReturningService(AdminService):
                     for attr in('mean', 'usage'):
                         stats_elem.expected_time_elems[suffix][attr] = key_values[attr]
 
-        mean_all_services = '{:.0f}'.format(sp_stats.tmean(mean_all_services_list)) if mean_all_services_list else 0
+        mean_all_services = '{:.0f}'.format(_mean(mean_all_services_list)) if mean_all_services_list else 0
 
         # 3rd pass (partly optional)
         for stats_elem in stats_elems.values():
@@ -443,7 +534,7 @@ class StatsReturningService(AdminService):
             stats_elem.mean_trend_int = [int(elem.mean) for elem in values]
             stats_elem.usage_trend_int = [int(elem.usage) for elem in values]
 
-            stats_elem.mean = float('{:.2f}'.format(sp_stats.tmean(stats_elem.mean_trend_int)))
+            stats_elem.mean = float('{:.2f}'.format(_mean(stats_elem.mean_trend_int)))
             stats_elem.usage = sum(stats_elem.usage_trend_int)
             stats_elem.rate = float('{:.2f}'.format(sum(stats_elem.usage_trend_int) / delta_seconds))
 
@@ -10,10 +10,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 from calendar import monthrange
-from copy import deepcopy
 from datetime import date, datetime, timedelta
-from itertools import chain
-from sys import maxint
 from traceback import format_exc
 
 # Bunch
@@ -27,21 +24,14 @@ from dateutil.rrule import DAILY, HOURLY, MINUTELY, MONTHLY, YEARLY
 # paodate
 from paodate import Date
 
-# SciPy
-from scipy import stats as sp_stats
-
 # Zato
 from zato.common import KVDB, StatsElem, ZatoException
 from zato.server.service import Integer, UTC
-from zato.server.service.internal.stats import BaseAggregatingService, STATS_KEYS, StatsReturningService, \
-    stop_excluding_rrset
+from zato.server.service.internal.stats import BaseAggregatingService, StatsReturningService, stop_excluding_rrset
+from zato.server.stats import get_mean_percentiles
 
 # ##############################################################################
 
-DEFAULT_STATS = {k:0 for k in STATS_KEYS}
-DEFAULT_STATS['mean'] = []
-DEFAULT_STATS['min'] = maxint
-
 class DT_PATTERNS(object):
     CURRENT_YEAR_START = '%Y-01-01'
     CURRENT_MONTH_START = '%Y-%m-01'
@@ -141,22 +131,22 @@ class BaseSummarizingService(BaseAggregatingService):
 
         return (elem.strftime('%Y') for elem in stop_excluding_rrset(YEARLY, start, stop))
 
-    def _get_patterns(self, now, start, stop, kvdb_key, method):
-        return ('{}*:{}'.format(kvdb_key, elem) for elem in method(now, start, stop))
+    def _get_suffixes(self, now, start, stop, kvdb_key, method):
+        return kvdb_key, list(method(now, start, stop))
 
-    def get_by_minute_patterns(self, now, start=None, stop=None):
-        return self._get_patterns(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, self.get_minutely_suffixes)
+    def get_by_minute_suffixes(self, now, start=None, stop=None):
+        return self._get_suffixes(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, self.get_minutely_suffixes)
 
-    def get_by_hour_patterns(self, now, start=None, stop=None):
-        return self._get_patterns(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR, self.get_hourly_suffixes)
+    def get_by_hour_suffixes(self, now, start=None, stop=None):
+        return self._get_suffixes(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR, self.get_hourly_suffixes)
 
-    def get_by_day_patterns(self, now, start=None, stop=None):
-        return self._get_patterns(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_DAY, self.get_daily_suffixes)
+    def get_by_day_suffixes(self, now, start=None, stop=None):
+        return self._get_suffixes(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_DAY, self.get_daily_suffixes)
 
-    def get_by_month_patterns(self, now, start=None, stop=None):
-        return self._get_patterns(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_MONTH, self.get_monthly_suffixes)
+    def get_by_month_suffixes(self, now, start=None, stop=None):
+        return self._get_suffixes(now, start, stop, KVDB.SERVICE_TIME_AGGREGATED_BY_MONTH, self.get_monthly_suffixes)
 
-    def create_summary(self, target, *pattern_names):
+    def create_summary(self, target, *suffix_names):
         try:
 
             now = datetime.utcnow()
@@ -170,36 +160,27 @@ class BaseSummarizingService(BaseAggregatingService):
                 key_suffix = now.strftime(DT_PATTERNS.SUMMARY_SUFFIX_PATTERNS[target])
             total_seconds = (now - start).total_seconds()
 
-            patterns = []
-            for name in pattern_names:
-                patterns.append(getattr(self, 'get_by_{}_patterns'.format(name))(now))
+            # Service name -> its statistics from each of the key prefixes
+            all_parts = {}
+
+            for name in suffix_names:
+                prefix, suffixes = getattr(self, 'get_by_{}_suffixes'.format(name))(now)
+                stats = self.collect_service_stats(prefix, suffixes, None, False)
+
+                for service_name, values in stats.items():
+                    all_parts.setdefault(service_name, []).append(values)
 
             services = {}
+            mean_percentiles = get_mean_percentiles(self.server.kvdb.conn, list(all_parts))
 
-            for elem in chain(*patterns):
-                prefix, suffix = elem.split('*')
-                suffix = suffix[1:]
-                stats = self.collect_service_stats(elem, prefix, suffix, None, False, False, False)
+            for service_name, parts in all_parts.items():
 
-                for service_name, values in stats.items():
-                    stats = services.setdefault(service_name, deepcopy(DEFAULT_STATS))
-
-                    for name in STATS_KEYS:
-                        value = values[name]
-                        if name == 'usage':
-                            stats[name] += value
-                        elif name == 'max':
-                            stats[name] = max(stats[name], value)
-                        elif name == 'mean':
-                            stats[name].append(value)
-                        elif name == 'min':
-                            stats[name] = min(stats[name], value)
-
-            for service_name, values in services.items():
-
-                values['mean'] = round(sp_stats.tmean(values['mean']), 2)
+                values = self.merge_stats(parts, mean_percentiles[service_name])
+                values['mean'] = round(values['mean'], 2)
                 values['rate'] = round(values['usage'] / total_seconds, 2)
 
+                services[service_name] = values
+
         except Exception, e:
             self.logger.debug('Could not store mean/rate. e=`%r`, locals=`%r`',
                 format_exc(e), locals())
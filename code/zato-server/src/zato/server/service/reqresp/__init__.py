@@ -24,7 +24,7 @@ from bunch import Bunch, bunchify
 # lxml
 from lxml import etree
 from lxml.etree import _Element as EtreeElement
-from lxml.objectify import deannotate, Element, ElementMaker, ObjectifiedElement
+from lxml.objectify import deannotate, Element, ElementMaker, ObjectifiedElement, ObjectPath
 
 # SQLAlchemy
 from sqlalchemy.util import KeyedTuple
@@ -34,7 +34,9 @@ from zato.common import NO_DEFAULT_VALUE, PARAMS_PRIORITY, ParsingException, SIM
      ZATO_OK
 from zato.common.odb.api import WritableKeyedTuple
 from zato.common.util import make_repr
-from zato.server.service.reqresp.sio import AsIs, convert_param, ForceType, ServiceInput, SIOConverter
+from zato.server.service.reqresp.sio import AsIs, COMPLEX_VALUE, convert_bool, convert_bool_skip_empty, convert_empty_to_none, \
+     convert_impl, convert_int, convert_param, convert_param_from_plan, ForceType, is_bool, is_int, is_secret, Opaque, \
+     ServiceInput, SIOConverter
 
 logger = logging.getLogger(__name__)
 
@@ -129,16 +131,21 @@ class Request(SIOConverter):
 
 # ################################################################################################################################
 
-    def init(self, is_sio, cid, sio, data_format, transport, wsgi_environ, encrypt_func):
+    def init(self, is_sio, cid, sio, data_format, transport, wsgi_environ, encrypt_func, input_plan=None):
         """ Initializes the object with an invocation-specific data.
         """
         self.input = ServiceInput()
         self.encrypt_func = encrypt_func
 
         if is_sio:
-            required_list = getattr(sio, 'input_required', [])
-            required_list = [required_list] if isinstance(required_list, basestring) else required_list
-            self.init_flat_sio(cid, sio, data_format, transport, wsgi_environ, required_list)
+
+            # The plan is not used if SimpleIO or its config changed since it was compiled
+            if input_plan and input_plan.is_valid_for(sio, self.simple_io_config):
+                self.init_flat_sio(cid, sio, data_format, transport, wsgi_environ, input_plan.required_list, input_plan)
+            else:
+                required_list = getattr(sio, 'input_required', [])
+                required_list = [required_list] if isinstance(required_list, basestring) else required_list
+                self.init_flat_sio(cid, sio, data_format, transport, wsgi_environ, required_list)
 
         # We merge channel params in if requested even if it's not SIO
         else:
@@ -147,30 +154,53 @@ class Request(SIOConverter):
 
 # ################################################################################################################################
 
-    def init_flat_sio(self, cid, sio, data_format, transport, wsgi_environ, required_list):
-        """ Initializes flat SIO requests, i.e. not list ones.
+    def init_flat_sio(self, cid, sio, data_format, transport, wsgi_environ, required_list, input_plan=None):
+        """ Initializes flat SIO requests, i.e. not list ones. If input_plan is given, it must have been compiled
+        from the same SimpleIO definition and config.
         """
         self.is_xml = data_format == SIMPLE_IO.FORMAT.XML
         self.data_format = data_format
         self.transport = transport
         self._wsgi_environ = wsgi_environ
 
-        optional_list = getattr(sio, 'input_optional', [])
-        optional_list = [optional_list] if isinstance(optional_list, basestring) else optional_list
+        if input_plan:
+            optional_list = input_plan.optional_list
+            path_prefix = input_plan.path_prefix
+            default_value = input_plan.default_value
+            use_text = input_plan.use_text
+            use_channel_params_only = input_plan.use_channel_params_only
+            self.encrypt_secrets = input_plan.encrypt_secrets
+
+            required_fields = input_plan.required_fields
+            optional_fields = input_plan.optional_fields
+
+            if input_plan.has_simple_io_config:
+                self.has_simple_io_config = True
+                self.bool_parameter_prefixes = input_plan.bool_parameter_prefixes
+                self.int_parameters = input_plan.int_parameters
+                self.int_parameter_suffixes = input_plan.int_parameter_suffixes
+            else:
+                self.payload = self.raw_request
 
-        path_prefix = getattr(sio, 'request_elem', 'request')
-        default_value = getattr(sio, 'default_value', NO_DEFAULT_VALUE)
-        use_text = getattr(sio, 'use_text', True)
-        use_channel_params_only = getattr(sio, 'use_channel_params_only', False)
-        self.encrypt_secrets = getattr(sio, 'encrypt_secrets', True)
-
-        if self.simple_io_config:
-            self.has_simple_io_config = True
-            self.bool_parameter_prefixes = self.simple_io_config.get('bool_parameter_prefixes', [])
-            self.int_parameters = self.simple_io_config.get('int_parameters', [])
-            self.int_parameter_suffixes = self.simple_io_config.get('int_parameter_suffixes', [])
         else:
-            self.payload = self.raw_request
+            optional_list = getattr(sio, 'input_optional', [])
+            optional_list = [optional_list] if isinstance(optional_list, basestring) else optional_list
+
+            path_prefix = getattr(sio, 'request_elem', 'request')
+            default_value = getattr(sio, 'default_value', NO_DEFAULT_VALUE)
+            use_text = getattr(sio, 'use_text', True)
+            use_channel_params_only = getattr(sio, 'use_channel_params_only', False)
+            self.encrypt_secrets = getattr(sio, 'encrypt_secrets', True)
+
+            required_fields = optional_fields = None
+
+            if self.simple_io_config:
+                self.has_simple_io_config = True
+                self.bool_parameter_prefixes = self.simple_io_config.get('bool_parameter_prefixes', [])
+                self.int_parameters = self.simple_io_config.get('int_parameters', [])
+                self.int_parameter_suffixes = self.simple_io_config.get('int_parameter_suffixes', [])
+            else:
+                self.payload = self.raw_request
 
         required_params = {}
 
@@ -181,11 +211,11 @@ class Request(SIOConverter):
                 raise ZatoException(cid, 'Missing input')
 
             required_params.update(self.get_params(
-                required_list, use_channel_params_only, path_prefix, default_value, use_text))
+                required_list, use_channel_params_only, path_prefix, default_value, use_text, True, required_fields))
 
         if optional_list:
             optional_params = self.get_params(
-                optional_list, use_channel_params_only, path_prefix, default_value, use_text, False)
+                optional_list, use_channel_params_only, path_prefix, default_value, use_text, False, optional_fields)
         else:
             optional_params = {}
 
@@ -199,18 +229,27 @@ class Request(SIOConverter):
 # ################################################################################################################################
 
     def get_params(self, params_to_visit, use_channel_params_only, path_prefix='', default_value=NO_DEFAULT_VALUE,
-            use_text=True, is_required=True):
+            use_text=True, is_required=True, fields=None, _convert_impl=convert_impl):
         """ Gets all requested parameters from a message. Will raise ParsingException if any is missing.
+        If given on input, fields are the parameters compiled into a SimpleIOInputPlan, in the same order.
         """
         params = {}
+        use_fields = fields is not None and self.data_format in _convert_impl
 
-        for param in params_to_visit:
+        for idx, param in enumerate(params_to_visit):
             try:
-                param_name, value = convert_param(
-                    self.cid, '' if use_channel_params_only else self.payload, param, self.data_format, is_required,
-                    default_value, path_prefix, use_text, self.channel_params, self.has_simple_io_config,
-                    self.bool_parameter_prefixes, self.int_parameters, self.int_parameter_suffixes,
-                    True, self.encrypt_func, self.encrypt_secrets, self.params_priority)
+                if use_fields:
+                    param_name, value = convert_param_from_plan(
+                        self.cid, '' if use_channel_params_only else self.payload, fields[idx], self.data_format, is_required,
+                        default_value, path_prefix, use_text, self.channel_params, self.has_simple_io_config,
+                        self.bool_parameter_prefixes, self.int_parameters, self.int_parameter_suffixes,
+                        self.encrypt_func, self.encrypt_secrets, self.params_priority)
+                else:
+                    param_name, value = convert_param(
+                        self.cid, '' if use_channel_params_only else self.payload, param, self.data_format, is_required,
+                        default_value, path_prefix, use_text, self.channel_params, self.has_simple_io_config,
+                        self.bool_parameter_prefixes, self.int_parameters, self.int_parameter_suffixes,
+                        True, self.encrypt_func, self.encrypt_secrets, self.params_priority)
                 params[param_name] = value
 
             except Exception, e:
@@ -252,12 +291,189 @@ class Request(SIOConverter):
 
 # ################################################################################################################################
 
+class _SimpleIOPlan(object):
+    """ A base class for SimpleIO definitions of services compiled when they are deployed.
+    """
+    io_attrs = ()
+
+    def __init__(self, io, simple_io_config):
+        self.simple_io_config = simple_io_config
+
+        # What we were built from - if any of these is changed later on, the plan will not be used
+        self.io_values = [(name, getattr(io, name, None)) for name in self.io_attrs]
+
+    def is_valid_for(self, io, simple_io_config):
+        """ Returns True if the plan can be used with the SimpleIO definition and config given.
+        """
+        if simple_io_config is not self.simple_io_config:
+            return False
+
+        for name, value in self.io_values:
+            if getattr(io, name, None) is not value:
+                return False
+
+        return True
+
+# ################################################################################################################################
+
+class SimpleIOInputPlan(_SimpleIOPlan):
+    """ SimpleIO input of a service compiled, when the service is deployed, to flat lists of required and optional fields
+    that Request extracts and converts input parameters with, without finding out each time what kind of a parameter
+    a given one is. Each field is a tuple of:
+
+    * param - the element as it was declared in SimpleIO, a string or a ForceType instance
+    * param_name - name of the element
+    * is_complex - whether the element's value is taken as-is from input, e.g. a whole XML element
+    * needs_conversion - False if the value is never converted, e.g. for AsIs elements
+    * convert - a function that converts values of the element, with the same signature as ForceType.convert,
+      or None if they need no conversion
+    * needs_sio_convert - True if the values need to go through the full SIOConverter.convert
+    * object_path - a compiled path to the element in XML requests
+    """
+    io_attrs = ('input_required', 'input_optional', 'request_elem', 'default_value', 'use_text', 'use_channel_params_only',
+        'encrypt_secrets')
+
+    def __init__(self, io, simple_io_config):
+        super(SimpleIOInputPlan, self).__init__(io, simple_io_config)
+
+        required_list = getattr(io, 'input_required', [])
+        self.required_list = [required_list] if isinstance(required_list, basestring) else required_list
+
+        optional_list = getattr(io, 'input_optional', [])
+        self.optional_list = [optional_list] if isinstance(optional_list, basestring) else optional_list
+
+        self.path_prefix = getattr(io, 'request_elem', 'request')
+        self.default_value = getattr(io, 'default_value', NO_DEFAULT_VALUE)
+        self.use_text = getattr(io, 'use_text', True)
+        self.use_channel_params_only = getattr(io, 'use_channel_params_only', False)
+        self.encrypt_secrets = getattr(io, 'encrypt_secrets', True)
+
+        self.has_simple_io_config = bool(simple_io_config)
+        simple_io_config = simple_io_config or {}
+
+        self.bool_parameter_prefixes = simple_io_config.get('bool_parameter_prefixes', [])
+        self.int_parameters = simple_io_config.get('int_parameters', [])
+        self.int_parameter_suffixes = simple_io_config.get('int_parameter_suffixes', [])
+
+        self.required_fields = [self._get_field(param) for param in self.required_list]
+        self.optional_fields = [self._get_field(param) for param in self.optional_list]
+
+    def _get_field(self, param):
+        param_name = param.name if isinstance(param, ForceType) else param
+        is_complex = isinstance(param, COMPLEX_VALUE)
+        needs_conversion = not isinstance(param, (AsIs, Opaque))
+        convert = None
+        needs_sio_convert = False
+
+        if needs_conversion:
+            param_is_bool = is_bool(param, param_name, self.bool_parameter_prefixes)
+            param_is_int = is_int(param_name, self.int_parameters, self.int_parameter_suffixes)
+
+            # Secrets are encrypted with a function that is known only when a request is received
+            param_is_secret = self.has_simple_io_config and self.encrypt_secrets and is_secret(param_name)
+
+            # More than one conversion applies, e.g. for Boolean elements, which only the full converter handles
+            if param_is_bool and (param_is_int or param_is_secret or isinstance(param, ForceType)):
+                needs_sio_convert = True
+
+            # Each ForceType subclass converts values on its own, depending on data format
+            elif isinstance(param, ForceType):
+                convert = param.convert
+
+            # Empty strings are always turned into None for input booleans
+            elif param_is_bool:
+                convert = convert_bool_skip_empty
+
+            elif param_is_int:
+                convert = convert_int if self.has_simple_io_config else convert_empty_to_none
+
+            elif param_is_secret:
+                needs_sio_convert = True
+
+        try:
+            object_path = ObjectPath('{}.{}'.format(self.path_prefix, param_name))
+        except Exception:
+            object_path = None # zato.common.path will report the error in XML requests, if there are any
+
+        return param, param_name, is_complex, needs_conversion, convert, needs_sio_convert, object_path
+
+# ################################################################################################################################
+
+class SimpleIOOutputPlan(_SimpleIOPlan):
+    """ SimpleIO output of a service compiled, when the service is deployed, to a flat list of fields that SimpleIOPayload
+    can produce responses from without checking each element's type and name in each row of output. Each field is a tuple of:
+
+    * key - under what name the value is read from input items and written to output
+    * param - the element as it was declared in SimpleIO, a string or a ForceType instance
+    * is_required - whether the element is in output_required
+    * convert - a function that converts values of the element, with the same signature as ForceType.convert,
+      or None if they need no conversion
+    * needs_sio_convert - True if the values need to go through the full SIOConverter.convert
+    * skip_empty - True if empty values of the element should not be returned
+    """
+    io_attrs = ('output_required', 'output_optional', 'skip_empty_keys', 'force_empty_keys', 'allow_empty_required')
+
+    def __init__(self, io, simple_io_config):
+        super(SimpleIOOutputPlan, self).__init__(io, simple_io_config)
+
+        required_list = getattr(io, 'output_required', [])
+        required_list = [required_list] if isinstance(required_list, basestring) else required_list
+
+        optional_list = getattr(io, 'output_optional', [])
+        optional_list = [optional_list] if isinstance(optional_list, basestring) else optional_list
+
+        skip_empty_keys = getattr(io, 'skip_empty_keys', False)
+        force_empty_keys = getattr(io, 'force_empty_keys', [])
+
+        bool_parameter_prefixes = simple_io_config.get('bool_parameter_prefixes', [])
+        int_parameters = simple_io_config.get('int_parameters', [])
+        int_parameter_suffixes = simple_io_config.get('int_parameter_suffixes', [])
+
+        self.fields = []
+
+        for is_required, param in chain(((True, name) for name in required_list), ((False, name) for name in optional_list)):
+
+            key = param.name if isinstance(param, ForceType) else param
+            convert = None
+            needs_sio_convert = False
+
+            # Never converted at all
+            if isinstance(param, AsIs):
+                pass
+
+            else:
+                param_is_bool = is_bool(param, key, bool_parameter_prefixes)
+                param_is_int = is_int(key, int_parameters, int_parameter_suffixes)
+
+                # More than one conversion applies, e.g. for Boolean elements, which only the full converter handles
+                if param_is_bool and (param_is_int or isinstance(param, ForceType)):
+                    needs_sio_convert = True
+
+                # Each ForceType subclass converts values on its own, depending on data format
+                elif isinstance(param, ForceType):
+                    convert = param.convert
+
+                elif param_is_bool:
+                    convert = convert_bool_skip_empty if skip_empty_keys else convert_bool
+
+                elif param_is_int:
+                    convert = convert_int
+
+            skip_empty = skip_empty_keys and param not in force_empty_keys
+
+            self.fields.append((key, param, is_required, convert, needs_sio_convert, skip_empty))
+
+        self.keys = [field[0] for field in self.fields]
+        self.all_attrs = set(self.keys)
+
+# ################################################################################################################################
+
 class SimpleIOPayload(SIOConverter):
     """ Produces the actual response - XML, JSON - out of the user-provided SimpleIO abstract data.
     All of the attributes are prefixed with zato_ so that they don't conflict with non-Zato data..
     """
     def __init__(self, zato_cid, data_format, required_list, optional_list, simple_io_config, response_elem, namespace,
-            output_repeated, skip_empty, ignore_skip_empty, allow_empty_required):
+            output_repeated, skip_empty, ignore_skip_empty, allow_empty_required, output_plan=None):
         self.zato_cid = zato_cid
         self.zato_data_format = data_format
         self.zato_is_xml = self.zato_data_format == SIMPLE_IO.FORMAT.XML
@@ -275,12 +491,16 @@ class SimpleIOPayload(SIOConverter):
         self.date_time_format = simple_io_config.get('date_time_format', 'YYYY-MM-DDTHH:MM:SS.mmmmmm+HH:MM')
         self.response_elem = response_elem
         self.namespace = namespace
+        self.zato_output_plan = output_plan
 
-        self.zato_all_attrs = set()
-        for name in chain(required_list, optional_list):
-            if isinstance(name, ForceType):
-                name = name.name
-            self.zato_all_attrs.add(name)
+        if output_plan:
+            self.zato_all_attrs = output_plan.all_attrs
+        else:
+            self.zato_all_attrs = set()
+            for name in chain(required_list, optional_list):
+                if isinstance(name, ForceType):
+                    name = name.name
+                self.zato_all_attrs.add(name)
 
         self.set_expected_attrs(required_list, optional_list)
 
@@ -369,6 +589,68 @@ class SimpleIOPayload(SIOConverter):
         return '{} elem:[{}] not found in item:[{}]'.format(
             'Expected' if is_required else 'Optional', name, msg_item)
 
+    def _getvalue_from_plan(self, output, value, _keyed_tuple=(WritableKeyedTuple, KeyedTuple), _Element=Element):
+        """ Same as the main loop in getvalue but uses a plan of output fields compiled when the service was deployed.
+        """
+        fields = self.zato_output_plan.fields
+        keys = self.zato_output_plan.keys
+
+        cid = self.zato_cid
+        is_xml = self.zato_is_xml
+        data_format = self.zato_data_format
+        allow_empty_required = self.zato_allow_empty_required
+        output_repeated = self.zato_output_repeated
+
+        # All elements must be of the same type so it's OK to do it
+        is_sa_namedtuple = isinstance(output[0], _keyed_tuple)
+
+        for item in output:
+
+            if is_sa_namedtuple or self._is_sqlalchemy(item):
+                item_values = [getattr(item, key, '') for key in keys]
+            else:
+                item_values = [item.get(key, '') for key in keys]
+
+            out_item = _Element('item') if is_xml else {}
+
+            for (key, param, is_required, convert, needs_sio_convert, skip_empty), elem_value in zip(fields, item_values):
+
+                if isinstance(elem_value, basestring) and not elem_value:
+                    if allow_empty_required:
+                        needs_sio_convert = convert = None
+                    elif is_required:
+                        raise ZatoException(cid, self._missing_value_log_msg(param, item, is_sa_namedtuple, is_required))
+
+                if convert:
+                    try:
+                        elem_value = convert(elem_value, key, data_format, True)
+                    except Exception:
+                        # Let the generic converter report the error
+                        needs_sio_convert = True
+
+                if needs_sio_convert:
+                    elem_value = self.convert(cid, param, key, elem_value, True, is_xml,
+                        self.bool_parameter_prefixes, self.int_parameters, self.int_parameter_suffixes, self.zato_skip_empty_keys,
+                        None, None, None, data_format, True)
+
+                if skip_empty and not elem_value and elem_value != 0:
+                    continue
+
+                if isinstance(elem_value, str):
+                    elem_value = elem_value.decode('utf-8')
+
+                if is_xml:
+                    setattr(out_item, key, elem_value)
+                else:
+                    out_item[key] = elem_value
+
+            if output_repeated:
+                value.append(out_item)
+            else:
+                value = out_item
+
+        return value
+
     def getvalue(self, serialize=True, _keyed_tuple=(WritableKeyedTuple, KeyedTuple)):
         """ Gets the actual payload's value converted to a string representing either XML or JSON.
         """
@@ -389,7 +671,10 @@ class SimpleIOPayload(SIOConverter):
             output = set(dir(self)) & self.zato_all_attrs
             output = [dict((name, getattr(self, name)) for name in output)]
 
-        if output:
+        if output and self.zato_output_plan:
+            value = self._getvalue_from_plan(output, value)
+
+        elif output:
 
             # All elements must be of the same type so it's OK to do it
             is_sa_namedtuple = isinstance(output[0], _keyed_tuple)
@@ -553,7 +838,7 @@ class Response(object):
 
     payload = property(_get_payload, _set_payload)
 
-    def init(self, cid, io, data_format, _not_given=NOT_GIVEN):
+    def init(self, cid, io, data_format, output_plan=None, _not_given=NOT_GIVEN):
         self.data_format = data_format
 
         required_list = getattr(io, 'output_required', [])
@@ -572,5 +857,10 @@ class Response(object):
         allow_empty_required = getattr(io, 'allow_empty_required', False)
 
         if required_list or optional_list:
+
+            # The plan is not used if SimpleIO or its config changed since it was compiled
+            if output_plan and not output_plan.is_valid_for(io, self.simple_io_config):
+                output_plan = None
+
             self._payload = SimpleIOPayload(cid, data_format, required_list, optional_list, self.simple_io_config,
-                response_elem, namespace, output_repeated, skip_empty_keys, force_empty_keys, allow_empty_required)
+                response_elem, namespace, output_repeated, skip_empty_keys, force_empty_keys, allow_empty_required, output_plan)
@@ -425,6 +425,27 @@ def convert_sio(cid, param, param_name, value, has_simple_io_config, is_xml, boo
 
 # ################################################################################################################################
 
+_convert_special_values = (ZATO_NONE, ZATO_SEC_USE_RBAC)
+
+# Each of the functions below has the same signature as ForceType.convert and is equivalent to what convert_sio does
+# with a value of a parameter of a given kind, found upfront, when SimpleIO plans of services are compiled.
+
+def convert_bool(value, *ignored):
+    return asbool(value or None) # value can be an empty string and asbool chokes on that
+
+def convert_bool_skip_empty(value, *ignored):
+    return None if value == '' else asbool(value or None)
+
+def convert_empty_to_none(value, *ignored):
+    return None if value == '' else value
+
+def convert_int(value, *ignored):
+    if value == '':
+        return None
+    return int(value) if value and value not in _convert_special_values else value
+
+# ################################################################################################################################
+
 class SIOConverter(object):
     """ A class which knows how to convert values into the types defined in a service's SimpleIO config.
     """
@@ -440,9 +461,23 @@ convert_from_dict = convert_from_json
 
 # ################################################################################################################################
 
-def convert_from_xml(payload, param_name, cid, is_required, is_complex, default_value, path_prefix, use_text):
+def get_from_xml(payload, object_path, is_required):
+    """ Same as zato.common.path.get_from but uses an already compiled ObjectPath.
+    """
+    try:
+        return object_path(payload)
+    except(ValueError, AttributeError), e:
+        if is_required:
+            raise ParsingException(None, format_exc(e))
+
+# ################################################################################################################################
+
+def convert_from_xml(payload, param_name, cid, is_required, is_complex, default_value, path_prefix, use_text, object_path=None):
     try:
-        elem = path('{}.{}'.format(path_prefix, param_name), is_required).get_from(payload)
+        if object_path is not None:
+            elem = get_from_xml(payload, object_path, is_required)
+        else:
+            elem = path('{}.{}'.format(path_prefix, param_name), is_required).get_from(payload)
     except ParsingException, e:
         msg = 'Caught an exception while parsing, payload:[<![CDATA[{}]]>], e:[{}]'.format(
             etree.tostring(payload), format_exc(e))
@@ -537,6 +572,64 @@ def convert_param(cid, payload, param, data_format, is_required, default_value,
 
 # ################################################################################################################################
 
+def convert_param_from_plan(cid, payload, field, data_format, is_required, default_value, path_prefix, use_text, channel_params,
+    has_simple_io_config, bool_parameter_prefixes, int_parameters, int_parameter_suffixes, encrypt_func, encrypt_secrets,
+    params_priority, _xml=DATA_FORMAT.XML):
+    """ Same as convert_param but for a parameter whose kind, i.e. what conversions its values need, is already known
+    because it is a field of a SimpleIOInputPlan.
+    """
+    param, param_name, is_complex, needs_conversion, convert, needs_sio_convert, object_path = field
+
+    # Values from channel params take part in the priority rules so convert_param needs to handle them
+    if param_name in channel_params:
+        return convert_param(cid, payload, param, data_format, is_required, default_value, path_prefix, use_text,
+            channel_params, has_simple_io_config, bool_parameter_prefixes, int_parameters, int_parameter_suffixes, True,
+            encrypt_func, encrypt_secrets, params_priority)
+
+    if payload is None:
+        value = NOT_GIVEN
+    elif data_format == _xml:
+        value = convert_from_xml(payload, param_name, cid, is_required, is_complex, default_value, path_prefix, use_text,
+            object_path)
+    else:
+        value = (payload or {}).get(param_name, NOT_GIVEN)
+
+    if (not isinstance(value, PubSubMessage)) and value == NOT_GIVEN:
+        if default_value != NO_DEFAULT_VALUE:
+            value = default_value
+        else:
+            if is_required:
+                msg = 'Required input element:`{}` not found, value:`{}`, data_format:`{}`, payload:`{}`'\
+                    ', channel_params:`{}`'.format(param, ZATO_NONE, data_format, payload, channel_params)
+                raise ParsingException(cid, msg)
+            else:
+                # Not required and not provided on input either in msg or channel params
+                value = ''
+
+    else:
+        if value is not None and not is_complex:
+            if isinstance(value, str):
+                value = value.decode('utf-8')
+            else:
+                value = unicode(value)
+
+        if needs_conversion:
+            if convert:
+                try:
+                    return param_name, convert(value, param_name, data_format, False)
+                except Exception:
+                    # Let the generic converter report the error
+                    needs_sio_convert = True
+
+            if needs_sio_convert:
+                return param_name, convert_sio(cid, param, param_name, value, has_simple_io_config, data_format==_xml,
+                    bool_parameter_prefixes, int_parameters, int_parameter_suffixes, True, encrypt_func, encrypt_secrets,
+                    None, data_format, False)
+
+    return param_name, value
+
+# ################################################################################################################################
+
 class SIO_TYPE_MAP:
 
 # ################################################################################################################################
@@ -16,11 +16,12 @@ from datetime import datetime
 from hashlib import sha256
 from importlib import import_module
 from inspect import isclass
-from json import dumps
+from time import time
+from json import dumps, loads
 from traceback import format_exc
 
 # Bunch
-from bunch import bunchify
+from bunch import Bunch, bunchify
 
 # dill
 from dill import dumps as dill_dumps, load as dill_load
@@ -46,6 +47,7 @@ from zato.common.odb.model.base import Base as ModelBase
 from zato.common.util import deployment_info, import_module_from_path, is_func_overridden, is_python_file, visit_py_source
 from zato.server.service import after_handle_hooks, after_job_hooks, before_handle_hooks, before_job_hooks, PubSubHook, Service
 from zato.server.service.internal import AdminService
+from zato.server.service.reqresp import SimpleIOInputPlan, SimpleIOOutputPlan
 
 # ################################################################################################################################
 
@@ -155,6 +157,102 @@ def get_service_name(class_obj):
 
 # ################################################################################################################################
 
+class DiscoveryCache(object):
+    """ Keeps track of which attributes of each module are services. Entries are keyed by hashes of modules' source code
+    and each source file is mapped to the hash its contents had when it was last imported. As long as a file's modification
+    time and size do not change, its hash is taken from the cache without reading the file, otherwise the file is read
+    and hashed again but need not be introspected if a module with the same hash has been seen already.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.modules = {}
+        self.is_dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = loads(f.read())
+                self.files = data.get('files', {})
+                self.modules = data.get('modules', {})
+        except IOError:
+            pass # No cache yet
+        except Exception:
+            logger.warn('Could not load discovery cache from `%s`, e:`%s`', self.path, format_exc())
+
+    def save(self):
+        """ Saves the cache if anything changed in it. Each worker may do it so it is written to a temporary file first.
+        """
+        if not self.is_dirty:
+            return
+
+        # Modules that no file has anymore are not needed
+        hashes = set(entry['hash'] for entry in self.files.values())
+        for hash in set(self.modules) - hashes:
+            del self.modules[hash]
+
+        tmp_path = '{}.{}'.format(self.path, os.getpid())
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(dumps({'files': self.files, 'modules': self.modules}))
+            os.rename(tmp_path, self.path)
+        except Exception:
+            logger.warn('Could not save discovery cache to `%s`, e:`%s`', self.path, format_exc())
+        else:
+            self.is_dirty = False
+
+    def _get_stat(self, file_name):
+        stat = os.stat(file_name)
+        return stat.st_mtime, stat.st_size
+
+    def get(self, file_name):
+        """ Returns an entry for the file unless it was modified since the entry was created. In the latter case,
+        the file needs to be hashed and looked up using get_by_hash.
+        """
+        entry = self.files.get(file_name)
+
+        if entry:
+            try:
+                mtime, size = self._get_stat(file_name)
+            except OSError:
+                pass
+            else:
+                if entry['mtime'] == mtime and entry['size'] == size:
+                    module = self.modules.get(entry['hash'])
+                    if module:
+                        self.hits += 1
+                        return module
+
+        self.misses += 1
+
+    def get_by_hash(self, hash):
+        return self.modules.get(hash)
+
+    def set(self, file_name, hash, hash_method, service_names):
+        try:
+            mtime, size = self._get_stat(file_name)
+        except OSError:
+            return
+
+        self.files[file_name] = {
+            'mtime': mtime,
+            'size': size,
+            'hash': hash,
+        }
+
+        self.modules[hash] = {
+            'hash': hash,
+            'hash_method': hash_method,
+            'service_names': service_names,
+        }
+
+        self.is_dirty = True
+
+# ################################################################################################################################
+
 class ServiceStore(InitializingObject):
     """ A store of Zato services.
     """
@@ -169,6 +267,12 @@ class ServiceStore(InitializingObject):
         self.update_lock = RLock()
         self.patterns_matcher = Matcher()
 
+        # Set by the server if modules that did not change since they were last imported need not be introspected again
+        self.discovery_cache = None
+
+        # How much time was spent on registering services in ODB, in seconds
+        self.odb_registration_time = 0.0
+
 # ################################################################################################################################
 
     def get_service_class_by_id(self, service_id):
@@ -270,9 +374,21 @@ class ServiceStore(InitializingObject):
             items = bunchify(dill_load(f))
             f.close()
 
+            # All internal services are registered in ODB in one batch
+            to_register = []
+
+            # Each module is read only once, no matter how many services it has
+            source_info = {}
+
             for item in items.service_info:
-                self._visit_class(item.mod, deployed, item.class_, item.fs_location, True,
-                    item.service_id, item.is_active, item.slow_threshold)
+                mod_source_info = source_info.get(item.mod.__name__)
+                if not mod_source_info:
+                    mod_source_info = source_info[item.mod.__name__] = self._get_source_code_info(item.mod)
+
+                to_register.append(self._visit_class(item.class_, item.fs_location, True, mod_source_info))
+                deployed.append(item.class_)
+
+            self._register_services(to_register)
 
             return deployed
 
@@ -284,6 +400,9 @@ class ServiceStore(InitializingObject):
         """
         deployed = []
 
+        # Services from all the items are registered in ODB in one batch
+        to_register = []
+
         for item in items:
             if has_debug:
                 logger.debug('About to import services from:`%s`', item)
@@ -292,21 +411,23 @@ class ServiceStore(InitializingObject):
 
             # A regular directory
             if os.path.isdir(item):
-                deployed.extend(self.import_services_from_directory(item, base_dir))
+                deployed.extend(self.import_services_from_directory(item, base_dir, to_register))
 
             # .. a .py/.pyw
             elif is_python_file(item):
-                deployed.extend(self.import_services_from_file(item, is_internal, base_dir))
+                deployed.extend(self.import_services_from_file(item, is_internal, base_dir, to_register))
 
             # .. must be a module object
             else:
-                deployed.extend(self.import_services_from_module(item, is_internal))
+                deployed.extend(self.import_services_from_module(item, is_internal, to_register))
+
+        self._register_services(to_register)
 
         return deployed
 
 # ################################################################################################################################
 
-    def import_services_from_file(self, file_name, is_internal, base_dir):
+    def import_services_from_file(self, file_name, is_internal, base_dir, to_register=None):
         """ Imports all the services from the path to a file.
         """
         deployed = []
@@ -317,13 +438,13 @@ class ServiceStore(InitializingObject):
             msg = 'Could not load source, file_name:`%s`, e:`%s`'
             logger.error(msg, file_name, format_exc(e))
         else:
-            deployed.extend(self._visit_module(mod_info.module, is_internal, mod_info.file_name))
+            deployed.extend(self._visit_module(mod_info.module, is_internal, mod_info.file_name, to_register))
         finally:
             return deployed
 
 # ################################################################################################################################
 
-    def import_services_from_directory(self, dir_name, base_dir):
+    def import_services_from_directory(self, dir_name, base_dir, to_register=None):
         """ dir_name points to a directory.
 
         If dist2 is True, the directory is assumed to be a Distutils2 one and its
@@ -336,64 +457,86 @@ class ServiceStore(InitializingObject):
         """
         deployed = []
 
+        # Unless the caller registers them, services from all the files are registered in ODB in one batch
+        needs_register = to_register is None
+        to_register = [] if needs_register else to_register
+
         for py_path in visit_py_source(dir_name):
-            deployed.extend(self.import_services_from_file(py_path, False, base_dir))
+            deployed.extend(self.import_services_from_file(py_path, False, base_dir, to_register))
+
+        if needs_register:
+            self._register_services(to_register)
 
         return deployed
 
 # ################################################################################################################################
 
-    def import_services_from_module(self, mod_name, is_internal):
+    def import_services_from_module(self, mod_name, is_internal, to_register=None):
         """ Imports all the services from a module specified by the given name.
         """
-        return self.import_services_from_module_object(import_module(mod_name), is_internal)
+        return self.import_services_from_module_object(import_module(mod_name), is_internal, to_register)
 
 # ################################################################################################################################
 
-    def import_services_from_module_object(self, mod, is_internal):
+    def import_services_from_module_object(self, mod, is_internal, to_register=None):
         """ Imports all the services from a Python module object.
         """
-        return self._visit_module(mod, is_internal, inspect.getfile(mod))
+        return self._visit_module(mod, is_internal, inspect.getfile(mod), to_register)
 
 # ################################################################################################################################
 
-    def _should_deploy(self, name, item):
-        """ Is an object something we can deploy on a server?
+    def _is_service_class(self, item):
+        """ Is an object a service class, no matter if this server may deploy it or not?
         """
         if isclass(item) and hasattr(item, '__mro__') and hasattr(item, 'get_name'):
             if item is not Service and item is not AdminService and item is not PubSubHook:
                 if not hasattr(item, DONT_DEPLOY_ATTR_NAME) and not issubclass(item, ModelBase):
+                    return True
+
+    def _is_allowed(self, item):
+        """ Is a service class allowed to be deployed on this server?
+        """
+        service_name = item.get_name()
 
-                    service_name = item.get_name()
+        # Don't deploy SSO services if SSO as such is not enabled
+        if not self.server.is_sso_enabled:
+            if 'zato.sso' in service_name:
+                return False
 
-                    # Don't deploy SSO services if SSO as such is not enabled
-                    if not self.server.is_sso_enabled:
-                        if 'zato.sso' in service_name:
-                            return False
+        if self.patterns_matcher.is_allowed(service_name):
+            return True
+        else:
+            logger.info('Skipped disallowed `%s`', service_name)
 
-                    if self.patterns_matcher.is_allowed(service_name):
-                        return True
-                    else:
-                        logger.info('Skipped disallowed `%s`', service_name)
+    def _should_deploy(self, name, item):
+        """ Is an object something we can deploy on a server?
+        """
+        return self._is_service_class(item) and self._is_allowed(item)
 
 # ################################################################################################################################
 
-    def _get_source_code_info(self, mod):
-        """ Returns the source code of and the FS path to the given module.
+    def _get_source_file_name(self, mod):
+        file_name = mod.__file__
+        return file_name[:-1] if file_name[-1] in('c', 'o') else file_name
+
+    def _get_source_code_info(self, mod, cache_entry=None):
+        """ Returns the source code of and the FS path to the given module. If the module did not change since
+        the discovery cache entry was created, its hash is taken from the cache and the source code is not read at all -
+        it will be read only if it needs to be stored in ODB, i.e. if the hash there is different.
         """
         si = SourceInfo()
         try:
-            file_name = mod.__file__
-            if file_name[-1] in('c', 'o'):
-                file_name = file_name[:-1]
-
-            # We would've used inspect.getsource(mod) hadn't it been apparently using
-            # cached copies of the source code
-            si.source = open(file_name, 'rb').read()
-
             si.path = inspect.getsourcefile(mod)
-            si.hash = sha256(si.source).hexdigest()
-            si.hash_method = 'SHA-256'
+
+            if cache_entry:
+                si.hash = cache_entry['hash']
+                si.hash_method = cache_entry['hash_method']
+            else:
+                # We would've used inspect.getsource(mod) hadn't it been apparently using
+                # cached copies of the source code
+                si.source = open(self._get_source_file_name(mod), 'rb').read()
+                si.hash = sha256(si.source).hexdigest()
+                si.hash_method = 'SHA-256'
 
         except IOError, e:
             if has_trace1:
@@ -403,7 +546,9 @@ class ServiceStore(InitializingObject):
 
 # ################################################################################################################################
 
-    def _visit_class(self, mod, deployed, class_, fs_location, is_internal, service_id=None, is_active=None, slow_threshold=None):
+    def _visit_class(self, class_, fs_location, is_internal, source_info):
+        """ Prepares a service class for use and returns information needed to register it in ODB.
+        """
         timestamp = datetime.utcnow()
         depl_info = dumps(deployment_info('service-store', str(class_), timestamp.isoformat(), fs_location))
 
@@ -412,29 +557,50 @@ class ServiceStore(InitializingObject):
 
         set_up_class_attributes(class_, self, name)
 
+        # SimpleIO is compiled once here instead of being interpreted each time a request or response is processed
+        if class_.has_sio:
+            simple_io_config = self.server.worker_store.worker_config.simple_io
+            class_._sio_input_plan = SimpleIOInputPlan(class_.SimpleIO, simple_io_config)
+            class_._sio_output_plan = SimpleIOOutputPlan(class_.SimpleIO, simple_io_config)
+
         self.services[impl_name] = {}
         self.services[impl_name]['name'] = name
         self.services[impl_name]['deployment_info'] = depl_info
         self.services[impl_name]['service_class'] = class_
 
-        si = self._get_source_code_info(mod)
+        return Bunch(class_=class_, name=name, impl_name=impl_name, is_internal=is_internal, deployment_time=timestamp,
+            details=dumps(str(depl_info)), source_info=source_info)
+
+# ################################################################################################################################
+
+    def _register_services(self, to_register):
+        """ Registers in ODB, in one batch, services returned by self._visit_class.
+        """
+        with self.update_lock:
+
+            start = time()
+            registered = self.odb.add_services(to_register)
+            self.odb_registration_time += time() - start
 
-        service_id, is_active, slow_threshold = self.odb.add_service(
-            name, impl_name, is_internal, timestamp, dumps(str(depl_info)), si)
+            for item in to_register:
 
-        deployed.append(class_)
+                try:
+                    service_id, is_active, slow_threshold = registered[item.name]
+                except KeyError:
+                    logger.warn('Service `%s` could not be registered in ODB', item.name)
+                    continue
 
-        self.services[impl_name]['is_active'] = is_active
-        self.services[impl_name]['slow_threshold'] = slow_threshold
+                self.services[item.impl_name]['is_active'] = is_active
+                self.services[item.impl_name]['slow_threshold'] = slow_threshold
 
-        self.id_to_impl_name[service_id] = impl_name
-        self.impl_name_to_id[impl_name] = service_id
-        self.name_to_impl_name[name] = impl_name
+                self.id_to_impl_name[service_id] = item.impl_name
+                self.impl_name_to_id[item.impl_name] = service_id
+                self.name_to_impl_name[item.name] = item.impl_name
 
-        if has_debug:
-            logger.debug('Imported service:`%s`', name)
+                if has_debug:
+                    logger.debug('Imported service:`%s`', item.name)
 
-        class_.after_add_to_store(logger)
+                item.class_.after_add_to_store(logger)
 
 # ################################################################################################################################
 
@@ -445,26 +611,53 @@ class ServiceStore(InitializingObject):
 
 # ################################################################################################################################
 
-    def _visit_module(self, mod, is_internal, fs_location, needs_odb_deployment=True):
-        """ Actually imports services from a module object.
+    def _visit_module(self, mod, is_internal, fs_location, to_register=None):
+        """ Actually imports services from a module object. Unless to_register is given, in which case it is up to the caller
+        to register them, services from the module are registered in ODB in one batch.
         """
         deployed = []
+
+        needs_register = to_register is None
+        to_register = [] if needs_register else to_register
+
         try:
-            for name in sorted(dir(mod)):
+            # If the module did not change since the last time it was imported, we already know its source's hash
+            # and which of its attributes are services, otherwise all of them need to be checked.
+            file_name = self._get_source_file_name(mod)
+            cache_entry = self.discovery_cache.get(file_name) if self.discovery_cache else None
+
+            source_info = self._get_source_code_info(mod, cache_entry)
+            service_names = []
+
+            # The file changed but its contents may be still the same as that of a module already seen
+            is_file_changed = self.discovery_cache and not cache_entry
+            if is_file_changed and source_info.hash:
+                cache_entry = self.discovery_cache.get_by_hash(source_info.hash)
+
+            for name in (cache_entry['service_names'] if cache_entry else sorted(dir(mod))):
                 with self.update_lock:
-                    item = getattr(mod, name)
+                    item = getattr(mod, name, None)
+
+                    if self._is_service_class(item):
+                        service_names.append(name)
+
+                        if self._is_allowed(item):
+                            if item.before_add_to_store(logger):
+                                to_register.append(self._visit_class(item, fs_location, is_internal, source_info))
+                                deployed.append(item)
+                            else:
+                                logger.info('Skipping `%s` from `%s`', item, fs_location)
 
-                    if self._should_deploy(name, item):
-                        if item.before_add_to_store(logger):
-                            self._visit_class(mod, deployed, item, fs_location, is_internal)
-                        else:
-                            logger.info('Skipping `%s` from `%s`', item, fs_location)
+            if is_file_changed and source_info.hash:
+                self.discovery_cache.set(file_name, source_info.hash, source_info.hash_method, service_names)
 
         except Exception, e:
             logger.error(
                 'Exception while visit mod:`%s`, is_internal:`%s`, fs_location:`%s`, e:`%s`',
                 mod, is_internal, fs_location, format_exc(e))
         finally:
+            if needs_register:
+                self._register_services(to_register)
             return deployed
 
 # ################################################################################################################################
@@ -9,8 +9,10 @@ Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 # stdlib
+from contextlib import contextmanager
 from importlib import import_module
 from logging import getLogger
+from time import time
 
 # ################################################################################################################################
 
@@ -60,6 +62,38 @@ class StartupCallableTool(object):
 
 # ################################################################################################################################
 
+class StartupProfile(object):
+    """ Measures how long each phase of a server's startup takes.
+    """
+    def __init__(self):
+        self.start = time()
+        self.phases = []
+
+    @contextmanager
+    def __call__(self, name):
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(name, time() - start)
+
+    def add(self, name, duration):
+        self.phases.append((name, duration))
+
+    def get_report(self):
+        """ Returns a table of phases with how long each of them took.
+        """
+        total = time() - self.start
+        name_len = max([len(name) for name, _ in self.phases] + [len('total')])
+
+        out = []
+        for name, duration in self.phases + [('total', total)]:
+            out.append('{} {:8.3f}s {:5.1f}%'.format(name.ljust(name_len), duration, duration / total * 100 if total else 0))
+
+        return '\n'.join(out)
+
+# ################################################################################################################################
+
 def default_callable(ctx):
     """ Default startup callable added for demonstration purposes.
     """
@@ -10,26 +10,400 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 import logging
+from traceback import format_exc
+
+# anyjson
+from anyjson import dumps, loads
 
 # dateutil
 from dateutil.rrule import MINUTELY, rrule
 
+# gevent
+from gevent import sleep
+
 # Zato
 from zato.common import KVDB
 
 logger = logging.getLogger(__name__)
 
+# ################################################################################################################################
+
+# Values below that are kept in histograms exactly, above it they are put into one of _sub_buckets buckets per power of two
+_exact_limit = 128
+_sub_buckets = 64
+_sub_buckets_shift = 6
+
+# For how long raw per-minute keys are kept - AggregateByMinute needs to read them within that many seconds
+_raw_by_minute_expire = 300
+
+# How many commands at most to send to KVDB in a single pipeline when reading statistics of many services
+_pipeline_batch_size = 1000
+
+# ################################################################################################################################
+
+def get_service_names(conn, _names_key=KVDB.SERVICE_STATS_NAMES, _backfilled_key=KVDB.SERVICE_STATS_NAMES_BACKFILLED,
+    _basic=KVDB.SERVICE_TIME_BASIC):
+    """ Returns names of all services that statistics have been collected for. These are kept in a set in KVDB to which,
+    the first time it is needed, names of services from basic statistics collected before the set existed are added,
+    using SCAN rather than KEYS.
+    """
+    with conn.pipeline(False) as pipe:
+        pipe.get(_backfilled_key)
+        pipe.smembers(_names_key)
+        is_backfilled, names = pipe.execute()
+
+    if not is_backfilled:
+        prefix_len = len(_basic)
+        names = set(names)
+        names.update(key[prefix_len:] for key in conn.scan_iter('{}*'.format(_basic), _pipeline_batch_size))
+
+        if names:
+            conn.sadd(_names_key, *names)
+
+        # Aggregators add names to the set all the time so it is this key, not the set, that says if we are done
+        conn.set(_backfilled_key, '1')
+
+    return names
+
+# ################################################################################################################################
+
+def prune_service_names(conn, names, _names_key=KVDB.SERVICE_STATS_NAMES, _basic=KVDB.SERVICE_TIME_BASIC,
+    _usage=KVDB.SERVICE_USAGE):
+    """ Removes from the set of names the services whose statistics have been deleted from KVDB. Returns the names removed.
+    """
+    exist = get_many(conn, 'exists', ['{}{}'.format(_basic, name) for name in names])
+    exist_usage = get_many(conn, 'exists', ['{}{}'.format(_usage, name) for name in names])
+
+    to_remove = [name for name, has_basic, has_usage in zip(names, exist, exist_usage) if not (has_basic or has_usage)]
+
+    if to_remove:
+        conn.srem(_names_key, *to_remove)
+
+    return to_remove
+
+# ################################################################################################################################
+
+def get_many(conn, command, keys, *args):
+    """ Runs a read-only command against each of the keys, in pipelined batches, and returns the results in the same order.
+    """
+    out = []
+
+    for idx in xrange(0, len(keys), _pipeline_batch_size):
+        with conn.pipeline(False) as pipe:
+            func = getattr(pipe, command)
+            for key in keys[idx:idx+_pipeline_batch_size]:
+                func(key, *args)
+            out.extend(pipe.execute())
+
+    return out
+
+# ################################################################################################################################
+
+def get_mean_percentiles(conn, names, _basic=KVDB.SERVICE_TIME_BASIC):
+    """ Returns a dictionary of service names to percentiles their mean processing times are computed up to.
+    """
+    values = get_many(conn, 'hget', ['{}{}'.format(_basic, name) for name in names], 'mean_percentile')
+
+    # An unset percentile means that no values are to be left out
+    return dict((name, int(value or 0) or 100) for name, value in zip(names, values))
+
+# ################################################################################################################################
+
+class LatencyHistogram(object):
+    """ A mergeable, HDR-style histogram of processing times in milliseconds. Times below _exact_limit are counted exactly,
+    larger ones go to one of _sub_buckets buckets per each power of two, which bounds the relative error of percentiles
+    to 1/_sub_buckets. Count, min, max and the total of all values are always exact.
+    """
+    __slots__ = ('counts', 'count', 'min', 'max', 'total')
+
+    def __init__(self):
+        self.counts = {} # Bucket index -> how many values fell into that bucket
+        self.count = 0
+        self.min = 0
+        self.max = 0
+        self.total = 0
+
+# ################################################################################################################################
+
+    @staticmethod
+    def get_bucket(value, _exact_limit=_exact_limit, _sub_buckets=_sub_buckets, _sub_buckets_shift=_sub_buckets_shift):
+        if value < _exact_limit:
+            return value
+
+        shift = value.bit_length() - _sub_buckets_shift - 1
+        return _exact_limit + (shift - 1) * _sub_buckets + (value >> shift) - _sub_buckets
+
+    @staticmethod
+    def get_bucket_value(idx, _exact_limit=_exact_limit, _sub_buckets=_sub_buckets, _sub_buckets_shift=_sub_buckets_shift):
+        """ Returns a value representing all the ones in a given bucket, i.e. the middle of its range.
+        """
+        if idx < _exact_limit:
+            return idx
+
+        idx -= _exact_limit
+        shift = (idx >> _sub_buckets_shift) + 1
+        low = ((idx & (_sub_buckets - 1)) + _sub_buckets) << shift
+
+        return low + ((1 << shift) - 1) / 2.0
+
+# ################################################################################################################################
+
+    def record(self, value, count=1):
+        """ Adds a processing time, possibly more than once.
+        """
+        idx = self.get_bucket(value)
+        self.counts[idx] = self.counts.get(idx, 0) + count
+
+        if self.count:
+            if value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+        else:
+            self.min = self.max = value
+
+        self.count += count
+        self.total += value * count
+
+# ################################################################################################################################
+
+    def merge(self, other):
+        """ Adds all the values from another histogram to this one.
+        """
+        if not other.count:
+            return
+
+        counts = self.counts
+        for idx, count in other.counts.iteritems():
+            counts[idx] = counts.get(idx, 0) + count
+
+        if self.count:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        else:
+            self.min = other.min
+            self.max = other.max
+
+        self.count += other.count
+        self.total += other.total
+
+# ################################################################################################################################
+
+    def _clamp(self, value):
+        return min(max(value, self.min), self.max)
+
+    def percentile(self, percentile):
+        """ Returns a value below which a given percentage of all values is.
+        """
+        if not self.count:
+            return 0
+
+        if percentile <= 0:
+            return self.min
+
+        if percentile >= 100:
+            return self.max
+
+        rank = percentile / 100.0 * (self.count - 1)
+        seen = 0
+
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen > rank:
+                return self._clamp(self.get_bucket_value(idx))
+
+        return self.max
+
+# ################################################################################################################################
+
+    def trimmed_mean(self, percentile):
+        """ Returns the mean of all values up to and including a given percentile.
+        """
+        if not self.count:
+            return 0
+
+        limit = self.percentile(percentile)
+
+        if limit >= self.max:
+            return self.total / self.count
+
+        if limit <= self.min:
+            return self.min
+
+        count = 0
+        total = 0
+
+        for idx in sorted(self.counts):
+            value = self._clamp(self.get_bucket_value(idx))
+            if value > limit:
+                break
+
+            count += self.counts[idx]
+            total += self.counts[idx] * value
+
+        return total / count
+
+# ################################################################################################################################
+
+    def to_json(self):
+        return dumps({'count':self.count, 'min':self.min, 'max':self.max, 'total':self.total, 'counts':self.counts})
+
+    @staticmethod
+    def from_raw(elems):
+        """ Builds a histogram out of elements of a raw times list in KVDB - each is either a processing time of a single
+        invocation or a histogram serialized to JSON, as written by ServiceStatsAggregator.
+        """
+        out = LatencyHistogram()
+
+        for elem in elems:
+            if elem.startswith('{'):
+                data = loads(elem)
+
+                if data['count']:
+                    other = LatencyHistogram()
+                    other.count = data['count']
+                    other.min = data['min']
+                    other.max = data['max']
+                    other.total = data['total']
+                    other.counts = dict((int(idx), count) for idx, count in data['counts'].iteritems())
+
+                    out.merge(other)
+            else:
+                out.record(int(elem))
+
+        return out
+
+# ################################################################################################################################
+
+class ServiceStatsAggregator(object):
+    """ Keeps usage counters and histograms of processing times of services invoked in the current worker process
+    and flushes them to KVDB in background, in pre-aggregated per-minute buckets, so that services themselves never
+    need to wait for KVDB to update their statistics.
+    """
+    def __init__(self, kvdb, flush_interval=5):
+        self.kvdb = kvdb
+        self.flush_interval = flush_interval
+        self.keep_running = True
+
+        self.usage = {}       # Service name -> how many times it has been invoked in the cluster, as far as we know
+        self.usage_delta = {} # Service name -> invocations since the last flush
+        self.last = {}        # Service name -> its most recent processing time
+        self.buckets = {}     # (Service name, minute) -> LatencyHistogram
+
+# ################################################################################################################################
+
+    def incr_usage(self, name):
+        """ Notes that a given service has been invoked and returns how many times it has been so far. This is the
+        cluster-wide counter as of the latest flush plus invocations in this process since then - exact if there is only
+        one process, and otherwise lagging behind other processes by no more than one flush interval.
+        """
+        usage = self.usage.get(name, 0) + 1
+        self.usage[name] = usage
+        self.usage_delta[name] = self.usage_delta.get(name, 0) + 1
+
+        return usage
+
+# ################################################################################################################################
+
+    def record(self, name, proc_time, minute):
+        """ Stores a processing time of a given service in a bucket of the minute it completed in.
+        """
+        key = (name, minute)
+        hist = self.buckets.get(key)
+
+        if hist is None:
+            hist = self.buckets[key] = LatencyHistogram()
+
+        hist.record(proc_time)
+        self.last[name] = proc_time
+
+# ################################################################################################################################
+
+    def _restore(self, usage_delta, last, buckets):
+        """ Puts data which could not be flushed back so that it is flushed next time.
+        """
+        for name, value in usage_delta.iteritems():
+            self.usage_delta[name] = self.usage_delta.get(name, 0) + value
+
+        for name, value in last.iteritems():
+            self.last.setdefault(name, value)
+
+        for key, hist in buckets.iteritems():
+            if key in self.buckets:
+                hist.merge(self.buckets[key])
+            self.buckets[key] = hist
+
+# ################################################################################################################################
+
+    def flush(self, _usage=KVDB.SERVICE_USAGE, _basic=KVDB.SERVICE_TIME_BASIC, _raw=KVDB.SERVICE_TIME_RAW,
+        _raw_by_minute=KVDB.SERVICE_TIME_RAW_BY_MINUTE, _names_key=KVDB.SERVICE_STATS_NAMES, _expire=_raw_by_minute_expire):
+        """ Writes everything collected since the previous flush to KVDB in a single pipeline.
+        """
+        usage_delta, self.usage_delta = self.usage_delta, {}
+        last, self.last = self.last, {}
+        buckets, self.buckets = self.buckets, {}
+
+        if not (usage_delta or buckets):
+            return
+
+        try:
+            with self.kvdb.conn.pipeline() as pipe:
+
+                # Lets statistics services find all the services without scanning the whole of KVDB
+                pipe.sadd(_names_key, *set(usage_delta).union(name for name, _ in buckets))
+
+                usage_names = list(usage_delta)
+                for name in usage_names:
+                    pipe.incrby('%s%s' % (_usage, name), usage_delta[name])
+
+                for name, value in last.iteritems():
+                    pipe.hset('%s%s' % (_basic, name), 'last', value)
+
+                for (name, minute), hist in buckets.iteritems():
+                    data = hist.to_json()
+                    pipe.rpush('%s%s' % (_raw, name), data)
+
+                    key = '%s%s:%s' % (_raw_by_minute, name, minute)
+                    pipe.rpush(key, data)
+                    pipe.expire(key, _expire)
+
+                result = pipe.execute()
+
+        except Exception, e:
+            logger.warn('Could not flush service statistics, e:`%s`', format_exc(e))
+            self._restore(usage_delta, last, buckets)
+
+        else:
+            # INCRBY returned cluster-wide counters, to which we add invocations made while the pipeline was executing
+            for name, usage in zip(usage_names, result[1:]):
+                self.usage[name] = usage + self.usage_delta.get(name, 0)
+
+# ################################################################################################################################
+
+    def run(self):
+        """ Flushes statistics periodically until told to stop. Runs in its own greenlet.
+        """
+        while self.keep_running:
+            sleep(self.flush_interval)
+            self.flush()
+
+# ################################################################################################################################
+
+    def stop(self):
+        self.keep_running = False
+        self.flush()
+
+# ################################################################################################################################
+
 class MaintenanceTool(object):
     """ A tool for performing maintenance-related tasks, such as deleting the statistics.
     """
     def __init__(self, conn):
         self.conn = conn
 
-    def delete(self, start, stop, interval):
-        with self.conn.pipeline() as p:
-            suffixes = (elem.strftime(':%Y:%m:%d:%H:%M') for elem in rrule(MINUTELY, dtstart=start, until=stop))
-            for suffix in suffixes:
-                for key in self.conn.keys('{}*{}'.format(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE, suffix)):
-                    p.delete(key)
+    def delete(self, start, stop, interval, _prefix=KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE):
+        suffixes = [elem.strftime('%Y:%m:%d:%H:%M') for elem in rrule(MINUTELY, dtstart=start, until=stop)]
+        keys = ['{}{}:{}'.format(_prefix, name, suffix) for name in get_service_names(self.conn) for suffix in suffixes]
 
-            p.execute()
+        for idx in xrange(0, len(keys), _pipeline_batch_size):
+            self.conn.delete(*keys[idx:idx+_pipeline_batch_size])
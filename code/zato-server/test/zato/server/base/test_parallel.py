@@ -17,6 +17,9 @@ from unittest import TestCase
 # Bunch
 from bunch import Bunch
 
+# mock
+from mock import Mock
+
 # nose
 from nose.tools import eq_
 
@@ -102,6 +105,33 @@ class ParallelServerTestCase(TestCase):
             eq_(msg.payload, expected_payload)
             eq_(msg.service, expected_service)
             self.assertEquals(len(msg.cid), 24)
+
+    def get_destroy_server(self, worker_store):
+        ps = ParallelServer()
+        ps.odb = Bunch(session_initialized=True)
+        ps.worker_store = worker_store
+        ps.server_startup_ipc = Mock()
+        ps.invoke = Mock()
+
+        return ps
+
+    def test_destroy_jwt_backend_stopped(self):
+        jwt_backend = Mock()
+        ps = self.get_destroy_server(FakeWorkerStore(FakeRequestDispatcher(Bunch(jwt_backend=jwt_backend))))
+        ps.destroy()
+
+        jwt_backend.stop.assert_called_once_with()
+        ps.server_startup_ipc.close.assert_called_once_with()
+
+    def test_destroy_worker_not_started(self):
+
+        # The worker store or its request dispatcher may not exist if the worker failed early during startup
+        for worker_store in (None, Bunch()):
+            ps = self.get_destroy_server(worker_store)
+            ps.destroy()
+
+            ps.server_startup_ipc.close.assert_called_once_with()
+
 # ################################################################################################################################
 
 class HTTPAccessLogTestCase(TestCase):
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# Zato
+from zato.common import MISC, SECRETS
+from zato.common.crypto import CryptoManager
+from zato.server.base.parallel.config import ConfigLoader
+from zato.server.config import ConfigDict, ConfigStore
+from zato.url_dispatcher import Matcher
+
+# ################################################################################################################################
+
+class BaseTestCase(TestCase):
+
+    def setUp(self):
+        self.crypto_manager = CryptoManager.from_secret_key(CryptoManager.generate_key())
+
+    def decrypt(self, encrypted):
+        return self.crypto_manager.decrypt(encrypted.replace(SECRETS.PREFIX, '', 1))
+
+    def get_loader(self):
+        loader = ConfigLoader()
+        loader.config = ConfigStore()
+        loader.config.http_soap = []
+        return loader
+
+    def get_query(self, len_items):
+        """ Returns data in the same format that ODB queries return it.
+        """
+        items = []
+        for idx in range(len_items):
+            items.append(Bunch(id=idx, name='item.{}'.format(idx), is_active=True, username='user.{}'.format(idx),
+                password=SECRETS.PREFIX + self.crypto_manager.encrypt(b'password.{}'.format(idx))))
+
+        return items, Bunch.fromkeys(['id', 'name', 'is_active', 'username', 'password'])
+
+    def load_from_query(self, loader, query, config_dict_names):
+        for name in config_dict_names:
+            setattr(loader.config, name, ConfigDict.from_query(name, query, decrypt_func=self.decrypt))
+
+# ################################################################################################################################
+
+class ConfigLoaderTestCase(BaseTestCase):
+
+    def test_snapshot(self):
+
+        loader = self.get_loader()
+        self.load_from_query(loader, self.get_query(3), ['basic_auth', 'out_sql'])
+
+        match_target = 'my.action{}/my/path'.format(MISC.SEPARATOR)
+        loader.config.http_soap = [{'id':1, 'name':'my.channel', 'match_target':match_target,
+            'match_target_compiled':Matcher(match_target)}]
+
+        other = self.get_loader()
+        other.set_config_snapshot(loader.get_config_snapshot())
+
+        for name in 'basic_auth', 'out_sql':
+            config_dict = getattr(other.config, name)
+            self.assertIsInstance(config_dict, ConfigDict)
+            self.assertEquals(config_dict.name, name)
+            self.assertEquals(sorted(config_dict.keys()), ['item.0', 'item.1', 'item.2'])
+            self.assertEquals(config_dict['item.1'].config.password, 'password.1')
+            self.assertEquals(config_dict['item.1'].config.username, 'user.1')
+
+        http_soap = other.config.http_soap[0]
+        self.assertEquals(http_soap['name'], 'my.channel')
+        self.assertIsInstance(http_soap['match_target_compiled'], Matcher)
+        self.assertIsNot(http_soap['match_target_compiled'], loader.config.http_soap[0]['match_target_compiled'])
+
+# ################################################################################################################################
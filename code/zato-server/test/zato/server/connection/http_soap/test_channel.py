@@ -10,12 +10,13 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 from cStringIO import StringIO
+from gzip import GzipFile
 from httplib import OK
 from unittest import TestCase
 from uuid import uuid4
 
 # anyjson
-from anyjson import loads
+from anyjson import dumps, loads
 
 # arrow
 import arrow
@@ -556,3 +557,131 @@ class TestRequestHandler(TestCase):
 
         rh.set_content_type(response, rand_string(), rand_string(), None, FakeChannelItem())
         eq_(response.content_type, user_content_type)
+
+# ##############################################################################
+
+class FakeCacheServer(object):
+    """ Keeps cache entries in a dict the way the built-in cache keeps them, i.e. as the very same objects.
+    """
+    def __init__(self):
+        self.fs_server_config = get_dummy_server().fs_server_config
+        self.cache = {}
+
+    def get_from_cache(self, cache_type, cache_name, key):
+        return self.cache.get(key)
+
+    def set_in_cache(self, cache_type, cache_name, key, value):
+        self.cache[key] = value
+
+class CachedService(object):
+    """ Produces a response each time it is invoked.
+    """
+    get_request_hash = None
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.invoked = 0
+
+    def update_handle(self, *ignored_args, **ignored_kwargs):
+        self.invoked += 1
+        return Bunch(payload=self.payload, content_type='application/json', headers={'X-Custom': 'abc'}, status_code=OK)
+
+def get_cache_channel_item():
+    channel_item = Bunch(id=1, service_impl_name='my.service', merge_url_params_req=False, data_format=None, transport=None,
+        params_pri=None, cache_type='builtin', cache_name='my.cache')
+    return channel_item
+
+def gunzip(data):
+    return GzipFile(fileobj=StringIO(data)).read()
+
+# ##############################################################################
+
+class TestResponseCache(TestCase):
+
+    def get_handler(self, service):
+        server = FakeCacheServer()
+        server.service_store = Bunch(new_instance=lambda ignored: (service, True))
+        return channel.RequestHandler(server)
+
+    def handle(self, handler, channel_item, raw_request='{"a":1}'):
+        wsgi_environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/my/api'}
+        return handler.handle(new_cid(), {}, channel_item, wsgi_environ, raw_request, Bunch(broker_client=None), None,
+            None, None, None)
+
+    def test_cache_hit(self):
+        payload = '{"customer":"%s"}' % NON_ASCII_STRING
+
+        service = CachedService(payload)
+        handler = self.get_handler(service)
+        channel_item = get_cache_channel_item()
+
+        first = self.handle(handler, channel_item)
+        second = self.handle(handler, channel_item)
+
+        # The service was invoked once only and the response is ready to be sent as-is
+        eq_(service.invoked, 1)
+        self.assertIs(first, second)
+        eq_(second.payload, payload.encode('utf-8'))
+        eq_(second.content_type, 'application/json')
+        eq_(dict(second.headers), {'X-Custom': 'abc'})
+        eq_(second.status_code, OK)
+
+        # Gzipped payload is created only once too
+        gzipped = second.get_gzipped_payload()
+        self.assertIs(second.get_gzipped_payload(), gzipped)
+        eq_(gunzip(gzipped), payload.encode('utf-8'))
+
+        # A different request means a different response
+        self.handle(handler, channel_item, '{"a":2}')
+        eq_(service.invoked, 2)
+
+    def test_entries_set_elsewhere(self):
+        service = CachedService('{"a":1}')
+        handler = self.get_handler(service)
+        channel_item = get_cache_channel_item()
+
+        self.handle(handler, channel_item)
+        key, entry = handler.server.cache.items()[0]
+
+        # Another worker cached a new response and its entry was received as unicode
+        handler.server.cache[key] = entry.replace(b'{"a":1}', b'{"a":2}').decode('utf-8')
+        eq_(self.handle(handler, channel_item).payload, b'{"a":2}')
+
+        # Entries in a format of a previous version are not used
+        handler.server.cache[key] = dumps({'payload': '{"a":3}', 'content_type': 'application/json', 'headers': {},
+            'status_code': OK})
+        eq_(self.handle(handler, channel_item).payload, b'{"a":1}')
+        eq_(service.invoked, 2)
+
+    def test_dispatch_gzip(self):
+        service = CachedService('{"a":1}')
+        handler = self.get_handler(service)
+        channel_item = get_cache_channel_item()
+        channel_item.content_encoding = 'gzip'
+
+        response = self.handle(handler, channel_item)
+        for idx in range(2):
+
+            class FakeRequestHandler(object):
+                def handle(self, *ignored_args, **ignored_kwargs):
+                    return response
+
+            rd = channel.RequestDispatcher(simple_io_config={})
+            rd.request_handler = FakeRequestHandler()
+            rd.url_data = DummyURLData(Bunch(), channel_item)
+            rd.url_data.url_sec = {None: Bunch(sec_def=ZATO_NONE, sec_use_rbac=False)}
+            channel_item.is_active = True
+            channel_item.method = None
+            channel_item.match_target = None
+
+            wsgi_environ = {'PATH_INFO': b'/my/api', 'wsgi.input': StringIO(b''), 'zato.http.response.headers': {}}
+            payload = rd.dispatch(new_cid(), None, wsgi_environ, None)
+
+            eq_(gunzip(payload), b'{"a":1}')
+            eq_(wsgi_environ['zato.http.response.headers']['Content-Encoding'], 'gzip')
+            eq_(wsgi_environ['zato.http.response.headers']['X-Custom'], 'abc')
+
+            # The cached response itself is never modified
+            eq_(response.payload, b'{"a":1}')
+
+# ##############################################################################
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# gevent
+from gevent import sleep, spawn
+from gevent.event import Event
+
+# Zato
+from zato.common import AMQP
+from zato.server.connection.amqp_ import Consumer
+
+# ################################################################################################################################
+
+_ack = AMQP.ACK_MODE.ACK.id
+_reject = AMQP.ACK_MODE.REJECT.id
+
+# ################################################################################################################################
+
+class FakeMessage(object):
+    def __init__(self, broker, delivery_tag):
+        self.broker = broker
+        self.delivery_tag = delivery_tag
+        self._state = 'RECEIVED'
+
+    def ack(self, multiple=False):
+        self._state = 'ACK'
+        self.broker.on_ack(self.delivery_tag, multiple)
+
+    def reject(self):
+        self._state = 'REJECTED'
+        self.broker.on_reject(self.delivery_tag)
+
+# ################################################################################################################################
+
+class FakeBroker(object):
+    """ Delivers messages to a consumer without exceeding its prefetch count of unacknowledged ones.
+    """
+    def __init__(self, consumer, len_messages):
+        self.consumer = consumer
+        self.len_messages = len_messages
+        self.prefetch_count = consumer.config.prefetch_count
+        self.unacked = set()
+        self.frames = []
+        self.settled = Event()
+
+    def on_ack(self, delivery_tag, multiple):
+        self.frames.append(('ack', delivery_tag, multiple))
+        if multiple:
+            self.unacked = set(tag for tag in self.unacked if tag > delivery_tag)
+        else:
+            self.unacked.discard(delivery_tag)
+        self.settled.set()
+
+    def on_reject(self, delivery_tag):
+        self.frames.append(('reject', delivery_tag, False))
+        self.unacked.discard(delivery_tag)
+        self.settled.set()
+
+    def run(self):
+        for delivery_tag in range(1, self.len_messages + 1):
+            while len(self.unacked) >= self.prefetch_count:
+                self.settled.clear()
+                self.settled.wait()
+
+            self.unacked.add(delivery_tag)
+            self.consumer._on_amqp_message('body.{}'.format(delivery_tag), FakeMessage(self, delivery_tag))
+
+        # Wait until all messages are processed
+        self.consumer.handlers.join()
+
+# ################################################################################################################################
+
+class ConsumerTestCase(TestCase):
+
+    def get_consumer(self, on_amqp_message, prefetch_count=4, ack_mode=_ack):
+        config = Bunch(name='my.channel', queue='my.queue', prefetch_count=prefetch_count, ack_mode=ack_mode)
+        return Consumer(config, on_amqp_message)
+
+    def run_broker(self, consumer, len_messages):
+        broker = FakeBroker(consumer, len_messages)
+        spawn(broker.run).get()
+        return broker
+
+# ################################################################################################################################
+
+    def test_concurrency_and_multiple_acks(self):
+        running = []
+        max_running = []
+
+        def on_amqp_message(body, msg, name, config):
+            running.append(msg.delivery_tag)
+            max_running.append(len(running))
+
+            # Later messages complete first
+            sleep(0.001 * (5 - msg.delivery_tag % 5))
+            running.remove(msg.delivery_tag)
+
+        consumer = self.get_consumer(on_amqp_message)
+        broker = self.run_broker(consumer, 20)
+
+        self.assertEquals(max(max_running), 4)
+        self.assertSetEqual(broker.unacked, set())
+
+        # All acks are multiple-acks, in the order of delivery tags
+        tags = [tag for action, tag, multiple in broker.frames]
+        self.assertListEqual(tags, sorted(tags))
+        self.assertEquals(tags[-1], 20)
+        self.assertLess(len(broker.frames), 20)
+
+        for action, tag, multiple in broker.frames:
+            self.assertEquals(action, 'ack')
+            self.assertTrue(multiple)
+
+# ################################################################################################################################
+
+    def test_reject_mode(self):
+        consumer = self.get_consumer(lambda *args: None, ack_mode=_reject)
+        broker = self.run_broker(consumer, 5)
+
+        self.assertListEqual(broker.frames, [('reject', tag, False) for tag in range(1, 6)])
+
+# ################################################################################################################################
+
+    def test_settled_by_service_and_failed(self):
+
+        def on_amqp_message(body, msg, name, config):
+            if msg.delivery_tag == 2:
+                msg.reject()
+            elif msg.delivery_tag == 3:
+                raise Exception('Service failed')
+
+        consumer = self.get_consumer(on_amqp_message, prefetch_count=10)
+        broker = self.run_broker(consumer, 5)
+
+        # Message 3 is not acked and, to keep it that way, neither are any other messages multiple-acked past it
+        self.assertListEqual(broker.frames, [('reject', 2, False), ('ack', 1, True), ('ack', 4, False), ('ack', 5, False)])
+        self.assertSetEqual(broker.unacked, set([3]))
+
+        # A new channel means that multiple-acks are allowed again
+        consumer._reset_acks()
+        self.assertTrue(consumer.can_ack_multiple)
+
+# ################################################################################################################################
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# gevent
+from gevent import sleep
+
+# Zato
+from zato.common import CACHE
+from zato.server.connection.cache import Cache, StateChangedBuffer
+
+# ################################################################################################################################
+
+_op = CACHE.STATE_CHANGED
+
+# ################################################################################################################################
+
+def get_cache(sync_method, batch_callback=None, name='my.cache'):
+    return Cache(Bunch({
+        'name': name,
+        'max_size': 1000,
+        'max_item_size': 1000,
+        'extend_expiry_on_get': False,
+        'extend_expiry_on_set': False,
+        'sync_method': sync_method,
+        'after_state_changed_callback': lambda *ignored: None,
+        'after_state_changed_batch_callback': batch_callback,
+        'sync_batch_window': 5,
+        'sync_batch_max_ops': 100,
+    }))
+
+# ################################################################################################################################
+
+class StateChangedBufferTestCase(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.buffer = StateChangedBuffer('my.cache', 3600, 1000, self._on_batch)
+
+    def _on_batch(self, cache_name, ops):
+        self.batches.append((cache_name, ops))
+
+    def _get_ops(self):
+        self.buffer.flush()
+        self.assertEquals(len(self.batches), 1)
+        cache_name, ops = self.batches[0]
+        self.assertEquals(cache_name, 'my.cache')
+
+        return [(op, data.get('key')) for op, data in ops]
+
+# ################################################################################################################################
+
+    def test_last_write_per_key_wins(self):
+
+        self.buffer.add(_op.SET, {'key':'a', 'value':1})
+        self.buffer.add(_op.SET, {'key':'b', 'value':1})
+        self.buffer.add(_op.SET, {'key':'a', 'value':2})
+        self.buffer.add(_op.DELETE, {'key':'b'})
+        self.buffer.add(_op.SET, {'key':'a', 'value':3})
+
+        self.assertEquals(len(self.buffer), 2)
+        self.assertListEqual(self._get_ops(), [(_op.DELETE, 'b'), (_op.SET, 'a')])
+        self.assertEquals(self.batches[0][1][1][1]['value'], 3)
+
+# ################################################################################################################################
+
+    def test_expire_is_kept_after_set(self):
+
+        self.buffer.add(_op.SET, {'key':'a', 'value':1})
+        self.buffer.add(_op.EXPIRE, {'key':'a', 'expiry':1})
+        self.buffer.add(_op.EXPIRE, {'key':'a', 'expiry':2})
+
+        self.assertListEqual(self._get_ops(), [(_op.SET, 'a'), (_op.EXPIRE, 'a')])
+        self.assertEquals(self.batches[0][1][1][1]['expiry'], 2)
+
+# ################################################################################################################################
+
+    def test_pattern_operations_are_barriers(self):
+
+        self.buffer.add(_op.SET, {'key':'a', 'value':1})
+        self.buffer.add(_op.DELETE_BY_PREFIX, {'key':'a'})
+        self.buffer.add(_op.SET, {'key':'a', 'value':2})
+
+        self.assertListEqual(self._get_ops(), [(_op.SET, 'a'), (_op.DELETE_BY_PREFIX, 'a'), (_op.SET, 'a')])
+
+# ################################################################################################################################
+
+    def test_clear_drops_earlier_changes(self):
+
+        self.buffer.add(_op.SET, {'key':'a', 'value':1})
+        self.buffer.add(_op.SET_BY_PREFIX, {'key':'a', 'value':1})
+        self.buffer.add(_op.CLEAR, {})
+        self.buffer.add(_op.SET, {'key':'b', 'value':1})
+
+        self.assertListEqual(self._get_ops(), [(_op.CLEAR, None), (_op.SET, 'b')])
+
+# ################################################################################################################################
+
+    def test_flush_after_window_and_max_ops(self):
+
+        self.buffer = StateChangedBuffer('my.cache', 0.01, 3, self._on_batch)
+
+        self.buffer.add(_op.SET, {'key':'a', 'value':1})
+        self.assertListEqual(self.batches, [])
+        sleep(0.05)
+        self.assertEquals(len(self.batches), 1)
+
+        for idx in range(3):
+            self.buffer.add(_op.SET, {'key':idx, 'value':idx})
+        sleep(0)
+        self.assertEquals(len(self.batches), 2)
+        self.assertEquals(len(self.batches[1][1]), 3)
+
+        # An empty buffer is never flushed
+        self.buffer.flush()
+        self.assertEquals(len(self.batches), 2)
+
+# ################################################################################################################################
+
+class CacheSyncTestCase(TestCase):
+
+    def test_batched_sync_round_trip(self):
+
+        batches = []
+
+        source = get_cache(CACHE.SYNC_METHOD.BATCHED.id, lambda cache_name, ops: batches.append(ops))
+        target = get_cache(CACHE.SYNC_METHOD.BATCHED.id)
+
+        for idx in range(50):
+            source.set('key', idx)
+
+        source.set('key2', 'value2')
+        source.set('key3', 'value3')
+        source.delete('key3')
+        source.set_by_prefix('key2', 'value22', return_found=True)
+        source.expire('key', 3600)
+
+        self.assertListEqual(batches, [])
+        sleep(0.05)
+        self.assertEquals(len(batches), 1)
+        self.assertEquals(len(batches[0]), 5)
+
+        target.sync_after_batch(batches[0])
+
+        self.assertEquals(target.get('key'), 49)
+        self.assertEquals(target.get('key2'), 'value22')
+        self.assertNotIn('key3', target)
+        self.assertEquals(target.get('key', details=True).expiry, 3600)
+
+# ################################################################################################################################
+
+    def test_local_only(self):
+
+        batches = []
+
+        cache = get_cache(CACHE.SYNC_METHOD.NO_SYNC.id, lambda cache_name, ops: batches.append(ops))
+        self.assertFalse(cache.needs_sync)
+        self.assertIsNone(cache.sync_buffer)
+
+        cache.set('key', 'value')
+        sleep(0.05)
+        self.assertListEqual(batches, [])
+
+# ################################################################################################################################
+
+    def test_update_sync_method(self):
+
+        batches = []
+
+        cache = get_cache(CACHE.SYNC_METHOD.BATCHED.id, lambda cache_name, ops: batches.append((cache_name, ops)))
+        cache.set('key', 'value')
+
+        config = Bunch(cache.config)
+        config.name = 'my.cache.2'
+        config.sync_method = CACHE.SYNC_METHOD.IN_BACKGROUND.id
+        cache.update_config(config)
+
+        # Changes collected under the previous sync method are flushed out immediately
+        self.assertEquals(len(batches), 1)
+        self.assertEquals(batches[0][0], 'my.cache')
+        self.assertIsNone(cache.sync_buffer)
+        self.assertTrue(cache.needs_sync)
+
+# ################################################################################################################################
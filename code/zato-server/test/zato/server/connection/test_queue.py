@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from itertools import count
+from time import time
+from unittest import TestCase
+
+# gevent
+from gevent import sleep, spawn
+from gevent.pool import Pool
+
+# mock
+from mock import patch
+
+# Zato
+from zato.server.connection.queue import ConnectionQueue
+
+# ################################################################################################################################
+
+class Client(object):
+    def __init__(self, id):
+        self.id = id
+        self.is_alive = True
+        self.is_closed = False
+
+    def close(self):
+        self.is_closed = True
+
+# ################################################################################################################################
+
+class ConnectionQueueTestCase(TestCase):
+
+    def get_queue(self, pool_size=2, create_time=0, **kwargs):
+
+        ids = count(1)
+
+        def add_client():
+            sleep(create_time)
+            queue.put_client(Client(next(ids)))
+
+        queue = ConnectionQueue(pool_size, 10, 'my.conn', 'Test', 'test://', add_client, close_func=Client.close, **kwargs)
+        queue.build_queue()
+
+        while queue.size < queue.min_size:
+            sleep(0.001)
+
+        return queue
+
+# ################################################################################################################################
+
+    def test_waits_for_free_connection(self):
+        queue = self.get_queue(1)
+
+        def use_client():
+            with queue() as client:
+                sleep(0.05)
+                return client.id
+
+        first = spawn(use_client)
+        sleep(0)
+
+        # The only client is in use so this one needs to wait until it is returned
+        with queue() as client:
+            self.assertEquals(client.id, 1)
+
+        self.assertEquals(first.get(), 1)
+        self.assertGreater(queue.get_stats()['wait_time_max'], 0.03)
+
+# ################################################################################################################################
+
+    def test_stats_logged(self):
+        queue = self.get_queue(1, acquire_timeout=0.01)
+
+        with patch.object(queue, 'logger') as logger:
+
+            # Nobody had to wait for a client yet
+            with queue():
+                queue.log_stats()
+                self.assertFalse(logger.info.called)
+
+                self.assertRaises(Exception, queue.acquire)
+
+            queue.log_stats()
+            self.assertEquals(logger.info.call_count, 1)
+            self.assertEquals(logger.info.call_args[0][4:7], (1, 1, 0))
+
+            # Nothing new to log
+            queue.log_stats()
+            self.assertEquals(logger.info.call_count, 1)
+
+# ################################################################################################################################
+
+    def test_acquire_timeout(self):
+        queue = self.get_queue(1, acquire_timeout=0.05)
+        client = queue.acquire()
+
+        start = time()
+        self.assertRaises(Exception, queue.acquire)
+        self.assertGreaterEqual(time() - start, 0.05)
+
+        stats = queue.get_stats()
+        self.assertEquals(stats['timeouts'], 1)
+        self.assertEquals(stats['waiters'], 0)
+        self.assertEquals(stats['in_use'], 1)
+
+        queue.release(client)
+        self.assertIs(queue.acquire(), client)
+
+# ################################################################################################################################
+
+    def test_waiters_fifo(self):
+        queue = self.get_queue(1)
+        client = queue.acquire()
+        order = []
+
+        def wait(idx):
+            with queue():
+                order.append(idx)
+
+        greenlets = []
+        for idx in range(10):
+            greenlets.append(spawn(wait, idx))
+            sleep(0)
+
+        self.assertEquals(queue.get_stats()['waiters'], 10)
+
+        queue.release(client)
+        for g in greenlets:
+            g.get()
+
+        self.assertListEqual(order, list(range(10)))
+
+# ################################################################################################################################
+
+    def test_grows_on_demand(self):
+        queue = self.get_queue(3, min_size=1)
+        self.assertEquals(queue.size, 1)
+
+        clients = [queue.acquire() for idx in range(3)]
+        self.assertEquals(sorted(client.id for client in clients), [1, 2, 3])
+        self.assertEquals(queue.size, 3)
+
+        # Never above max size
+        queue.acquire_timeout = 0.01
+        self.assertRaises(Exception, queue.acquire)
+        self.assertEquals(queue.size, 3)
+
+# ################################################################################################################################
+
+    def test_idle_eviction(self):
+        queue = self.get_queue(4, min_size=1, idle_timeout=10)
+        clients = [queue.acquire() for idx in range(4)]
+
+        for client in clients:
+            queue.release(client)
+
+        # Nothing is idle long enough yet
+        self.assertListEqual(queue.evict_idle(), [])
+
+        # The most recently used clients are kept, the other ones are evicted
+        queue.last_used[id(clients[0])] -= 20
+        queue.last_used[id(clients[1])] -= 20
+
+        evicted = queue.evict_idle()
+        self.assertEquals(sorted(client.id for client in evicted), [clients[0].id, clients[1].id])
+        self.assertEquals(queue.size, 2)
+
+        # Eviction passes do not change the order in which clients are checked out,
+        # i.e. the most recently used one is still first.
+        self.assertListEqual(queue.evict_idle(), [])
+        self.assertIs(queue.acquire(), clients[3])
+        self.assertIs(queue.acquire(), clients[2])
+
+        # Evicted clients are closed, not only dereferenced
+        self.assertListEqual([client.is_closed for client in clients], [True, True, False, False])
+
+# ################################################################################################################################
+
+    def test_idle_eviction_keeps_min_size(self):
+        queue = self.get_queue(3, min_size=2, idle_timeout=10)
+        clients = [queue.acquire() for idx in range(3)]
+
+        for client in clients:
+            queue.release(client)
+            queue.last_used[id(client)] -= 20
+
+        self.assertEquals(len(queue.evict_idle()), 1)
+        self.assertEquals(queue.size, 2)
+
+# ################################################################################################################################
+
+    def test_dead_client_replaced(self):
+
+        def ping(client):
+            if not client.is_alive:
+                raise Exception('Client {} is not alive'.format(client.id))
+
+        queue = self.get_queue(1, ping_func=ping, ping_idle_time=0)
+
+        with queue() as client:
+            client.is_alive = False
+            dead = client
+
+        with queue() as client:
+            self.assertEquals(client.id, 2)
+
+        self.assertTrue(dead.is_closed)
+        self.assertFalse(client.is_closed)
+
+        stats = queue.get_stats()
+        self.assertEquals(stats['ping_failed'], 1)
+        self.assertEquals(stats['size'], 1)
+
+# ################################################################################################################################
+
+    def test_load(self):
+        """ Twice as many greenlets as there are connections, none of them should fail.
+        """
+        pool_size = 10
+        queue = self.get_queue(pool_size, create_time=0.005, min_size=2, acquire_timeout=5)
+        failures = []
+
+        def use_client(_ignored):
+            try:
+                with queue():
+                    sleep(0.002)
+            except Exception as e:
+                failures.append(e)
+
+        list(Pool(pool_size * 2).imap_unordered(use_client, range(2000)))
+
+        stats = queue.get_stats()
+        self.assertListEqual(failures, [])
+        self.assertEquals(stats['acquired'], 2000)
+        self.assertEquals(stats['size'], pool_size)
+        self.assertEquals(stats['in_use'], 0)
+
+# ################################################################################################################################
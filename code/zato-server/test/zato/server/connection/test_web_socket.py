@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+import socket
+from time import time
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# gevent
+from gevent import spawn_later
+from gevent.lock import RLock
+
+# mock
+from mock import Mock, patch
+
+# pyrapidjson
+from rapidjson import loads
+
+# Zato
+from zato.common.util import new_cid
+from zato.server.connection.web_socket import KeepAliveScheduler, WebSocket
+
+# ################################################################################################################################
+
+class SwarmClient(WebSocket):
+    """ A WebSocket connection without a socket - pings are answered with pongs after pong_delay seconds,
+    or right away if it is zero, unless answers is False.
+    """
+    def __init__(self, container, pong_delay=0, answers=True):
+        self.container = container
+        self.pong_delay = pong_delay
+        self.answers = answers
+        self.config = Bunch(name='my.channel', token_ttl=3600)
+        self.stream = True
+        self.server_terminated = self.client_terminated = False
+        self.update_lock = RLock()
+        self.responses_received = {}
+        self.pub_client_id = 'ws.{}'.format(new_cid())
+        self.pings_missed = 0
+        self.pings_missed_threshold = 2
+        self.ping_last_response_time = None
+        self._peer_address = self._peer_fqdn = self._local_address = 'localhost'
+        self._token = None
+        self.token = 'ws.token.{}'.format(new_cid())
+        self.sent = []
+
+    def ping(self, data):
+        if self.answers:
+            if self.pong_delay:
+                spawn_later(self.pong_delay, self.ponged, Bunch(data=data))
+            else:
+                self.ponged(Bunch(data=data))
+
+    def send(self, data):
+        self.sent.append(data)
+
+# ################################################################################################################################
+
+class FakeTime(object):
+    """ A clock that only moves forward when told to.
+    """
+    def __init__(self):
+        self.now = time()
+
+    def __call__(self):
+        return self.now
+
+# ################################################################################################################################
+
+class KeepAliveSchedulerTestCase(TestCase):
+
+    def get_clients(self, keep_alive, len_clients, **kwargs):
+        container = Bunch(keep_alive=keep_alive, clients={})
+        return [SwarmClient(container, **kwargs) for idx in range(len_clients)]
+
+# ################################################################################################################################
+
+    def test_buckets(self):
+        keep_alive = KeepAliveScheduler(ping_interval=10)
+        now = time()
+        first, second, third = self.get_clients(keep_alive, 3)
+
+        keep_alive.add(first, lambda: now)
+        keep_alive.add(second, lambda: now + 1)
+        keep_alive.add(third, lambda: now + 1)
+
+        self.assertEquals(len(keep_alive.buckets), 2)
+
+        # Nothing is due yet
+        self.assertListEqual(keep_alive.get_due(now + 5), [])
+
+        keep_alive.remove(third)
+        self.assertListEqual(keep_alive.get_due(now + 10), [first])
+        self.assertListEqual(keep_alive.get_due(now + 11), [second])
+        self.assertDictEqual(keep_alive.buckets, {})
+        self.assertDictEqual(keep_alive.clients, {})
+
+# ################################################################################################################################
+
+    def test_pings(self):
+        keep_alive = KeepAliveScheduler(ping_interval=10, response_wait_time=1)
+        clients = self.get_clients(keep_alive, 10)
+        expires_at = clients[0].token.expires_at
+        _time = FakeTime()
+
+        for client in clients:
+            keep_alive.add(client, _time)
+
+        with patch('zato.server.connection.web_socket.spawn') as spawn:
+
+            # Nothing is due yet
+            self.assertListEqual(keep_alive.run_once(_time), [])
+            self.assertFalse(spawn.called)
+
+            _time.now += 10
+            batch = keep_alive.run_once(_time)
+            self.assertEquals(len(batch), 10)
+
+            # Pongs from the whole batch are waited for in one greenlet
+            spawn.assert_called_once_with(keep_alive._wait_for_pongs, batch, _time)
+
+        # Clients are already scheduled for their next pings
+        self.assertEquals(len(keep_alive.clients), 10)
+        self.assertListEqual(list(keep_alive.buckets), [int(_time.now + 10)])
+
+        keep_alive._wait_for_pongs(batch, _time)
+
+        for client in clients:
+            self.assertIsNotNone(client.ping_last_response_time)
+            self.assertDictEqual(client.responses_received, {})
+
+        self.assertGreater(clients[0].token.expires_at, expires_at)
+
+# ################################################################################################################################
+
+    def test_missed_pings(self):
+        keep_alive = KeepAliveScheduler(ping_interval=10, response_wait_time=0)
+        client, = self.get_clients(keep_alive, 1, answers=False)
+        _time = FakeTime()
+        keep_alive.add(client, _time)
+
+        with patch('zato.server.connection.web_socket.spawn'):
+            for idx in range(2):
+                _time.now += 10
+                batch = keep_alive.run_once(_time)
+                self.assertEquals(len(batch), 1)
+                keep_alive._wait_for_pongs(batch, _time)
+
+        self.assertEquals(client.pings_missed, 2)
+        self.assertTrue(client.server_terminated)
+        self.assertEquals(len(client.sent), 1)
+
+# ################################################################################################################################
+
+    def test_failed_ping(self):
+        keep_alive = KeepAliveScheduler(ping_interval=10, response_wait_time=1)
+        clients = self.get_clients(keep_alive, 5)
+        _time = FakeTime()
+
+        # Each client is in a bucket of its own so they are pinged in order
+        for client in clients:
+            keep_alive.add(client, _time)
+            _time.now += 1
+
+        # The peer of a client in the middle of the batch is gone
+        failed = clients[2]
+        failed.ping = Mock(side_effect=socket.error(32, 'Broken pipe'))
+        failed.on_socket_terminated = Mock()
+
+        _time.now += 10
+
+        with patch('zato.server.connection.web_socket.spawn') as spawn:
+            batch = keep_alive.run_once(_time)
+
+        others = clients[:2] + clients[3:]
+
+        # All the other clients were pinged and are scheduled for their next pings
+        self.assertListEqual([elem[0] for elem in batch], others)
+        self.assertListEqual(sorted(keep_alive.clients), sorted(others))
+        spawn.assert_called_once_with(keep_alive._wait_for_pongs, batch, _time)
+
+        # The failed one is closed and its ping is not waited for
+        failed.on_socket_terminated.assert_called_once_with()
+        self.assertDictEqual(failed.responses_received, {})
+
+        keep_alive._wait_for_pongs(batch, _time)
+
+        for client in others:
+            self.assertIsNotNone(client.ping_last_response_time)
+            self.assertDictEqual(client.responses_received, {})
+
+# ################################################################################################################################
+
+class InvokeClientTestCase(TestCase):
+
+    def test_invoke_client(self):
+        client = SwarmClient(None)
+
+        def respond():
+            request = loads(client.sent[0])
+            client._handle_client_response(None, Bunch(in_reply_to=request['meta']['id'], data={'a': 1}))
+
+        spawn_later(0.01, respond)
+
+        start = time()
+        self.assertDictEqual(client.invoke_client(new_cid(), {'b': 2}), {'a': 1})
+        self.assertLess(time() - start, 0.5)
+        self.assertDictEqual(client.responses_received, {})
+
+    def test_no_response(self):
+        client = SwarmClient(None)
+        self.assertIsNone(client.invoke_client(new_cid(), {'b': 2}, wait_time=0.01))
+        self.assertDictEqual(client.responses_received, {})
+
+        # Late responses are ignored
+        client._handle_client_response(None, Bunch(in_reply_to=loads(client.sent[0])['meta']['id'], data={}))
+        self.assertDictEqual(client.responses_received, {})
+
+    def test_ping(self):
+        client = SwarmClient(None, pong_delay=0.01)
+        self.assertTrue(client.invoke_client(new_cid(), None, False))
+
+# ################################################################################################################################
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# Zato
+from zato.common import PUBSUB
+from zato.server.pubsub import Endpoint
+
+# ################################################################################################################################
+
+def get_endpoint(topic_patterns):
+    return Endpoint(Bunch(id=1, name='my.endpoint', endpoint_type=PUBSUB.ENDPOINT_TYPE.REST.id,
+        role=PUBSUB.ROLE.PUBLISHER_SUBSCRIBER.id, is_active=True, is_internal=False, topic_patterns=topic_patterns))
+
+# ################################################################################################################################
+
+def get_legacy_pattern(endpoint, name, is_pub):
+    """ Finds the matching pattern the way it used to be done, i.e. by trying each pattern in turn.
+    """
+    for orig, matcher in (endpoint.pub_topic_patterns if is_pub else endpoint.sub_topic_patterns):
+        if matcher.match(name):
+            return orig
+
+# ################################################################################################################################
+
+class BaseTestCase(TestCase):
+
+    def get_patterns(self, len_patterns):
+        patterns = []
+        for idx in range(len_patterns):
+            patterns.append('pub=/customer/{}/*'.format(idx))
+            patterns.append('sub=/customer/{}/orders/**'.format(idx))
+
+        return '\n'.join(patterns)
+
+# ################################################################################################################################
+
+class EndpointTestCase(BaseTestCase):
+
+    def test_get_allowed_topic_pattern(self):
+        endpoint = get_endpoint('\n'.join([
+            'pub=/a/b/*',
+            'pub=/a/**',
+            'sub=/c/?/d',
+            'sub=/c/*',
+            'invalid=/e',
+        ]))
+
+        names = ['/a/b/c', '/a/b/c/d', '/a', '/a/b', '/a/', '/c/1/d', '/c/12/d', '/c/d', '/c/d/e', '/e', '/x', '']
+
+        for name in names:
+            for is_pub in True, False:
+                self.assertEquals(endpoint.get_allowed_topic_pattern(name, is_pub), get_legacy_pattern(endpoint, name, is_pub),
+                    (name, is_pub))
+
+        self.assertEquals(endpoint.get_allowed_topic_pattern('/a/b/c', True), 'pub=/a/b/*')
+        self.assertEquals(endpoint.get_allowed_topic_pattern('/a/x/y', True), 'pub=/a/**')
+
+        # Patterns match topic names by their prefixes
+        self.assertEquals(endpoint.get_allowed_topic_pattern('/a/b/c/d', True), 'pub=/a/b/*')
+        self.assertIsNone(endpoint.get_allowed_topic_pattern('/a/b/c', False))
+
+# ################################################################################################################################
+
+    def test_many_patterns(self):
+        endpoint = get_endpoint(self.get_patterns(300))
+
+        # More patterns than a single regular expression may have groups for
+        self.assertGreater(len(endpoint.topic_matcher[True].combined), 1)
+
+        for idx in (0, 98, 99, 100, 299):
+            self.assertEquals(endpoint.get_allowed_topic_pattern('/customer/{}/1'.format(idx), True),
+                'pub=/customer/{}/*'.format(idx))
+            self.assertEquals(endpoint.get_allowed_topic_pattern('/customer/{}/orders/1/2'.format(idx), False),
+                'sub=/customer/{}/orders/**'.format(idx))
+
+        self.assertIsNone(endpoint.get_allowed_topic_pattern('/customer/300/1', True))
+
+# ################################################################################################################################
+
+    def test_cache(self):
+        endpoint = get_endpoint('pub=/a/*')
+
+        self.assertEquals(endpoint.get_allowed_topic_pattern('/a/b', True), 'pub=/a/*')
+        self.assertIsNone(endpoint.get_allowed_topic_pattern('/c', True))
+        self.assertDictEqual(endpoint.allowed_cache[True], {'/a/b': 'pub=/a/*', '/c': None})
+
+        endpoint.clear_allowed_cache()
+        self.assertDictEqual(endpoint.allowed_cache[True], {})
+
+        # The cache never grows beyond its maximum size
+        for idx in range(25):
+            endpoint.get_allowed_topic_pattern('/a/{}'.format(idx), True, _max_size=10)
+            self.assertLessEqual(len(endpoint.allowed_cache[True]), 10)
+
+# ################################################################################################################################
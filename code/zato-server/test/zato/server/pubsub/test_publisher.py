@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from contextlib import closing
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# gevent
+from gevent import spawn
+
+# SQLAlchemy
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+# Zato
+from zato.common.exception import BadRequest, ServiceUnavailable
+from zato.common.odb.model import Base, PubSubEndpointEnqueuedMessage, PubSubMessage
+from zato.common.pubsub import new_msg_id
+from zato.common.util.time_ import utcnow_as_ms
+from zato.server.pubsub.publisher import GDPublisher
+
+# ################################################################################################################################
+
+def get_msg(topic, subscriptions, pub_msg_id=None, **kwargs):
+    msg = {
+        'pub_msg_id': pub_msg_id or new_msg_id(),
+        'pub_time': utcnow_as_ms(),
+        'pub_pattern_matched': 'pub=/*',
+        'data': 'abc',
+        'data_prefix': 'abc',
+        'data_prefix_short': 'abc',
+        'size': 3,
+        'expiration': 0,
+        'has_gd': True,
+        'published_by_id': 1,
+        'topic_id': topic.id,
+        'cluster_id': 1,
+        'is_in_sub_queue': bool(subscriptions),
+        'sub_pattern_matched': dict((sub.sub_key, 'sub=/*') for sub in subscriptions),
+    }
+    msg.update(kwargs)
+    return msg
+
+# ################################################################################################################################
+
+class ODB(object):
+    """ A single SQL database with a session factory, as the server's ODB provides it.
+    """
+    def __init__(self, url):
+        self.engine = create_engine(url)
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)
+
+    def count(self, model):
+        with closing(self.session()) as session:
+            return session.query(model).count()
+
+# ################################################################################################################################
+
+class GDPublisherTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='zato-test-publisher-')
+        self.odb = ODB('sqlite:///{}/odb.db'.format(self.tmp_dir))
+
+        self.topic = Bunch(id=1, name='/my/topic', max_depth_gd=100)
+        self.subs = [Bunch(sub_key='sk.{}'.format(idx), endpoint_id=idx) for idx in range(2)]
+        self.publisher = GDPublisher(self.odb, 10, 500)
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def publish(self, msg_list, needs_depth_check=False):
+        return self.publisher.publish(new_msg_id(), 1, self.topic, self.subs, msg_list, utcnow_as_ms(), False, needs_depth_check)
+
+# ################################################################################################################################
+
+    def test_group_commit(self):
+
+        commits = []
+        session_factory = self.odb.session
+
+        def session():
+            commits.append(1)
+            return session_factory()
+
+        self.odb.session = session
+
+        msg_lists = [[get_msg(self.topic, self.subs)] for idx in range(20)]
+
+        # One of the messages has optional attributes that others do not have
+        msg_lists[5][0]['pub_correl_id'] = 'my.correl.id'
+
+        greenlets = [spawn(self.publish, msg_list) for msg_list in msg_lists]
+        results = [g.get() for g in greenlets]
+
+        self.assertListEqual(results, [None] * 20)
+        self.assertEquals(len(commits), 1)
+
+        self.odb.session = session_factory
+        self.assertEquals(self.odb.count(PubSubMessage), 20)
+        self.assertEquals(self.odb.count(PubSubEndpointEnqueuedMessage), 40)
+
+        with closing(self.odb.session()) as session:
+            msg = session.query(PubSubMessage).filter(PubSubMessage.pub_msg_id==msg_lists[5][0]['pub_msg_id']).one()
+            self.assertEquals(msg.pub_correl_id, 'my.correl.id')
+
+# ################################################################################################################################
+
+    def test_each_publisher_gets_its_own_error(self):
+
+        existing = get_msg(self.topic, self.subs)
+        self.publish([existing])
+
+        # The second publication duplicates a msg_id of a message already in the database
+        ok1 = spawn(self.publish, [get_msg(self.topic, self.subs)])
+        duplicate = spawn(self.publish, [get_msg(self.topic, self.subs, existing['pub_msg_id'])])
+        ok2 = spawn(self.publish, [get_msg(self.topic, self.subs), get_msg(self.topic, self.subs)])
+
+        self.assertIsNone(ok1.get())
+        self.assertIsNone(ok2.get())
+
+        # SQLite does not give the name of the index violated so the error cannot be turned into a BadRequest
+        self.assertRaises((BadRequest, IntegrityError), duplicate.get)
+
+        self.assertEquals(self.odb.count(PubSubMessage), 4)
+        self.assertEquals(self.odb.count(PubSubEndpointEnqueuedMessage), 8)
+
+# ################################################################################################################################
+
+    def test_max_depth(self):
+
+        self.topic.max_depth_gd = 5
+        self.subs = []
+
+        first = spawn(self.publish, [get_msg(self.topic, [])], True)
+        too_many = spawn(self.publish, [get_msg(self.topic, []) for idx in range(5)], True)
+        last = spawn(self.publish, [get_msg(self.topic, []) for idx in range(4)], True)
+
+        self.assertEquals(first.get(), 1)
+        self.assertRaises(ServiceUnavailable, too_many.get)
+        self.assertEquals(last.get(), 5)
+
+        self.assertEquals(self.odb.count(PubSubMessage), 5)
+
+# ################################################################################################################################
+
+    def test_max_msgs(self):
+
+        # With a long window, publications are committed only once there are enough messages
+        self.publisher = GDPublisher(self.odb, 60000, 10)
+
+        greenlets = [spawn(self.publish, [get_msg(self.topic, self.subs) for idx in range(5)]) for idx in range(2)]
+        for g in greenlets:
+            self.assertIsNone(g.get(timeout=1))
+
+        self.assertEquals(self.odb.count(PubSubMessage), 10)
+
+# ################################################################################################################################
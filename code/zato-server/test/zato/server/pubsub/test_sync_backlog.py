@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# mock
+from mock import patch
+
+# Zato
+from zato.server.pubsub import InRAMSyncBacklog
+
+# ################################################################################################################################
+
+_topic_id = 1
+_now = 1000000
+
+# ################################################################################################################################
+
+def get_msg(idx, expiration_time):
+    return {
+        'pub_msg_id': 'msg.{}'.format(idx),
+        'pub_time': _now,
+        'data': 'data.{}'.format(idx),
+        'size': 6,
+        'priority': 5,
+        'pub_correl_id': None,
+        'in_reply_to': None,
+        'mime_type': 'text/plain',
+        'expiration': expiration_time - _now,
+        'expiration_time': expiration_time,
+        'topic_id': _topic_id,
+        'topic_name': '/my/topic',
+        'published_by_id': 1,
+    }
+
+# ################################################################################################################################
+
+class FakePubSub(object):
+    def __init__(self):
+        self.server = Bunch(name='server1', pid=123)
+
+    def get_endpoint_by_id(self, endpoint_id):
+        return Bunch(name='my.endpoint')
+
+# ################################################################################################################################
+
+class BaseTestCase(TestCase):
+
+    def get_backlog(self, messages, sub_keys=('sk.1', 'sk.2')):
+        with patch('zato.server.pubsub.spawn_greenlet'):
+            backlog = InRAMSyncBacklog(FakePubSub())
+        backlog.add_messages('cid.1', _topic_id, '/my/topic', len(messages) + 1, list(sub_keys), messages)
+        return backlog
+
+# ################################################################################################################################
+
+class InRAMSyncBacklogTestCase(BaseTestCase):
+
+    def test_cleanup(self):
+        backlog = self.get_backlog([get_msg(idx, _now + idx) for idx in range(10)])
+
+        self.assertEquals(backlog.run_cleanup(lambda: _now + 4), 5)
+        self.assertEquals(sorted(backlog.msg_id_to_msg), ['msg.{}'.format(idx) for idx in range(5, 10)])
+        self.assertEquals(sorted(backlog.topic_msg_id[_topic_id]), sorted(backlog.msg_id_to_msg))
+        self.assertEquals(sorted(backlog.msg_id_to_sub_key), sorted(backlog.msg_id_to_msg))
+
+        for sub_key in 'sk.1', 'sk.2':
+            self.assertEquals(sorted(backlog.sub_key_to_msg_id[sub_key]), sorted(backlog.msg_id_to_msg))
+
+        # Nothing else expired yet
+        self.assertEquals(backlog.run_cleanup(lambda: _now + 4), 0)
+        self.assertEquals(backlog.run_cleanup(lambda: _now + 100), 5)
+        self.assertDictEqual(backlog.msg_id_to_msg, {})
+
+# ################################################################################################################################
+
+    def test_cleanup_in_batches(self):
+        backlog = self.get_backlog([get_msg(idx, _now) for idx in range(25)])
+        sleeps = []
+
+        self.assertEquals(backlog.run_cleanup(lambda: _now, sleeps.append, 10), 25)
+        self.assertEquals(len(sleeps), 2)
+        self.assertDictEqual(backlog.msg_id_to_msg, {})
+
+# ################################################################################################################################
+
+    def test_deleted_and_updated_messages(self):
+        backlog = self.get_backlog([get_msg(idx, _now + idx) for idx in range(3)])
+
+        # Deleted before it expired
+        backlog.delete_msg_by_id('msg.0')
+
+        # Its expiration time is extended
+        msg = dict(backlog.get_message_by_id('msg.1'))
+        msg['msg_id'] = msg['pub_msg_id']
+        msg['expiration_time'] = _now + 100
+        backlog.update_msg(msg)
+
+        self.assertEquals(backlog.run_cleanup(lambda: _now + 10), 1)
+        self.assertEquals(list(backlog.msg_id_to_msg), ['msg.1'])
+
+        self.assertEquals(backlog.run_cleanup(lambda: _now + 100), 1)
+        self.assertDictEqual(backlog.msg_id_to_msg, {})
+
+# ################################################################################################################################
+
+    def test_expiry_index_compacted(self):
+        # Messages are retrieved only if they did not expire as of the current time, hence such a distant expiration time
+        backlog = self.get_backlog([get_msg(idx, 2 ** 50) for idx in range(2000)])
+
+        with backlog.lock:
+            backlog._get_delete_messages_by_sub_keys(_topic_id, ['sk.1', 'sk.2'])
+
+        # All messages were retrieved so they are no longer kept in the expiry index either
+        backlog.run_cleanup(lambda: _now)
+        self.assertEquals(len(backlog.msg_expiry), 0)
+
+# ################################################################################################################################
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# gevent
+from gevent import sleep, spawn
+
+# mock
+from mock import patch
+
+# Zato
+from zato.common import PUBSUB
+from zato.common.util.time_ import utcnow_as_ms
+from zato.server.pubsub import PubSub
+from zato.server.pubsub.task import NonGDMessage, PubSubTool, SortedList
+
+# ################################################################################################################################
+
+_notify = PUBSUB.DELIVERY_METHOD.NOTIFY.id
+_pull = PUBSUB.DELIVERY_METHOD.PULL.id
+
+# ################################################################################################################################
+
+def get_msg(sub_key, idx):
+    return {
+        'pub_msg_id': 'msg.{}'.format(idx),
+        'pub_time': utcnow_as_ms(),
+        'data': 'data.{}'.format(idx),
+        'expiration': 0,
+        'expiration_time': None,
+        'topic_name': '/my/topic',
+        'size': 6,
+        'published_by_id': 1,
+        'pub_pattern_matched': '/*',
+        'sub_pattern_matched': {sub_key: '/*'},
+    }
+
+# ################################################################################################################################
+
+class FakePubSub(object):
+    """ Implements as much of PubSub as PubSubTool and DeliveryTask need.
+    """
+    def __init__(self, task_delivery_interval=0, delivery_method=_notify):
+        self.server = Bunch(name='server1', pid=123, odb=Bunch(session=lambda: Bunch(close=lambda: None)))
+        self.task_delivery_interval = task_delivery_interval
+        self.delivery_method = delivery_method
+        self.delivered = []
+        self.sub_configs = {}
+
+    def register_pubsub_tool(self, pubsub_tool):
+        pass
+
+    def set_pubsub_tool_for_sub_key(self, sub_key, pubsub_tool):
+        pass
+
+    def get_subscription_by_sub_key(self, sub_key):
+        config = self.sub_configs[sub_key] = Bunch(topic_name='/my/topic', endpoint_name='my.endpoint', wait_sock_err=1,
+            wait_non_sock_err=1, task_delivery_interval=self.task_delivery_interval, delivery_max_retry=100,
+            delivery_method=self.delivery_method, delivery_batch_size=100, wrap_one_msg_in_list=True)
+        return Bunch(config=config)
+
+    def get_initial_sql_msg_ids_by_sub_key(self, *ignored):
+        return []
+
+    def get_before_delivery_hook(self, sub_key):
+        return None
+
+    def deliver_pubsub_msg(self, sub_key, msg_list):
+        self.delivered.append((utcnow_as_ms(), sub_key, [msg.pub_msg_id for msg in msg_list]))
+
+    def confirm_pubsub_msg_delivered(self, sub_key, delivered_list):
+        pass
+
+# ################################################################################################################################
+
+class DeliveryTaskTestCase(TestCase):
+
+    def get_pubsub_tool(self, sub_keys=('sk.1',), **kwargs):
+        self.pubsub = FakePubSub(**kwargs)
+        self.greenlets = []
+        pubsub_tool = PubSubTool(self.pubsub, None, PUBSUB.ENDPOINT_TYPE.REST.id)
+
+        # There is no need to wait for each task to start
+        with patch('zato.server.pubsub.task.spawn_greenlet', lambda func: self.greenlets.append(spawn(func))):
+            for sub_key in sub_keys:
+                pubsub_tool.add_sub_key(sub_key)
+        sleep(0)
+
+        return pubsub_tool
+
+# ################################################################################################################################
+
+    def test_delivery_on_new_messages(self):
+
+        pubsub_tool = self.get_pubsub_tool()
+        task = pubsub_tool.get_delivery_task('sk.1')
+
+        # The task is idle, waiting to be woken up rather than polling for messages
+        self.assertFalse(task.wake_event.is_set())
+
+        # New messages wake it up
+        pubsub_tool.add_non_gd_messages_by_sub_key('sk.1', [get_msg('sk.1', 1), get_msg('sk.1', 2)])
+        self.assertTrue(task.wake_event.is_set())
+        sleep(0.01)
+
+        self.assertEquals(len(self.pubsub.delivered), 1)
+        _, sub_key, msg_ids = self.pubsub.delivered[0]
+
+        self.assertEquals(sub_key, 'sk.1')
+        self.assertListEqual(sorted(msg_ids), ['msg.1', 'msg.2'])
+        self.assertFalse(task.wake_event.is_set())
+
+        pubsub_tool.add_non_gd_messages_by_sub_key('sk.1', [get_msg('sk.1', 3)])
+        sleep(0.01)
+
+        self.assertEquals(len(self.pubsub.delivered), 2)
+        self.assertListEqual(pubsub_tool.get_messages('sk.1'), [])
+
+        pubsub_tool.remove_all_sub_keys()
+
+# ################################################################################################################################
+
+    def test_delivery_interval(self):
+
+        # Messages are delivered at most once in 200 ms
+        pubsub_tool = self.get_pubsub_tool(task_delivery_interval=200)
+        sleep(0.2)
+
+        pubsub_tool.add_non_gd_messages_by_sub_key('sk.1', [get_msg('sk.1', 1)])
+        sleep(0.01)
+        self.assertEquals(len(self.pubsub.delivered), 1)
+
+        for idx in range(2, 5):
+            pubsub_tool.add_non_gd_messages_by_sub_key('sk.1', [get_msg('sk.1', idx)])
+            sleep(0.01)
+
+        self.assertEquals(len(self.pubsub.delivered), 1)
+
+        sleep(0.25)
+        self.assertEquals(len(self.pubsub.delivered), 2)
+        self.assertEquals(len(self.pubsub.delivered[1][2]), 3)
+        self.assertGreaterEqual(self.pubsub.delivered[1][0] - self.pubsub.delivered[0][0], 0.19)
+
+        pubsub_tool.remove_all_sub_keys()
+
+# ################################################################################################################################
+
+    def test_delivery_method_changed(self):
+
+        pubsub_tool = self.get_pubsub_tool(delivery_method=_pull)
+
+        pubsub_tool.add_non_gd_messages_by_sub_key('sk.1', [get_msg('sk.1', 1)])
+        sleep(0.01)
+        self.assertListEqual(self.pubsub.delivered, [])
+
+        self.pubsub.sub_configs['sk.1'].delivery_method = _notify
+        pubsub_tool.wake_delivery_task('sk.1')
+        sleep(0.01)
+
+        self.assertEquals(len(self.pubsub.delivered), 1)
+
+        pubsub_tool.remove_all_sub_keys()
+
+# ################################################################################################################################
+
+    def test_stop(self):
+
+        pubsub_tool = self.get_pubsub_tool()
+        self.assertFalse(self.greenlets[0].dead)
+
+        pubsub_tool.remove_sub_key('sk.1')
+        sleep(0)
+
+        self.assertTrue(self.greenlets[0].dead)
+
+# ################################################################################################################################
+
+class TriggerNotifyPubSubTasksTestCase(TestCase):
+
+    def setUp(self):
+        fs_server_config = Bunch(
+            pubsub=Bunch(log_if_deliv_server_not_found=False, log_if_wsx_deliv_server_not_found=False,
+                data_prefix_len=100, data_prefix_short_len=10),
+            pubsub_meta_topic=Bunch(enabled=False, store_frequency=1),
+            pubsub_meta_endpoint_pub=Bunch(enabled=False, store_frequency=1, data_len=100, max_history=10))
+
+        self.pubsub = PubSub(1, Bunch(fs_server_config=fs_server_config))
+        self.pubsub.invoke_service = self.invoke_service
+        self.requests = []
+
+        # A topic synced with delivery tasks at most once in 100 ms
+        self.pubsub.create_topic(Bunch(id=1, name='/my/topic', is_active=True, is_internal=False, max_depth_gd=100,
+            max_depth_non_gd=100, has_gd=True, depth_check_freq=100, pub_buffer_size_gd=0, task_delivery_interval=0,
+            hook_service_id=None, task_sync_interval=100))
+
+        self.pubsub.add_subscription(self.get_sub_config())
+        self.pubsub.sub_key_servers['sk.1'] = Bunch(server_name='server1', server_pid=123)
+
+    def get_sub_config(self):
+        return Bunch(id=1, creation_time=utcnow_as_ms(), sub_key='sk.1', endpoint_id=1, topic_id=1, topic_name='/my/topic',
+            sub_pattern_matched='/*', task_delivery_interval=0)
+
+    def tearDown(self):
+        self.pubsub.keep_running = False
+        self.pubsub.sync_event.set()
+
+    def invoke_service(self, name, request):
+        self.requests.append((utcnow_as_ms(), name, request))
+
+# ################################################################################################################################
+
+    def test_sync_on_publish(self):
+
+        # Nothing was published yet
+        sleep(0.15)
+        self.assertListEqual(self.requests, [])
+        self.assertFalse(self.pubsub.topics_to_sync)
+
+        # Publications wake up the greenlet syncing topics
+        self.assertFalse(self.pubsub.sync_event.is_set())
+
+        start = utcnow_as_ms()
+        self.pubsub.set_sync_has_msg(1, True, True, start)
+        self.assertTrue(self.pubsub.sync_event.is_set())
+        sleep(0.01)
+
+        self.assertEquals(len(self.requests), 1)
+        request_time, name, request = self.requests[0]
+
+        self.assertEquals(name, 'zato.pubsub.after-publish')
+        self.assertEquals(request['topic_name'], '/my/topic')
+        self.assertTrue(request['has_gd_msg_list'])
+        self.assertEquals(request['pub_time_max'], start)
+        self.assertFalse(self.pubsub.topics_to_sync)
+
+        # Messages published within task_sync_interval of the last sync are synced together once it passes
+        self.pubsub.set_sync_has_msg(1, True, True, start)
+        sleep(0.01)
+        self.pubsub.set_sync_has_msg(1, True, True, start)
+        sleep(0.01)
+        self.assertEquals(len(self.requests), 1)
+
+        sleep(0.1)
+        self.assertEquals(len(self.requests), 2)
+        self.assertGreaterEqual(self.requests[1][0] - request_time, 0.099)
+
+# ################################################################################################################################
+
+    def test_no_subscribers(self):
+
+        self.pubsub.subscriptions_by_topic.clear()
+        self.pubsub.set_sync_has_msg(1, True, True, utcnow_as_ms())
+        sleep(0.01)
+
+        self.assertListEqual(self.requests, [])
+        self.assertSetEqual(self.pubsub.topics_to_sync, set([1]))
+
+        # Messages wait until there is a subscriber
+        self.pubsub.add_subscription(self.get_sub_config())
+        sleep(0.15)
+
+        self.assertEquals(len(self.requests), 1)
+
+# ################################################################################################################################
+
+class SortedListTestCase(TestCase):
+
+    def get_msg(self, idx, priority=5, pub_time=1000):
+        msg = get_msg('sk.1', idx)
+        msg['priority'] = priority
+        msg['pub_time'] = pub_time
+        return NonGDMessage('sk.1', 'server1', 123, msg)
+
+    def test_order(self):
+        delivery_list = SortedList()
+
+        delivery_list.add(self.get_msg(1, pub_time=2000))
+        delivery_list.add(self.get_msg(2))
+        delivery_list.add(self.get_msg(3))
+        delivery_list.add(self.get_msg(4, priority=9, pub_time=3000))
+
+        # By priority, then by publication time, then in the order of enqueueing
+        self.assertListEqual([msg.pub_msg_id for msg in delivery_list], ['msg.4', 'msg.2', 'msg.3', 'msg.1'])
+
+    def test_remove(self):
+        messages = [self.get_msg(idx) for idx in range(10)]
+        delivery_list = SortedList(messages)
+
+        # Duplicates are ignored
+        delivery_list.add(self.get_msg(5))
+        self.assertEquals(len(delivery_list), 10)
+
+        delivery_list.remove_pubsub_msg(messages[5])
+        self.assertEquals(len(delivery_list), 9)
+        self.assertIsNone(delivery_list.get_pubsub_msg('msg.5'))
+        self.assertIs(delivery_list.get_pubsub_msg('msg.6'), messages[6])
+        self.assertRaises(ValueError, delivery_list.remove_pubsub_msg, messages[5])
+
+        delivery_list.clear()
+        self.assertIsNone(delivery_list.get_pubsub_msg('msg.6'))
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(self.get_msg(1), '__dict__'))
+
+# ################################################################################################################################
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from logging import getLogger
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# SQLAlchemy
+from sqlalchemy.util import KeyedTuple
+
+# Zato
+from zato.common import DATA_FORMAT, ZatoException
+from zato.server.service import AsIs, Integer, Unicode
+from zato.server.service.reqresp import Response, SimpleIOOutputPlan
+
+# ################################################################################################################################
+
+logger = getLogger(__name__)
+
+simple_io_config = Bunch({
+    'bool_parameter_prefixes': ['is_', 'has_'],
+    'int_parameters': ['id'],
+    'int_parameter_suffixes': ['_id', '_count'],
+})
+
+# ################################################################################################################################
+
+class MySIO:
+    output_required = ('id', 'name', 'is_active', 'user_id')
+    output_optional = (AsIs('raw_id'), Integer('size'), Unicode('desc'), 'has_data', 'address', 'last_count')
+
+def get_row(idx):
+    return {
+        'id': str(idx),
+        'name': b'name-{}-\xc5\xbc'.format(idx),
+        'is_active': 'true' if idx % 2 else 'false',
+        'user_id': idx * 10,
+        'raw_id': str(idx),
+        'size': str(idx * 100),
+        'desc': b'desc-\xc5\xbc',
+        'has_data': idx % 3 == 0,
+        'address': '' if idx % 2 else 'address-{}'.format(idx),
+        'last_count': 0,
+    }
+
+def get_keyed_tuple(idx):
+    row = get_row(idx)
+    keys = sorted(row)
+    return KeyedTuple([row[key] for key in keys], labels=keys)
+
+# ################################################################################################################################
+
+def get_response(io, data_format, output_plan=None, _simple_io_config=simple_io_config):
+    response = Response(logger, simple_io_config=_simple_io_config)
+    response.init('my-cid', io, data_format, output_plan)
+    return response
+
+def get_value(io, data_format, output, use_plan, is_repeated=True, serialize=False):
+
+    response = get_response(io, data_format, SimpleIOOutputPlan(io, simple_io_config) if use_plan else None)
+    if use_plan:
+        assert response.payload.zato_output_plan
+
+    if is_repeated:
+        response.payload[:] = output
+    else:
+        response.payload = output
+
+    return response.payload.getvalue(serialize)
+
+# ################################################################################################################################
+
+class SimpleIOOutputPlanTestCase(TestCase):
+
+    def _assert_same(self, io, data_format, output, is_repeated=True):
+        expected = get_value(io, data_format, output, False, is_repeated, True)
+        given = get_value(io, data_format, output, True, is_repeated, True)
+        self.assertEquals(given, expected)
+
+        return given
+
+    def test_same_output_as_without_plan(self):
+
+        class SkipEmpty(MySIO):
+            skip_empty_keys = True
+            force_empty_keys = ['address']
+
+        class AllowEmptyRequired(MySIO):
+            allow_empty_required = True
+
+        for io in (MySIO, SkipEmpty, AllowEmptyRequired):
+            for data_format in (DATA_FORMAT.JSON, DATA_FORMAT.XML):
+                for get_item in (get_row, get_keyed_tuple):
+                    self._assert_same(io, data_format, [get_item(idx) for idx in range(1, 10)])
+                self._assert_same(io, data_format, get_row(1), False)
+
+    def test_conversions(self):
+
+        value = get_value(MySIO, DATA_FORMAT.JSON, [get_row(1)], True)['response'][0]
+
+        self.assertIs(value['id'], 1)
+        self.assertEquals(value['name'], 'name-1-ż')
+        self.assertIsInstance(value['name'], unicode)
+        self.assertIs(value['is_active'], True)
+        self.assertEquals(value['raw_id'], '1')
+        self.assertIs(value['size'], 100)
+        self.assertIs(value['has_data'], False)
+
+# ################################################################################################################################
+
+    def test_missing_required(self):
+
+        row = get_row(1)
+        row['name'] = ''
+
+        for use_plan in (False, True):
+            with self.assertRaises(ZatoException) as ctx:
+                get_value(MySIO, DATA_FORMAT.JSON, [row], use_plan)
+            self.assertIn('Expected elem:[name] not found', ctx.exception.msg)
+
+    def test_conversion_error(self):
+
+        row = get_row(1)
+        row['user_id'] = 'abc'
+
+        for use_plan in (False, True):
+            with self.assertRaises(ZatoException) as ctx:
+                get_value(MySIO, DATA_FORMAT.JSON, [row], use_plan)
+            self.assertIn('Conversion error, param:`user_id`', ctx.exception.msg)
+
+# ################################################################################################################################
+
+    def test_plan_not_used_after_changes(self):
+
+        class MyChangedSIO(MySIO):
+            pass
+
+        plan = SimpleIOOutputPlan(MyChangedSIO, simple_io_config)
+        self.assertTrue(get_response(MyChangedSIO, DATA_FORMAT.JSON, plan).payload.zato_output_plan)
+
+        # The config given on input is not the one the plan was compiled with
+        response = get_response(MyChangedSIO, DATA_FORMAT.JSON, plan, Bunch(simple_io_config))
+        self.assertIsNone(response.payload.zato_output_plan)
+
+        # SimpleIO changed at runtime
+        MyChangedSIO.output_optional = ('address',)
+        self.assertIsNone(get_response(MyChangedSIO, DATA_FORMAT.JSON, plan).payload.zato_output_plan)
+
+        MyChangedSIO.output_optional = MySIO.output_optional
+        MyChangedSIO.skip_empty_keys = True
+        self.assertIsNone(get_response(MyChangedSIO, DATA_FORMAT.JSON, plan).payload.zato_output_plan)
+
+# ################################################################################################################################
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from logging import getLogger
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# lxml
+from lxml import objectify
+
+# Zato
+from zato.common import DATA_FORMAT, ParsingException, PARAMS_PRIORITY
+from zato.server.service import AsIs, Boolean, Integer, List, Unicode
+from zato.server.service.reqresp import Request, SimpleIOInputPlan
+
+# ################################################################################################################################
+
+logger = getLogger(__name__)
+
+simple_io_config = Bunch({
+    'bool_parameter_prefixes': ['is_', 'has_'],
+    'int_parameters': ['id'],
+    'int_parameter_suffixes': ['_id', '_count'],
+})
+
+# ################################################################################################################################
+
+class MySIO:
+    input_required = ('id', 'name', 'is_active', 'user_id', Integer('size'))
+    input_optional = (AsIs('raw_id'), Unicode('desc'), Boolean('flag'), List('tags'), 'has_data', 'password', 'address',
+        'last_count', 'is_missing')
+
+def get_payload(idx=1):
+    return {
+        'id': str(idx),
+        'name': b'name-{}-\xc5\xbc'.format(idx),
+        'is_active': 'true' if idx % 2 else 'false',
+        'user_id': idx * 10,
+        'size': str(idx * 100),
+        'raw_id': str(idx),
+        'desc': b'desc-\xc5\xbc',
+        'flag': 'y',
+        'tags': ['a', 'b'],
+        'has_data': '',
+        'password': 'my-password',
+        'address': '',
+        'last_count': '',
+    }
+
+def get_xml_payload(idx=1):
+    payload = get_payload(idx)
+    payload.pop('tags')
+
+    elems = ''.join('<{0}>{1}</{0}>'.format(key, value.decode('utf8') if isinstance(value, str) else value)
+        for key, value in payload.items())
+
+    return objectify.fromstring('<request>{}</request>'.format(elems).encode('utf8'))
+
+def encrypt(value):
+    return 'encrypted.{}'.format(value)
+
+# ################################################################################################################################
+
+def get_input(io, data_format, payload, use_plan, channel_params=None, params_priority=PARAMS_PRIORITY.DEFAULT,
+        input_plan=None, _simple_io_config=simple_io_config):
+
+    request = Request(logger, simple_io_config=_simple_io_config)
+    request.payload = payload
+    request.raw_request = payload
+    request.channel_params = channel_params or {}
+    request.params_priority = params_priority
+
+    if use_plan and not input_plan:
+        input_plan = SimpleIOInputPlan(io, simple_io_config)
+
+    request.init(True, 'my-cid', io, data_format, None, {}, encrypt, input_plan)
+
+    return request.input
+
+# ################################################################################################################################
+
+class SimpleIOInputPlanTestCase(TestCase):
+
+    def _assert_same(self, io, data_format, payload, *args, **kwargs):
+        expected = get_input(io, data_format, payload, False, *args, **kwargs)
+        given = get_input(io, data_format, payload, True, *args, **kwargs)
+        self.assertDictEqual(given, expected)
+
+        return given
+
+    def test_same_input_as_without_plan(self):
+
+        class XMLSIO(MySIO):
+            input_optional = tuple(elem for elem in MySIO.input_optional if elem not in ('tags', 'is_missing'))
+
+        class DefaultValue(MySIO):
+            default_value = 'my-default'
+
+        class NoSecrets(MySIO):
+            encrypt_secrets = False
+
+        for io in (MySIO, DefaultValue, NoSecrets):
+            for data_format in (DATA_FORMAT.JSON, DATA_FORMAT.DICT):
+                self._assert_same(io, data_format, get_payload())
+                self._assert_same(io, data_format, get_payload(2), {'name': 'abc', 'address': 'channel', 'is_missing': '1'})
+
+        self._assert_same(XMLSIO, DATA_FORMAT.XML, get_xml_payload())
+        self._assert_same(XMLSIO, DATA_FORMAT.XML, get_xml_payload(2), {'name': 'abc', 'address': 'channel'})
+
+    def test_conversions(self):
+
+        value = self._assert_same(MySIO, DATA_FORMAT.JSON, get_payload())
+
+        self.assertIs(value.id, 1)
+        self.assertEquals(value.name, 'name-1-ż')
+        self.assertIs(value.is_active, True)
+        self.assertIs(value.user_id, 10)
+        self.assertIs(value.size, 100)
+        self.assertEquals(value.raw_id, '1')
+        self.assertIs(value.flag, True)
+        self.assertListEqual(value.tags, ['a', 'b'])
+        self.assertIsNone(value.has_data)
+        self.assertEquals(value.password, 'encrypted.my-password')
+        self.assertEquals(value.address, '')
+        self.assertIsNone(value.last_count)
+        self.assertEquals(value.is_missing, '')
+
+# ################################################################################################################################
+
+    def test_channel_params(self):
+
+        channel_params = {'name': 'channel-name', 'last_count': '5'}
+
+        value = self._assert_same(MySIO, DATA_FORMAT.JSON, get_payload(), channel_params,
+            PARAMS_PRIORITY.MSG_OVER_CHANNEL_PARAMS)
+        self.assertEquals(value.name, 'name-1-ż')
+        self.assertIs(value.last_count, None)
+
+        value = self._assert_same(MySIO, DATA_FORMAT.JSON, get_payload(), channel_params,
+            PARAMS_PRIORITY.CHANNEL_PARAMS_OVER_MSG)
+        self.assertEquals(value.name, 'channel-name')
+        self.assertIs(value.last_count, 5)
+
+# ################################################################################################################################
+
+    def test_errors(self):
+
+        missing = get_payload()
+        missing.pop('name')
+
+        invalid = get_payload()
+        invalid['user_id'] = 'abc'
+
+        for payload, msg in ((missing, 'Required input element:`name` not found'), (invalid, 'invalid literal for int()')):
+            for use_plan in (False, True):
+                with self.assertRaises(ParsingException) as ctx:
+                    get_input(MySIO, DATA_FORMAT.JSON, payload, use_plan)
+                self.assertIn(msg, ctx.exception.cid)
+
+# ################################################################################################################################
+
+    def test_plan_not_used_after_changes(self):
+
+        class MyChangedSIO(MySIO):
+            pass
+
+        plan = SimpleIOInputPlan(MyChangedSIO, simple_io_config)
+        payload = get_payload()
+
+        # SimpleIO changed at runtime so, had the plan been used, 'id' would have been in input
+        MyChangedSIO.input_required = ('name',)
+        value = get_input(MyChangedSIO, DATA_FORMAT.JSON, payload, True, input_plan=plan)
+        self.assertNotIn('id', value)
+        self.assertDictEqual(value, get_input(MyChangedSIO, DATA_FORMAT.JSON, payload, False))
+
+        # The config given on input is not the one the plan was compiled with, e.g. there are no int suffixes in it
+        MyChangedSIO.input_required = MySIO.input_required
+        value = get_input(MyChangedSIO, DATA_FORMAT.JSON, payload, True, input_plan=plan, _simple_io_config=Bunch(a=1))
+        self.assertEquals(value.user_id, '10')
+
+# ################################################################################################################################
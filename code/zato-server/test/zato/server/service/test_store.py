@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+import os
+import sys
+from datetime import datetime
+from hashlib import sha256
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# mock
+from mock import patch
+
+# SQLAlchemy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# Zato
+from zato.common import SourceInfo
+from zato.common.odb.api import ODBManager
+from zato.common.odb.model import Base, Cluster, DeployedService, Server, Service
+from zato.common.util import import_module_from_path
+from zato.server.service.store import DiscoveryCache, ServiceStore
+
+# ################################################################################################################################
+
+def get_items(len_items, prefix='my.service'):
+    items = []
+
+    for idx in range(len_items):
+        source_info = SourceInfo()
+        source_info.source = b'# Source of {}'.format(idx)
+        source_info.path = '/tmp/my_service_{}.py'.format(idx)
+        source_info.hash = sha256(source_info.source).hexdigest()
+        source_info.hash_method = 'SHA-256'
+
+        items.append(Bunch(name='{}.{}'.format(prefix, idx), impl_name='my_service_{}.MyService{}'.format(idx, idx),
+            is_internal=False, deployment_time=datetime.utcnow(), details='{}', source_info=source_info))
+
+    return items
+
+# ################################################################################################################################
+
+class BaseTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='zato-test-store-')
+        self.odb = self.get_odb('odb.db')
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def get_odb(self, db_name):
+        engine = create_engine('sqlite:///{}/{}'.format(self.tmp_dir, db_name))
+        Base.metadata.create_all(engine)
+
+        odb = ODBManager()
+        odb._Session = sessionmaker(bind=engine)
+        odb._session = odb._Session()
+
+        odb.cluster = Cluster(None, 'my.cluster', None, 'sqlite', broker_host='localhost', broker_port=6379,
+            lb_host='localhost', lb_port=11223, lb_agent_port=20151)
+        odb.server = Server(None, 'my.server', odb.cluster, 'my.token')
+
+        odb._session.add(odb.cluster)
+        odb._session.add(odb.server)
+        odb._session.commit()
+
+        return odb
+
+    def count(self, model):
+        return self.odb._session.query(model).count()
+
+# ################################################################################################################################
+
+class AddServicesTestCase(BaseTestCase):
+
+    def test_add_services(self):
+        items = get_items(5)
+        result = self.odb.add_services(items)
+
+        self.assertEquals(sorted(result), sorted(item.name for item in items))
+        self.assertEquals(self.count(Service), 5)
+        self.assertEquals(self.count(DeployedService), 5)
+
+        for item in items:
+            service_id, is_active, slow_threshold = result[item.name]
+            service = self.odb._session.query(Service).filter(Service.id==service_id).one()
+
+            self.assertEquals(service.name, item.name)
+            self.assertEquals(service.impl_name, item.impl_name)
+            self.assertTrue(is_active)
+            self.assertEquals(slow_threshold, 99999)
+
+            ds = self.odb._session.query(DeployedService).filter(DeployedService.service_id==service_id).one()
+            self.assertEquals(ds.source, item.source_info.source)
+            self.assertEquals(ds.source_hash, item.source_info.hash)
+
+# ################################################################################################################################
+
+    def test_existing_services_are_updated(self):
+        items = get_items(3)
+        first = self.odb.add_services(items)
+
+        # Existing services keep their configuration, their deployment details are updated
+        service = self.odb._session.query(Service).filter(Service.name==items[0].name).one()
+        service.is_active = False
+        self.odb._session.commit()
+
+        items[0].source_info.source = b'# New source'
+        items[0].source_info.hash = sha256(items[0].source_info.source).hexdigest()
+        items.extend(get_items(2, 'my.other.service'))
+
+        second = self.odb.add_services(items)
+
+        self.assertEquals(second[items[0].name], (first[items[0].name][0], False, 99999))
+        self.assertEquals(self.count(Service), 5)
+        self.assertEquals(self.count(DeployedService), 5)
+
+        ds = self.odb._session.query(DeployedService).filter(DeployedService.service_id==first[items[0].name][0]).one()
+        self.assertEquals(ds.source, b'# New source')
+
+# ################################################################################################################################
+
+    def test_unchanged_source_not_stored(self):
+        items = get_items(1)
+        self.odb.add_services(items)
+
+        # The source is not read again if its hash is the same as in ODB
+        source_info = items[0].source_info
+        source_info.source = None
+        source_info.path = os.path.join(self.tmp_dir, 'does-not-exist.py')
+
+        self.odb.add_services(items)
+
+        ds = self.odb._session.query(DeployedService).one()
+        self.assertEquals(ds.source, b'# Source of 0')
+        self.assertIsNone(source_info.source)
+
+# ################################################################################################################################
+
+    def test_changed_source_read(self):
+        items = get_items(1)
+        self.odb.add_services(items)
+
+        # Only the hash is known so the source is read from the file
+        source_info = items[0].source_info
+        source_info.source = None
+        source_info.path = os.path.join(self.tmp_dir, 'my_service.py')
+        source_info.hash = sha256(b'# New source').hexdigest()
+
+        with open(source_info.path, 'wb') as f:
+            f.write(b'# New source')
+
+        self.odb.add_services(items)
+
+        ds = self.odb._session.query(DeployedService).one()
+        self.assertEquals(ds.source, b'# New source')
+        self.assertEquals(ds.source_hash, source_info.hash)
+
+# ################################################################################################################################
+
+    def test_duplicates(self):
+        items = get_items(3)
+        items.append(items[0])
+
+        result = self.odb.add_services(items)
+
+        self.assertEquals(len(result), 3)
+        self.assertEquals(self.count(Service), 3)
+        self.assertEquals(self.count(DeployedService), 3)
+
+# ################################################################################################################################
+
+class VisitOnlyServiceStore(ServiceStore):
+    """ Finds services in modules without setting them up or registering them in ODB.
+    """
+    def __init__(self):
+        super(VisitOnlyServiceStore, self).__init__({}, None, None, Bunch(is_sso_enabled=True))
+        self.patterns_matcher.read_config({'order':'true_false', '*':'True'})
+        self.visited = []
+
+    def _visit_class(self, class_, fs_location, is_internal, source_info):
+        self.visited.append((class_.get_name(), source_info.hash))
+        return Bunch()
+
+    def _register_services(self, to_register):
+        pass
+
+# ################################################################################################################################
+
+mod_source = b"""
+from zato.server.service import Service
+
+NOT_A_SERVICE = 123
+
+class MyService1(Service):
+    pass
+
+class MyService2(Service):
+    pass
+"""
+
+# ################################################################################################################################
+
+class DiscoveryCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp(prefix='zato-test-discovery-')
+        self.mod_path = os.path.join(self.tmp_dir, 'my_services.py')
+        self.cache_path = os.path.join(self.tmp_dir, 'discovery-cache.json')
+
+        with open(self.mod_path, 'wb') as f:
+            f.write(mod_source)
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+        sys.modules.pop('my_services', None)
+
+    def visit(self):
+        store = VisitOnlyServiceStore()
+        store.discovery_cache = DiscoveryCache(self.cache_path)
+        store.discovery_cache.load()
+
+        mod = import_module_from_path(self.mod_path, self.tmp_dir).module
+        store._visit_module(mod, False, self.mod_path)
+        store.discovery_cache.save()
+
+        return store
+
+    def test_cache(self):
+
+        first = self.visit()
+        self.assertEquals(first.discovery_cache.misses, 1)
+
+        mod_hash = sha256(mod_source).hexdigest()
+        self.assertEquals(first.discovery_cache.files[self.mod_path]['hash'], mod_hash)
+        self.assertEquals(first.discovery_cache.modules[mod_hash]['service_names'], ['MyService1', 'MyService2'])
+
+        # The module did not change so the cache is used and the file is neither read nor hashed
+        with patch('zato.server.service.store.sha256', wraps=sha256) as store_sha256:
+            second = self.visit()
+            self.assertFalse(store_sha256.called)
+
+        self.assertEquals(second.discovery_cache.hits, 1)
+        self.assertEquals(second.visited, first.visited)
+
+        # Now it changed and needs to be introspected again
+        with open(self.mod_path, 'ab') as f:
+            f.write(b'\nclass MyService3(Service):\n    pass\n')
+
+        third = self.visit()
+        self.assertEquals(third.discovery_cache.misses, 1)
+        self.assertEquals(len(third.visited), 3)
+
+        new_hash = sha256(open(self.mod_path, 'rb').read()).hexdigest()
+        self.assertEquals(third.discovery_cache.files[self.mod_path]['hash'], new_hash)
+        self.assertEquals(third.discovery_cache.modules[new_hash]['service_names'], ['MyService1', 'MyService2', 'MyService3'])
+
+        # The module the old hash pointed to is not needed anymore
+        self.assertNotIn(mod_hash, third.discovery_cache.modules)
+
+    def test_cache_same_hash(self):
+
+        self.visit()
+
+        # The file is modified but its contents are still the same so it is found by its hash
+        with open(self.mod_path, 'wb') as f:
+            f.write(mod_source + b'\n')
+        with open(self.mod_path, 'wb') as f:
+            f.write(mod_source)
+        os.utime(self.mod_path, (0, 0))
+
+        with patch.object(ServiceStore, '_is_service_class', autospec=True, side_effect=ServiceStore._is_service_class) as is_service_class:
+            store = self.visit()
+
+        self.assertEquals(store.discovery_cache.misses, 1)
+        self.assertEquals(len(store.visited), 2)
+        self.assertEquals(is_service_class.call_count, 2)
+        self.assertEquals(store.discovery_cache.files[self.mod_path]['mtime'], 0)
+
+# ################################################################################################################################
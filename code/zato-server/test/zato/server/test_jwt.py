@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from contextlib import closing
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# gevent
+from gevent import sleep
+
+# Cryptography
+from cryptography.fernet import Fernet
+
+# SQLAlchemy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# Zato
+from zato.common.odb.model import Base, KVData
+from zato.common.test import InRAMRedis
+from zato.server.jwt import JWT
+
+# ################################################################################################################################
+
+class ODB(object):
+    def __init__(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)
+
+# ################################################################################################################################
+
+class JWTTestCase(TestCase):
+
+    def setUp(self):
+        self.conn = InRAMRedis()
+        self.kvdb = Bunch(conn=self.conn)
+        self.odb = ODB()
+        self.secret = Fernet.generate_key()
+
+    def get_jwt(self, verified_time=5, renew_interval=60, renew_odb=False):
+        return JWT(self.kvdb, self.odb, self.secret, verified_time, renew_interval, renew_odb)
+
+    def get_token(self, jwt, ttl=3600, username='my.user'):
+        token = jwt._create_token(username=username, ttl=ttl)
+        self.conn.set(token, token)
+
+        with closing(self.odb.session()) as session:
+            session.add(KVData(key=token, value=token, creation_time=datetime.utcnow(), expiry_time=datetime.utcnow()))
+            session.commit()
+
+        self.conn.round_trips = 0
+        return token
+
+# ################################################################################################################################
+
+    def test_validate_no_local_cache(self):
+        jwt = self.get_jwt(0, 0)
+        token = self.get_token(jwt)
+
+        for idx in range(3):
+            result = jwt.validate('my.user', token)
+            self.assertTrue(result.valid)
+            self.assertEquals(result.token.username, 'my.user')
+
+        # Each validation checks KVDB
+        self.assertGreaterEqual(self.conn.round_trips, 3)
+
+    def test_validate_skips_io_for_recently_validated(self):
+        jwt = self.get_jwt(verified_time=5)
+        token = self.get_token(jwt)
+
+        self.assertTrue(jwt.validate('my.user', token, _time=lambda: 100).valid)
+        self.assertEquals(self.conn.round_trips, 1)
+
+        # Within verified_time no KVDB calls are made
+        for now in (101, 102, 104.9):
+            result = jwt.validate('my.user', token, _time=lambda: now)
+            self.assertTrue(result.valid)
+            self.assertEquals(result.token.username, 'my.user')
+
+        self.assertEquals(self.conn.round_trips, 1)
+
+        # After it passes, KVDB is checked again
+        self.assertTrue(jwt.validate('my.user', token, _time=lambda: 105).valid)
+        self.assertEquals(self.conn.round_trips, 2)
+
+    def test_validate_local_cache_bound_by_token_ttl(self):
+        jwt = self.get_jwt(verified_time=30)
+        token = self.get_token(jwt, ttl=2)
+
+        self.assertTrue(jwt.validate('my.user', token, _time=lambda: 100).valid)
+
+        # The token's TTL passed and it expired in KVDB in the meantime
+        self.conn.delete(token)
+        self.assertFalse(jwt.validate('my.user', token, _time=lambda: 102).valid)
+
+    def test_validate_unexpected_user(self):
+        jwt = self.get_jwt()
+        token = self.get_token(jwt)
+
+        self.assertTrue(jwt.validate('my.user', token).valid)
+
+        result = jwt.validate('my.user2', token)
+        self.assertFalse(result.valid)
+        self.assertEquals(result.message, 'Unexpected user for token found')
+
+    def test_validate_invalid_token(self):
+        jwt = self.get_jwt()
+
+        result = jwt.validate('my.user', jwt._create_token(username='my.user', ttl=10))
+        self.assertFalse(result.valid)
+        self.assertEquals(result.message, 'Invalid token')
+
+# ################################################################################################################################
+
+    def test_renewals_coalesced(self):
+        jwt = self.get_jwt()
+        token1 = self.get_token(jwt, ttl=100)
+        token2 = self.get_token(jwt, ttl=200)
+
+        for idx in range(10):
+            jwt.validate('my.user', token1)
+            jwt.validate('my.user', token2)
+
+        self.assertTrue(jwt.renewer.is_scheduled)
+        self.assertDictEqual(jwt.renewer.pending, {token1: 100, token2: 200})
+
+        self.conn.round_trips = 0
+        jwt.renewer.flush()
+
+        # A single pipeline for all the renewals
+        self.assertEquals(self.conn.round_trips, 1)
+        self.assertDictEqual(self.conn.expiry, {token1: 100, token2: 200})
+        self.assertFalse(jwt.renewer.is_scheduled)
+        self.assertDictEqual(jwt.renewer.pending, {})
+
+    def test_renewals_short_ttl_not_delayed(self):
+        jwt = self.get_jwt(renew_interval=60)
+        token1 = self.get_token(jwt, ttl=3600)
+        token2 = self.get_token(jwt, ttl=60)
+
+        jwt.validate('my.user', token1)
+        jwt.validate('my.user', token2)
+
+        # The token would expire before the interval passed so it is renewed, along with other pending ones, right away
+        sleep(0)
+
+        self.assertDictEqual(self.conn.expiry, {token1: 3600, token2: 60})
+        self.assertDictEqual(jwt.renewer.pending, {})
+
+    def test_renewals_flushed_on_stop(self):
+        jwt = self.get_jwt(renew_odb=True)
+        token = self.get_token(jwt, ttl=3600)
+
+        jwt.validate('my.user', token)
+        jwt.stop()
+
+        self.assertDictEqual(self.conn.expiry, {token: 3600})
+        self.assertDictEqual(jwt.renewer.pending, {})
+
+        with closing(self.odb.session()) as session:
+            self.assertGreater(session.query(KVData.expiry_time).filter_by(key=token).scalar(), datetime.utcnow())
+
+    def test_renewals_odb(self):
+        jwt = self.get_jwt(renew_odb=True)
+        token1 = self.get_token(jwt, ttl=100)
+        token2 = self.get_token(jwt, ttl=3600)
+
+        jwt.validate('my.user', token1)
+        jwt.validate('my.user', token2)
+
+        now = datetime.utcnow()
+        jwt.renewer.flush()
+
+        with closing(self.odb.session()) as session:
+            expiry = dict(session.query(KVData.key, KVData.expiry_time))
+
+        self.assertTrue(now + timedelta(seconds=100) <= expiry[token1] < now + timedelta(seconds=110))
+        self.assertTrue(now + timedelta(seconds=3600) <= expiry[token2] < now + timedelta(seconds=3610))
+
+    def test_renewals_odb_optional(self):
+        jwt = self.get_jwt(renew_odb=False)
+        token = self.get_token(jwt, ttl=3600)
+
+        jwt.validate('my.user', token)
+        jwt.renewer.flush()
+
+        with closing(self.odb.session()) as session:
+            self.assertLess(session.query(KVData.expiry_time).filter_by(key=token).scalar(), datetime.utcnow())
+
+    def test_delete(self):
+        jwt = self.get_jwt()
+        token = self.get_token(jwt)
+
+        self.assertTrue(jwt.validate('my.user', token).valid)
+        jwt.delete(token)
+
+        # Neither is the deleted token accepted anymore nor is its pending renewal written
+        self.assertFalse(jwt.validate('my.user', token).valid)
+        self.assertDictEqual(jwt.renewer.pending, {})
+
+    def test_renewal_does_not_recreate_token(self):
+        jwt = self.get_jwt()
+        token = self.get_token(jwt)
+
+        self.assertTrue(jwt.validate('my.user', token).valid)
+
+        # Deleted by another worker
+        self.conn.delete(token)
+        jwt.renewer.flush()
+
+        self.assertNotIn(token, self.conn.data)
+        self.assertNotIn(token, self.conn.expiry)
+
+# ################################################################################################################################
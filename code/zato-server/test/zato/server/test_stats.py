@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2018, Zato Source s.r.o. https://zato.io
+
+Licensed under LGPLv3, see LICENSE.txt for terms and conditions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# stdlib
+from datetime import datetime, timedelta
+from logging import getLogger
+from random import Random
+from unittest import TestCase
+
+# Bunch
+from bunch import Bunch
+
+# Zato
+from zato.common import KVDB
+from zato.common.test import enrich_with_static_config, InRAMRedis
+from zato.server.service.internal.stats import AggregateByHour, AggregateByMinute, ProcessRawTimes, StatsReturningService
+from zato.server.stats import get_service_names, LatencyHistogram, MaintenanceTool, ServiceStatsAggregator
+
+# ################################################################################################################################
+
+class FakePipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *ignored):
+        pass
+
+    def __getattr__(self, name):
+        def _record(*args):
+            self.commands.append((name,) + args)
+        return _record
+
+    def execute(self):
+        if self.conn.needs_error:
+            raise Exception('Test error')
+        self.conn.executed.append(self.commands)
+
+        result = []
+        for command in self.commands:
+            if command[0] == 'incrby':
+                self.conn.counters[command[1]] = self.conn.counters.get(command[1], 0) + command[2]
+                result.append(self.conn.counters[command[1]])
+            else:
+                result.append(True)
+
+        return result
+
+class FakeConn(object):
+    def __init__(self):
+        self.needs_error = False
+        self.executed = []
+        self.counters = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+# ################################################################################################################################
+
+class LatencyHistogramTestCase(TestCase):
+
+    def test_exact_values(self):
+        hist = LatencyHistogram()
+        for value in range(100):
+            hist.record(value)
+
+        self.assertEquals(hist.count, 100)
+        self.assertEquals(hist.min, 0)
+        self.assertEquals(hist.max, 99)
+        self.assertEquals(hist.percentile(50), 49)
+        self.assertEquals(hist.trimmed_mean(100), 49.5)
+        self.assertEquals(hist.trimmed_mean(0), 0)
+
+# ################################################################################################################################
+
+    def test_relative_error(self):
+        random = Random(1)
+        values = sorted(random.randint(0, 10 ** 6) for _ in range(10000))
+
+        hist = LatencyHistogram()
+        for value in values:
+            hist.record(value)
+
+        for percentile in (10, 50, 90, 99):
+            expected = values[int(percentile / 100.0 * (len(values) - 1))]
+            self.assertAlmostEqual(hist.percentile(percentile) / expected, 1.0, delta=1.0 / 64)
+
+        self.assertEquals(hist.trimmed_mean(100), sum(values) / len(values))
+
+# ################################################################################################################################
+
+    def test_from_raw_merges_histograms_and_single_values(self):
+        hist1 = LatencyHistogram()
+        hist1.record(10)
+        hist1.record(5000, 3)
+
+        hist2 = LatencyHistogram()
+        hist2.record(1)
+
+        hist = LatencyHistogram.from_raw([hist1.to_json(), b'7', hist2.to_json(), LatencyHistogram().to_json()])
+
+        self.assertEquals(hist.count, 6)
+        self.assertEquals(hist.min, 1)
+        self.assertEquals(hist.max, 5000)
+        self.assertEquals(hist.total, 15018)
+        self.assertEquals(hist.percentile(100), 5000)
+
+# ################################################################################################################################
+
+class ServiceStatsAggregatorTestCase(TestCase):
+
+    def setUp(self):
+        self.conn = FakeConn()
+        self.aggr = ServiceStatsAggregator(Bunch(conn=self.conn))
+
+    def test_flush(self):
+
+        self.assertEquals(self.aggr.incr_usage('my.service'), 1)
+        self.assertEquals(self.aggr.incr_usage('my.service'), 2)
+
+        self.aggr.record('my.service', 10, '2018:01:02:03:04')
+        self.aggr.record('my.service', 20, '2018:01:02:03:05')
+        self.aggr.flush()
+
+        self.assertEquals(len(self.conn.executed), 1)
+        commands = self.conn.executed[0]
+
+        self.assertIn(('incrby', KVDB.SERVICE_USAGE + 'my.service', 2), commands)
+        self.assertIn(('hset', KVDB.SERVICE_TIME_BASIC + 'my.service', 'last', 20), commands)
+        self.assertIn(('expire', KVDB.SERVICE_TIME_RAW_BY_MINUTE + 'my.service:2018:01:02:03:04', 300), commands)
+        self.assertIn(('expire', KVDB.SERVICE_TIME_RAW_BY_MINUTE + 'my.service:2018:01:02:03:05', 300), commands)
+
+        raw = [command[2] for command in commands if command[:2] == ('rpush', KVDB.SERVICE_TIME_RAW + 'my.service')]
+        self.assertEquals(LatencyHistogram.from_raw(raw).total, 30)
+
+        # Nothing new to flush
+        self.aggr.flush()
+        self.assertEquals(len(self.conn.executed), 1)
+
+# ################################################################################################################################
+
+    def test_flush_error(self):
+
+        self.aggr.incr_usage('my.service')
+        self.aggr.record('my.service', 10, '2018:01:02:03:04')
+
+        self.conn.needs_error = True
+        self.aggr.flush()
+        self.assertEquals(self.conn.executed, [])
+
+        self.aggr.incr_usage('my.service')
+        self.aggr.record('my.service', 20, '2018:01:02:03:04')
+
+        self.conn.needs_error = False
+        self.aggr.flush()
+
+        commands = self.conn.executed[0]
+        self.assertIn(('incrby', KVDB.SERVICE_USAGE + 'my.service', 2), commands)
+
+        raw = [command[2] for command in commands if command[:2] == ('rpush', KVDB.SERVICE_TIME_RAW + 'my.service')]
+        self.assertEquals(len(raw), 1)
+        self.assertEquals(LatencyHistogram.from_raw(raw).count, 2)
+
+# ################################################################################################################################
+
+    def test_usage_is_cluster_wide_after_flush(self):
+
+        # Other processes invoked the service 100 times already
+        self.conn.counters[KVDB.SERVICE_USAGE + 'my.service'] = 100
+
+        self.assertEquals(self.aggr.incr_usage('my.service'), 1)
+        self.aggr.flush()
+
+        self.assertEquals(self.aggr.incr_usage('my.service'), 102)
+        self.assertEquals(self.aggr.incr_usage('my.service'), 103)
+
+        self.aggr.flush()
+        self.assertEquals(self.conn.counters[KVDB.SERVICE_USAGE + 'my.service'], 103)
+
+# ################################################################################################################################
+
+def get_service(class_, conn, payload=''):
+    enrich_with_static_config(class_)
+
+    service = class_()
+    service.logger = getLogger(__name__)
+    service.request = Bunch(payload=payload)
+    service.server = Bunch(kvdb=Bunch(conn=conn), component_enabled=Bunch(stats=True), fs_server_config=Bunch(stats={}))
+
+    return service
+
+# ################################################################################################################################
+
+class AggregatingServicesTestCase(TestCase):
+
+    def setUp(self):
+        self.conn = InRAMRedis()
+        self.aggr = ServiceStatsAggregator(Bunch(conn=self.conn))
+
+        # Two minutes back is what AggregateByMinute processes
+        self.now = datetime.utcnow()
+        self.minute = (self.now - timedelta(minutes=2)).strftime('%Y:%m:%d:%H:%M')
+
+        for name, count in (('my.service.1', 100), ('my.service.2', 10)):
+            for idx in range(count):
+                self.aggr.incr_usage(name)
+                self.aggr.record(name, idx + 1, self.minute)
+            self.aggr.flush()
+
+        # Another flush for the same minute
+        self.aggr.record('my.service.1', 1000, self.minute)
+        self.aggr.flush()
+
+# ################################################################################################################################
+
+    def test_service_names(self):
+
+        # Statistics collected before the index existed are added to it even though aggregators already added new ones
+        self.conn.hset(KVDB.SERVICE_TIME_BASIC + 'my.service.3', 'last', 1)
+
+        self.assertSetEqual(get_service_names(self.conn), set(['my.service.1', 'my.service.2', 'my.service.3']))
+        self.assertSetEqual(self.conn.smembers(KVDB.SERVICE_STATS_NAMES), set(['my.service.1', 'my.service.2', 'my.service.3']))
+
+        # This is done once only
+        self.conn.hset(KVDB.SERVICE_TIME_BASIC + 'my.service.4', 'last', 1)
+        self.assertSetEqual(get_service_names(self.conn), set(['my.service.1', 'my.service.2', 'my.service.3']))
+
+# ################################################################################################################################
+
+    def test_service_names_pruned(self):
+
+        self.conn.delete(KVDB.SERVICE_TIME_BASIC + 'my.service.2', KVDB.SERVICE_TIME_RAW + 'my.service.2',
+            KVDB.SERVICE_USAGE + 'my.service.2')
+
+        get_service(ProcessRawTimes, self.conn, 'global_slow_threshold=120\nmax_batch_size=99999').handle()
+        self.assertSetEqual(get_service_names(self.conn), set(['my.service.1']))
+
+        # Services with statistics are kept even if they have nothing new to process
+        get_service(ProcessRawTimes, self.conn, 'global_slow_threshold=120\nmax_batch_size=99999').handle()
+        self.assertSetEqual(get_service_names(self.conn), set(['my.service.1']))
+
+# ################################################################################################################################
+
+    def test_process_raw_times(self):
+
+        service = get_service(ProcessRawTimes, self.conn, 'global_slow_threshold=120\nmax_batch_size=1')
+        service.handle()
+
+        # Only the first of the two histograms of my.service.1 was processed
+        basic = self.conn.hgetall(KVDB.SERVICE_TIME_BASIC + 'my.service.1')
+        self.assertEquals(int(basic['usage_all_time']), 100)
+        self.assertEquals(float(basic['min_all_time']), 1)
+        self.assertEquals(float(basic['max_all_time']), 100)
+        self.assertEquals(float(basic['mean_all_time']), 50.5)
+        self.assertEquals(self.conn.llen(KVDB.SERVICE_TIME_RAW + 'my.service.1'), 1)
+
+        basic = self.conn.hgetall(KVDB.SERVICE_TIME_BASIC + 'my.service.2')
+        self.assertEquals(int(basic['usage_all_time']), 10)
+        self.assertEquals(float(basic['mean_all_time']), 5.5)
+
+        # Now the remaining one, the mean is weighted by usage
+        self.conn.hset(KVDB.SERVICE_TIME_BASIC + 'my.service.1', 'usage_all_time', 100)
+        service.handle()
+
+        basic = self.conn.hgetall(KVDB.SERVICE_TIME_BASIC + 'my.service.1')
+        self.assertEquals(int(basic['usage_all_time']), 101)
+        self.assertEquals(float(basic['max_all_time']), 1000)
+        self.assertAlmostEquals(float(basic['mean_all_time']), (5050 + 1000) / 101.0)
+
+# ################################################################################################################################
+
+    def test_aggregate_by_minute_and_hour(self):
+
+        self.conn.hset(KVDB.SERVICE_TIME_BASIC + 'my.service.1', 'mean_percentile', 99)
+
+        # Statistics from before the index of services existed are added to it only once, this is not measured below
+        get_service_names(self.conn)
+
+        round_trips = self.conn.round_trips
+        get_service(AggregateByMinute, self.conn).handle()
+
+        # A constant number of round-trips regardless of how many services there are
+        self.assertLessEqual(self.conn.round_trips - round_trips, 5)
+
+        key = KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE + 'my.service.1:' + self.minute
+        values = self.conn.hgetall(key)
+
+        self.assertEquals(int(values['usage']), 101)
+        self.assertEquals(float(values['min']), 1)
+        self.assertEquals(float(values['max']), 1000)
+        self.assertEquals(float(values['mean']), 50.5) # The 1% slowest invocations are left out
+        self.assertEquals(LatencyHistogram.from_raw([values['hist']]).count, 101)
+        self.assertIn(key, self.conn.expiry)
+
+        values = self.conn.hgetall(KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE + 'my.service.2:' + self.minute)
+        self.assertEquals(float(values['mean']), 5.5)
+
+        # Per-hour statistics are built out of the per-minute histograms
+        minute = datetime.strptime(self.minute, '%Y:%m:%d:%H:%M')
+        service = get_service(AggregateByHour, self.conn)
+        service.aggregate_partly_aggregated(timedelta(hours=1), '%Y:%m:%d:%H', KVDB.SERVICE_TIME_AGGREGATED_BY_MINUTE,
+            KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR, lambda _, key_suffix: ['{}:{:02}'.format(key_suffix, idx) for idx in range(60)],
+            minute + timedelta(hours=1))
+
+        values = self.conn.hgetall(KVDB.SERVICE_TIME_AGGREGATED_BY_HOUR + 'my.service.1:' + minute.strftime('%Y:%m:%d:%H'))
+        self.assertEquals(int(values['usage']), 101)
+        self.assertEquals(float(values['mean']), 50.5)
+        self.assertAlmostEquals(float(values['rate']), 101 / 3600.0)
+
+        # Reading statistics back
+        service = get_service(StatsReturningService, self.conn)
+        start = minute.isoformat()
+        stop = (minute + timedelta(minutes=1)).isoformat()
+
+        stats = dict((elem.service_name, elem) for elem in service.get_stats(start, stop))
+        self.assertEquals(stats['my.service.1'].usage, 101)
+        self.assertEquals(stats['my.service.1'].mean, 50) # Per-minute means are truncated to integers
+        self.assertEquals(stats['my.service.1'].max_resp_time, 1000)
+        self.assertEquals(stats['my.service.2'].usage, 10)
+        self.assertEquals(stats['my.service.1'].all_services_usage, 111)
+
+        # Statistics are deleted without scanning KVDB
+        MaintenanceTool(self.conn).delete(minute, minute, None)
+        self.assertListEqual(list(service.get_stats(start, stop)), [])
+
+# ################################################################################################################################
+
+    def test_round_trips_do_not_depend_on_services(self):
+
+        round_trips = []
+
+        for len_services in (5, 50):
+            conn = InRAMRedis()
+            aggr = ServiceStatsAggregator(Bunch(conn=conn))
+
+            for idx in xrange(len_services):
+                aggr.incr_usage('my.service.{}'.format(idx))
+                aggr.record('my.service.{}'.format(idx), idx, self.minute)
+            aggr.flush()
+
+            before = conn.round_trips
+            get_service(ProcessRawTimes, conn, 'global_slow_threshold=120\nmax_batch_size=99999').handle()
+            get_service(AggregateByMinute, conn).handle()
+
+            round_trips.append(conn.round_trips - before)
+
+        self.assertEquals(round_trips[0], round_trips[1])
+
+# ################################################################################################################################